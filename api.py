@@ -1,16 +1,31 @@
 '''
 Author: utkarshohm
 Description: All functions necessary to transact in mutual funds on BSEStar using its SOAP API
+	All reads and writes of tables go through repository.get(), so this module runs with or without django
+	zeep (and lxml) and the numpy based order checks are imported on first use, see lazy.py
+	Failures are raised as the errors of errors.py, which tell whether retrying may help
 '''
 
-from django import forms
-from django.core.validators import MaxValueValidator, MinValueValidator, RegexValidator 
-
 import settings
-from models.transactions import TransactionBSE, TransactionXsipBSE, TransResponseBSE, Transaction, PaymentLinkBSE
-from models.users import Info, KycDetail, BankDetail
-
-import zeep
+from settings import (WSDL_ORDER_URL, SVC_ORDER_URL, METHOD_ORDER_URL, WSDL_UPLOAD_URL, SVC_UPLOAD_URL,
+	METHOD_UPLOAD_URL)
+import audit
+from errors import (BSEError, AuthError, ValidationError, RateLimitError, TransportError, RejectionError,
+	InternalError)
+import lazy
+import metrics
+import payment_links
+import repository
+import resilience
+import schemes
+
+import collections
+import threading
+import time
+
+zeep = lazy.module('zeep')
+eligibility = lazy.module('eligibility')
+FolioResolver = lazy.attribute('folios', 'FolioResolver')
 
 
 ################ MAIN FUNCTIONS - called by transact_using_api.py
@@ -23,10 +38,24 @@ def create_transaction_bse(transaction):
 	- Prepares fields to be sent to BSEStar transaction creation endpoint
 	- Posts the requests
 	- Updates internal Transaction record based on response from endpoint
+	Transactions that break rules of their scheme plan are marked failed without calling BSEStar
+	A redemption spread over several folios is placed as one order per folio (see folios.py), one at a time.
+		The transaction is saved as placed once the first of them is, and each order placed is tracked by its
+		record (see tracking.orders_to_check); order id of the first is returned. If a later order fails, it
+		is noted in status_comment and the error is raised
 	'''
 
+	## check minimum amounts, sip rules etc locally instead of waiting for BSEStar to reject the order
+	try:
+		eligibility.ensure_eligible([transaction])
+	except eligibility.IneligibleOrderError as e:
+		transaction.status = '1'
+		transaction.status_comment = '; '.join(r.message for r in e.rejections)
+		repository.get().save_transaction(transaction)
+		raise
+
 	## initialise the zeep client for order wsdl
-	client = zeep.Client(wsdl=WSDL_ORDER_URL[settings.LIVE])
+	client = init_soap_client(WSDL_ORDER_URL[settings.LIVE])
 	set_soap_logging()
 
 	## get the password for posting order
@@ -35,9 +64,10 @@ def create_transaction_bse(transaction):
 	## prepare order, post it to BSE and save response
 	## for lumpsum transaction 
 	if (transaction.order_type == '1'):
-		## prepare the transaction record
-		bse_order = prepare_order(transaction, pass_dict)
-		## post the transaction
+		## prepare the transaction records- one per folio of a redemption across folios
+		bse_orders = prepare_orders([transaction], pass_dict, check=False)
+		## post the first transaction; the rest are posted once it is saved below
+		bse_order = bse_orders[0]
 		order_id = soap_post_order(client, bse_order)
 	
 	## for SIP transaction 
@@ -49,41 +79,121 @@ def create_transaction_bse(transaction):
 		order_id = soap_post_xsip_order(client, bse_order)
 
 	else:
-		raise Exception(
-			"Internal error 630: Invalid order_type in transaction table"
+		raise InternalError(
+			630, "Invalid order_type in transaction table"
 		)
 
 	## update internal's transaction table to have a foreign key to TransactionBSE or TransactionXsipBSE table
 	transaction.bse_trans_no = bse_order.trans_no
-	transaction.save()
+	repository.get().save_transaction(transaction)
 
 	## TODO: MANUALLY update folio number & status assigned to a transaction after the mf is allotted to user
 	## have added it here for purpose of testing only
 	transaction.status = '2'
-	transaction.save()
+	repository.get().save_transaction(transaction)
 	if (transaction.transaction_type == 'R'):
 		## TODO: make changes to purchase transactions corresponding to the redeem transaction
 		pass
 
+	## later orders of a redemption across folios
+	if (transaction.order_type == '1'):
+		post_later_orders(client, transaction, bse_orders[1:])
+
 	return order_id
 
 
+def create_transactions_bse(transactions):
+	'''
+	Creates a batch of lumpsum transactions on BSEStar with one login
+	- Transactions that break rules of their scheme plan are marked failed and left out
+	- Order records of the rest are prepared together- all validated first and then saved with a single
+		bulk insert (see prepare_orders()); a redemption spread over several folios is one order per folio
+	- Orders are posted one by one, as BSEStar takes one order per call, and each transaction is saved as
+		placed once its first order is. An order rejected or not placed (eg. BSEStar being down) affects its
+		transaction only- a rejected first order fails it, one not placed leaves it to be placed again, and a
+		later order of a redemption across folios is noted (see post_later_orders()). The error is kept in
+		status_comment of the transaction and counted in the batch_orders metric by result and error code
+	Returns dict of transaction id to order id (of the first order of a redemption across folios)
+	'''
+	transactions = list(transactions)
+	for transaction in transactions:
+		if (transaction.order_type != '1'):
+			raise InternalError(
+				630, "Only lumpsum transactions can be created in a batch, create SIPs with create_transaction_bse()"
+			)
+	repo = repository.get()
+
+	## check minimum amounts, sip rules etc of all of them locally
+	eligible, rejections = eligibility.split(transactions)
+	messages = {}
+	for rejection in rejections:
+		messages.setdefault(rejection.index, []).append(rejection.message)
+	for i, reasons in messages.items():
+		transactions[i].status = '1'
+		transactions[i].status_comment = '; '.join(reasons)
+		repo.save_transaction(transactions[i])
+	if not eligible:
+		return {}
+
+	## initialise the zeep client for order wsdl and get the password for posting orders
+	client = init_soap_client(WSDL_ORDER_URL[settings.LIVE])
+	set_soap_logging()
+	pass_dict = soap_get_password_order(client)
+
+	## orders of each transaction- more than one of a redemption across folios
+	orders = collections.OrderedDict()
+	for transaction, bse_order in prepare_orders_by_transaction(eligible, pass_dict, check=False):
+		orders.setdefault(transaction.id, (transaction, []))[1].append(bse_order)
+
+	order_ids = {}
+	for transaction, bse_orders in orders.values():
+		try:
+			order_id = soap_post_order(client, bse_orders[0])
+		except RejectionError as e:
+			metrics.incr('batch_orders', result='rejected', code=metrics.error_code(e))
+			transaction.status = '1'
+			transaction.status_comment = e.message
+			repo.save_transaction(transaction)
+			continue
+		except BSEError as e:
+			## not placed, eg. as BSEStar is down- the transaction stays as it was, to be placed again
+			metrics.incr('batch_orders', result='not_placed', code=metrics.error_code(e))
+			transaction.status_comment = 'Order %s not placed: %s' % (bse_orders[0].trans_no, e.message)
+			repo.save_transaction(transaction)
+			continue
+		metrics.incr('batch_orders', result='placed')
+		order_ids[transaction.id] = order_id
+		## as in create_transaction_bse(), the transaction now awaits payment
+		transaction.bse_trans_no = bse_orders[0].trans_no
+		transaction.status = '2'
+		repo.save_transaction(transaction)
+		try:
+			post_later_orders(client, transaction, bse_orders[1:])
+		except BSEError as e:
+			## noted in the transaction; the orders placed are tracked
+			metrics.incr('batch_orders', result='later_order_failed', code=metrics.error_code(e))
+	return order_ids
+
+
 def get_payment_link_bse(client_code, transaction_id):
 	'''
-	Gets the payment link corresponding to a client
-	Called immediately after creating transaction 
+	Gets the payment link of a transaction of a client, whose order must already be placed
+	Called immediately after creating transaction, and by checkout pages
+	A live link of the transaction is reused; BSEStar is called only if there is none (see payment_links.py)
 	'''
+	return payment_links.LINKS.get(client_code, transaction_id)
 
-	## get the payment link and store it
-	client = zeep.Client(wsdl=WSDL_UPLOAD_URL[settings.LIVE])
-	set_soap_logging()
-	pass_dict = soap_get_password_upload(client)
-	payment_url = soap_create_payment(client, str(client_code), transaction_id, pass_dict)
-	PaymentLinkBSE.objects.create(
-		user_id=client_code, 
-		link=payment_url, 
+
+def get_payment_links_bse(transactions):
+	'''
+	Gets payment links of a batch of transactions with one login
+	Called right after placing the batch so that checkout pages find links ready. Transactions whose order
+	is not placed are left out, as a link pays only the orders awaiting payment when it is made
+	Returns dict of transaction id to payment link
+	'''
+	return payment_links.LINKS.prepare(
+		(transaction.user_id, transaction.id) for transaction in transactions if transaction.status == '2'
 	)
-	return payment_url
 
 
 def create_user_bse(client_code):
@@ -96,7 +206,7 @@ def create_user_bse(client_code):
 	'''
 
 	## initialise the zeep client for order wsdl
-	client = zeep.Client(wsdl=WSDL_UPLOAD_URL[settings.LIVE])
+	client = init_soap_client(WSDL_UPLOAD_URL[settings.LIVE])
 	set_soap_logging()
 
 	## get the password 
@@ -104,13 +214,12 @@ def create_user_bse(client_code):
 	## prepare the user record 
 	bse_user = prepare_user_param(client_code)
 	## post the user creation request
+	## soap request and response are archived in the audit log by soap_call()
 	user_response = soap_create_user(client, bse_user, pass_dict)
-	## TODO: Log the soap request and response post the user creation request
 
 	pass_dict = soap_get_password_upload(client)
 	bse_fatca = prepare_fatca_param(client_code)
 	fatca_response = soap_create_fatca(client, bse_fatca, pass_dict)
-	## TODO: Log the soap request and response post the fatca creation request
 
 
 def cancel_transaction_bse(transaction):
@@ -120,7 +229,7 @@ def cancel_transaction_bse(transaction):
 	'''
 
 	## initialise the zeep client for order wsdl
-	client = zeep.Client(wsdl=WSDL_ORDER_URL[settings.LIVE])
+	client = init_soap_client(WSDL_ORDER_URL[settings.LIVE])
 	set_soap_logging()
 
 	## get the password for posting order
@@ -132,7 +241,7 @@ def cancel_transaction_bse(transaction):
 	## get order_id of the transaction to be cancelled 
 	## trans_no is of the type 2016080110000011 
 	order_type = trans_no_of_order[8]
-	order_id = TransResponseBSE.objects.get(trans_no=trans_no_of_order).order_id
+	order_id = repository.get().order_id(trans_no_of_order)
 
 	## prepare cancellation order
 	bse_order = prepare_order_cxl(transaction, order_id, pass_dict)
@@ -148,7 +257,7 @@ def cancel_transaction_bse(transaction):
 	## update internal's transaction table to have a foreign key to cancellation order
 	transaction.bse_trans_no = bse_order.trans_no
 	transaction.status = '1'	## status 'canceled'
-	transaction.save()
+	repository.get().save_transaction(transaction)
 
 
 def create_mandate_bse(client_code, amount):
@@ -159,7 +268,7 @@ def create_mandate_bse(client_code, amount):
 	'''
 
 	## initialise the zeep client for wsdl
-	client = zeep.Client(wsdl=WSDL_UPLOAD_URL[settings.LIVE])
+	client = init_soap_client(WSDL_UPLOAD_URL[settings.LIVE])
 	set_soap_logging()
 
 	## get the password
@@ -179,7 +288,7 @@ def get_payment_status_bse(client_code, transaction_id):
 	'''
 
 	## initialise the zeep client for wsdl
-	client = zeep.Client(wsdl=WSDL_UPLOAD_URL[settings.LIVE])
+	client = init_soap_client(WSDL_UPLOAD_URL[settings.LIVE])
 	set_soap_logging()
 
 	## get the password
@@ -194,17 +303,15 @@ def get_payment_status_bse(client_code, transaction_id):
 
 ## fire SOAP query to get password for Order API endpoint
 ## used by create_transaction_bse() and cancel_transaction_bse()
+@metrics.timed('soap')
 def soap_get_password_order(client):
 	method_url = METHOD_ORDER_URL[settings.LIVE] + 'getPassword'
 	svc_url = SVC_ORDER_URL[settings.LIVE]
-	header_value = soap_set_wsa_headers(method_url, svc_url)
-	response = client.service.getPassword(
+	response = soap_call(client, 'getPassword', method_url, svc_url,
 		UserId=settings.USERID[settings.LIVE], 
 		Password=settings.PASSWORD[settings.LIVE], 
 		PassKey=settings.PASSKEY[settings.LIVE], 
-		_soapheaders=[header_value]
 	)
-	print
 	response = response.split('|')
 	status = response[0]
 	if (status == '100'):
@@ -212,25 +319,23 @@ def soap_get_password_order(client):
 		pass_dict = {'password': response[1], 'passkey': settings.PASSKEY[settings.LIVE]}
 		return pass_dict
 	else:
-		raise Exception(
-			"BSE error 640: Login unsuccessful for Order API endpoint"
+		raise AuthError(
+			640, "Login unsuccessful for Order API endpoint", response
 		)
 
 
 ## fire SOAP query to get password for Upload API endpoint
 ## used by all functions except create_transaction_bse() and cancel_transaction_bse()
+@metrics.timed('soap')
 def soap_get_password_upload(client):
 	method_url = METHOD_UPLOAD_URL[settings.LIVE] + 'getPassword'
 	svc_url = SVC_UPLOAD_URL[settings.LIVE]
-	header_value = soap_set_wsa_headers(method_url, svc_url)
-	response = client.service.getPassword(
+	response = soap_call(client, 'getPassword', method_url, svc_url,
 		MemberId=settings.MEMBERID[settings.LIVE], 
 		UserId=settings.USERID[settings.LIVE],
 		Password=settings.PASSWORD[settings.LIVE], 
 		PassKey=settings.PASSKEY[settings.LIVE], 
-		_soapheaders=[header_value]
 	)
-	print
 	response = response.split('|')
 	status = response[0]
 	if (status == '100'):
@@ -238,16 +343,16 @@ def soap_get_password_upload(client):
 		pass_dict = {'password': response[1], 'passkey': settings.PASSKEY[settings.LIVE]}
 		return pass_dict
 	else:
-		raise Exception(
-			"BSE error 640: Login unsuccessful for upload API endpoint"
+		raise AuthError(
+			640, "Login unsuccessful for upload API endpoint", response
 		)
 
 
 ## fire SOAP query to post the order 
+@metrics.timed('soap')
 def soap_post_order(client, bse_order):
 	method_url = METHOD_ORDER_URL[settings.LIVE] + 'orderEntryParam'
-	header_value = soap_set_wsa_headers(method_url, SVC_ORDER_URL[settings.LIVE])
-	response = client.service.orderEntryParam(
+	response = soap_call(client, 'orderEntryParam', method_url, SVC_ORDER_URL[settings.LIVE],
 		bse_order.trans_code,
 		bse_order.trans_no,
 		bse_order.order_id,
@@ -276,7 +381,6 @@ def soap_post_order(client, bse_order):
 		bse_order.param1,
 		bse_order.param2,
 		bse_order.param3,
-		_soapheaders=[header_value]
 	)
 	
 	## this is a good place to put in a slack alert
@@ -289,16 +393,30 @@ def soap_post_order(client, bse_order):
 		# order successful
 		return order_id
 	else:
-		raise Exception(
-			"BSE error 641: %s" % response[6]
+		raise RejectionError(
+			641, response[6], response
 		)
 
 
+## fire SOAP queries to post orders of a redemption across folios after the first, once the transaction is
+## saved as placed. An order that fails is noted in status_comment of the transaction, and the error is
+## raised without posting the rest
+def post_later_orders(client, transaction, bse_orders):
+	for bse_order in bse_orders:
+		try:
+			soap_post_order(client, bse_order)
+		except BSEError as e:
+			transaction.status_comment = 'Order %s of folio %s not placed: %s' % (
+				bse_order.trans_no, bse_order.folio_no, e.message)
+			repository.get().save_transaction(transaction)
+			raise
+
+
 ## fire SOAP query to post the XSIP order 
+@metrics.timed('soap')
 def soap_post_xsip_order(client, bse_order):
 	method_url = METHOD_ORDER_URL[settings.LIVE] + 'xsipOrderEntryParam'
-	header_value = soap_set_wsa_headers(method_url, SVC_ORDER_URL[settings.LIVE])
-	response = client.service.xsipOrderEntryParam(
+	response = soap_call(client, 'xsipOrderEntryParam', method_url, SVC_ORDER_URL[settings.LIVE],
 		bse_order.trans_code,
 		bse_order.trans_no,
 		bse_order.scheme_cd,
@@ -331,7 +449,6 @@ def soap_post_xsip_order(client, bse_order):
 		# bse_order.mandate_id,
 		bse_order.param2,
 		bse_order.param3,
-		_soapheaders=[header_value]
 	)
 	
 	## this is a good place to put in a slack alert
@@ -344,24 +461,22 @@ def soap_post_xsip_order(client, bse_order):
 		# order successful
 		return order_id
 	else:
-		raise Exception(
-			"BSE error 642: %s" % response[6]
+		raise RejectionError(
+			642, response[6], response
 		)
 
 
-## fire SOAP query to get the payment url 
+## fire SOAP query to get the payment url, which returns the client to the payment page of transaction_id
+@metrics.timed('soap')
 def soap_create_payment(client, client_code, transaction_id, pass_dict):
 	method_url = METHOD_UPLOAD_URL[settings.LIVE] + 'MFAPI'
-	header_value = soap_set_wsa_headers(method_url, SVC_UPLOAD_URL[settings.LIVE])
 	logout_url = settings.FRONTEND[settings.FB_LIVE] + 'payment/' + str(transaction_id)
-	response = client.service.MFAPI(
+	response = soap_call(client, 'MFAPI', method_url, SVC_UPLOAD_URL[settings.LIVE],
 		'03',
 		settings.USERID[settings.LIVE],
 		pass_dict['password'],
 		settings.MEMBERID[settings.LIVE]+'|'+client_code+'|'+logout_url,
-		_soapheaders=[header_value]
 	)
-	print
 	response = response.split('|')
 	status = response[0]
 	
@@ -370,21 +485,20 @@ def soap_create_payment(client, client_code, transaction_id, pass_dict):
 		payment_url = response[1]
 		return payment_url
 	else:
-		raise Exception(
-			"BSE error 646: Payment link creation unsuccessful: %s" % response[1]
+		raise RejectionError(
+			646, "Payment link creation unsuccessful: %s" % response[1], response
 		)
 
 
 ## fire SOAP query to create a new user on bsestar
+@metrics.timed('soap')
 def soap_create_user(client, user_param, pass_dict):
 	method_url = METHOD_UPLOAD_URL[settings.LIVE] + 'MFAPI'
-	header_value = soap_set_wsa_headers(method_url, SVC_UPLOAD_URL[settings.LIVE])
-	response = client.service.MFAPI(
+	response = soap_call(client, 'MFAPI', method_url, SVC_UPLOAD_URL[settings.LIVE],
 		'02',
 		settings.USERID[settings.LIVE],
 		pass_dict['password'],
 		user_param,
-		_soapheaders=[header_value]
 	)
 	
 	## this is a good place to put in a slack alert
@@ -395,21 +509,20 @@ def soap_create_user(client, user_param, pass_dict):
 		# User creation successful
 		pass
 	else:
-		raise Exception(
-			"BSE error 644: User creation unsuccessful: %s" % response[1]
+		raise RejectionError(
+			644, "User creation unsuccessful: %s" % response[1], response
 		)
 
 
 ## fire SOAP query to craete fatca record of user on bsestar
+@metrics.timed('soap')
 def soap_create_fatca(client, fatca_param, pass_dict):
 	method_url = METHOD_UPLOAD_URL[settings.LIVE] + 'MFAPI'
-	header_value = soap_set_wsa_headers(method_url, SVC_UPLOAD_URL[settings.LIVE])
-	response = client.service.MFAPI(
+	response = soap_call(client, 'MFAPI', method_url, SVC_UPLOAD_URL[settings.LIVE],
 		'01',
 		settings.USERID[settings.LIVE],
 		pass_dict['password'],
 		fatca_param,
-		_soapheaders=[header_value]
 	)
 	
 	## this is a good place to put in a slack alert
@@ -420,21 +533,20 @@ def soap_create_fatca(client, fatca_param, pass_dict):
 		# Fatca creation successful
 		pass
 	else:
-		raise Exception(
-			"BSE error 645: Fatca creation unsuccessful: %s" % response[1]
+		raise RejectionError(
+			645, "Fatca creation unsuccessful: %s" % response[1], response
 		)
 
 
 ## fire SOAP query to create a new mandate on bsestar
+@metrics.timed('soap')
 def soap_create_mandate(client, mandate_param, pass_dict):
 	method_url = METHOD_UPLOAD_URL[settings.LIVE] + 'MFAPI'
-	header_value = soap_set_wsa_headers(method_url, SVC_UPLOAD_URL[settings.LIVE])
-	response = client.service.MFAPI(
+	response = soap_call(client, 'MFAPI', method_url, SVC_UPLOAD_URL[settings.LIVE],
 		'06',
 		settings.USERID[settings.LIVE],
 		pass_dict['password'],
 		mandate_param,
-		_soapheaders=[header_value]
 	)
 	
 	## this is a good place to put in a slack alert
@@ -443,51 +555,44 @@ def soap_create_mandate(client, mandate_param, pass_dict):
 	status = response[0]
 	if (status == '100'):
 		# Mandate creation successful, so save it in table
-		from users.models import Mandate, BankDetail
+		repo = repository.get()
 		mandate_values = mandate_param.split('|')
 		mandate_id = int(response[2])
-		bank = BankDetail.objects.get(user_id=int(mandate_values[1]))
-
-		mandate = Mandate.objects.create(
-            user = Info.objects.get(id=int(mandate_values[1])),
-            bank = bank,
-            id = mandate_id,
-            amount = int(mandate_values[2]),
-            status = '2',
-        )
-		if (bank.branch.ifsc_code != mandate_values[3]):
+		user_id = int(mandate_values[1])
+		bank = repo.bank(user_id)
+
+		repo.create_mandate(mandate_id, user_id, bank.id, int(mandate_values[2]), '2')
+		if (bank.ifsc_code != mandate_values[3]):
 			# raise error that banks dont match
-			raise Exception(
-				"BSE error 651: Mandate created for a bank that doesnt match with user's bank"
+			raise RejectionError(
+				651, "Mandate created for a bank that doesnt match with user's bank", response
 			)
 		return mandate_id
 	else:
-		raise Exception(
-			"BSE error 651: Mandate creation unsuccessful: %s" % response[1]
+		raise RejectionError(
+			651, "Mandate creation unsuccessful: %s" % response[1], response
 		)
 
 
 ## fire SOAP query to create a new mandate on bsestar
+@metrics.timed('soap')
 def soap_get_payment_status(client, client_code, transaction_id, pass_dict):
 	# find order_id for transaction
-	transaction = Transaction.objects.get(id=transaction_id)
+	repo = repository.get()
+	transaction = repo.transaction(transaction_id)
 	if transaction.transaction_type == 'R':
-		raise Exception(
-			"Error 630: Cannot get payment status for redeem transactions"
+		raise InternalError(
+			630, "Cannot get payment status for redeem transactions"
 		)
-	order_id = TransResponseBSE.objects.get(
-			trans_no=transaction.bse_trans_no
-		).order_id
+	order_id = repo.order_id(transaction.bse_trans_no)
 	# TODO: handle case when order_id not found
 	
 	method_url = METHOD_UPLOAD_URL[settings.LIVE] + 'MFAPI'
-	header_value = soap_set_wsa_headers(method_url, SVC_UPLOAD_URL[settings.LIVE])
-	response = client.service.MFAPI(
+	response = soap_call(client, 'MFAPI', method_url, SVC_UPLOAD_URL[settings.LIVE],
 		'11',
 		settings.USERID[settings.LIVE],
 		pass_dict['password'],
 		str(client_code)+'|'+str(order_id)+'|BSEMF',
-		_soapheaders=[header_value]
 	)
 	
 	## this is a good place to put in a slack alert
@@ -499,7 +604,7 @@ def soap_get_payment_status(client, client_code, transaction_id, pass_dict):
 			# payment unsucessful
 			if transaction.status in ['4', '5', '6']:
 				transaction.status = '2'
-				transaction.save()
+				repo.save_transaction(transaction)
 				return '2'
 			else:
 				# no change
@@ -507,17 +612,18 @@ def soap_get_payment_status(client, client_code, transaction_id, pass_dict):
 		else:
 			# payment successful- update in db
 			transaction.status = '5'
-			transaction.save()
+			repo.save_transaction(transaction)
 			return '5'
 	else:		
-		raise Exception(
-			"BSE error 644: Get payment status unsuccessful: %s" % response[1]
+		raise RejectionError(
+			644, "Get payment status unsuccessful: %s" % response[1], response
 		)
 
 
 ################ PREPARE FUNCTIONS to post data- called by MAIN FUNCTIONS
 
 
+@metrics.timed('prepare')
 def prepare_trans_no(client_code, bse_order_type):
 	'''
 	trans_no is a unique number sent with every transaction creation request sent to BSE
@@ -530,66 +636,144 @@ def prepare_trans_no(client_code, bse_order_type):
 			TransactionBse or TransactionXsipBse table. counter reset to 1 every day 
 	'''
 
-	# pad client code with 0s till it is CC_LEN digits 
+	return prepare_trans_nos([client_code], bse_order_type)[0]
+
+
+@metrics.timed('prepare')
+def prepare_trans_nos(client_codes, bse_order_type):
+	'''
+	Same as prepare_trans_no() but for a batch of orders, one trans_no per entry of client_codes
+	Finds today's last counter of all clients in the batch with a single query
+		and then increments it in memory for every order of that client
+	'''
 	CC_LEN = 6
-	
-	# pad client_code with 0s
-	cc_str = str(client_code)
-	cc_str = '0'* (CC_LEN - len(cc_str)) + cc_str 
 
-	# prepare unique trans_no by looking for the last transaction made by the client today
 	import datetime
 	now = datetime.datetime.now()
-	# If this is testing environment, replace first digit of year with 1
 	if settings.LIVE == 0:
 		today_str = '00' + now.strftime('%y%m%d') + bse_order_type
 	else:
 		today_str = now.strftime('%Y%m%d') + bse_order_type
 
-	try:
-		if (bse_order_type == '1'):
-			relevant_trans = TransactionBSE.objects.filter(client_code=client_code, trans_no__contains=today_str)
-		elif (bse_order_type == '2'):
-			## for basanti-2: since xsip orders cannot be placed in off-market hours, placing a lumpsum order instead 
-			relevant_trans = TransactionXsipBSE.objects.filter(client_code=client_code, trans_no__contains=today_str)
-		max_trans_no = 0
-		for trans in relevant_trans:
-			prev_trans_no = int(trans.trans_no[CC_LEN+9:])
-			if (prev_trans_no > max_trans_no):
-				max_trans_no = prev_trans_no
-		if (max_trans_no >= 99):
-			raise Exception(
-				"BSE error 647: 99 transactions already placed today for this user"
+	if (bse_order_type not in ('1', '2')):
+		raise InternalError(
+			630, "Invalid order_type in transaction table"
+		)
+	relevant_trans = repository.get().order_counters(bse_order_type, client_codes, today_str)
+	max_trans_no = {}
+	for client_code, trans_no in relevant_trans:
+		prev_trans_no = int(trans_no[CC_LEN+9:])
+		if (prev_trans_no > max_trans_no.get(client_code, 0)):
+			max_trans_no[client_code] = prev_trans_no
+
+	trans_nos = []
+	for client_code in client_codes:
+		cc_str = str(client_code)
+		counter = max_trans_no.get(cc_str, 0) + 1
+		if (counter > 99):
+			## BSEStar takes 99 orders per user per day, so this can't be retried before tomorrow
+			raise RateLimitError(
+				647, "99 transactions already placed today for this user", retryable=False
 			)
-		trans_no = today_str + cc_str + str(max_trans_no + 1)
-	except (TransactionBSE.DoesNotExist, TransactionXsipBSE.DoesNotExist) as e :
-		trans_no = today_str + cc_str + '1'
+		max_trans_no[cc_str] = counter
+		trans_nos.append(today_str + '0'* (CC_LEN - len(cc_str)) + cc_str + str(counter))
+	return trans_nos
+
+
+# prepare the TransactionBSE record
+# a redemption across folios needs several, see prepare_orders()
+@metrics.timed('prepare')
+def prepare_order(transaction, pass_dict):
 	
-	# print 'trans_no', trans_no
-	return trans_no
+	folios = FolioResolver.preload([transaction])
+	leg = None
+	if (transaction.transaction_type == 'R'):
+		## a redemption spread over several folios needs one order per folio
+		legs = folios.redemption_legs(transaction)
+		if len(legs) > 1:
+			raise InternalError(
+				674, "Redemption needs %d orders across folios, place it with prepare_orders()" % len(legs)
+			)
+		leg = legs[0]
+	trans_no = prepare_trans_no(transaction.user_id, transaction.order_type)
+	data_dict = prepare_order_data(transaction, trans_no, pass_dict, folios, leg)
+
+	# validator applies the same field rules as the model's ModelForm would
+	# but without the extra queries of form.is_valid() and model.full_clean()
+	repo = repository.get()
+	validator = repo.validator('new_order')
+	cleaned, errors = validator.clean(data_dict)
+	if not errors:
+		bse_transaction = validator.build(cleaned)
+		insert_orders(repo, [bse_transaction])
+		return bse_transaction
+	else:
+		raise ValidationError(
+			648, str(errors)
+		)
 
 
-# get previous purchase transactions 
-def get_previous_trans(transaction):
-	try:
-		trans_l = Transaction.objects.filter(
-			user_id=transaction.user_id,
-			scheme_plan_id=transaction.scheme_plan_id,
-			transaction_type='P',	## folio must have been allotted in a purchase transaction only
-			status='6',	## status is 'completed'
-			folio_number__gt='',	## folio is not blank
+# prepare TransactionBSE records for a batch of lumpsum transactions
+# all records are validated first and then saved with a single bulk_create
+# folios of the whole batch are loaded up front and a redemption spanning folios becomes one order per folio
+# check=False skips the eligibility check, for transactions checked already
+def prepare_orders(transactions, pass_dict, check=True):
+	return [bse_transaction for transaction, bse_transaction in prepare_orders_by_transaction(transactions, pass_dict, check)]
+
+
+# same as prepare_orders() but returns (transaction, TransactionBSE record) pairs, in order
+@metrics.timed('prepare')
+def prepare_orders_by_transaction(transactions, pass_dict, check=True):
+
+	## raises with reasons of all ineligible transactions; use eligibility.split() to drop them instead
+	if check:
+		eligibility.ensure_eligible(transactions)
+	folios = FolioResolver.preload(transactions)
+	orders = []
+	for transaction in transactions:
+		if (transaction.transaction_type == 'R'):
+			orders.extend((transaction, leg) for leg in folios.redemption_legs(transaction))
+		else:
+			orders.append((transaction, None))
+
+	trans_nos = prepare_trans_nos([t.user_id for t, leg in orders], '1')
+	data_list = [
+		prepare_order_data(transaction, trans_no, pass_dict, folios, leg) 
+		for (transaction, leg), trans_no in zip(orders, trans_nos)
+	]
+
+	repo = repository.get()
+	bse_transactions, errors = repo.validator('new_order').build_many(data_list)
+	if not errors:
+		insert_orders(repo, bse_transactions)
+		return [(transaction, bse_transaction) for (transaction, leg), bse_transaction in zip(orders, bse_transactions)]
+	else:
+		raise ValidationError(
+			648, str(dict(
+				(orders[i][0].id, row_errors) for i, row_errors in errors.items()
+			))
 		)
-	except Transaction.DoesNotExist:
-		raise Exception(
-			"Internal error 632: No existing purchase found such that an additional purchase or redeem transaction be made"
+
+
+# save TransactionBSE records
+# trans_no is their primary key- one taken meanwhile (eg. by an order of the same client prepared by another
+# process from the same counter) fails the insert, and is reported as a validation error like the rest
+def insert_orders(repo, bse_transactions):
+	try:
+		repo.insert_orders(bse_transactions)
+	except Exception as e:
+		## IntegrityError of django or of the DB-API driver, by name as they are different classes
+		if type(e).__name__ != 'IntegrityError':
+			raise
+		raise ValidationError(
+			648, "trans_no of orders %s already used: %s" % (', '.join(o.trans_no for o in bse_transactions), e)
 		)
-	return trans_l
 
 
-# prepare the TransactionBSE record
-def prepare_order(transaction, pass_dict):
-	
-	trans_no = prepare_trans_no(transaction.user_id, transaction.order_type)
+# prepare fields of the TransactionBSE record
+# folios is a FolioResolver preloaded for the transaction; leg is the folios.Leg of a redemption
+@metrics.timed('prepare')
+def prepare_order_data(transaction, trans_no, pass_dict, folios=None, leg=None):
 
 	# Fill all fields for a FRESH PURCHASE
 	# Change fields if its a redeem or addl purchase
@@ -599,14 +783,14 @@ def prepare_order(transaction, pass_dict):
 		'user_id': settings.USERID[settings.LIVE],
 		'member_id': settings.MEMBERID[settings.LIVE],
 		'client_code': transaction.user_id,
-		'scheme_cd': transaction.scheme_plan.bse_code,
+		'scheme_cd': schemes.bse_code(transaction.scheme_plan_id),
 		'buy_sell': 'P',
 		'buy_sell_type': 'FRESH',
 		'all_redeem': 'N',
 		'min_redeem': 'N',
 		'password': pass_dict['password'],
 		'pass_key': pass_dict['passkey'],
-		'internal_transaction': transaction.id, 
+		'internal_transaction': transaction, 
 	}
 
 	if (transaction.transaction_type == 'P'):
@@ -615,71 +799,57 @@ def prepare_order(transaction, pass_dict):
 
 	else:
 		# ADDITIONAL PURCHASE OR REDEEM transaction
-		## set folio_no by looking at previous transactions
-		trans_l = get_previous_trans(transaction)
-
-		### assumption: pick the first relevant transaction's folio number if there are multiple transactions 
-		# data_dict['folio_no'] = '123456789012345'
-		data_dict['folio_no'] = trans_l[0].folio_number
+		## folio_no is picked deterministically from the user's folios in the scheme plan
+		if folios is None:
+			folios = FolioResolver.preload([transaction])
 
 		if (transaction.transaction_type == 'A'):
 			# ADDITIONAL PURCHASE order
+			data_dict['folio_no'] = folios.folio_for(transaction)
 			data_dict['buy_sell_type'] = 'ADDITIONAL'
 			data_dict['order_val'] = int(transaction.amount)
 		
 		elif (transaction.transaction_type == 'R'):
 			# REDEEM order
 			data_dict['buy_sell'] = 'R'
+			if (transaction.all_redeem == None):
+				raise InternalError(
+					634, "all_redeem field of internal transaction table is not set for a redeem transaction"
+				)
+			if leg is None:
+				leg = folios.redemption_legs(transaction)[0]
+			data_dict['folio_no'] = leg.folio_number
 
-			## set all_redeem flag in case entire investment is being redeemed, else 
-			if (transaction.all_redeem):
+			## set all_redeem flag in case entire folio is being redeemed, else amount
+			if (leg.all_redeem):
 				data_dict['all_redeem'] = 'Y'
 				data_dict['order_val'] = ''
-			elif (transaction.all_redeem == None):
-				raise Exception(
-					"Internal error 634: all_redeem field of internal transaction table is not set for a redeem transaction"
-				)
+			else:
+				data_dict['order_val'] = int(leg.amount)
 
-	form = NewOrderForm(data_dict)
-	# form.is_valid() calls form.clean() as well as model.full_clean()
-	# so validators on model are also applied
-	if form.is_valid():
-		bse_transaction = form.save()
-		return bse_transaction
-	else:
-		raise Exception(
-			'BSE error 648: %s' % form.errors
-		)
+	return data_dict
 
 
 # prepare the TransactionXsipBSE record
+@metrics.timed('prepare')
 def prepare_xsip_order(transaction, pass_dict):
 	
 	if (transaction.order_type != '2'):
-		raise Exception(
-			"Internal error 630: XSIP Order entry cannot be prepared because Transaction argument passed is not SIP"
+		raise InternalError(
+			630, "XSIP Order entry cannot be prepared because Transaction argument passed is not SIP"
 		)
 
 	trans_no = prepare_trans_no(transaction.user_id, transaction.order_type)
 	
 	# find mandate id; if not found then create one
-	from users.models import Mandate
-	mandates = Mandate.objects.filter(
-		user = transaction.user,
-		status__in = (2,3,4,5), 
-	)
+	repo = repository.get()
+	mandates = repo.mandates(transaction.user_id, ('2', '3', '4', '5'))
+	# statuses are kept up to date by mandates.py; try mandates the bank has accepted before those still in process
+	mandates = sorted(mandates, key=lambda mandate: mandate.status != '5')
 	create_new = True
 	# check if any of the mandates is valid
 	for mandate in mandates:
-		tr_list = Transaction.objects.filter(
-			user = transaction.user,
-			order_type = '2',
-			status__in = ('2','5','6'),
-			mandate = mandate.id,
-		)
-		amount_exhausted = 0
-		for tr in tr_list:
-			amount_exhausted += tr.amount
+		amount_exhausted = repo.sip_amount_on_mandate(transaction.user_id, mandate.id)
 		if (mandate.amount >= amount_exhausted + transaction.amount):
 			# use this mandate
 			transaction.mandate_id = mandate.id
@@ -693,19 +863,19 @@ def prepare_xsip_order(transaction, pass_dict):
 		# query bse for new mandate
 		transaction.mandate_id = create_mandate_bse(transaction.user_id, mandate_amount)
 	# in either case save the mandate_id in transaction entry
-	transaction.save()
+	repo.save_transaction(transaction)
 
 	# Internally, SIP transactions will necessarly have first instalment on day of placing xsip order itself and xsip start date (2nd instalment) will be atleast 30 days away
 	import datetime
 	now = datetime.date.today()
 	num_days = (transaction.sip_start_date - now).days
 	if (num_days < 30 and num_days >= 0):
-		raise Exception(
-			"BSE error 649: XSIP start date must be atleast 30 days from today"
+		raise ValidationError(
+			649, "XSIP start date must be atleast 30 days from today"
 		)
 	elif (num_days > 60):
-		raise Exception(
-			"BSE error 649: XSIP start date must be at most 60 days from today"
+		raise ValidationError(
+			649, "XSIP start date must be at most 60 days from today"
 		)
 
 	data_dict = {
@@ -714,7 +884,7 @@ def prepare_xsip_order(transaction, pass_dict):
 		'user_id': settings.USERID[settings.LIVE],
 		'member_id': settings.MEMBERID[settings.LIVE],
 		'client_code': transaction.user_id,
-		'scheme_cd': transaction.scheme_plan.bse_code,
+		'scheme_cd': schemes.bse_code(transaction.scheme_plan_id),
 		'start_date': transaction.sip_start_date.strftime('%d/%m/%Y'),
 		'inst_amt': int(transaction.amount),
 		'num_inst': int(transaction.sip_num_inst),
@@ -723,32 +893,32 @@ def prepare_xsip_order(transaction, pass_dict):
 		'mandate_id': transaction.mandate_id,
 		'password': pass_dict['password'],
 		'pass_key': pass_dict['passkey'],
-		'internal_transaction': transaction.id, 
+		'internal_transaction': transaction, 
 	}
 
 	# ADDITIONAL PURCHASE order
 	if (transaction.transaction_type == 'A'):
-		## set folio_no by looking at previous transactions
-		trans_l = get_previous_trans(transaction)
-		## assumption: pick the first relevant transaction's folio number if there are multiple transactions 
-		data_dict['folio_no'] = trans_l[0].folio_number
-		transaction.folio_number = trans_l[0].folio_number
-		transaction.save()
-
-	form = NewXsipOrderForm(data_dict)
-	# form.is_valid() calls form.clean() as well as model.full_clean()
-	# so validators on model are also applied
-	if form.is_valid():
-		bse_transaction = form.save()
+		## set folio_no to the user's largest folio in the scheme plan
+		folio_number = FolioResolver.preload([transaction]).folio_for(transaction)
+		data_dict['folio_no'] = folio_number
+		transaction.folio_number = folio_number
+		repo.save_transaction(transaction)
+
+	validator = repo.validator('new_xsip_order')
+	cleaned, errors = validator.clean(data_dict)
+	if not errors:
+		bse_transaction = validator.build(cleaned)
+		repo.insert_order(bse_transaction)
 		# print bse_transaction
 		return bse_transaction
 	else:
-		raise Exception(
-			'BSE error 649: %s' % form.errors
+		raise ValidationError(
+			649, str(errors)
 		)
 
 
 # prepare the TransactionBSE record
+@metrics.timed('prepare')
 def prepare_order_cxl(transaction, order_id, pass_dict):
 	
 	trans_no = prepare_trans_no(transaction.user_id, transaction.order_type)
@@ -759,40 +929,42 @@ def prepare_order_cxl(transaction, order_id, pass_dict):
 		'user_id': settings.USERID[settings.LIVE],	
 		'password': pass_dict['password'],
 		'pass_key': pass_dict['passkey'],
-		'internal_transaction': transaction.id, 
+		'internal_transaction': transaction, 
 		## not reqd by BSE. added for easier tracking internally
 		'client_code': transaction.user_id,
 		'member_id': settings.MEMBERID[settings.LIVE], 
 	}
-	## depening on whether lumpsum order or xsip order, change data_dict and apply different form 
+	## depening on whether lumpsum order or xsip order, change data_dict and apply different validator 
+	repo = repository.get()
 	if (transaction.order_type == '2'):
 		data_dict['xsip_reg_id'] = order_id
-		form = CxlXsipOrderForm(data_dict)
+		validator = repo.validator('cxl_xsip_order')
 	elif (transaction.order_type == '1'):
 		data_dict['order_id'] = order_id
-		form = CxlOrderForm(data_dict)
+		validator = repo.validator('cxl_order')
 	else:
-		raise Exception(
-			"Internal error 630: Invalid order_type in transaction table: "
+		raise InternalError(
+			630, "Invalid order_type in transaction table: %s" % transaction.order_type
 		)
 
-	# form.is_valid() calls form.clean() as well as model.full_clean()
-	# so validators on model are also applied
-	if form.is_valid():
-		bse_transaction = form.save()
+	cleaned, errors = validator.clean(data_dict)
+	if not errors:
+		bse_transaction = validator.build(cleaned)
+		repo.insert_order(bse_transaction)
 		# print bse_transaction
 		return bse_transaction
 	else:
-		raise Exception(
-			'BSE error 650: %s' % form.errors
+		raise ValidationError(
+			650, str(errors)
 		)
 
 
 # store response to order entry from bse 
+@metrics.timed('orm')
 def store_order_response(response, order_type):
 	## lumpsum order 
 	if (order_type == '1'):
-		trans_response = TransResponseBSE(
+		trans_response = dict(
 			trans_code = response[0],
 			trans_no = response[1],
 			order_id = response[2],
@@ -805,7 +977,7 @@ def store_order_response(response, order_type):
 		)
 	## SIP order  
 	elif (order_type == '2'):
-		trans_response = TransResponseBSE(
+		trans_response = dict(
 			trans_code = response[0],
 			trans_no = response[1],
 			member_id = response[2],
@@ -816,16 +988,17 @@ def store_order_response(response, order_type):
 			success_flag = response[7],
 			order_type = '2',
 		)
-	trans_response.save()
-	return trans_response.order_id
+	return repository.get().save_response(**trans_response).order_id
 
 
 # prepare the string that will be sent as param for user creation in bse
+@metrics.timed('prepare')
 def prepare_user_param(client_code):
 	# extract the records from the table
-	info = Info.objects.get(id=client_code)
-	kyc = KycDetail.objects.get(user=client_code)
-	bank = BankDetail.objects.get(user=client_code)
+	repo = repository.get()
+	info = repo.user(client_code)
+	kyc = repo.kyc(client_code)
+	bank = repo.bank(client_code)
 	
 	# some fields require processing
 	## address field can be 40 chars as per BSE but RTA is truncating it to 30 chars and showing that in account statement which is confusing customers, so reducing the length to 30 chars
@@ -845,7 +1018,7 @@ def prepare_user_param(client_code):
 		appname1 = appname1 + ' ' + kyc.last_name
 	appname1 = appname1[:70]
 	
-	ifsc_code = bank.branch.ifsc_code
+	ifsc_code = bank.ifsc_code
 
 	# make the list that will be used to create param
 	param_list = [
@@ -935,9 +1108,10 @@ def prepare_user_param(client_code):
 
 
 # prepare the string that will be sent as param for fatca creation in bse
+@metrics.timed('prepare')
 def prepare_fatca_param(client_code):
 	# extract the records from the table
-	kyc = KycDetail.objects.get(user=client_code)
+	kyc = repository.get().kyc(client_code)
 	
 	# some fields require processing
 	inv_name = kyc.first_name
@@ -1041,17 +1215,17 @@ def prepare_fatca_param(client_code):
 
 
 # prepare the string that will be sent as param for user creation in bse
+@metrics.timed('prepare')
 def prepare_mandate_param(client_code, amount):
 	# extract the records from the table
-	info = Info.objects.get(id=client_code)
-	bank = BankDetail.objects.get(user=client_code)
+	bank = repository.get().bank(client_code)
 	
 	# make the list that will be used to create param
 	param_list = [
 		('MEMBERCODE', settings.MEMBERID[settings.LIVE]),
 		('CLIENTCODE', client_code),
 		('AMOUNT', amount),
-		('IFSCCODE', bank.branch.ifsc_code),
+		('IFSCCODE', bank.ifsc_code),
 		('ACCOUNTNUMBER', bank.account_number),
 		('MANDATETYPE', 'X'),
 	]
@@ -1064,39 +1238,23 @@ def prepare_mandate_param(client_code, amount):
 	return mandate_param[1:]
 
 
-################ FORMS to prepare data- called by PREPARE FUNCTIONS
-
-# Used in validating fields when preparing new order entry
-class NewOrderForm(forms.ModelForm):
-	class Meta:
-		model =  TransactionBSE
-		exclude = 'dp_txn','kyc_status','euin','euin_val','dpc'
-
-
-# Used in validating fields when preparing cancellation order entry
-class CxlOrderForm(forms.ModelForm):
-	order_id = forms.CharField(validators=[RegexValidator(r'^[0-9]*$')], max_length=8)
-	class Meta:
-		model =  TransactionBSE
-		fields = 'trans_code','trans_no','order_id','user_id','password','pass_key','internal_transaction','client_code','member_id'
-
-
-# Used in validating fields when preparing new XSIP order entry
-class NewXsipOrderForm(forms.ModelForm):
-	class Meta:
-		model =  TransactionXsipBSE
-		exclude = 'trans_mode','dp_txn','freq_type','freq_allowed','euin','euin_val','dpc'
-
-
-# Used in validating fields when preparing cancellation XSIP order entry
-class CxlXsipOrderForm(forms.ModelForm):
-	xsip_reg_id = forms.CharField(validators=[RegexValidator(r'^[0-9]*$')], max_length=10)
-	class Meta:
-		model =  TransactionXsipBSE
-		fields = 'trans_code','trans_no','xsip_reg_id','user_id','password','pass_key','internal_transaction','client_code','member_id'
+################ HELPER SOAP FUNCTIONS
 
+# initialise zeep client for a wsdl; loading the wsdl is timed separately from the soap queries
+# zeep clients by wsdl, loaded once per process and shared by all calls
+# a client only holds the parsed wsdl and a transport; passwords are passed per call
+_soap_clients = {}
+_soap_clients_lock = threading.Lock()
+def init_soap_client(wsdl):
+	client = _soap_clients.get(wsdl)
+	if client is None:
+		with _soap_clients_lock:
+			client = _soap_clients.get(wsdl)
+			if client is None:
+				with metrics.timer('wsdl_load'):
+					client = _soap_clients[wsdl] = zeep.Client(wsdl=wsdl)
+	return client
 
-################ HELPER SOAP FUNCTIONS
 
 # every soap query to bse must have wsa headers set 
 def soap_set_wsa_headers(method_url, svc_url):
@@ -1109,29 +1267,57 @@ def soap_set_wsa_headers(method_url, svc_url):
 	return header_value
 
 
-# set logging such that its easy to debug soap queries
-def set_soap_logging():
-	import logging.config
-	logging.config.dictConfig({
-	    'version': 1,
-	    'formatters': {
-	        'verbose': {
-	            'format': '%(name)s: %(message)s'
-	        }
-	    },
-	    'handlers': {
-	        'console': {
-	            'level': 'DEBUG',
-	            'class': 'logging.StreamHandler',
-	            'formatter': 'verbose',
-	        },
-	    },
-	    'loggers': {
-	        'zeep.transports': {
-	            'level': 'DEBUG',
-	            'propagate': True,
-	            'handlers': ['console'],
-	        },
-	    }
-	})
+# flags of MFAPI queries that only read from BSEStar and so can be retried- payment status
+# (a payment link, flag 03, is made anew by every call)
+MFAPI_READ_FLAGS = ('11',)
+
+# fire a SOAP query with wsa headers set and record it in the audit log
+# all soap functions query BSEStar only through this function
+# it goes through the endpoint's circuit breaker and concurrency limit, and transient failures are retried-
+# for queries that change something on BSEStar only when the request can't have reached it (see resilience.py)
+def soap_call(client, operation, method_url, svc_url, *args, **kwargs):
+	header_value = soap_set_wsa_headers(method_url, svc_url)
+	idempotent = operation == 'getPassword' or (operation == 'MFAPI' and args[0] in MFAPI_READ_FLAGS)
+
+	def attempt():
+		started = time.time()
+		try:
+			with metrics.timer('soap_call', operation=operation, endpoint=svc_url):
+				response = getattr(client.service, operation)(*args, _soapheaders=[header_value], **kwargs)
+		except Exception as e:
+			audit.log_soap(operation, method_url, svc_url, args, kwargs, None, repr(e), time.time() - started)
+			raise
+		audit.log_soap(operation, method_url, svc_url, args, kwargs, response, None, time.time() - started)
+		return response
 
+	try:
+		response = resilience.endpoint(svc_url).call(attempt, idempotent)
+	except Exception as e:
+		if isinstance(e, TransportError) or not resilience.is_transient(e):
+			raise
+		## out of retries
+		raise TransportError(
+			679, "%s failed: %r" % (operation, e)
+		)
+	if (operation == 'getPassword'):
+		## one-time password must not be archived
+		audit.add_secret(response.split('|')[-1])
+	return response
+
+
+# set logging such that every soap query is archived in the audit log
+# configured only once per process; set settings.SOAP_DEBUG to also print raw soap traffic to console
+_soap_logging_set = False
+def set_soap_logging():
+	global _soap_logging_set
+	if _soap_logging_set:
+		return
+	audit.configure()
+	if settings.SOAP_DEBUG:
+		import logging
+		handler = logging.StreamHandler()
+		handler.setFormatter(logging.Formatter('%(name)s: %(message)s'))
+		logger = logging.getLogger('zeep.transports')
+		logger.setLevel(logging.DEBUG)
+		logger.addHandler(handler)
+	_soap_logging_set = True
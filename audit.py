@@ -0,0 +1,275 @@
+'''
+Author: utkarshohm
+Description: Audit log of every SOAP request sent to BSEStar and the response received.
+	Regulations require to archive these for 5 years. Records are handed over to a queue on the
+	calling thread and written by a background thread as gzip compressed JSONL segments which are
+	rotated by size and by day. If the writer falls behind, the calling thread writes the record itself
+	so that no record is ever lost. Passwords and passkeys are redacted before writing
+'''
+
+import atexit
+import datetime
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+
+try:
+	import queue
+except ImportError:
+	import Queue as queue
+
+import settings
+
+
+LOGGER_NAME = 'bse.audit'
+REDACTED = '********'
+## keys of soap params whose values are always redacted
+SECRET_KEYS = ('password', 'passkey', 'pass_key')
+## how many one-time passwords received from BSEStar to remember for redaction
+MAX_SESSION_SECRETS = 256
+
+_lock = threading.Lock()
+_secrets_lock = threading.Lock()
+_configured = False
+_writer = None
+_handler = None
+
+_static_secrets = frozenset()
+_session_secrets = []
+
+
+################ PUBLIC FUNCTIONS - called by api.py
+
+def configure():
+	'''
+	Sets up the audit logger, its queue handler and the background writer
+	Safe to call any number of times- configuration happens only once per process
+	'''
+	global _configured, _writer, _handler, _static_secrets
+	if _configured:
+		return
+	with _lock:
+		if _configured:
+			return
+		_static_secrets = frozenset(
+			s for s in list(settings.PASSWORD) + list(settings.PASSKEY) if s
+		)
+		records = queue.Queue(maxsize=settings.AUDIT_QUEUE_SIZE)
+		_writer = AuditWriter(
+			records,
+			settings.AUDIT_LOG_DIR,
+			settings.AUDIT_SEGMENT_MAX_BYTES,
+		)
+		_writer.start()
+		_handler = QueueHandler(records, _writer.write, settings.AUDIT_QUEUE_TIMEOUT)
+		logger = logging.getLogger(LOGGER_NAME)
+		logger.setLevel(logging.INFO)
+		logger.propagate = False
+		logger.addHandler(_handler)
+		atexit.register(shutdown)
+		_configured = True
+
+
+def log_soap(operation, method_url, svc_url, args, kwargs, response, error, duration):
+	'''
+	Hands over one soap request/response to the audit writer
+	Only a tuple is built here; serialization and redaction happen on the writer thread
+	'''
+	if not _configured:
+		configure()
+	logging.getLogger(LOGGER_NAME).info(
+		operation,
+		extra={'audit': (time.time(), operation, method_url, svc_url, args, kwargs, response, error, duration)},
+	)
+
+
+def add_secret(secret):
+	'''
+	Registers a value (eg. one-time password from getPassword) to be redacted wherever it appears
+	'''
+	if not secret:
+		return
+	with _secrets_lock:
+		_session_secrets.append(secret)
+		if len(_session_secrets) > MAX_SESSION_SECRETS:
+			del _session_secrets[0]
+
+
+def shutdown(timeout=10):
+	'''
+	Flushes pending records, closes the current segment and removes the handler from the audit logger,
+	so that a later configure() starts afresh instead of adding a second handler
+	'''
+	global _configured, _writer, _handler
+	with _lock:
+		if _handler is not None:
+			logging.getLogger(LOGGER_NAME).removeHandler(_handler)
+		if _writer is not None and _writer.is_alive():
+			_writer.stop(timeout)
+		_writer = None
+		_handler = None
+		_configured = False
+
+
+def spilled_count():
+	'''
+	Number of records written by the calling thread because the queue was full
+	'''
+	return _handler.spilled if _handler is not None else 0
+
+
+################ HELPER FUNCTIONS
+
+def redact(value, secrets):
+	'''
+	Replaces secrets in a (possibly nested) soap param with REDACTED
+	'''
+	if isinstance(value, dict):
+		return dict(
+			(k, REDACTED if k.lower() in SECRET_KEYS else redact(v, secrets))
+			for k, v in value.items()
+		)
+	elif isinstance(value, (list, tuple)):
+		return [redact(v, secrets) for v in value]
+	elif value is None or isinstance(value, (bool, int, float)):
+		return value
+	value = value if isinstance(value, type(u'')) else str(value)
+	for secret in secrets:
+		if secret in value:
+			value = value.replace(secret, REDACTED)
+	return value
+
+
+def to_json(item, secrets):
+	'''
+	Serializes one audit tuple to a JSON line
+	'''
+	created, operation, method_url, svc_url, args, kwargs, response, error, duration = item
+	if operation == 'getPassword' and response:
+		## response is 100|<one-time password>
+		response = response.split('|')[0] + '|' + REDACTED
+	record = {
+		'ts': datetime.datetime.utcfromtimestamp(created).isoformat() + 'Z',
+		'operation': operation,
+		'action': method_url,
+		'endpoint': svc_url,
+		'request': {
+			'args': redact(list(args), secrets),
+			'kwargs': redact(dict(kwargs), secrets),
+		},
+		'response': redact(response, secrets),
+		'error': redact(error, secrets) if error else None,
+		'duration_ms': round(duration * 1000, 3),
+	}
+	return json.dumps(record, sort_keys=True)
+
+
+class QueueHandler(logging.Handler):
+	'''
+	Puts audit records on a queue, waiting at most timeout seconds for the writer to make room
+	When the writer cannot keep up, the record is spilled ie. written synchronously by spill()
+	on the calling thread, so a record is never dropped
+	'''
+	## print a warning on the first spill and then on every this many
+	WARN_EVERY = 100
+
+	def __init__(self, records, spill, timeout):
+		logging.Handler.__init__(self)
+		self.records = records
+		self.spill = spill
+		self.timeout = timeout
+		self.spilled = 0
+
+	def emit(self, record):
+		item = getattr(record, 'audit', None)
+		if item is None:
+			return
+		try:
+			self.records.put(item, timeout=self.timeout)
+		except queue.Full:
+			if self.spilled % self.WARN_EVERY == 0:
+				print('WARNING: audit queue full, writing %s synchronously (%d records spilled so far)' % (
+					item[1], self.spilled + 1))
+			self.spilled += 1
+			self.spill(item)
+
+
+class AuditWriter(threading.Thread):
+	'''
+	Background thread that appends audit records to gzip compressed JSONL segments
+	A new segment is started every day (UTC) and whenever a segment exceeds max_bytes
+	Segments are named soap-<YYYYMMDD>-<HHMMSS>-<pid>-<n>.jsonl.gz and never deleted
+	write() is also called by QueueHandler on other threads when the queue is full, so it holds a lock
+	'''
+	FLUSH_INTERVAL = 1.0
+
+	def __init__(self, records, log_dir, max_bytes):
+		threading.Thread.__init__(self, name='bse-audit-writer')
+		self.daemon = True
+		self.records = records
+		self.log_dir = log_dir
+		self.max_bytes = max_bytes
+		self.segment = None
+		self.segment_day = None
+		self.segment_bytes = 0
+		self.segment_num = 0
+		self._write_lock = threading.Lock()
+		self._stop_event = threading.Event()
+
+	def run(self):
+		try:
+			while not (self._stop_event.is_set() and self.records.empty()):
+				try:
+					item = self.records.get(timeout=self.FLUSH_INTERVAL)
+				except queue.Empty:
+					with self._write_lock:
+						if self.segment is not None:
+							self.segment.flush()
+					continue
+				self.write(item)
+		finally:
+			with self._write_lock:
+				self.close_segment()
+
+	def write(self, item):
+		with self._write_lock:
+			self._write(item)
+
+	def _write(self, item):
+		with _secrets_lock:
+			secrets = _static_secrets.union(_session_secrets)
+		try:
+			line = to_json(item, secrets) + '\n'
+		except Exception as e:
+			## never lose the fact that a request was made
+			line = json.dumps({'operation': item[1], 'error': 'Audit serialization failed: %s' % e}) + '\n'
+		day = datetime.datetime.utcfromtimestamp(item[0]).strftime('%Y%m%d')
+		if self.segment is None or day != self.segment_day or self.segment_bytes >= self.max_bytes:
+			self.open_segment(day)
+		data = line.encode('utf-8')
+		self.segment.write(data)
+		self.segment_bytes += len(data)
+
+	def open_segment(self, day):
+		self.close_segment()
+		if not os.path.isdir(self.log_dir):
+			os.makedirs(self.log_dir)
+		self.segment_num += 1
+		name = 'soap-%s-%s-%d-%d.jsonl.gz' % (
+			day, datetime.datetime.utcnow().strftime('%H%M%S'), os.getpid(), self.segment_num
+		)
+		self.segment = gzip.open(os.path.join(self.log_dir, name), 'ab')
+		self.segment_day = day
+		self.segment_bytes = 0
+
+	def close_segment(self):
+		if self.segment is not None:
+			self.segment.close()
+			self.segment = None
+
+	def stop(self, timeout=None):
+		self._stop_event.set()
+		self.join(timeout)
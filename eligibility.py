@@ -0,0 +1,164 @@
+'''
+Author: utkarshohm
+Description: Pre-trade checks of transactions against the rules of their scheme plans- minimum amounts,
+	SIP availability, SIP start days and open/closed plans- using the scheme cache. Orders that break
+	them would only be rejected by BSEStar after a full SOAP round trip. Rules are evaluated on numpy
+	arrays across a whole batch and every failure is reported as a Rejection with a stable code
+'''
+
+import numpy as np
+
+from errors import ValidationError
+import metrics
+import schemes
+
+
+## rejection codes
+UNKNOWN_SCHEME = 'UNKNOWN_SCHEME'
+CLOSED_SCHEME = 'CLOSED_SCHEME'
+SIP_NOT_ALLOWED = 'SIP_NOT_ALLOWED'
+BELOW_MIN_INV = 'BELOW_MIN_INV'
+BELOW_MIN_ADDL_INV = 'BELOW_MIN_ADDL_INV'
+BELOW_MIN_SIP_INV = 'BELOW_MIN_SIP_INV'
+BELOW_MIN_SIP_INST = 'BELOW_MIN_SIP_INST'
+SIP_START_DAY = 'SIP_START_DAY'
+
+MESSAGES = {
+	UNKNOWN_SCHEME: 'Scheme plan %(scheme_plan_id)s not found',
+	CLOSED_SCHEME: 'Scheme plan %(scheme_plan_id)s is not open for purchase',
+	SIP_NOT_ALLOWED: 'Scheme plan %(scheme_plan_id)s does not allow SIP',
+	BELOW_MIN_INV: 'Amount %(amount)s is below minimum investment of %(min_inv)s',
+	BELOW_MIN_ADDL_INV: 'Amount %(amount)s is below minimum additional investment of %(min_addl_inv)s',
+	BELOW_MIN_SIP_INV: 'SIP instalment %(amount)s is below minimum of %(min_sip_inv)s',
+	BELOW_MIN_SIP_INST: 'SIP of %(sip_num_inst)s instalments is below minimum of %(min_sip_inst)s',
+	SIP_START_DAY: 'SIP cannot start on day %(sip_start_day)s of month, allowed days are %(sip_start_days)s',
+}
+
+
+## stands in for plans missing from the cache so that rule arrays stay aligned with transactions
+EMPTY_RECORD = schemes.SchemeRecord(None, '', '', '', '', '', None, False, None, None, None, None, '', None)
+
+
+class Rejection(object):
+	'''
+	Reason a transaction is not eligible. index is its position in the checked batch
+	'''
+	__slots__ = ('index', 'transaction_id', 'code', 'message')
+
+	def __init__(self, index, transaction_id, code, message):
+		self.index = index
+		self.transaction_id = transaction_id
+		self.code = code
+		self.message = message
+
+	def __repr__(self):
+		return '<Rejection %s %s>' % (self.transaction_id, self.code)
+
+	def as_dict(self):
+		return {'transaction_id': self.transaction_id, 'code': self.code, 'message': self.message}
+
+
+class IneligibleOrderError(ValidationError):
+	'''
+	Raised when transactions fail pre-trade checks; rejections holds all reasons
+	'''
+	label = 'Eligibility error'
+
+	def __init__(self, rejections):
+		self.rejections = rejections
+		ValidationError.__init__(self, 672, '; '.join(
+			'transaction %s: %s' % (r.transaction_id, r.message) for r in rejections
+		))
+
+
+def floats(values):
+	'''
+	Array of floats with NaN for None, so comparisons with missing limits are False
+	'''
+	return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+
+
+def check(transactions, cache=None):
+	'''
+	Checks purchase transactions (lumpsum and SIP) against rules of their scheme plans
+	Returns list of Rejection, empty if all transactions are eligible. Redemptions are not checked
+	'''
+	if cache is None:
+		cache = schemes.cache()
+	n = len(transactions)
+	if not n:
+		return []
+	records = [cache.get(t.scheme_plan_id) for t in transactions]
+	known = np.array([r is not None for r in records])
+	records = [r if r is not None else EMPTY_RECORD for r in records]
+
+	transaction_type = np.array([t.transaction_type for t in transactions])
+	order_type = np.array([t.order_type for t in transactions])
+	amount = floats([t.amount for t in transactions])
+	sip_num_inst = floats([t.sip_num_inst for t in transactions])
+	sip_day = np.array([t.sip_start_date.day if t.sip_start_date else 0 for t in transactions])
+
+	if_open = np.array([r.if_open for r in records])
+	if_sip = np.array([r.if_sip for r in records])
+	min_inv = floats([r.min_inv for r in records])
+	min_addl_inv = floats([r.min_addl_inv for r in records])
+	min_sip_inv = floats([r.min_sip_inv for r in records])
+	min_sip_inst = floats([r.min_sip_inst for r in records])
+	## plans without a list of start days allow any day
+	day_ok = np.array([not r.sip_start_days or day in r.sip_start_days for r, day in zip(records, sip_day)])
+
+	purchase = (transaction_type == 'P') | (transaction_type == 'A')
+	sip = purchase & (order_type == '2')
+	lumpsum = purchase & (order_type == '1')
+	checked = purchase & known
+
+	with np.errstate(invalid='ignore'):
+		failures = (
+			(UNKNOWN_SCHEME, purchase & ~known),
+			(CLOSED_SCHEME, checked & ~if_open),
+			(SIP_NOT_ALLOWED, checked & sip & ~if_sip),
+			(BELOW_MIN_INV, checked & lumpsum & (transaction_type == 'P') & (amount < min_inv)),
+			(BELOW_MIN_ADDL_INV, checked & lumpsum & (transaction_type == 'A') & (amount < min_addl_inv)),
+			(BELOW_MIN_SIP_INV, checked & sip & if_sip & (amount < min_sip_inv)),
+			(BELOW_MIN_SIP_INST, checked & sip & if_sip & (sip_num_inst < min_sip_inst)),
+			(SIP_START_DAY, checked & sip & if_sip & (sip_day > 0) & ~day_ok),
+		)
+
+	rejections = []
+	for code, mask in failures:
+		for i in np.nonzero(mask)[0]:
+			t, r = transactions[i], records[i]
+			rejections.append(Rejection(int(i), t.id, code, MESSAGES[code] % {
+				'scheme_plan_id': t.scheme_plan_id,
+				'amount': t.amount,
+				'sip_num_inst': t.sip_num_inst,
+				'sip_start_day': sip_day[i],
+				'min_inv': r.min_inv,
+				'min_addl_inv': r.min_addl_inv,
+				'min_sip_inv': r.min_sip_inv,
+				'min_sip_inst': r.min_sip_inst,
+				'sip_start_days': ','.join(str(d) for d in sorted(r.sip_start_days)),
+			}))
+	rejections.sort(key=lambda r: r.index)
+	for r in rejections:
+		metrics.incr('eligibility_rejections', code=r.code)
+	return rejections
+
+
+def split(transactions, cache=None):
+	'''
+	Returns (eligible transactions, rejections) so that a batch can go ahead without the rejected ones
+	'''
+	rejections = check(transactions, cache)
+	rejected = set(r.index for r in rejections)
+	eligible = [t for i, t in enumerate(transactions) if i not in rejected]
+	return eligible, rejections
+
+
+def ensure_eligible(transactions, cache=None):
+	'''
+	Raises IneligibleOrderError with all rejections if any transaction is not eligible
+	'''
+	rejections = check(transactions, cache)
+	if rejections:
+		raise IneligibleOrderError(rejections)
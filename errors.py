@@ -0,0 +1,70 @@
+'''
+Author: utkarshohm
+Description: Errors raised by api.py, web.py and the modules they use. Every error has
+	- code: its 3 digit error code, also in its message eg. "BSE error 641: ..." so logs read as before
+	- response: the raw response of BSEStar, if the error is about one
+	- retryable: whether the same call may succeed if made again later
+	so that callers, eg. batch workers, can decide what to do with a failure by its class or flags
+	instead of parsing its message. Kinds of errors
+	- AuthError: BSEStar didn't accept the credentials in settings
+	- ValidationError: a request breaks BSEStar's or a scheme plan's rules and was not sent
+	- RateLimitError: BSEStar won't take more requests of the kind for now
+	- TransportError: the network, BSEStar's service or the browser failed; retryable
+	- RejectionError: BSEStar received the request and turned it down
+	- InternalError: data in our tables or a call is inconsistent
+'''
+
+
+class BSEError(Exception):
+	'''
+	Base of all errors with a code
+	'''
+	label = 'BSE error'
+	retryable = False
+
+	def __init__(self, code, message, response=None, retryable=None):
+		self.code = code
+		self.message = message
+		## responses are split into their fields by the time they are checked
+		self.response = '|'.join(response) if isinstance(response, list) else response
+		if retryable is not None:
+			self.retryable = retryable
+		Exception.__init__(self, '%s %d: %s' % (self.label, code, message))
+
+
+class AuthError(BSEError):
+	pass
+
+
+class ValidationError(BSEError):
+	pass
+
+
+class RateLimitError(BSEError):
+	retryable = True
+
+
+class TransportError(BSEError):
+	retryable = True
+
+
+class CircuitOpenError(TransportError):
+	'''
+	Calls to an endpoint are failed without making them for a while after repeated failures (see resilience.py)
+	'''
+	label = 'Internal error'
+
+
+class BrowserError(TransportError):
+	'''
+	The browser crawling the web portal stopped responding and needs to be started again
+	'''
+	label = 'Crawler error'
+
+
+class RejectionError(BSEError):
+	pass
+
+
+class InternalError(BSEError):
+	label = 'Internal error'
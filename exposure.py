@@ -0,0 +1,215 @@
+'''
+Author: utkarshohm
+Description: Look-through exposure and fund overlap from disclosed portfolios (EquityPortfolio, DebtPortfolio).
+	All holdings are loaded once into a sparse (fund scheme x asset) CSR matrix of weights, equity and debt
+	assets side by side in one column space. A user's exposure to every stock and bond, breakdowns of it by
+	sector, cap size and credit rating, and overlap between every pair of funds are then sparse matrix
+	products instead of a query per scheme and nested loops. The loaded holdings are kept until a portfolio
+	with a newer for_date is disclosed
+'''
+
+import threading
+
+import numpy as np
+from scipy import sparse
+from django.db.models import Max, Sum
+
+from models.funds import EquityPortfolio, DebtPortfolio, EquityAsset, DebtAsset
+from models.transactions import Transaction
+from returns import HELD_STATUS
+
+
+## labels of assets without a sector, cap type or rating
+UNCLASSIFIED = 'unclassified'
+
+
+def index_of(ids):
+	'''
+	Returns sorted unique ids and a dict from id to its position
+	'''
+	ids = np.array(sorted(set(ids)), dtype=np.int64)
+	return ids, dict((int(i), pos) for pos, i in enumerate(ids))
+
+
+def indicator(labels):
+	'''
+	Returns (categories, CSR matrix of assets x categories) with a 1 where an asset has that label
+	'''
+	categories = sorted(set(labels))
+	position = dict((c, i) for i, c in enumerate(categories))
+	cols = np.array([position[l] for l in labels], dtype=np.int64)
+	rows = np.arange(len(labels))
+	matrix = sparse.csr_matrix((np.ones(len(labels)), (rows, cols)), shape=(len(labels), len(categories)))
+	return categories, matrix
+
+
+class Holdings(object):
+	'''
+	Disclosed holdings of all fund schemes as a CSR matrix of weights (fraction of the scheme's assets)
+	Columns are equity assets followed by debt assets; asset_kinds, asset_ids and the label arrays
+	are aligned with columns
+	'''
+
+	def __init__(self, scheme_ids, asset_kinds, asset_ids, matrix, sectors, cap_types, ratings, for_date):
+		self.scheme_ids = scheme_ids
+		self.scheme_pos = dict((int(s), i) for i, s in enumerate(scheme_ids))
+		self.asset_kinds = asset_kinds
+		self.asset_ids = asset_ids
+		self.matrix = matrix
+		self.sectors = sectors
+		self.cap_types = cap_types
+		self.ratings = ratings
+		self.for_date = for_date
+		self._breakdowns = {}
+
+	@classmethod
+	def load(cls, for_date=None):
+		'''
+		Reads all holdings and asset attributes with four queries
+		'''
+		equity = list(EquityPortfolio.objects.filter(percentage__isnull=False).values_list(
+			'fund_scheme_id', 'equity_asset_id', 'percentage'))
+		debt = list(DebtPortfolio.objects.filter(percentage__isnull=False).values_list(
+			'fund_scheme_id', 'debt_asset_id', 'percentage'))
+
+		scheme_ids, scheme_pos = index_of([r[0] for r in equity] + [r[0] for r in debt])
+		equity_ids, equity_pos = index_of([r[1] for r in equity])
+		debt_ids, debt_pos = index_of([r[1] for r in debt])
+		n_equity = len(equity_ids)
+
+		rows = np.array([scheme_pos[r[0]] for r in equity] + [scheme_pos[r[0]] for r in debt], dtype=np.int64)
+		cols = np.array(
+			[equity_pos[r[1]] for r in equity] + [n_equity + debt_pos[r[1]] for r in debt], dtype=np.int64)
+		weights = np.array([r[2] for r in equity] + [r[2] for r in debt], dtype=np.float64) / 100.0
+		matrix = sparse.csr_matrix(
+			(weights, (rows, cols)), shape=(len(scheme_ids), n_equity + len(debt_ids)))
+
+		equity_attrs = dict(
+			(i, (sector, cap_type)) for i, sector, cap_type in
+			EquityAsset.objects.filter(id__in=[int(i) for i in equity_ids]).values_list('id', 'equity_sector', 'cap_type')
+		)
+		debt_attrs = dict(
+			DebtAsset.objects.filter(id__in=[int(i) for i in debt_ids]).values_list('id', 'credit_rating')
+		)
+		## sector and cap type of debt assets are 'debt' and rating of equity assets 'equity' so that
+		## every breakdown adds up to the whole exposure
+		sectors = [equity_attrs.get(int(i), ('', ''))[0] or UNCLASSIFIED for i in equity_ids] + ['debt'] * len(debt_ids)
+		cap_types = [equity_attrs.get(int(i), ('', ''))[1] or UNCLASSIFIED for i in equity_ids] + ['debt'] * len(debt_ids)
+		ratings = ['equity'] * n_equity + [debt_attrs.get(int(i)) or UNCLASSIFIED for i in debt_ids]
+		asset_kinds = np.array(['equity'] * n_equity + ['debt'] * len(debt_ids))
+		asset_ids = np.concatenate([equity_ids, debt_ids])
+		return cls(scheme_ids, asset_kinds, asset_ids, matrix, sectors, cap_types, ratings, for_date)
+
+	def scheme_weights(self, owner_scheme_amounts, n_owners):
+		'''
+		Builds a CSR matrix of (owners x schemes) portfolio weights from (owner index, scheme id, amount)
+		triples. Rows sum to 1; schemes without disclosed holdings are left out
+		'''
+		owners = []
+		cols = []
+		amounts = []
+		for owner, scheme_id, amount in owner_scheme_amounts:
+			pos = self.scheme_pos.get(scheme_id)
+			if pos is not None and amount:
+				owners.append(owner)
+				cols.append(pos)
+				amounts.append(amount)
+		weights = sparse.csr_matrix(
+			(np.array(amounts, dtype=np.float64), (np.array(owners, dtype=np.int64), np.array(cols, dtype=np.int64))),
+			shape=(n_owners, len(self.scheme_ids)),
+		)
+		totals = np.asarray(weights.sum(axis=1)).ravel()
+		with np.errstate(divide='ignore'):
+			scale = np.where(totals > 0, 1.0 / totals, 0.0)
+		return sparse.diags(scale).dot(weights).tocsr()
+
+	def exposure(self, weights):
+		'''
+		Look-through exposure (owners x assets) of portfolios given as (owners x schemes) weights
+		'''
+		return weights.dot(self.matrix).tocsr()
+
+	def breakdown(self, exposure, by):
+		'''
+		Sums exposure (owners x assets) by asset label- 'sector', 'cap_type' or 'rating'
+		Returns (categories, dense owners x categories array)
+		'''
+		if by not in self._breakdowns:
+			labels = {'sector': self.sectors, 'cap_type': self.cap_types, 'rating': self.ratings}[by]
+			self._breakdowns[by] = indicator(labels)
+		categories, matrix = self._breakdowns[by]
+		return categories, exposure.dot(matrix).toarray()
+
+	def overlap(self):
+		'''
+		Overlap between all pairs of schemes as a CSR matrix; entry (a, b) is the fraction of scheme a's
+		assets invested in holdings that scheme b also holds. Only pairs with a common holding are stored
+		'''
+		held = self.matrix.copy()
+		held.data = np.ones(len(held.data))
+		return self.matrix.dot(held.T).tocsr()
+
+	def common_holdings(self):
+		'''
+		Number of holdings common to every pair of schemes as a CSR matrix
+		'''
+		held = self.matrix.copy()
+		held.data = np.ones(len(held.data))
+		return held.dot(held.T).tocsr()
+
+
+################ CACHE
+
+_cache = {'holdings': None}
+_lock = threading.Lock()
+
+
+def latest_disclosure():
+	'''
+	for_date of the latest disclosed portfolio (equity or debt)
+	'''
+	dates = [
+		EquityPortfolio.objects.aggregate(latest=Max('for_date'))['latest'],
+		DebtPortfolio.objects.aggregate(latest=Max('for_date'))['latest'],
+	]
+	dates = [d for d in dates if d is not None]
+	return max(dates) if dates else None
+
+
+def holdings():
+	'''
+	Returns holdings of all schemes, reloaded only when a portfolio with a newer for_date is disclosed
+	'''
+	for_date = latest_disclosure()
+	with _lock:
+		cached = _cache['holdings']
+		if cached is None or cached.for_date != for_date:
+			cached = _cache['holdings'] = Holdings.load(for_date)
+		return cached
+
+
+################ USERS
+
+def user_exposure(user_ids, data=None):
+	'''
+	Look-through exposure of users' held investments, weighted by amount invested in each scheme
+	Returns (holdings, CSR matrix of users x assets) with rows aligned with user_ids
+	'''
+	data = data or holdings()
+	user_pos = dict((int(u), i) for i, u in enumerate(user_ids))
+	rows = Transaction.objects.filter(
+		user_id__in=list(user_pos),
+		status__in=HELD_STATUS,
+		transaction_type__in=('P', 'A'),
+	).values_list('user_id', 'scheme_plan__fund_scheme_id').annotate(invested=Sum('amount'))
+	weights = data.scheme_weights(
+		((user_pos[user_id], scheme_id, invested) for user_id, scheme_id, invested in rows), len(user_ids))
+	return data, data.exposure(weights)
+
+
+def user_breakdowns(user_ids):
+	'''
+	Returns dict of 'sector', 'cap_type' and 'rating' to (categories, users x categories array) in fractions
+	'''
+	data, exposure = user_exposure(user_ids)
+	return dict((by, data.breakdown(exposure, by)) for by in ('sector', 'cap_type', 'rating'))
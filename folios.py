@@ -0,0 +1,138 @@
+'''
+Author: utkarshohm
+Description: Resolves the folio of additional purchase and redeem orders. Folios of all (user, scheme plan)
+	pairs of a batch are read up front from the holdings ledger (with one fallback query on completed
+	purchases for pairs the ledger doesn't have yet), so preparing orders adds no query per order.
+	Folios are always picked in the same order- largest current value first, then folio number- and
+	a redemption larger than one folio is split across folios
+'''
+
+from errors import InternalError
+import lazy
+import repository
+
+timeseries = lazy.module('timeseries')
+
+
+class Folio(object):
+	'''
+	A folio of a user in a scheme plan; value is None when its balance is unknown
+	'''
+	__slots__ = ('folio_number', 'units', 'value')
+
+	def __init__(self, folio_number, units, value):
+		self.folio_number = folio_number
+		self.units = units
+		self.value = value
+
+	def sort_key(self):
+		return (-(self.value or 0.0), self.folio_number)
+
+
+class Leg(object):
+	'''
+	One redeem order of a redemption- amount from a folio, or all of it if all_redeem
+	'''
+	__slots__ = ('folio_number', 'amount', 'all_redeem')
+
+	def __init__(self, folio_number, amount, all_redeem):
+		self.folio_number = folio_number
+		self.amount = amount
+		self.all_redeem = all_redeem
+
+	def __repr__(self):
+		return '<Leg %s %s%s>' % (self.folio_number, self.amount, ' all' if self.all_redeem else '')
+
+
+class FolioResolver(object):
+	'''
+	Folios of (user_id, scheme_plan_id) pairs, sorted in the order they are picked
+	'''
+
+	def __init__(self, folios):
+		self.folios = folios
+
+	@classmethod
+	def preload(cls, transactions, store=None):
+		'''
+		Loads folios of all additional purchase and redeem transactions given with at most two queries
+		'''
+		pairs = set((t.user_id, t.scheme_plan_id) for t in transactions if t.transaction_type in ('A', 'R'))
+		folios = {}
+		if not pairs:
+			return cls(folios)
+		store = store or timeseries.fund_store()
+		repo = repository.get()
+		user_ids = set(p[0] for p in pairs)
+		plan_ids = set(p[1] for p in pairs)
+
+		latest_nav = {}
+		rows = repo.holding_folios(user_ids, plan_ids)
+		for user_id, plan_id, folio_number, units in rows:
+			if (user_id, plan_id) not in pairs or units <= 0:
+				continue
+			if plan_id not in latest_nav:
+				series = store.get(plan_id)
+				latest_nav[plan_id] = float(series.values[-1]) if len(series) else None
+			nav = latest_nav[plan_id]
+			folios.setdefault((user_id, plan_id), []).append(
+				Folio(folio_number, units, units * nav if nav else None))
+
+		## pairs not in the ledger yet- folios of completed purchases, balance unknown
+		missing = pairs - set(folios)
+		if missing:
+			rows = repo.purchase_folios(set(p[0] for p in missing), set(p[1] for p in missing))
+			for user_id, plan_id, folio_number in rows:
+				if (user_id, plan_id) in missing:
+					folios.setdefault((user_id, plan_id), []).append(Folio(folio_number, None, None))
+
+		for key in folios:
+			folios[key].sort(key=Folio.sort_key)
+		return cls(folios)
+
+	def folios_of(self, transaction):
+		folios = self.folios.get((transaction.user_id, transaction.scheme_plan_id))
+		if not folios:
+			raise InternalError(
+				632, "No existing purchase found such that an additional purchase or redeem transaction be made"
+			)
+		return folios
+
+	def folio_for(self, transaction):
+		'''
+		Folio of an additional purchase- the user's largest folio in the scheme plan
+		'''
+		return self.folios_of(transaction)[0].folio_number
+
+	def redemption_legs(self, transaction):
+		'''
+		Splits a redemption into one Leg per folio it is taken from
+		- all_redeem: every folio is redeemed fully
+		- amount: largest folios first; folios used up are redeemed fully (all_redeem) so that nav
+			movement between now and allotment doesn't leave a residue or fail the order
+		If balances are unknown the whole amount is taken from the first folio
+		'''
+		folios = self.folios_of(transaction)
+		if transaction.all_redeem:
+			return [Leg(f.folio_number, None, True) for f in folios]
+
+		amount = transaction.amount
+		if any(f.value is None for f in folios) or folios[0].value >= amount:
+			return [Leg(folios[0].folio_number, amount, False)]
+		total = sum(f.value for f in folios)
+		if total < amount:
+			raise InternalError(
+				673, "Redemption of %s is more than holdings of %.2f" % (amount, total)
+			)
+		legs = []
+		remaining = amount
+		for f in folios:
+			if remaining <= 0:
+				break
+			if f.value <= remaining:
+				legs.append(Leg(f.folio_number, None, True))
+				remaining -= f.value
+			else:
+				legs.append(Leg(f.folio_number, remaining, False))
+				remaining = 0
+		return legs
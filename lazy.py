@@ -0,0 +1,74 @@
+'''
+Author: utkarshohm
+Description: Deferred imports of heavy dependencies (selenium, zeep/lxml, numpy, pytz ...). A module or an
+	attribute of a module is stood in for by a proxy that imports it on first use, so that importing
+	api.py or web.py to call one light function doesn't pay for libraries that function never touches.
+	Proxies can't be used in except clauses; resolve() the real class there (see web.crawl_errors)
+'''
+
+import importlib
+import sys
+
+
+class LazyModule(object):
+	'''
+	Stands in for a module until one of its attributes is first used
+	'''
+
+	def __init__(self, name):
+		self.__dict__['_name'] = name
+		self.__dict__['_module'] = None
+
+	def resolve(self):
+		module = self.__dict__['_module']
+		if module is None:
+			module = self.__dict__['_module'] = importlib.import_module(self.__dict__['_name'])
+		return module
+
+	def __getattr__(self, attr):
+		return getattr(self.resolve(), attr)
+
+	def __repr__(self):
+		return '<LazyModule %s%s>' % (self.__dict__['_name'], '' if self.__dict__['_module'] is None else ' loaded')
+
+
+class LazyAttribute(object):
+	'''
+	Stands in for a class or function of a module until it is first called or one of its attributes used
+	'''
+
+	def __init__(self, module, name):
+		self.__dict__['_module'] = module
+		self.__dict__['_name'] = name
+		self.__dict__['_value'] = None
+
+	def resolve(self):
+		value = self.__dict__['_value']
+		if value is None:
+			module = importlib.import_module(self.__dict__['_module'])
+			value = self.__dict__['_value'] = getattr(module, self.__dict__['_name'])
+		return value
+
+	def __getattr__(self, attr):
+		return getattr(self.resolve(), attr)
+
+	def __call__(self, *args, **kwargs):
+		return self.resolve()(*args, **kwargs)
+
+	def __repr__(self):
+		return '<LazyAttribute %s.%s>' % (self.__dict__['_module'], self.__dict__['_name'])
+
+
+def module(name):
+	return LazyModule(name)
+
+
+def attribute(module, name):
+	return LazyAttribute(module, name)
+
+
+def loaded(name):
+	'''
+	Whether module name has been imported in this process
+	'''
+	return name in sys.modules
@@ -0,0 +1,187 @@
+'''
+Author: utkarshohm
+Description: Partitioning of status tracking between tracker daemons (tracker.py) on one or many machines
+	sharing one database, so that each transaction is checked by one daemon and more daemons check more
+	of them. Transactions are split into settings.TRACKER_SHARDS shards by user id (user_id modulo
+	TRACKER_SHARDS), so all transactions of a user are with one daemon. Shards are leased to daemons
+	through rows of TrackerLease
+	- every daemon holds a membership lease ('node:<n>'), so that daemons know how many of them are alive
+	- it claims free or expired shard leases ('shard:<n>') up to its fair share- shards / live daemons,
+		rounded up- and frees those above it, so shards spread out as daemons join and leave
+	- leases are renewed every tick and expire settings.TRACKER_LEASE_TTL seconds later; shards of a daemon
+		that died are taken over once they expire. During a step that may outlast them, eg. a crawl, a
+		Heartbeat thread extends the leases held every third of TRACKER_LEASE_TTL
+	Claims are conditional updates, so one daemon holds a lease at a time. A daemon that stalled past its
+	leases may still finish a step on a shard taken over- updates of transactions are conditional on the
+	status read (see tracking.py), so such a write is dropped rather than applied twice
+	Leases expire by the clocks of daemons, which should differ by much less than TRACKER_LEASE_TTL
+'''
+
+import datetime
+import os
+import random
+import socket
+import threading
+
+import settings
+import lazy
+import metrics
+import repository
+
+
+NODE = 'node:%d'
+SHARD = 'shard:%d'
+
+
+def shard_of(user_id):
+	return user_id % settings.TRACKER_SHARDS
+
+
+def default_owner():
+	return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+def number(lease):
+	return int(lease.name.split(':')[1])
+
+
+def expired(lease, now):
+	return not lease.owner or lease.expires_at is None or lease.expires_at.replace(tzinfo=None) < now
+
+
+class ShardLeases(object):
+	'''
+	Leases of one daemon. renew() claims, renews and frees them; held is the list of shards held after it
+	'''
+
+	def __init__(self, repo=None, owner=None, shards=None, ttl=None):
+		self.repo = repo or repository.get()
+		self.owner = owner or default_owner()
+		self.shards = shards or settings.TRACKER_SHARDS
+		self.ttl = ttl or settings.TRACKER_LEASE_TTL
+		self.node = None
+		self.held = []
+
+	def renew(self, now=None):
+		'''
+		Renews membership and shards held, frees shards above the fair share and claims free ones up to it
+		now is naive UTC. Returns shards held
+		'''
+		now = now or datetime.datetime.utcnow()
+		expires_at = now + datetime.timedelta(seconds=self.ttl)
+		leases = self.repo.leases()
+		nodes = [l for l in leases if l.name.startswith('node:')]
+		shard_leases = dict((number(l), l) for l in leases if l.name.startswith('shard:'))
+
+		self.node = self.join(nodes, now, expires_at)
+		if self.node is None:
+			## without membership its shards would be counted for nobody; they expire and are taken over
+			self.held = []
+			return self.held
+		live = 1 + len([l for l in nodes if l.name != self.node and not expired(l, now)])
+		share = -(-self.shards // live)
+
+		held = []
+		for shard in sorted(s for s, l in shard_leases.items() if l.owner == self.owner and s < self.shards):
+			if len(held) >= share:
+				self.repo.release_lease(SHARD % shard, self.owner)
+				metrics.incr('leases', event='released')
+			elif self.repo.claim_lease(SHARD % shard, self.owner, now, expires_at):
+				held.append(shard)
+			else:
+				metrics.incr('leases', event='lost')
+
+		free = [s for s in range(self.shards) if s not in shard_leases or
+			(shard_leases[s].owner != self.owner and expired(shard_leases[s], now))]
+		## in random order so that daemons claiming at once mostly try different shards
+		random.shuffle(free)
+		for shard in free:
+			if len(held) >= share:
+				break
+			if self.repo.claim_lease(SHARD % shard, self.owner, now, expires_at):
+				held.append(shard)
+				metrics.incr('leases', event='claimed')
+
+		if sorted(held) != self.held:
+			print('Tracking shards %s of %d with %d daemons' % (sorted(held), self.shards, live))
+		self.held = sorted(held)
+		return self.held
+
+	def extend(self, now=None):
+		'''
+		Renews membership and shards held without claiming or freeing any, so that a step working on them
+		keeps them however long it takes. Shards taken over by another daemon are dropped. Returns shards held
+		'''
+		if self.node is None:
+			return self.held
+		now = now or datetime.datetime.utcnow()
+		expires_at = now + datetime.timedelta(seconds=self.ttl)
+		if not self.repo.claim_lease(self.node, self.owner, now, expires_at):
+			metrics.incr('leases', event='lost')
+		held = []
+		for shard in self.held:
+			if self.repo.claim_lease(SHARD % shard, self.owner, now, expires_at):
+				held.append(shard)
+			else:
+				metrics.incr('leases', event='lost')
+		self.held = held
+		return self.held
+
+	def join(self, nodes, now, expires_at):
+		'''
+		Claims a membership slot- the one held, else a free one, else a new one. None if all claims failed
+		'''
+		names = [l.name for l in nodes if l.owner == self.owner] + \
+			[l.name for l in nodes if l.owner != self.owner and expired(l, now)]
+		names.append(NODE % (max([number(l) for l in nodes] or [-1]) + 1))
+		for name in names:
+			if self.repo.claim_lease(name, self.owner, now, expires_at):
+				return name
+		return None
+
+	def release(self):
+		'''
+		Frees all leases held, so that other daemons take over its shards without waiting for them to expire
+		'''
+		for shard in self.held:
+			self.repo.release_lease(SHARD % shard, self.owner)
+		if self.node is not None:
+			self.repo.release_lease(self.node, self.owner)
+		self.held = []
+		self.node = None
+
+
+class Heartbeat(threading.Thread):
+	'''
+	Extends leases of a daemon every interval seconds (a third of their ttl by default) while a long step runs
+		with Heartbeat(leases):
+			crawl()
+	'''
+
+	def __init__(self, leases, interval=None):
+		threading.Thread.__init__(self, name='tracker-heartbeat')
+		self.daemon = True
+		self.leases = leases
+		self.interval = interval or leases.ttl / 3.0
+		self.stopped = threading.Event()
+
+	def run(self):
+		try:
+			while not self.stopped.wait(self.interval):
+				try:
+					self.leases.extend()
+				except Exception as e:
+					print('Error in extending leases: %r' % e)
+		finally:
+			## the thread's own DB connection
+			if lazy.loaded('django.db'):
+				from django.db import connection
+				connection.close()
+
+	def __enter__(self):
+		self.start()
+		return self
+
+	def __exit__(self, *exc_info):
+		self.stopped.set()
+		self.join()
@@ -0,0 +1,331 @@
+'''
+Author: utkarshohm
+Description: Holdings ledger- keeps the Holding table (units and amount invested per user, scheme plan
+	and folio) up to date as transactions move. Every change is derived from a transaction's status and
+	instalments before and after it moved, so the same rules serve three uses-
+	- record(): called where a transaction's status or sip_num_inst_done changes, updates one row
+	- rebuild(): replays all transactions in chunks and rewrites the table
+	- check(): replays all transactions in memory and reports rows of the table that differ
+'''
+
+import datetime
+
+import lazy
+import repository
+
+timeseries = lazy.module('timeseries')
+
+
+## statuses in which a purchase is held- completed and SIP concluded
+HELD_STATUS = ('6', '8')
+## status of a purchase whose investment has been reversed
+REVERSED_STATUS = '7'
+## transactions read per query when replaying
+CHUNK = 2000
+## differences below these are rounding, not inconsistencies
+UNITS_TOLERANCE = 1e-3
+AMOUNT_TOLERANCE = 1e-2
+
+FIELDS = ('id', 'user_id', 'scheme_plan_id', 'transaction_type', 'order_type', 'status', 'amount',
+	'all_redeem', 'sip_dates', 'sip_num_inst_done', 'datetime_at_mf', 'folio_number')
+
+
+class Position(object):
+	'''
+	In-memory counterpart of a Holding row used when replaying
+	'''
+	__slots__ = ('user_id', 'scheme_plan_id', 'folio_number', 'units', 'invested', 'missing_navs',
+		'num_transactions', 'last_transaction_id')
+
+	def __init__(self, user_id, scheme_plan_id, folio_number):
+		self.user_id = user_id
+		self.scheme_plan_id = scheme_plan_id
+		self.folio_number = folio_number
+		self.units = 0.0
+		self.invested = 0.0
+		self.missing_navs = 0
+		self.num_transactions = 0
+		self.last_transaction_id = None
+
+	def key(self):
+		return (self.user_id, self.scheme_plan_id, self.folio_number)
+
+
+class Row(object):
+	'''
+	Fields of a Transaction read with values_list, so replaying doesn't build model instances
+	'''
+	__slots__ = FIELDS
+
+	def __init__(self, *values):
+		for field, value in zip(FIELDS, values):
+			setattr(self, field, value)
+
+
+class Navs(object):
+	'''
+	Nav of a scheme plan on a date from the time series store, series cached per plan
+	'''
+
+	def __init__(self, store=None):
+		self.store = store or timeseries.fund_store()
+		self.series = {}
+
+	def on(self, scheme_plan_id, d):
+		if d is None:
+			return None
+		series = self.series.get(scheme_plan_id)
+		if series is None:
+			series = self.series[scheme_plan_id] = self.store.get(scheme_plan_id)
+		return series.value_on(d)
+
+
+################ RULES
+
+def parse_sip_date(s):
+	return datetime.datetime.strptime(s, '%d%m%y').date()
+
+
+def purchase_flows(tr, old_status, old_inst_done):
+	'''
+	Returns list of (sign, amount, date) that a purchase's move from (old_status, old_inst_done)
+	to its current state adds to (+1) or removes from (-1) its holding
+	'''
+	if not tr.amount:
+		return []
+	was_held = old_status in HELD_STATUS
+	is_held = tr.status in HELD_STATUS
+	if tr.order_type == '2':
+		dates = [d for d in (tr.sip_dates or '').split(',') if d]
+		before = dates[:old_inst_done or 0] if was_held else []
+		after = dates[:tr.sip_num_inst_done or 0] if is_held else []
+		if was_held and is_held:
+			## instalments are only ever added, so the new ones are at the end
+			after, before = after[len(before):], []
+		return (
+			[(1, tr.amount, parse_sip_date(d)) for d in after] +
+			[(-1, tr.amount, parse_sip_date(d)) for d in before]
+		)
+	trade_date = tr.datetime_at_mf.date() if tr.datetime_at_mf else None
+	if is_held and not was_held:
+		return [(1, tr.amount, trade_date)]
+	if was_held and not is_held:
+		return [(-1, tr.amount, trade_date)]
+	return []
+
+
+def apply_purchase(position, tr, old_status, old_inst_done, navs):
+	flows = purchase_flows(tr, old_status, old_inst_done)
+	for sign, amount, d in flows:
+		nav = navs.on(tr.scheme_plan_id, d)
+		if nav:
+			position.units += sign * amount / nav
+		else:
+			position.missing_navs += sign
+		position.invested += sign * amount
+	clamp(position)
+	return bool(flows)
+
+
+def apply_redemption(position, tr, old_status, navs):
+	'''
+	A redemption takes units out once it completes; all_redeem empties the holding
+	Amount invested goes down in proportion to units redeemed
+	A completed redemption that is reversed puts them back (see restore_redemption())
+	'''
+	if old_status == '6' and tr.status == REVERSED_STATUS:
+		return restore_redemption(position, tr, navs)
+	if tr.status != '6' or old_status == '6':
+		return False
+	if tr.all_redeem or not tr.amount:
+		position.units = 0.0
+		position.invested = 0.0
+		return True
+	nav = navs.on(tr.scheme_plan_id, tr.datetime_at_mf.date() if tr.datetime_at_mf else None)
+	if nav and position.units > 0:
+		fraction = min(tr.amount / nav / position.units, 1.0)
+		position.units -= position.units * fraction
+		position.invested -= position.invested * fraction
+	else:
+		position.missing_navs += 1
+		position.invested -= tr.amount
+	clamp(position)
+	return True
+
+
+def restore_redemption(position, tr, navs):
+	'''
+	Inverse of apply_redemption() on a holding that hasn't changed since- units redeemed are added back
+	and amount invested goes up in the same proportion. Units of an all_redeem, or of a holding the
+	redemption emptied, aren't known any more, so those are counted in missing_navs
+	'''
+	nav = navs.on(tr.scheme_plan_id, tr.datetime_at_mf.date() if tr.datetime_at_mf else None)
+	if tr.all_redeem or not tr.amount:
+		position.missing_navs += 1
+	elif nav and position.units > 0:
+		units = tr.amount / nav
+		position.invested += position.invested * units / position.units
+		position.units += units
+	elif nav:
+		position.missing_navs += 1
+	else:
+		position.missing_navs -= 1
+		position.invested += tr.amount
+	return True
+
+
+def clamp(position):
+	if position.units < UNITS_TOLERANCE:
+		position.units = 0.0
+	if position.invested < AMOUNT_TOLERANCE:
+		position.invested = 0.0
+
+
+def apply(position, tr, old_status, old_inst_done, navs):
+	'''
+	Applies the move of transaction tr to position. Returns True if position changed
+	'''
+	if tr.transaction_type == 'R':
+		changed = apply_redemption(position, tr, old_status, navs)
+	else:
+		changed = apply_purchase(position, tr, old_status, old_inst_done, navs)
+	if changed:
+		position.num_transactions += 1
+		position.last_transaction_id = tr.id
+	return changed
+
+
+def affects_ledger(tr, old_status, old_inst_done):
+	return (
+		tr.status != old_status and (tr.status in HELD_STATUS + (REVERSED_STATUS,) or old_status in HELD_STATUS)
+	) or (tr.status in HELD_STATUS and (tr.sip_num_inst_done or 0) != (old_inst_done or 0))
+
+
+################ INCREMENTAL
+
+def record(tr, old_status, old_inst_done=0, navs=None, repo=None):
+	'''
+	Updates the holding of transaction tr after its status changed from old_status or its
+	sip_num_inst_done from old_inst_done. Call right after saving tr, in the same repo.atomic() so that
+	the holding can't be left behind, eg.
+		with repo.atomic():
+			old_status, old_inst_done = tr.status, tr.sip_num_inst_done
+			... change tr ...
+			repo.save_transaction(tr)
+			ledger.record(tr, old_status, old_inst_done, repo=repo)
+	'''
+	if not affects_ledger(tr, old_status, old_inst_done):
+		return None
+	navs = navs or Navs()
+	repo = repo or repository.get()
+	with repo.atomic():
+		## a redemption without a folio is taken from the user's largest folio of the scheme plan
+		holding = repo.holding_for_update(tr)
+		if holding is None:
+			return None
+		if apply(holding, tr, old_status, old_inst_done, navs):
+			repo.save_holding(holding)
+	return holding
+
+
+################ REPLAY
+
+def transaction_rows(queryset=None, chunk=CHUNK):
+	'''
+	Streams transactions as Rows in order of id, one query per chunk
+	Replaying needs django (see rebuild_holdings management command)
+	'''
+	from models.transactions import Transaction
+	if queryset is None:
+		queryset = Transaction.objects.all()
+	last_id = 0
+	while True:
+		rows = list(queryset.filter(id__gt=last_id).order_by('id').values_list(*FIELDS)[:chunk])
+		if not rows:
+			break
+		for values in rows:
+			yield Row(*values)
+		last_id = rows[-1][0]
+
+
+def replay(rows, navs=None):
+	'''
+	Builds positions from transactions in their current state, as if each moved there from '0'
+	Returns dict of (user_id, scheme_plan_id, folio_number) to Position
+	'''
+	navs = navs or Navs()
+	positions = {}
+	by_plan = {}
+	for tr in rows:
+		if not affects_ledger(tr, '0', 0):
+			continue
+		if tr.transaction_type == 'R' and not tr.folio_number:
+			candidates = by_plan.get((tr.user_id, tr.scheme_plan_id))
+			if not candidates:
+				continue
+			position = sorted(candidates, key=lambda p: (-p.units, p.folio_number))[0]
+		else:
+			key = (tr.user_id, tr.scheme_plan_id, tr.folio_number or '')
+			position = positions.get(key)
+			if position is None:
+				position = positions[key] = Position(*key)
+				by_plan.setdefault(key[:2], []).append(position)
+		if tr.transaction_type == 'R' and tr.status == REVERSED_STATUS:
+			## a reversed redemption completed first- both moves are applied, as record() saw them
+			tr.status = '6'
+			apply(position, tr, '0', 0, navs)
+			tr.status = REVERSED_STATUS
+			apply(position, tr, '6', 0, navs)
+		else:
+			apply(position, tr, '0', 0, navs)
+	return positions
+
+
+def rebuild(queryset=None, navs=None):
+	'''
+	Rewrites the Holding table from all transactions. Returns number of rows written
+	'''
+	from django.db import transaction as db_transaction
+	from models.transactions import Holding
+	positions = replay(transaction_rows(queryset), navs)
+	with db_transaction.atomic():
+		Holding.objects.all().delete()
+		Holding.objects.bulk_create([
+			Holding(
+				user_id=p.user_id,
+				scheme_plan_id=p.scheme_plan_id,
+				folio_number=p.folio_number,
+				units=p.units,
+				invested=p.invested,
+				missing_navs=p.missing_navs,
+				num_transactions=p.num_transactions,
+				last_transaction_id=p.last_transaction_id,
+			)
+			for p in positions.values()
+		], batch_size=500)
+	return len(positions)
+
+
+def check(queryset=None, navs=None):
+	'''
+	Compares the Holding table with a replay of all transactions
+	Returns list of (key, expected Position or None, actual (units, invested) or None) that differ
+	'''
+	from models.transactions import Holding
+	positions = replay(transaction_rows(queryset), navs)
+	mismatches = []
+	seen = set()
+	for user_id, plan_id, folio, units, invested in Holding.objects.values_list(
+		'user_id', 'scheme_plan_id', 'folio_number', 'units', 'invested').iterator():
+		key = (user_id, plan_id, folio)
+		seen.add(key)
+		expected = positions.get(key)
+		if expected is None:
+			if units or invested:
+				mismatches.append((key, None, (units, invested)))
+		elif abs(expected.units - units) > UNITS_TOLERANCE or abs(expected.invested - invested) > AMOUNT_TOLERANCE:
+			mismatches.append((key, expected, (units, invested)))
+	for key, expected in positions.items():
+		if key not in seen and (expected.units or expected.invested):
+			mismatches.append((key, expected, None))
+	return mismatches
@@ -0,0 +1,37 @@
+'''
+Author: utkarshohm
+Description: export tables of the models and rules of BSE order records to the schema file read by the
+    sqlite and sql backends of repository.py. Re-run whenever those models change
+    Usage: python manage.py export_repository_schema   (writes settings.REPOSITORY_SCHEMA)
+'''
+
+import json
+import os
+
+from django.core.management.base import BaseCommand
+
+import repository
+import settings
+
+
+class Command(BaseCommand):
+    help = 'Export tables and order validation rules for repository backends that run without django'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--output',
+            dest='output',
+            default=None,
+            help='Path of the schema file, defaults to settings.REPOSITORY_SCHEMA',
+        )
+
+    def handle(self, *args, **options):
+        path = options.get('output') or settings.REPOSITORY_SCHEMA
+        schema = repository.export_schema()
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(path, 'w') as f:
+            json.dump(schema, f, indent=1, sort_keys=True)
+        self.stdout.write('Exported %d tables and %d order validators to %s' % (
+            len(schema['tables']), len(schema['validators']), path))
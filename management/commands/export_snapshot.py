@@ -0,0 +1,38 @@
+'''
+Author: utkarshohm
+Description: publish the snapshot of the market calendar and scheme plans that worker processes map
+    (see snapshot.py). It is only rewritten if the calendar file or scheme plans changed since the last one,
+    so this can be run as often as plans are updated, eg. after loading the scheme master
+'''
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+import settings
+import snapshot
+
+
+class Command(BaseCommand):
+    help = 'Publish the snapshot of market calendar and scheme plans shared by worker processes'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--output',
+            dest='output',
+            default=None,
+            help='File to write the snapshot to, settings.SNAPSHOT_FILE by default',
+        )
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            dest='force',
+            default=False,
+            help='Write the snapshot even if the calendar and plans have not changed',
+        )
+
+    def handle(self, *args, **options):
+        path = options.get('output') or settings.SNAPSHOT_FILE
+        if not path:
+            raise CommandError('Set settings.SNAPSHOT_FILE or pass --output')
+        version = snapshot.publish(path, force=options.get('force'))
+        self.stdout.write('Snapshot %s published to %s' % (version, path))
@@ -0,0 +1,45 @@
+'''
+Author: utkarshohm
+Description: Import nav and index time series from mongo documents (FundTimeSeries, IndexTimeSeries)
+    into the columnar time series store. Safe to re-run- every series is rewritten from its document
+'''
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from models.graphs import FundTimeSeries, IndexTimeSeries
+import timeseries
+
+
+class Command(BaseCommand):
+    help = 'Import FundTimeSeries and IndexTimeSeries documents into the columnar time series store'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--root',
+            dest='root',
+            default=None,
+            help='Directory of the store, defaults to settings.TIMESERIES_DIR',
+        )
+        parser.add_argument(
+            '--scheme',
+            dest='scheme_ids',
+            type=int,
+            action='append',
+            default=None,
+            help='Import only this scheme_id (can be repeated); indices are skipped',
+        )
+
+    def handle(self, *args, **options):
+        root = options.get('root')
+        scheme_ids = options.get('scheme_ids')
+
+        docs = FundTimeSeries.objects.all()
+        if scheme_ids:
+            docs = docs.filter(scheme_id__in=scheme_ids)
+        count = timeseries.import_fund_time_series(timeseries.fund_store(root), docs)
+        self.stdout.write('Imported %d fund time series' % count)
+
+        if not scheme_ids:
+            count = timeseries.import_index_time_series(timeseries.index_store(root))
+            self.stdout.write('Imported %d index time series' % count)
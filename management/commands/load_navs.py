@@ -0,0 +1,47 @@
+'''
+Author: utkarshohm
+Description: load the daily nav file published by AMFI into the time series store and set nav_latest
+    of all scheme plans. Safe to re-run on the same file
+    Usage: python manage.py load_navs NAVAll.txt   or   curl <nav file url> | python manage.py load_navs -
+'''
+
+import sys
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from navs import ingest_navs, open_nav_file
+import metrics
+import timeseries
+
+
+class Command(BaseCommand):
+    help = 'Load daily navs from an AMFI nav file (or stdin) and update nav_latest of scheme plans'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'path',
+            help='Path of the nav file, - to read from stdin',
+        )
+        parser.add_argument(
+            '--root',
+            dest='root',
+            default=None,
+            help='Directory of the time series store, defaults to settings.TIMESERIES_DIR',
+        )
+
+    def handle(self, *args, **options):
+        try:
+            nav_file = open_nav_file(options['path'])
+        except IOError as e:
+            raise CommandError('Cannot read nav file: %s' % e)
+        try:
+            counts = ingest_navs(nav_file, timeseries.fund_store(options.get('root')))
+            self.stdout.write(
+                'Read %(rows)d navs, %(unmatched)d not matched to a scheme plan; '
+                'appended %(appended)d points and updated %(updated)d scheme plans' % counts
+            )
+        finally:
+            if nav_file is not sys.stdin:
+                nav_file.close()
+            metrics.flush()
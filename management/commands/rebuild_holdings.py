@@ -0,0 +1,40 @@
+'''
+Author: utkarshohm
+Description: rebuild the Holding table by replaying all transactions, or with --check only report
+    holdings that differ from a replay. Holdings are otherwise kept up to date by ledger.record()
+    as transaction status is updated
+'''
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+import ledger
+
+
+class Command(BaseCommand):
+    help = 'Rebuild holdings of all users from transactions, or check them with --check'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check',
+            action='store_true',
+            dest='check',
+            default=False,
+            help='Only compare holdings with a replay of transactions and print differences',
+        )
+
+    def handle(self, *args, **options):
+        if options.get('check'):
+            mismatches = ledger.check()
+            for key, expected, actual in mismatches:
+                self.stdout.write('user %s scheme plan %s folio %r: expected %s, found %s' % (
+                    key[0], key[1], key[2],
+                    '(%.4f units, %.2f invested)' % (expected.units, expected.invested) if expected else 'nothing',
+                    '(%.4f units, %.2f invested)' % actual if actual else 'nothing',
+                ))
+            if mismatches:
+                raise CommandError('%d holdings are inconsistent with transactions' % len(mismatches))
+            self.stdout.write('Holdings are consistent with transactions')
+        else:
+            count = ledger.rebuild()
+            self.stdout.write('Rebuilt %d holdings' % count)
@@ -0,0 +1,64 @@
+'''
+Author: utkarshohm
+Description: reconcile transactions with order status and allotment files of BSE and RTAs (see reconcile.py)
+    Files are read in the order given, so give allotment statements after order status files of the same days
+    Usage: python manage.py reconcile_order_reports OrderStatus.csv Allotment.txt --report diff.csv
+'''
+
+import sys
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+import metrics
+import reconcile
+
+
+class Command(BaseCommand):
+    help = 'Update status, folio and date of transactions from order status and allotment files'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'paths',
+            nargs='+',
+            help='Paths of the files, - to read one from stdin',
+        )
+        parser.add_argument(
+            '--report',
+            dest='report',
+            default=None,
+            help='Write rows that differ from their transaction, and what became of them, to this csv file',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            dest='dry_run',
+            default=False,
+            help='Only report differences, dont save them',
+        )
+
+    def handle(self, *args, **options):
+        files = []
+        report_file, report = None, None
+        try:
+            try:
+                for path in options['paths']:
+                    files.append(reconcile.open_report_file(path))
+                if options.get('report'):
+                    report_file, report = reconcile.open_report(options['report'])
+            except IOError as e:
+                raise CommandError('Cannot open file: %s' % e)
+            counts = reconcile.reconcile(files, report=report, dry_run=options.get('dry_run'))
+            self.stdout.write(
+                'Read %(rows)d rows, %(unmatched)d not matched to a transaction being tracked, %(unchanged)d '
+                'unchanged and %(mismatch)d unchanged but with another folio or date; applied %(applied)d, '
+                '%(stale)d changed meanwhile, %(invalid)d with an unknown status, %(partial)d of redemptions '
+                'across folios waiting for their other orders, %(dry_run)d not applied in a dry run' % counts
+            )
+        finally:
+            for f in files:
+                if f is not sys.stdin:
+                    f.close()
+            if report_file is not None:
+                report_file.close()
+            metrics.flush()
@@ -0,0 +1,33 @@
+'''
+Author: utkarshohm
+Description: run the tracker daemon (tracker.py) that keeps transaction status up to date- it replaces
+    running update_transaction_status with cron. Stop it with SIGTERM or Ctrl-C
+'''
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+import tracker
+
+
+class Command(BaseCommand):
+    help = 'Keep status of transactions up to date by polling BSEStar api and crawling its web portal'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--no-crawl',
+            action='store_false',
+            dest='crawl',
+            default=True,
+            help='Only poll payment status, dont crawl order status from the web portal',
+        )
+        parser.add_argument(
+            '--crawl-now',
+            action='store_true',
+            dest='crawl_now',
+            default=False,
+            help='Crawl order status at start instead of at the next crawl time',
+        )
+
+    def handle(self, *args, **options):
+        tracker.Tracker(crawl=options.get('crawl'), crawl_now=options.get('crawl_now')).run()
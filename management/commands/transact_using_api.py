@@ -11,10 +11,21 @@ from datetime import date
 from models.transactions import Transaction
 from models.users import KycDetail, BankDetail
 import api
+import metrics
+import profiling
 
 
 class Command(BaseCommand):
     help = 'Transact on BSEStar using its api'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--profile',
+            action='store_true',
+            dest='profile',
+            default=None,
+            help='Write a profiling report of this run to settings.PROFILE_DIR',
+        )
     
     def create_dummy_user(self, user_id):
         kyc, created = KycDetail.objects.get_or_create(
@@ -103,6 +114,18 @@ class Command(BaseCommand):
 
 
     def handle(self, *args, **options):
+        profiler = profiling.start('transact_using_api', options.get('profile'))
+        try:
+            self.transact(profiler)
+        finally:
+            # export latency and error metrics of this run
+            metrics.flush()
+            report = profiler.write_report()
+            if report:
+                self.stdout.write('Profile written to %s' % report)
+
+
+    def transact(self, profiler):
 
         # set up values
         ## id for Info table in models.users
@@ -112,17 +135,27 @@ class Command(BaseCommand):
         amount = 1000
 
         # user api 
-        self.create_dummy_user(user_id)
-        api.create_user_bse(user_id)
+        with profiler.phase('create_user'):
+            self.create_dummy_user(user_id)
+            api.create_user_bse(user_id)
 
         # create transaction api
-        transaction = self.create_dummy_invest(user_id, scheme_id, amount)
-        api.create_transaction_bse(transaction)
-        api.get_payment_link_bse(user_id, transaction.id)
+        with profiler.phase('create_transaction'):
+            transaction = self.create_dummy_invest(user_id, scheme_id, amount)
+            api.create_transaction_bse(transaction)
+            api.get_payment_link_bse(user_id, transaction.id)
+
+        # create a batch of transactions api, with payment links of their users made in one go
+        with profiler.phase('create_transactions'):
+            transactions = [self.create_dummy_invest(user_id, scheme_id, amount) for i in range(2)]
+            api.create_transactions_bse(transactions)
+            api.get_payment_links_bse(transactions)
 
         # cancel transaction api
-        cancel_transaction_bse(transaction.id)
+        with profiler.phase('cancel_transaction'):
+            cancel_transaction_bse(transaction.id)
 
         # create mandate api
-        create_mandate_bse(user_id, amount)
+        with profiler.phase('create_mandate'):
+            create_mandate_bse(user_id, amount)
 
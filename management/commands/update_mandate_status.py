@@ -0,0 +1,24 @@
+'''
+Author: utkarshohm
+Description: update status of mandates awaiting acceptance by BSE and the bank by crawling BSEStar web portal
+    (bsestarmf.in), and mark accepted mandates used up by SIPs exhausted (see mandates.py)
+    It should be run once a day by a cron job if the tracker daemon (run_tracker) isn't running, which does it
+    after every crawl of order status
+'''
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from web import crawl_to_update_mandate_status
+import metrics
+
+
+class Command(BaseCommand):
+    help = 'Update status of mandates by crawling the BSEStar web portal'
+
+    def handle(self, *args, **options):
+        try:
+            crawl_to_update_mandate_status()
+        finally:
+            # export latency and error metrics of this run
+            metrics.flush()
@@ -0,0 +1,22 @@
+'''
+Author: utkarshohm
+Description: update return_till_date and return_date of all completed transactions in bulk.
+    Should be run daily after navs of the day are loaded
+'''
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from returns import update_transaction_returns
+import metrics
+
+
+class Command(BaseCommand):
+    help = 'Update returns of all completed transactions using navs in the time series store'
+
+    def handle(self, *args, **options):
+        try:
+            updated = update_transaction_returns()
+            self.stdout.write('Updated returns of %d transactions' % updated)
+        finally:
+            metrics.flush()
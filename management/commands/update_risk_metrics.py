@@ -0,0 +1,43 @@
+'''
+Author: utkarshohm
+Description: write monthly risk and return snapshots (SchemePlanHistory) of all scheme plans and
+    update avg/min/max_return of SchemePlan and BenchmarkIndex. Should be run monthly after navs
+    and index values of the month are loaded
+'''
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from risk import update_risk_snapshots, WINDOWS
+import metrics
+
+
+class Command(BaseCommand):
+    help = 'Compute rolling risk and return statistics of all scheme plans and snapshot them in SchemePlanHistory'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--full',
+            action='store_true',
+            dest='full',
+            default=False,
+            help='Fill every month missing a snapshot instead of only months after the latest snapshot',
+        )
+        parser.add_argument(
+            '--years',
+            dest='years',
+            type=int,
+            choices=WINDOWS,
+            default=None,
+            help='Window of risk measures in years, defaults to settings.RISK_WINDOW_YEARS',
+        )
+
+    def handle(self, *args, **options):
+        try:
+            created = update_risk_snapshots(
+                incremental=not options.get('full'),
+                years=options.get('years'),
+            )
+            self.stdout.write('Created %d scheme plan snapshots' % created)
+        finally:
+            metrics.flush()
@@ -8,39 +8,49 @@ Description: update status of all transactions that need a status update (i.e. n
 from django.core.management.base import BaseCommand
 from django.core.management.base import CommandError
 
-from models.transactions import Transaction
-
 from web import crawl_to_update_transaction_status
-from api import get_payment_status_bse
+import metrics
+import profiling
+import tracking
 
 
 class Command(BaseCommand):
     help = 'Update status of transactions using BSEStar api and by crawling its web portal'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--profile',
+            action='store_true',
+            dest='profile',
+            default=None,
+            help='Write a profiling report of this run to settings.PROFILE_DIR',
+        )
+
     def update_payment_status(self):
         '''
-        Updates payment status of all transactions whose payment status is not updated internally
-        Uses api.get_payment_status_bse() as BSEStar offers API endpoint for this
+        Updates payment status of transactions awaiting payment that are due a check (see schedule.py)
+        Uses BSEStar's API endpoint for this, see tracking.check_payments()
         '''
-        tr_list = Transaction.objects.filter(
-                order_type='1',
-                status__in=('2','4'),
-            )
-        status_list = []
-        for tr in tr_list:
-            try:
-                status_list.append(get_payment_status_bse(tr.user_id, tr.id))
-            except:
-                status_list.append('-1')
+        tracking.check_payments()
         
         ## this is a good place to put in a slack alert
 
 
     def handle(self, *args, **options):
         
-        # Update payment stautus of transactions with pending payment using api
-        self.update_payment_status()
-        
-        # Update transaction status of transactions by crawling web
-        crawl_to_update_transaction_status()
+        profiler = profiling.start('update_transaction_status', options.get('profile'))
+        try:
+            # Update payment stautus of transactions with pending payment using api
+            with profiler.phase('payment_status'):
+                self.update_payment_status()
+            
+            # Update transaction status of transactions by crawling web
+            with profiler.phase('crawl'):
+                crawl_to_update_transaction_status()
+        finally:
+            # export latency and error metrics of this run
+            metrics.flush()
+            report = profiler.write_report()
+            if report:
+                self.stdout.write('Profile written to %s' % report)
 
@@ -0,0 +1,104 @@
+'''
+Author: utkarshohm
+Description: Lifecycle of mandates after api.soap_create_mandate registers them (status '2')- the user
+	submits the signed form ('3'), BSE receives it ('4') and the bank accepts ('5') or rejects it ('6').
+	BSEStar's api doesn't tell status of a mandate, so it is read from the mandate report of the web portal
+	(see web.update_mandate_status); this module says which mandates need a check, what statuses of the
+	report mean and how they update mandates, and doesn't need a browser
+	- mandates awaiting acceptance are checked together, from one report, skipping those checked less than
+		settings.MANDATE_CHECK_INTERVAL seconds ago
+	- accepted mandates whose amount is used up by live SIPs paid with them are marked exhausted ('7'), and
+		accepted again once SIPs using them end, from one query of SIP amounts of all of them
+	Updates are made only if status of a mandate is still the one read, so trackers checking it at the
+	same time don't undo each other. With several tracker daemons each checks mandates of its shards
+'''
+
+import datetime
+
+import settings
+import metrics
+import repository
+
+
+## status column of BSEStar's mandate report to Mandate status
+STATUS_BY_TEXT = {
+	'REGISTERED BY MEMBER': '2',
+	'SCAN IMAGE UPLOADED': '3',
+	'RECEIVED BY BSE': '4',
+	'UNDER PROCESSING': '4',
+	'SENT TO BANK': '4',
+	'APPROVED': '5',
+	'ACCEPTED': '5',
+	'REJECTED': '6',
+	'CANCELLED': '1',
+}
+
+## statuses that BSE or the bank may still change
+PENDING = ('2', '3', '4')
+ACCEPTED = '5'
+EXHAUSTED = '7'
+
+
+def mandate_status_code(text):
+	'''
+	Mandate status of a status shown by the mandate report, None if it isn't known
+	'''
+	return STATUS_BY_TEXT.get(text.strip().upper())
+
+
+def mandates_to_check(now=None, repo=None, shards=None):
+	'''
+	Mandates awaiting acceptance not checked in the last settings.MANDATE_CHECK_INTERVAL seconds, of users
+	in shards if given. now is naive UTC
+	'''
+	now = now or datetime.datetime.utcnow()
+	repo = repo or repository.get()
+	checked_before = now - datetime.timedelta(seconds=settings.MANDATE_CHECK_INTERVAL)
+	return repo.mandates_to_track(PENDING, checked_before, shards)
+
+
+def save_mandate_statuses(mandate_list, statuses, repo=None, now=None):
+	'''
+	Saves statuses found in the mandate report (dict of mandate id to status text) of mandates of
+	mandates_to_check() and marks all of them checked. Returns number of mandates whose status changed
+	'''
+	repo = repo or repository.get()
+	now = now or datetime.datetime.utcnow()
+	changed = 0
+	for mandate in mandate_list:
+		text = statuses.get(str(mandate.id))
+		if text is None:
+			metrics.incr('mandate_checks', status='not_found')
+			continue
+		status = mandate_status_code(text)
+		if status is None:
+			print('Unknown status %r of mandate %s' % (text, mandate.id))
+			metrics.incr('mandate_checks', status='unknown')
+		elif status == mandate.status:
+			metrics.incr('mandate_checks', status='unchanged')
+		elif repo.update_mandate_status(mandate.id, mandate.status, status):
+			metrics.incr('mandate_checks', status=status)
+			changed += 1
+		else:
+			## updated meanwhile by another check
+			metrics.incr('mandate_checks', status='stale')
+	repo.mark_mandates_checked([mandate.id for mandate in mandate_list], now)
+	return changed
+
+
+def mark_exhausted(repo=None, shards=None):
+	'''
+	Marks accepted mandates whose amount is used up by live SIPs paid with them exhausted, and exhausted
+	ones with room again accepted, of users in shards if given. Returns number of mandates changed
+	'''
+	repo = repo or repository.get()
+	mandate_list = repo.mandates_to_track((ACCEPTED, EXHAUSTED), shards=shards)
+	used = repo.sip_amounts_on_mandates([mandate.id for mandate in mandate_list])
+	changed = 0
+	for mandate in mandate_list:
+		exhausted = mandate.amount is not None and (used.get(str(mandate.id)) or 0) >= mandate.amount
+		status = EXHAUSTED if exhausted else ACCEPTED
+		if status != mandate.status and repo.update_mandate_status(mandate.id, mandate.status, status):
+			metrics.incr('mandate_checks', status=status)
+			changed += 1
+	return changed
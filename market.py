@@ -0,0 +1,83 @@
+'''
+Author: utkarshohm
+Description: Calendar of days BSE is open for mutual fund transactions, read once per process from
+	settings.MARKET_DATES_FILE (one dd/mm/yy date per line). Only uses the standard library so that
+	deciding when an order is placed doesn't import the crawler
+	Workers of a pool read it from the snapshot their parent published if settings.SNAPSHOT_FILE is set
+	(see snapshot.py)
+'''
+
+import bisect
+import datetime
+import threading
+
+import settings
+import snapshot
+
+
+## orders placed at or after this hour are placed on the next market day
+CUTOFF_HOUR = 15
+
+## the calendar and CUTOFF_HOUR are in IST, which has no daylight saving
+IST_OFFSET = datetime.timedelta(hours=5, minutes=30)
+
+_cache = {'dates': None}
+_lock = threading.Lock()
+
+
+def load_dates(path=None):
+	'''
+	Returns sorted list of market dates in the file
+	'''
+	with open(path or settings.MARKET_DATES_FILE, 'r') as f:
+		return sorted(
+			datetime.datetime.strptime(line.strip(), '%d/%m/%y').date()
+			for line in f if line.strip()
+		)
+
+
+def dates():
+	'''
+	Market dates, read on first use
+	'''
+	if settings.SNAPSHOT_FILE:
+		mapped = snapshot.current()
+		if mapped is not None:
+			return mapped.dates
+	if _cache['dates'] is None:
+		with _lock:
+			if _cache['dates'] is None:
+				_cache['dates'] = load_dates()
+	return _cache['dates']
+
+
+def next_market_date(d):
+	'''
+	First market date on or after date d, None if the calendar ends before
+	'''
+	days = dates()
+	i = bisect.bisect_left(days, d)
+	return days[i] if i < len(days) else None
+
+
+def is_market_date(d):
+	return next_market_date(d) == d
+
+
+def now_ist():
+	'''
+	Current datetime in IST, naive
+	'''
+	return datetime.datetime.utcnow() + IST_OFFSET
+
+
+def calculate_order_date(order_dt):
+	'''
+	Checks if BSE was open for MF transactions at the datetime when order was placed (order_dt)
+	If it was not, then which is the next date when market was open and order would get placed
+	Uses CUTOFF_HOUR (1500 hours) as cut off time when BSE closes for MF transactions
+	Returns False if no such date is in the calendar
+	'''
+	if order_dt.hour >= CUTOFF_HOUR:
+		order_dt += datetime.timedelta(days=1)
+	return next_market_date(order_dt.date()) or False
@@ -0,0 +1,298 @@
+'''
+Author: utkarshohm
+Description: Lightweight latency and outcome instrumentation for api.py and web.py.
+	Timers and counters are kept in process memory, cost a couple of microseconds each
+	and can be exported in Prometheus text format, sent as StatsD lines, or printed as a
+	per-run summary at the end of a management command
+'''
+
+import bisect
+import functools
+import re
+import socket
+import threading
+import time
+
+import settings
+
+
+## upper bounds (in seconds) of latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+## error codes are part of every exception message raised by api.py eg. "BSE error 641: ..."
+ERROR_CODE_REGEX = re.compile(r'error (\d{3})')
+
+
+class Timer(object):
+	'''
+	Latency statistics of one timer- count, sum, min, max and histogram buckets
+	'''
+	__slots__ = ('count', 'total', 'min', 'max', 'buckets')
+
+	def __init__(self):
+		self.count = 0
+		self.total = 0.0
+		self.min = None
+		self.max = 0.0
+		self.buckets = [0] * (len(BUCKETS) + 1)
+
+	def observe(self, seconds):
+		self.count += 1
+		self.total += seconds
+		if self.min is None or seconds < self.min:
+			self.min = seconds
+		if seconds > self.max:
+			self.max = seconds
+		## last bucket is for values above the largest bound
+		self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+
+
+class Registry(object):
+	'''
+	Holds all timers and counters of a process, keyed by name and sorted label pairs
+	'''
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.timers = {}
+		self.counters = {}
+		self.started = time.time()
+
+	def observe(self, name, seconds, labels):
+		key = (name, labels)
+		with self.lock:
+			timer = self.timers.get(key)
+			if timer is None:
+				timer = self.timers[key] = Timer()
+			timer.observe(seconds)
+
+	def incr(self, name, labels, value=1):
+		key = (name, labels)
+		with self.lock:
+			self.counters[key] = self.counters.get(key, 0) + value
+
+	def reset(self):
+		with self.lock:
+			self.timers = {}
+			self.counters = {}
+			self.started = time.time()
+
+
+REGISTRY = Registry()
+
+
+################ INSTRUMENTATION - used by api.py and web.py
+
+def enabled():
+	return settings.METRICS_ENABLED
+
+
+def error_code(exc):
+	'''
+	Returns BSE/internal error code of an exception, else its class name
+	'''
+	code = getattr(exc, 'code', None)
+	if code:
+		return str(code)
+	match = ERROR_CODE_REGEX.search(str(exc))
+	if match:
+		return match.group(1)
+	return type(exc).__name__
+
+
+def labels_of(**labels):
+	return tuple(sorted(labels.items()))
+
+
+def incr(name, value=1, **labels):
+	'''
+	Increments counter name with labels
+	'''
+	if enabled():
+		REGISTRY.incr(name, labels_of(**labels), value)
+
+
+class timer(object):
+	'''
+	Context manager that records the duration of its block as timer name with labels
+	and counts its outcome in <name>_total with result ok or error and the error code
+	eg. with metrics.timer('crawler', stage='login'):
+	'''
+	__slots__ = ('name', 'labels', 'started')
+
+	def __init__(self, name, **labels):
+		self.name = name
+		self.labels = labels
+
+	def __enter__(self):
+		self.started = time.time()
+		return self
+
+	def __exit__(self, exc_type, exc, tb):
+		if not enabled():
+			return False
+		elapsed = time.time() - self.started
+		labels = labels_of(**self.labels)
+		REGISTRY.observe(self.name, elapsed, labels)
+		if exc_type is None:
+			REGISTRY.incr(self.name + '_total', tuple(sorted(labels + (('result', 'ok'),))))
+		else:
+			REGISTRY.incr(
+				self.name + '_total',
+				tuple(sorted(labels + (('code', error_code(exc)), ('result', 'error')))),
+			)
+		return False
+
+
+def timed(name, **labels):
+	'''
+	Decorator version of timer() that labels the timer with the decorated function's name
+	eg. @metrics.timed('soap') on soap_post_order records soap{function="soap_post_order"}
+	'''
+	def decorator(func):
+		func_labels = dict(labels, function=func.__name__)
+
+		@functools.wraps(func)
+		def wrapper(*args, **kwargs):
+			with timer(name, **func_labels):
+				return func(*args, **kwargs)
+		return wrapper
+	return decorator
+
+
+################ EXPORT
+
+def format_labels(labels, extra=()):
+	pairs = list(labels) + list(extra)
+	if not pairs:
+		return ''
+	return '{%s}' % ','.join(
+		'%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs
+	)
+
+
+def export_prometheus(registry=REGISTRY):
+	'''
+	Returns all metrics in Prometheus text exposition format
+	Timers are exported as histograms in seconds and counters as counters
+	'''
+	prefix = settings.METRICS_PREFIX
+	with registry.lock:
+		timers = sorted((k, (t.count, t.total, list(t.buckets))) for k, t in registry.timers.items())
+		counters = sorted(registry.counters.items())
+
+	lines = []
+	last_name = None
+	for (name, labels), (count, total, buckets) in timers:
+		metric = '%s_%s_seconds' % (prefix, name)
+		if metric != last_name:
+			lines.append('# TYPE %s histogram' % metric)
+			last_name = metric
+		cumulative = 0
+		for bound, n in zip(BUCKETS, buckets):
+			cumulative += n
+			lines.append('%s_bucket%s %d' % (metric, format_labels(labels, [('le', repr(bound))]), cumulative))
+		lines.append('%s_bucket%s %d' % (metric, format_labels(labels, [('le', '+Inf')]), count))
+		lines.append('%s_sum%s %f' % (metric, format_labels(labels), total))
+		lines.append('%s_count%s %d' % (metric, format_labels(labels), count))
+	for (name, labels), value in counters:
+		metric = '%s_%s' % (prefix, name)
+		if metric != last_name:
+			lines.append('# TYPE %s counter' % metric)
+			last_name = metric
+		lines.append('%s%s %d' % (metric, format_labels(labels), value))
+	return '\n'.join(lines) + '\n'
+
+
+def export_statsd(registry=REGISTRY):
+	'''
+	Returns all metrics as StatsD lines with labels folded into the metric name
+	Timers are sent as mean latency gauges in ms along with their count, counters as counts
+	'''
+	prefix = settings.METRICS_PREFIX
+	with registry.lock:
+		timers = sorted((k, (t.count, t.total)) for k, t in registry.timers.items())
+		counters = sorted(registry.counters.items())
+
+	lines = []
+	for (name, labels), (count, total) in timers:
+		metric = '.'.join([prefix, name] + ['%s_%s' % (k, v) for k, v in labels])
+		lines.append('%s.mean_ms:%f|g' % (metric, total * 1000.0 / count if count else 0))
+		lines.append('%s.count:%d|c' % (metric, count))
+	for (name, labels), value in counters:
+		metric = '.'.join([prefix, name] + ['%s_%s' % (k, v) for k, v in labels])
+		lines.append('%s:%d|c' % (metric, value))
+	return lines
+
+
+def send_statsd(host=None, port=None, registry=REGISTRY):
+	'''
+	Sends all metrics to a StatsD daemon over UDP, batching lines into datagrams
+	'''
+	host = host or settings.METRICS_STATSD_HOST
+	port = port or settings.METRICS_STATSD_PORT
+	if not host:
+		return
+	sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	try:
+		packet = []
+		size = 0
+		for line in export_statsd(registry):
+			if size + len(line) + 1 > 1400 and packet:
+				sock.sendto('\n'.join(packet).encode('utf-8'), (host, port))
+				packet = []
+				size = 0
+			packet.append(line)
+			size += len(line) + 1
+		if packet:
+			sock.sendto('\n'.join(packet).encode('utf-8'), (host, port))
+	finally:
+		sock.close()
+
+
+def summary(registry=REGISTRY):
+	'''
+	Returns a human readable per-run summary, slowest (by total time) first
+	'''
+	with registry.lock:
+		timers = [(k, t.count, t.total, t.min or 0.0, t.max) for k, t in registry.timers.items()]
+		counters = sorted(registry.counters.items())
+	timers.sort(key=lambda x: -x[2])
+
+	lines = ['Run time: %.1fs' % (time.time() - registry.started)]
+	lines.append('%-60s %8s %10s %10s %10s' % ('timer', 'count', 'total s', 'mean ms', 'max ms'))
+	for (name, labels), count, total, tmin, tmax in timers:
+		lines.append('%-60s %8d %10.3f %10.1f %10.1f' % (
+			name + format_labels(labels), count, total, total * 1000.0 / count, tmax * 1000.0
+		))
+	errors = [(k, v) for k, v in counters if ('result', 'error') in k[1]]
+	if errors:
+		lines.append('errors:')
+		for (name, labels), value in errors:
+			lines.append('  %-58s %8d' % (name + format_labels(labels), value))
+	return '\n'.join(lines)
+
+
+def write_prometheus(path, registry=REGISTRY):
+	'''
+	Writes metrics for node_exporter's textfile collector; rename makes the write atomic
+	'''
+	import os
+	tmp_path = path + '.tmp'
+	with open(tmp_path, 'w') as f:
+		f.write(export_prometheus(registry))
+	os.rename(tmp_path, path)
+
+
+def flush(registry=REGISTRY):
+	'''
+	Exports metrics to whatever is configured in settings. Called at end of every run
+	'''
+	if not enabled():
+		return
+	if settings.METRICS_STATSD_HOST:
+		send_statsd(registry=registry)
+	if settings.METRICS_PROMETHEUS_FILE:
+		write_prometheus(settings.METRICS_PROMETHEUS_FILE, registry)
+	if settings.METRICS_SUMMARY:
+		print(summary(registry))
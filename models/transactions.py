@@ -74,6 +74,9 @@ class Transaction(models.Model):
 	## datetime when order was placed on bsestar
 	datetime_at_mf = models.DateTimeField(auto_now=False, auto_now_add=False, blank=True, null=True)	#datetime of purchase of units on mf
 	created = models.DateTimeField(auto_now_add=True)
+	## when the tracker daemon (tracker.py) checks payment status of this transaction next, in UTC
+	## null means on its next poll
+	next_check_at = models.DateTimeField(blank=True, null=True)
 	
 	# set these fields after the transaction is successfully PLACED
 	## this is the trans_no of the order on bsestar
@@ -289,6 +292,56 @@ class PaymentLinkBSE(models.Model):
 		on_delete=models.PROTECT,
 		related_name='paymentlinks',
 		related_query_name='paymentlink')
+	## a link returns to the payment page of this transaction; null for links made before links were kept per transaction
+	transaction = models.ForeignKey(Transaction,
+		on_delete=models.PROTECT,
+		null=True,
+		related_name='paymentlinks',
+		related_query_name='paymentlink')
 	link = models.CharField(max_length=1000, blank=False)
 	created = models.DateTimeField(auto_now_add=True)
 
+
+
+# Materialized holdings
+class Holding(models.Model):
+	'''
+	Units and amount invested that a user holds in a folio of a scheme plan
+	Maintained by ledger.py on every status change of a Transaction to or from 6/7/8 and on every
+		SIP instalment, so that holdings don't need to be derived by replaying all transactions
+	- Units are amount / nav on the date of purchase or redemption. Flows whose nav is not in the
+		time series store yet are counted in missing_navs and don't add units
+	'''
+	user = models.ForeignKey(Info,
+		on_delete=models.PROTECT,
+		related_name='holdings',
+		related_query_name='holding')
+	scheme_plan = models.ForeignKey(SchemePlan,
+		on_delete=models.PROTECT,
+		related_name='holdings',
+		related_query_name='holding')
+	folio_number = models.CharField(max_length=25, blank=True)
+
+	units = models.FloatField(default=0)
+	invested = models.FloatField(default=0)
+	missing_navs = models.IntegerField(default=0)
+	num_transactions = models.IntegerField(default=0)
+	last_transaction = models.ForeignKey(Transaction,
+		on_delete=models.SET_NULL,
+		null=True,
+		related_name='+')
+	updated = models.DateTimeField(auto_now=True)
+
+	class Meta:
+		unique_together = ("user", "scheme_plan", "folio_number")
+
+
+# Leases of tracker daemons
+class TrackerLease(models.Model):
+	'''
+	A shard of transactions ('shard:<n>') or a membership slot ('node:<n>') held by a tracker daemon
+	till expires_at (see leases.py). owner is blank when it is free
+	'''
+	name = models.CharField(max_length=50, unique=True)
+	owner = models.CharField(max_length=100, blank=True)
+	expires_at = models.DateTimeField(blank=True, null=True)
@@ -152,7 +152,7 @@ class Mandate(models.Model):
 	'''
 	Stores mandates registered in BSE for user
 	Written as per BSEStar API documentation for mandate creation endpoint
-	Entry created in table only after calling endpoint
+	Entry created in table only after calling endpoint; its status is kept up to date by mandates.py
 	'''
 	user = models.ForeignKey(Info, on_delete=models.PROTECT, related_name='mandate',  related_query_name="mandate")
 	bank = models.ForeignKey(BankDetail, on_delete=models.PROTECT, related_name='mandate',  related_query_name="mandate")
@@ -174,4 +174,6 @@ class Mandate(models.Model):
 	
 	updated = models.DateTimeField(auto_now=True, auto_now_add=False)
 	created = models.DateTimeField(auto_now_add=True)
+	## when status was last read from BSEStar's mandate report (see mandates.py), in UTC
+	checked_at = models.DateTimeField(blank=True, null=True)
 
@@ -0,0 +1,216 @@
+'''
+Author: utkarshohm
+Description: Daily nav ingestion. Reads the daily nav text file published by AMFI (semicolon separated,
+	with a header line and scheme category / fund house lines in between), maps every row to a SchemePlan
+	through the scheme cache's isin, amc_code and rta_code, appends new points to the columnar time
+	series store and sets nav_latest/nav_latest_date of all plans with a few batched UPDATE queries.
+	Rows already loaded are skipped, so re-running on the same file changes nothing
+'''
+
+import sys
+
+import numpy as np
+from django.db.models import Case, When, Value, FloatField
+
+from models.funds import SchemePlan
+import metrics
+import schemes
+import timeseries
+
+
+## rows per UPDATE query when setting nav_latest
+UPDATE_BATCH = 500
+
+## column names in the header line of the nav file; files of some days have repurchase and sale price
+## columns before date, so columns are looked up by name
+COL_CODE = 'Scheme Code'
+COL_ISIN = 'ISIN Div Payout/ ISIN Growth'
+COL_ISIN_REINVEST = 'ISIN Div Reinvestment'
+COL_NAME = 'Scheme Name'
+COL_NAV = 'Net Asset Value'
+COL_DATE = 'Date'
+
+DEFAULT_HEADER = [COL_CODE, COL_ISIN, COL_ISIN_REINVEST, COL_NAME, COL_NAV, COL_DATE]
+
+
+class NavRow(object):
+	__slots__ = ('code', 'isins', 'name', 'nav', 'day')
+
+	def __init__(self, code, isins, name, nav, day):
+		self.code = code
+		self.isins = isins
+		self.name = name
+		self.nav = nav
+		self.day = day
+
+
+################ PARSING
+
+def parse_nav_file(lines):
+	'''
+	Yields a NavRow for every scheme row of a nav file given as an iterable of lines
+	Category and fund house lines, blank lines and rows without a nav (N.A.) are skipped
+	'''
+	columns = dict((name, i) for i, name in enumerate(DEFAULT_HEADER))
+	dates = {}
+	for line in lines:
+		if isinstance(line, bytes) and not isinstance(line, str):
+			line = line.decode('utf-8', 'replace')
+		line = line.strip()
+		if ';' not in line:
+			continue
+		parts = [p.strip() for p in line.split(';')]
+		if parts[0] == COL_CODE:
+			columns = dict((name.replace('/ISIN', '/ ISIN'), i) for i, name in enumerate(parts))
+			continue
+		try:
+			nav = float(parts[columns[COL_NAV]].replace(',', ''))
+			date_str = parts[columns[COL_DATE]]
+		except (ValueError, IndexError):
+			continue
+		if nav <= 0:
+			continue
+		## thousands of rows share a handful of dates
+		day = dates.get(date_str)
+		if day is None:
+			try:
+				day = dates[date_str] = timeseries.to_days(date_str)
+			except ValueError:
+				continue
+		isins = tuple(
+			parts[columns[col]] for col in (COL_ISIN, COL_ISIN_REINVEST)
+			if len(parts[columns[col]]) == 12
+		)
+		yield NavRow(parts[columns[COL_CODE]], isins, parts[columns[COL_NAME]], nav, day)
+
+
+################ MAPPING
+
+class PlanIndex(object):
+	'''
+	Maps isin, amc_code and rta_code to SchemePlan id, built from the scheme cache
+	A row is matched by isin first, then by its (AMFI) scheme code as amc_code and as rta_code
+	'''
+
+	def __init__(self, rows=None):
+		if rows is None:
+			rows = [(r.id, r.isin, r.amc_code, r.rta_code) for r in schemes.cache().records()]
+		self.by_isin = {}
+		self.by_amc_code = {}
+		self.by_rta_code = {}
+		for plan_id, isin, amc_code, rta_code in rows:
+			if isin:
+				self.by_isin[isin.strip().upper()] = plan_id
+			if amc_code:
+				self.by_amc_code[amc_code.strip()] = plan_id
+			if rta_code:
+				self.by_rta_code[rta_code.strip()] = plan_id
+
+	def lookup(self, row):
+		for isin in row.isins:
+			plan_id = self.by_isin.get(isin.upper())
+			if plan_id is not None:
+				return plan_id
+		return self.by_amc_code.get(row.code) or self.by_rta_code.get(row.code)
+
+
+################ LOADING
+
+def group_navs(rows, index):
+	'''
+	Groups rows by matched plan
+	Returns (dict of plan id to (days, navs) arrays, number of rows, number of rows not matched)
+	'''
+	points = {}
+	count = 0
+	unmatched = 0
+	for row in rows:
+		count += 1
+		plan_id = index.lookup(row)
+		if plan_id is None:
+			unmatched += 1
+			continue
+		days, navs = points.setdefault(plan_id, ([], []))
+		days.append(row.day)
+		navs.append(row.nav)
+	for plan_id, (days, navs) in points.items():
+		points[plan_id] = (np.array(days, dtype=np.int64), np.array(navs, dtype=np.float64))
+	return points, count, unmatched
+
+
+def latest_navs(points):
+	'''
+	Returns (plan ids, days, navs) arrays with the latest nav of every plan in points
+	'''
+	plan_ids = np.array(sorted(points), dtype=np.int64)
+	latest = [np.argmax(points[p][0]) for p in plan_ids]
+	days = np.array([points[p][0][i] for p, i in zip(plan_ids, latest)], dtype=np.int64)
+	navs = np.array([points[p][1][i] for p, i in zip(plan_ids, latest)], dtype=np.float64)
+	return plan_ids, days, navs
+
+
+def append_navs(points, store):
+	'''
+	Appends navs of every plan to its series; points not newer than the series' last one are ignored
+	Returns number of points appended
+	'''
+	appended = 0
+	for plan_id, (days, navs) in points.items():
+		appended += store.append(int(plan_id), days, navs)
+	return appended
+
+
+def save_latest_navs(plan_ids, days, navs, batch=UPDATE_BATCH):
+	'''
+	Sets nav_latest and nav_latest_date of plans whose nav_latest_date is older than the new nav
+	One UPDATE per batch per nav date. Returns number of plans updated
+	'''
+	updated = 0
+	for day in np.unique(days):
+		same_day = days == day
+		ids = plan_ids[same_day]
+		values = navs[same_day]
+		nav_date = timeseries.from_days(day)
+		for start in range(0, len(ids), batch):
+			chunk_ids = [int(i) for i in ids[start:start + batch]]
+			chunk_navs = [float(v) for v in values[start:start + batch]]
+			stale = SchemePlan.objects.filter(id__in=chunk_ids).exclude(nav_latest_date__gte=nav_date)
+			updated += stale.update(
+				nav_latest=Case(
+					*[When(id=i, then=Value(v)) for i, v in zip(chunk_ids, chunk_navs)],
+					output_field=FloatField()
+				),
+				nav_latest_date=nav_date,
+			)
+	return updated
+
+
+def ingest_navs(lines, store=None, index=None):
+	'''
+	Loads a nav file given as an iterable of lines. Returns dict of counts-
+	rows read, rows not matched to a plan, points appended to the store and plans updated
+	'''
+	store = store or timeseries.fund_store()
+	with metrics.timer('navs', stage='index'):
+		index = index or PlanIndex()
+	with metrics.timer('navs', stage='parse'):
+		points, count, unmatched = group_navs(parse_nav_file(lines), index)
+	with metrics.timer('navs', stage='append'):
+		appended = append_navs(points, store)
+	with metrics.timer('navs', stage='save'):
+		updated = save_latest_navs(*latest_navs(points))
+	return {
+		'rows': count,
+		'unmatched': unmatched,
+		'appended': appended,
+		'updated': updated,
+	}
+
+
+def open_nav_file(path):
+	'''
+	Returns lines of the nav file at path, or of stdin if path is '-'
+	'''
+	if path == '-':
+		return sys.stdin
+	return open(path, 'rb')
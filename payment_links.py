@@ -0,0 +1,196 @@
+'''
+Author: utkarshohm
+Description: Payment links of transactions, made once and reused, so that checkout pages asking for a link
+	on every refresh needn't each log in to BSEStar and make another
+	- links are kept by (client code, transaction id): a link returns the client to the payment page of the
+		transaction it was made for (see api.soap_create_payment), and it pays the orders the client has
+		awaiting payment when it is made, so a link is never handed out for another transaction
+	- a link is made only after the order of its transaction is placed (see api.get_payment_links_bse)
+	- a link is reused for settings.PAYMENT_LINK_TTL seconds after it was made. It is kept in the process and
+		other processes find it in PaymentLinkBSE, so a row is saved only when BSEStar makes a link
+	- requests for a link while it is being made wait for that call instead of making their own
+	- prepare() makes links of many transactions with one login, eg. right after a batch of orders is
+		placed, so that their checkout pages find them ready
+'''
+
+import collections
+import datetime
+import threading
+
+import settings
+from errors import RejectionError
+import lazy
+import metrics
+import repository
+
+api = lazy.module('api')
+
+
+class Call(object):
+	'''
+	Making of a transaction's link; requests for the same link wait for its result
+	'''
+
+	def __init__(self):
+		self.done = threading.Event()
+		self.link = None
+		self.error = None
+
+	def result(self):
+		self.done.wait()
+		if self.error is not None:
+			raise self.error
+		return self.link
+
+
+class PaymentLinks(object):
+	'''
+	Live links by (client code, transaction id) and the links being made
+	'''
+
+	def __init__(self, ttl=None, repo=None):
+		self.ttl = datetime.timedelta(seconds=settings.PAYMENT_LINK_TTL if ttl is None else ttl)
+		self.repo = repo
+		self.links = {}
+		self.calls = {}
+		self.lock = threading.Lock()
+
+	def claim(self, key, now):
+		'''
+		Returns ('link', live link) of a (client code, transaction id) key, or ('wait', Call) if another
+		request is making it, or ('make', Call) registered for the caller to make it and finish()
+		'''
+		with self.lock:
+			entry = self.links.get(key)
+			if entry is not None and entry[1] > now:
+				return 'link', entry[0]
+			call = self.calls.get(key)
+			if call is not None:
+				return 'wait', call
+			call = self.calls[key] = Call()
+			return 'make', call
+
+	def finish(self, key, call, link=None, expires_at=None, error=None):
+		with self.lock:
+			if link is not None:
+				self.links[key] = (link, expires_at)
+			del self.calls[key]
+		call.link = link
+		call.error = error
+		call.done.set()
+
+	def stored(self, key, now):
+		'''
+		(link, expiry) of a live link another process made, None if there is none
+		'''
+		client_code, transaction_id = key
+		record = (self.repo or repository.get()).payment_link(client_code, transaction_id, now - self.ttl)
+		if record is None:
+			return None
+		return record.link, repository.db_value(record.created) + self.ttl
+
+	def login(self):
+		client = api.init_soap_client(api.WSDL_UPLOAD_URL[settings.LIVE])
+		api.set_soap_logging()
+		return client, api.soap_get_password_upload(client)
+
+	def get(self, client_code, transaction_id):
+		'''
+		Live payment link of a transaction of a client, made by BSEStar if there is none
+		'''
+		client_code = str(client_code)
+		key = (client_code, int(transaction_id))
+		now = datetime.datetime.utcnow()
+		kind, value = self.claim(key, now)
+		if kind == 'link':
+			metrics.incr('payment_links', event='cached')
+			return value
+		elif kind == 'wait':
+			metrics.incr('payment_links', event='coalesced')
+			return value.result()
+
+		call = value
+		try:
+			stored = self.stored(key, now)
+			if stored is not None:
+				metrics.incr('payment_links', event='stored')
+				link, expires_at = stored
+			else:
+				client, pass_dict = self.login()
+				link = api.soap_create_payment(client, client_code, transaction_id, pass_dict)
+				expires_at = now + self.ttl
+				(self.repo or repository.get()).save_payment_link(client_code, key[1], link)
+				metrics.incr('payment_links', event='made')
+		except Exception as e:
+			self.finish(key, call, error=e)
+			raise
+		self.finish(key, call, link, expires_at)
+		return link
+
+	def prepare(self, transactions):
+		'''
+		Makes links of (client code, transaction id) pairs that have no live link, with one login and
+		saving them in one go. A transaction whose link BSEStar refused is left out
+		Returns dict of transaction id to live link
+		'''
+		now = datetime.datetime.utcnow()
+		links = {}
+		waiting = {}
+		mine = collections.OrderedDict()
+		for client_code, transaction_id in transactions:
+			key = (str(client_code), int(transaction_id))
+			if key in links or key in waiting or key in mine:
+				continue
+			kind, value = self.claim(key, now)
+			if kind == 'link':
+				links[key] = value
+			elif kind == 'wait':
+				waiting[key] = value
+			else:
+				mine[key] = value
+
+		made = []
+		try:
+			for key, call in list(mine.items()):
+				stored = self.stored(key, now)
+				if stored is not None:
+					links[key] = stored[0]
+					self.finish(key, call, *stored)
+					del mine[key]
+			if mine:
+				client, pass_dict = self.login()
+			for key, call in list(mine.items()):
+				client_code, transaction_id = key
+				try:
+					link = api.soap_create_payment(client, client_code, transaction_id, pass_dict)
+				except RejectionError as e:
+					print('Error in payment link of transaction %s of client %s: %s' % (transaction_id, client_code, e))
+					metrics.incr('payment_links', event='error')
+					self.finish(key, call, error=e)
+					del mine[key]
+					continue
+				made.append((client_code, transaction_id, link))
+				links[key] = link
+				self.finish(key, call, link, now + self.ttl)
+				del mine[key]
+		except Exception as e:
+			## the rest fail with the error that stopped the batch, eg. BSEStar being down
+			for key, call in mine.items():
+				self.finish(key, call, error=e)
+			raise
+		finally:
+			if made:
+				(self.repo or repository.get()).save_payment_links(made)
+				metrics.incr('payment_links', len(made), event='made')
+
+		for key, call in waiting.items():
+			try:
+				links[key] = call.result()
+			except Exception:
+				## reported by the request that made it
+				pass
+		return dict((transaction_id, link) for (client_code, transaction_id), link in links.items())
+
+
+## process level links
+LINKS = PaymentLinks()
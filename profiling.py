@@ -0,0 +1,243 @@
+'''
+Author: utkarshohm
+Description: Opt-in profiling of management command runs. Every run is split into phases and
+	for each phase it captures cProfile stats, count and time of sql queries (with the most
+	repeated query shapes to catch N+1 queries) and peak memory from tracemalloc- or, on python 2, the
+	peak resident memory of the process so far from getrusage. A report is written per run so that runs
+	can be compared over time
+'''
+
+import cProfile
+import datetime
+import json
+import os
+import pstats
+import re
+import sys
+import time
+
+try:
+	from StringIO import StringIO
+except ImportError:
+	from io import StringIO
+
+## tracemalloc is only available from python 3.4 onwards
+try:
+	import tracemalloc
+except ImportError:
+	tracemalloc = None
+
+## resource is not available on windows
+try:
+	import resource
+except ImportError:
+	resource = None
+
+import settings
+
+
+## number of rows printed from cProfile stats and from repeated sql queries per phase
+TOP_FUNCTIONS = 30
+TOP_QUERIES = 10
+
+## literals in sql are replaced to group queries that differ only in parameters
+SQL_LITERAL_REGEX = re.compile(r"'(?:[^']|'')*'|\b\d+\b")
+
+
+def max_rss():
+	'''
+	Peak resident memory of the process so far in bytes, None if it can't be found
+	ru_maxrss is in kilobytes on linux and in bytes on mac os
+	'''
+	if resource is None:
+		return None
+	rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def start(name, enabled=None):
+	'''
+	Returns a profiler for a run of command name
+	Profiling is on if enabled is True, or if enabled is None and settings.PROFILE_COMMANDS is set
+	'''
+	if enabled is None:
+		enabled = settings.PROFILE_COMMANDS
+	if enabled:
+		return RunProfiler(name, settings.PROFILE_DIR)
+	return NullProfiler()
+
+
+class NullProfiler(object):
+	'''
+	Used when profiling is off so that commands don't need to check for it
+	'''
+	def phase(self, name):
+		return NullPhase()
+
+	def write_report(self):
+		return None
+
+
+class NullPhase(object):
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc, tb):
+		return False
+
+
+class RunProfiler(object):
+	'''
+	Collects phase profiles of one run and writes them as a report
+	'''
+
+	def __init__(self, name, report_dir):
+		self.name = name
+		self.report_dir = report_dir
+		self.started = datetime.datetime.now()
+		self.phases = []
+
+	def phase(self, name):
+		return Phase(self, name)
+
+	def write_report(self):
+		'''
+		Writes <name>-<timestamp>.txt (readable report), .json (numbers to compare runs) and
+		one .prof file per phase (for snakeviz, pstats etc) in report_dir
+		Returns path of the text report
+		'''
+		if not os.path.isdir(self.report_dir):
+			os.makedirs(self.report_dir)
+		base = os.path.join(self.report_dir, '%s-%s' % (self.name, self.started.strftime('%Y%m%d-%H%M%S')))
+
+		summary = {'command': self.name, 'started': self.started.isoformat(), 'phases': []}
+		lines = ['Profile of %s started at %s' % (self.name, self.started.isoformat()), '']
+		for phase in self.phases:
+			summary['phases'].append(phase.summary())
+			lines.extend(phase.report_lines())
+			if phase.profile is not None:
+				phase.profile.dump_stats('%s-%s.prof' % (base, phase.name))
+
+		with open(base + '.json', 'w') as f:
+			json.dump(summary, f, indent=2, sort_keys=True)
+		with open(base + '.txt', 'w') as f:
+			f.write('\n'.join(lines) + '\n')
+		return base + '.txt'
+
+
+class Phase(object):
+	'''
+	Context manager that profiles one phase of a run
+	'''
+
+	def __init__(self, run, name):
+		self.run = run
+		self.name = name
+		self.profile = None
+		self.duration = 0.0
+		self.queries = []
+		self.memory_peak = None
+		self.error = None
+
+	def __enter__(self):
+		self.sql_start()
+		if tracemalloc is not None:
+			self.tracing = tracemalloc.is_tracing()
+			if self.tracing:
+				tracemalloc.stop()
+			tracemalloc.start()
+		self.profile = cProfile.Profile()
+		self.started = time.time()
+		self.profile.enable()
+		return self
+
+	def __exit__(self, exc_type, exc, tb):
+		self.profile.disable()
+		self.duration = time.time() - self.started
+		if tracemalloc is not None:
+			self.memory_peak = tracemalloc.get_traced_memory()[1]
+			tracemalloc.stop()
+			if self.tracing:
+				tracemalloc.start()
+		else:
+			## of the whole process, not just this phase
+			self.memory_peak = max_rss()
+		self.queries = self.sql_stop()
+		if exc_type is not None:
+			self.error = repr(exc)
+		self.run.phases.append(self)
+		return False
+
+	def sql_start(self):
+		'''
+		Forces django to log queries of this phase even if DEBUG is off
+		'''
+		self.connections = []
+		try:
+			from django.db import connections
+		except ImportError:
+			return
+		for connection in connections.all():
+			self.connections.append((connection, connection.force_debug_cursor))
+			connection.force_debug_cursor = True
+			connection.queries_log.clear()
+
+	def sql_stop(self):
+		queries = []
+		for connection, force_debug_cursor in self.connections:
+			queries.extend(connection.queries_log)
+			connection.queries_log.clear()
+			connection.force_debug_cursor = force_debug_cursor
+		return queries
+
+	def sql_time(self):
+		return sum(float(q.get('time') or 0) for q in self.queries)
+
+	def repeated_queries(self):
+		'''
+		Returns (count, total time, query shape) sorted by count, for shapes run more than once
+		'''
+		shapes = {}
+		for q in self.queries:
+			shape = SQL_LITERAL_REGEX.sub('?', q['sql'])
+			count, total = shapes.get(shape, (0, 0.0))
+			shapes[shape] = (count + 1, total + float(q.get('time') or 0))
+		repeated = [(count, total, shape) for shape, (count, total) in shapes.items() if count > 1]
+		repeated.sort(reverse=True)
+		return repeated
+
+	def summary(self):
+		return {
+			'phase': self.name,
+			'duration_s': round(self.duration, 3),
+			'sql_count': len(self.queries),
+			'sql_time_s': round(self.sql_time(), 3),
+			'sql_repeated': [
+				{'count': count, 'time_s': round(total, 3), 'sql': shape}
+				for count, total, shape in self.repeated_queries()[:TOP_QUERIES]
+			],
+			'memory_peak_bytes': self.memory_peak,
+			'error': self.error,
+		}
+
+	def report_lines(self):
+		lines = [
+			'=' * 80,
+			'Phase %s: %.3fs' % (self.name, self.duration),
+			'SQL: %d queries in %.3fs' % (len(self.queries), self.sql_time()),
+		]
+		if self.memory_peak is not None:
+			lines.append('Peak memory: %.1f MB%s' % (
+				self.memory_peak / 1024.0 / 1024.0, '' if tracemalloc is not None else ' (of process)'))
+		if self.error:
+			lines.append('Failed with: %s' % self.error)
+		repeated = self.repeated_queries()[:TOP_QUERIES]
+		if repeated:
+			lines.append('Most repeated queries:')
+			for count, total, shape in repeated:
+				lines.append('  %6d x %8.3fs  %s' % (count, total, shape[:200]))
+		stream = StringIO()
+		stats = pstats.Stats(self.profile, stream=stream)
+		stats.sort_stats('cumulative').print_stats(TOP_FUNCTIONS)
+		lines.append(stream.getvalue())
+		return lines
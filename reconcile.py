@@ -0,0 +1,358 @@
+'''
+Author: utkarshohm
+Description: Reconciliation of transactions with the order status and allotment files BSE and RTAs publish,
+	besides crawling the order status report of the web portal (see web.update_order_status)
+	Files are comma or pipe separated with a header line, and columns are found by name (see
+	settings.RECONCILE_COLUMNS). A file without a status column is an allotment statement- each of its
+	rows is an allotment. Files are read in one pass, a row at a time- only the index of order ids of
+	transactions being tracked and one batch of matched rows are held in memory- so files of millions of
+	rows can be reconciled
+	- rows are matched to transactions by order id, of a lumpsum order or of the current SIP instalment
+	- status, folio and date of rows that change a transaction are saved as the crawler's are (see
+		tracking.save_order_statuses), settings.RECONCILE_BATCH rows at a time; if files have several rows
+		of an order, the last one read wins
+	- once a SIP instalment is saved, completed or failed, later rows of its order are about that
+		instalment, not the next one, so they are not applied again
+	- a redemption across folios, placed as one order per folio, is updated once rows of all its orders are
+		read, from all of them (see tracking.combined_status)
+	- the diff report lists every matched row that differs from its transaction- in status, or in folio or
+		allotment date from those the transaction already has- and what became of it
+'''
+
+import collections
+import csv
+import datetime
+import io
+import itertools
+import sys
+
+import settings
+from errors import InternalError
+import metrics
+import repository
+import tracking
+
+
+## statuses (see tracking.STATUS_BY_TEXT) a row can set
+STATUSES = ('1', '5', '6', '-1')
+## status of rows of allotment statements
+ALLOTTED = '6'
+
+REPORT_HEADER = ['order_id', 'transaction_id', 'status', 'file_status', 'folio', 'date', 'differs', 'result']
+
+
+class ReportRow(object):
+	__slots__ = ('order_id', 'status', 'text', 'folio', 'date')
+
+	def __init__(self, order_id, status, text, folio, date):
+		self.order_id = order_id
+		self.status = status
+		self.text = text
+		self.folio = folio
+		self.date = date
+
+
+################ PARSING
+
+def open_report_file(path):
+	'''
+	Returns lines of the file at path, or of stdin if path is '-', as the csv module reads them
+	'''
+	if path == '-':
+		return sys.stdin
+	if sys.version_info[0] < 3:
+		return open(path, 'rb')
+	return io.open(path, 'r', encoding='utf-8', errors='replace', newline='')
+
+
+def header_columns(header):
+	'''
+	Position of each column of settings.RECONCILE_COLUMNS in header, None for those it doesn't have
+	'''
+	names = [name.strip().lower() for name in header]
+	columns = {}
+	for column, aliases in settings.RECONCILE_COLUMNS.items():
+		positions = [names.index(alias.lower()) for alias in aliases if alias.lower() in names]
+		columns[column] = positions[0] if positions else None
+	return columns
+
+
+def parse_date(value):
+	value = value.strip().split(' ')[0]
+	for date_format in settings.RECONCILE_DATE_FORMATS:
+		try:
+			return datetime.datetime.strptime(value, date_format).date()
+		except ValueError:
+			pass
+	return None
+
+
+def parse_report_file(lines):
+	'''
+	Yields a ReportRow for every row with an order id of a file given as an iterable of lines
+	'''
+	lines = iter(lines)
+	for header in lines:
+		if header.strip():
+			break
+	else:
+		return
+	reader = csv.reader(itertools.chain([header], lines), delimiter='|' if '|' in header else ',')
+	columns = header_columns(next(reader))
+	if columns['order_id'] is None:
+		raise InternalError(
+			683, "No order id column in header %r" % header.strip()
+		)
+
+	def field(fields, column):
+		i = columns[column]
+		return fields[i].strip() if i is not None and i < len(fields) else ''
+
+	## thousands of rows share a handful of dates
+	dates = {}
+	for fields in reader:
+		order_id = field(fields, 'order_id')
+		if not order_id:
+			continue
+		if columns['status'] is None:
+			text, status = '', ALLOTTED
+		else:
+			text = field(fields, 'status')
+			status = tracking.order_status_code(text.upper())
+		date_str = field(fields, 'date')
+		date = dates.get(date_str)
+		if date is None and date_str:
+			date = dates[date_str] = parse_date(date_str)
+		yield ReportRow(order_id, status, text, field(fields, 'folio'), date)
+
+
+################ MATCHING
+
+class OrderIndex(object):
+	'''
+	Maps order ids of transactions being tracked- due a check or not- to [transaction id, its state(), its
+	next check if status doesn't change, order date, its folio and allotment date], from
+	tracking.orders_to_check. Orders of a transaction placed as several orders (a redemption across folios)
+	share the entry, and the last status read of each is kept, as the transaction is updated from all of
+	them (see tracking.combined_status); their folios differ, so aren't compared
+	'''
+
+	def __init__(self, date_dict_list=None, repo=None, today=None, now=None):
+		if date_dict_list is None:
+			date_dict_list = tracking.orders_to_check(today, repo, now, due_only=False)
+		self.orders = {}
+		## order ids of transactions placed as several orders, and last status read of each
+		self.legs = {}
+		self.statuses = {}
+		## order ids of SIP instalments saved in this run
+		self.retired = set()
+		entries = {}
+		for date_dict in date_dict_list:
+			for i in range(len(date_dict['ids'])):
+				transaction_id = date_dict['ids'][i]
+				order_id = str(date_dict['order_ids'][i])
+				if transaction_id not in entries:
+					entries[transaction_id] = [
+						transaction_id, date_dict['state'][i], date_dict['next_check_at'][i], date_dict['date'],
+						date_dict['folio_number'][i], date_dict['date_at_mf'][i],
+					]
+				self.orders[order_id] = entries[transaction_id]
+				self.legs.setdefault(transaction_id, []).append(order_id)
+		self.legs = dict((transaction_id, legs) for transaction_id, legs in self.legs.items() if len(legs) > 1)
+		for transaction_id in self.legs:
+			entries[transaction_id][4] = ''
+
+	def __len__(self):
+		return len(self.orders)
+
+	def lookup(self, order_id):
+		return self.orders.get(order_id)
+
+	def read(self, order_id, status):
+		'''
+		Keeps status of a row of order_id if its transaction was placed as several orders. Returns its entry
+		'''
+		entry = self.orders[order_id]
+		if entry[0] in self.legs:
+			self.statuses[order_id] = status
+		return entry
+
+	def retire(self, order_id):
+		'''
+		Stops matching rows of order_id, a SIP instalment that was saved
+		'''
+		self.orders.pop(order_id, None)
+		self.retired.add(order_id)
+
+
+def instalment_order_id(tr):
+	'''
+	Order id of the current instalment of SIP transaction tr, None if it hasn't been placed
+	'''
+	order_ids = [order_id for order_id in tr.sip_order_ids.split(',') if order_id]
+	return order_ids[tr.sip_num_inst_done] if len(order_ids) > tr.sip_num_inst_done else None
+
+
+def changes(entry, row):
+	'''
+	Whether row changes the transaction of index entry- for a SIP in instalments (status '6'), whether it
+	tells that the instalment completed or failed
+	'''
+	status = entry[1][0]
+	if status == '6':
+		return row.status in ('6', '1', '-1')
+	return row.status != status
+
+
+def differences(entry, row):
+	'''
+	Fields of the transaction of index entry that row has a different value of- its folio and allotment date,
+	where both have one
+	'''
+	fields = []
+	if row.folio and entry[4] and row.folio != entry[4]:
+		fields.append('folio_number')
+	if row.date and entry[5] and row.date != entry[5]:
+		fields.append('datetime_at_mf')
+	return fields
+
+
+################ RECONCILING
+
+def open_report(path):
+	'''
+	Returns (file, csv writer) of a diff report at path with its header written
+	'''
+	if sys.version_info[0] < 3:
+		f = open(path, 'wb')
+	else:
+		f = io.open(path, 'w', encoding='utf-8', newline='')
+	writer = csv.writer(f)
+	writer.writerow(REPORT_HEADER)
+	return f, writer
+
+
+def reconcile(files, repo=None, report=None, index=None, today=None, now=None, batch=None, dry_run=False):
+	'''
+	Reconciles transactions with order status and allotment files, each given as an iterable of lines
+	report is a csv writer of the diff report (see open_report), or None. With dry_run nothing is saved
+	Returns dict of counts- rows read, rows not matched to a transaction, matched rows that don't change
+	it (or are of a SIP instalment already saved), mismatch (those that don't, but whose folio or date
+	differ from the transaction's), rows applied, stale (the transaction changed meanwhile), invalid (status
+	not understood), partial (of a transaction placed as several orders, not all of which were read) and
+	dry_run (rows that would be applied)
+	'''
+	repo = repo or repository.get()
+	now = now or datetime.datetime.utcnow()
+	batch = batch or settings.RECONCILE_BATCH
+	with metrics.timer('reconcile', stage='index'):
+		index = index or OrderIndex(repo=repo, today=today, now=now)
+	counts = dict.fromkeys(
+		('rows', 'unmatched', 'unchanged', 'mismatch', 'applied', 'stale', 'invalid', 'partial', 'dry_run'), 0)
+	pending = collections.OrderedDict()
+	for lines in files:
+		for row in parse_report_file(lines):
+			counts['rows'] += 1
+			entry = index.lookup(row.order_id)
+			if entry is None and row.order_id in index.retired:
+				counts['unchanged'] += 1
+			elif entry is None:
+				counts['unmatched'] += 1
+			elif row.status not in STATUSES:
+				counts['invalid'] += 1
+				write_report(report, row, entry, 'invalid')
+			elif not changes(index.read(row.order_id, row.status), row):
+				if differences(entry, row):
+					counts['mismatch'] += 1
+					write_report(report, row, entry, 'mismatch')
+				else:
+					counts['unchanged'] += 1
+			else:
+				## a later row of the order replaces one not saved yet
+				pending.pop(row.order_id, None)
+				pending[row.order_id] = row
+				if len(pending) >= batch:
+					save(pending, index, repo, report, counts, now, dry_run)
+	save(pending, index, repo, report, counts, now, dry_run)
+	for result, count in counts.items():
+		metrics.incr('reconcile_rows', count, result=result)
+	return counts
+
+
+def save(pending, index, repo, report, counts, now, dry_run):
+	'''
+	Saves statuses of the rows pending, grouped by order date, and empties it
+	'''
+	if not pending:
+		return
+	date_dicts = collections.OrderedDict()
+	## transactions placed as several orders, added once with all their orders, and those some orders of
+	## which were not read yet
+	added = set()
+	partial = set()
+	for order_id, row in pending.items():
+		transaction_id, state, next_check_at, order_d = index.lookup(order_id)[:4]
+		legs = index.legs.get(transaction_id)
+		if legs is None:
+			statuses = [(order_id, row.status)]
+		elif transaction_id in added:
+			continue
+		else:
+			added.add(transaction_id)
+			statuses = [(leg, index.statuses.get(leg, '0')) for leg in legs]
+			if tracking.combined_status([status for leg, status in statuses]) == '0':
+				partial.add(transaction_id)
+				continue
+		order_d = row.date or order_d
+		date_dict = date_dicts.get(order_d)
+		if date_dict is None:
+			date_dict = date_dicts[order_d] = {
+				'date': order_d, 'ids': [], 'state': [], 'order_ids': [], 'next_check_at': [], 'status': [], 'folio': [],
+			}
+		for leg, status in statuses:
+			date_dict['ids'].append(transaction_id)
+			date_dict['state'].append(state)
+			date_dict['order_ids'].append(leg)
+			date_dict['next_check_at'].append(next_check_at)
+			date_dict['status'].append(status)
+			date_dict['folio'].append(row.folio)
+
+	saved = {}
+	if not dry_run:
+		with metrics.timer('reconcile', stage='save'):
+			saved = dict((tr.id, tr) for tr in tracking.save_order_statuses(list(date_dicts.values()), repo, now=now))
+	for order_id, row in pending.items():
+		entry = index.lookup(order_id)
+		differs = differences(entry, row)
+		if entry[0] in partial:
+			result = 'partial'
+		elif dry_run:
+			result = 'dry_run'
+		elif entry[0] in saved:
+			result = 'applied'
+		else:
+			result = 'stale'
+		write_report(report, row, entry, result, differs)
+		counts[result] += 1
+		## a later row of the order is compared with the transaction as saved
+		tr = saved.get(entry[0])
+		if tr is not None:
+			entry[1] = tracking.state(tr)
+			if entry[0] not in index.legs:
+				entry[4] = tr.folio_number or ''
+			if tr.order_type == '1' and tr.datetime_at_mf:
+				entry[5] = tr.datetime_at_mf.date()
+			if tr.order_type == '2' and instalment_order_id(tr) != order_id:
+				index.retire(order_id)
+	pending.clear()
+
+
+def write_report(report, row, entry, result, differs=None):
+	if report is None:
+		return
+	if differs is None:
+		differs = differences(entry, row)
+	report.writerow([
+		row.order_id, entry[0], entry[1][0], row.text or row.status, row.folio,
+		row.date.isoformat() if row.date else '', ';'.join(differs), result,
+	])
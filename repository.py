@@ -0,0 +1,1091 @@
+'''
+Author: utkarshohm
+Description: Data access of api.py and web.py- transactions, BSE order records and responses, users,
+	mandates, payment links, scheme plans and holdings- behind one interface with two backends
+	- DjangoRepository uses the django ORM and models, as the management commands do
+	- SQLRepository (and SQLiteRepository) query the same tables over a plain DB-API connection,
+		so a worker that only places orders or tracks status doesn't load django, its settings and apps
+	Tables of the SQL backends and rules of order records are read from a schema file exported once
+	from the django models with the export_repository_schema management command
+	Pick the backend with settings.REPOSITORY_BACKEND; get() returns the process level repository
+'''
+
+import contextlib
+import datetime
+import importlib
+import json
+import threading
+
+import settings
+from errors import InternalError
+
+
+try:
+	string_types = basestring
+except NameError:
+	string_types = str
+
+## most values in one IN (...) of a query; sqlite takes at most 999 parameters
+IN_CHUNK = 500
+
+
+class DoesNotExist(Exception):
+	'''
+	Raised by all backends when a row asked for is not found
+	'''
+	pass
+
+
+class Record(object):
+	'''
+	A row read by an SQL backend (or an order record built from a validator spec), columns as attributes
+	'''
+
+	def __init__(self, **values):
+		self.__dict__.update(values)
+
+	def __repr__(self):
+		return '<Record %s>' % getattr(self, 'id', getattr(self, 'trans_no', ''))
+
+
+class Repository(object):
+	'''
+	Interface of all backends. Transactions and order records are returned as objects of the backend
+	(model instances or Records) and must be saved through the same backend
+	'''
+
+	################ transactions
+
+	def transaction(self, transaction_id, for_update=False):
+		'''
+		for_update locks it till the end of atomic()
+		'''
+		raise NotImplementedError
+
+	def save_transaction(self, transaction):
+		raise NotImplementedError
+
+	def transactions_to_track(self, shards=None):
+		'''
+		Transactions whose order status can still change- placed, paid or SIPs with instalments due
+		In order of creation. Those of users in shards (list of shard numbers, see leases.py) if given
+		'''
+		raise NotImplementedError
+
+	def sips_to_track(self, shards=None):
+		'''
+		SIP transactions that may have an instalment order placed today, of users in shards if given
+		'''
+		raise NotImplementedError
+
+	def sip_amount_on_mandate(self, user_id, mandate_id):
+		'''
+		Sum of instalment amounts of a user's live SIPs paid with a mandate
+		'''
+		raise NotImplementedError
+
+	def payments_due(self, now, limit=None, shards=None):
+		'''
+		Lumpsum transactions awaiting payment whose next_check_at (naive UTC) is at or before now or not set
+		Earliest first, at most limit of them, of users in shards if given
+		'''
+		raise NotImplementedError
+
+	def schedule_checks(self, next_check_at_by_id):
+		'''
+		Sets next_check_at of transactions by id without touching their other fields
+		'''
+		raise NotImplementedError
+
+	################ order records
+
+	def validator(self, name):
+		'''
+		validators.OrderValidator of validators.VALIDATORS whose build() makes order records of this backend
+		'''
+		raise NotImplementedError
+
+	def order_counters(self, order_type, client_codes, today_str):
+		'''
+		(client_code, trans_no) of orders of clients whose trans_no contains today_str
+		order_type is '1' for lumpsum (TransactionBSE) and '2' for XSIP (TransactionXsipBSE)
+		'''
+		raise NotImplementedError
+
+	def insert_order(self, order):
+		raise NotImplementedError
+
+	def insert_orders(self, orders):
+		raise NotImplementedError
+
+	################ responses
+
+	def save_response(self, **fields):
+		'''
+		Saves BSEStar's response to an order entry (TransResponseBSE) and returns it
+		'''
+		raise NotImplementedError
+
+	def order_id(self, trans_no):
+		'''
+		order_id of BSEStar's response to the order entry trans_no
+		'''
+		raise NotImplementedError
+
+	def order_ids(self, trans_nos):
+		'''
+		Dict of trans_no to order_id of BSEStar's responses to order entries trans_nos; those without one are left out
+		'''
+		raise NotImplementedError
+
+	def placed_orders(self, transaction_ids):
+		'''
+		Dict of transaction id to order ids of its lumpsum orders (TransactionBSE) that BSEStar accepted, in the
+		order they were made- more than one of a redemption across folios. Transactions without one are left out
+		'''
+		raise NotImplementedError
+
+	################ users
+
+	def user(self, user_id):
+		raise NotImplementedError
+
+	def kyc(self, user_id):
+		raise NotImplementedError
+
+	def bank(self, user_id):
+		'''
+		Bank detail of a user with ifsc_code of its branch
+		'''
+		raise NotImplementedError
+
+	################ mandates
+
+	def mandates(self, user_id, statuses):
+		raise NotImplementedError
+
+	def create_mandate(self, mandate_id, user_id, bank_id, amount, status):
+		raise NotImplementedError
+
+	def mandates_to_track(self, statuses, checked_before=None, shards=None):
+		'''
+		Mandates in statuses, in order of creation. If checked_before (naive UTC) is given, only those not
+		checked since; if shards are given, only those of users in shards
+		'''
+		raise NotImplementedError
+
+	def sip_amounts_on_mandates(self, mandate_ids):
+		'''
+		Dict of mandate id to sum of instalment amounts of live SIPs paid with it; unused mandates are left out
+		'''
+		raise NotImplementedError
+
+	def update_mandate_status(self, mandate_id, old_status, status):
+		'''
+		Sets status of a mandate if it is still old_status. Returns whether it was set
+		'''
+		raise NotImplementedError
+
+	def mark_mandates_checked(self, mandate_ids, now):
+		'''
+		Sets checked_at of mandates to now (naive UTC) without touching their other fields
+		'''
+		raise NotImplementedError
+
+	################ payment links
+
+	def save_payment_link(self, user_id, transaction_id, link):
+		raise NotImplementedError
+
+	def save_payment_links(self, links):
+		'''
+		Saves (user_id, transaction_id, link) tuples in one go
+		'''
+		raise NotImplementedError
+
+	def payment_link(self, user_id, transaction_id, since):
+		'''
+		Latest payment link of a transaction of a user created at or after since (naive UTC), None if there is none
+		'''
+		raise NotImplementedError
+
+	################ scheme plans and holdings
+
+	def scheme_plans(self, fields, changed_since=None):
+		'''
+		Tuples of fields of all scheme plans, or of those with last_updated >= changed_since
+		'''
+		raise NotImplementedError
+
+	def holding_folios(self, user_ids, plan_ids):
+		'''
+		(user_id, scheme_plan_id, folio_number, units) of holdings with a folio
+		'''
+		raise NotImplementedError
+
+	def purchase_folios(self, user_ids, plan_ids):
+		'''
+		Distinct (user_id, scheme_plan_id, folio_number) of completed purchases with a folio
+		'''
+		raise NotImplementedError
+
+	def atomic(self):
+		'''
+		Context manager running its block in a database transaction
+		'''
+		raise NotImplementedError
+
+	def holding_for_update(self, transaction):
+		'''
+		Locks and returns the holding of a transaction, created if it doesn't exist, in atomic()
+		A redemption without a folio is taken from the user's largest folio of the scheme plan (None if
+		there is none)
+		'''
+		raise NotImplementedError
+
+	def save_holding(self, holding):
+		raise NotImplementedError
+
+	################ tracker leases
+
+	def leases(self):
+		'''
+		All leases of tracker daemons (see leases.py)
+		'''
+		raise NotImplementedError
+
+	def claim_lease(self, name, owner, now, expires_at):
+		'''
+		Makes owner hold lease name till expires_at (naive UTC) if it is free, expired at now or already
+		held by owner; the lease is created if it doesn't exist. Returns whether owner holds it
+		'''
+		raise NotImplementedError
+
+	def release_lease(self, name, owner):
+		'''
+		Frees lease name if owner holds it
+		'''
+		raise NotImplementedError
+
+
+################ DJANGO
+
+class DjangoRepository(Repository):
+	'''
+	Backend on the django ORM. Transactions and order records are model instances
+	'''
+
+	def __init__(self):
+		from django.core.exceptions import ObjectDoesNotExist
+		from django.db import transaction as db_transaction
+		from django.conf import settings as django_settings
+		from django.db.models import Q, Sum
+		from django.utils import timezone
+		from models.funds import SchemePlan
+		from models.transactions import (Transaction, TransactionBSE, TransactionXsipBSE, TransResponseBSE,
+			PaymentLinkBSE, Holding, TrackerLease)
+		from models.users import Info, KycDetail, BankDetail, Mandate
+		self.ObjectDoesNotExist = ObjectDoesNotExist
+		self.db_transaction = db_transaction
+		self.django_settings = django_settings
+		self.timezone = timezone
+		self.Q = Q
+		self.Sum = Sum
+		self.SchemePlan = SchemePlan
+		self.Transaction = Transaction
+		self.orders = {'1': TransactionBSE, '2': TransactionXsipBSE}
+		self.TransResponseBSE = TransResponseBSE
+		self.PaymentLinkBSE = PaymentLinkBSE
+		self.Holding = Holding
+		self.TrackerLease = TrackerLease
+		self.Info = Info
+		self.KycDetail = KycDetail
+		self.BankDetail = BankDetail
+		self.Mandate = Mandate
+
+	def get(self, queryset, **filters):
+		try:
+			return queryset.get(**filters)
+		except self.ObjectDoesNotExist as e:
+			raise DoesNotExist(str(e))
+
+	def aware(self, value):
+		'''
+		Naive UTC datetime of the SQL backends as django expects it when time zone support is on
+		'''
+		if value is not None and self.timezone.is_naive(value) and self.django_settings.USE_TZ:
+			return self.timezone.make_aware(value, self.timezone.utc)
+		return value
+
+	def in_shards(self, queryset, shards):
+		'''
+		Rows (transactions or mandates) of queryset of users in shards, all if shards is None
+		'''
+		if shards is None:
+			return queryset
+		if not shards:
+			return queryset.none()
+		## django has no modulo lookup; %% is % after the backend fills in parameters
+		return queryset.extra(where=['(user_id %%%% %d) IN (%s)' % (
+			settings.TRACKER_SHARDS, ', '.join(str(int(shard)) for shard in shards))])
+
+	def transaction(self, transaction_id, for_update=False):
+		queryset = self.Transaction.objects
+		return self.get(queryset.select_for_update() if for_update else queryset, id=transaction_id)
+
+	def save_transaction(self, transaction):
+		transaction.save()
+
+	def transactions_to_track(self, shards=None):
+		return list(self.in_shards(self.Transaction.objects.filter(
+			self.Q(status__in=('2','4','5')) |
+			self.Q(status='6', order_type='2')
+		), shards).order_by('created'))
+
+	def sips_to_track(self, shards=None):
+		return list(self.in_shards(self.Transaction.objects.filter(
+			order_type='2',
+			status__in=('2','4','5','6'),
+		), shards))
+
+	def sip_amount_on_mandate(self, user_id, mandate_id):
+		return self.Transaction.objects.filter(
+			user_id=user_id,
+			order_type='2',
+			status__in=('2','5','6'),
+			mandate_id=mandate_id,
+		).aggregate(amount=self.Sum('amount'))['amount'] or 0
+
+	def payments_due(self, now, limit=None, shards=None):
+		now = self.aware(now)
+		queryset = self.in_shards(self.Transaction.objects.filter(
+			self.Q(next_check_at__isnull=True) | self.Q(next_check_at__lte=now),
+			order_type='1',
+			status__in=('2','4'),
+		), shards).order_by('next_check_at', 'id')
+		return list(queryset[:limit] if limit else queryset)
+
+	def schedule_checks(self, next_check_at_by_id):
+		with self.db_transaction.atomic():
+			for transaction_id, next_check_at in next_check_at_by_id.items():
+				self.Transaction.objects.filter(id=transaction_id).update(next_check_at=self.aware(next_check_at))
+
+	def validator(self, name):
+		import validators
+		return validators.from_models(name)
+
+	def order_counters(self, order_type, client_codes, today_str):
+		return list(self.orders[order_type].objects.filter(
+			client_code__in=set(str(cc) for cc in client_codes),
+			trans_no__contains=today_str,
+		).values_list('client_code', 'trans_no'))
+
+	def insert_order(self, order):
+		order.save(force_insert=True)
+
+	def insert_orders(self, orders):
+		if orders:
+			type(orders[0]).objects.bulk_create(orders)
+
+	def save_response(self, **fields):
+		response = self.TransResponseBSE(**fields)
+		response.save()
+		return response
+
+	def order_id(self, trans_no):
+		return self.get(self.TransResponseBSE.objects, trans_no=trans_no).order_id
+
+	def order_ids(self, trans_nos):
+		trans_nos = list(trans_nos)
+		order_ids = {}
+		for start in range(0, len(trans_nos), IN_CHUNK):
+			order_ids.update(self.TransResponseBSE.objects.filter(
+				trans_no__in=trans_nos[start:start + IN_CHUNK],
+			).values_list('trans_no', 'order_id'))
+		return order_ids
+
+	def placed_orders(self, transaction_ids):
+		transaction_ids = list(transaction_ids)
+		legs = []
+		for start in range(0, len(transaction_ids), IN_CHUNK):
+			legs.extend(self.orders['1'].objects.filter(
+				internal_transaction_id__in=transaction_ids[start:start + IN_CHUNK],
+			).values_list('created', 'internal_transaction_id', 'trans_no'))
+		## orders of a batch are created together; counters at the end of their trans_no tell them apart
+		legs = [leg[1:] for leg in sorted(legs, key=lambda leg: (leg[0], len(leg[2]), leg[2]))]
+		accepted = {}
+		trans_nos = [trans_no for transaction_id, trans_no in legs]
+		for start in range(0, len(trans_nos), IN_CHUNK):
+			accepted.update(self.TransResponseBSE.objects.filter(
+				trans_no__in=trans_nos[start:start + IN_CHUNK], success_flag='0',
+			).values_list('trans_no', 'order_id'))
+		placed = {}
+		for transaction_id, trans_no in legs:
+			if trans_no in accepted:
+				placed.setdefault(transaction_id, []).append(accepted[trans_no])
+		return placed
+
+	def user(self, user_id):
+		return self.get(self.Info.objects, id=user_id)
+
+	def kyc(self, user_id):
+		return self.get(self.KycDetail.objects, user_id=user_id)
+
+	def bank(self, user_id):
+		bank = self.get(self.BankDetail.objects.select_related('branch'), user_id=user_id)
+		bank.ifsc_code = bank.branch.ifsc_code
+		return bank
+
+	def mandates(self, user_id, statuses):
+		return list(self.Mandate.objects.filter(user_id=user_id, status__in=statuses))
+
+	def create_mandate(self, mandate_id, user_id, bank_id, amount, status):
+		return self.Mandate.objects.create(id=mandate_id, user_id=user_id, bank_id=bank_id, amount=amount, status=status)
+
+	def mandates_to_track(self, statuses, checked_before=None, shards=None):
+		queryset = self.Mandate.objects.filter(status__in=statuses)
+		if checked_before is not None:
+			queryset = queryset.filter(
+				self.Q(checked_at__isnull=True) | self.Q(checked_at__lte=self.aware(checked_before)))
+		return list(self.in_shards(queryset, shards).order_by('created'))
+
+	def sip_amounts_on_mandates(self, mandate_ids):
+		mandate_ids = [str(mandate_id) for mandate_id in mandate_ids]
+		amounts = {}
+		for start in range(0, len(mandate_ids), IN_CHUNK):
+			amounts.update(self.Transaction.objects.filter(
+				order_type='2',
+				status__in=('2','5','6'),
+				mandate_id__in=mandate_ids[start:start + IN_CHUNK],
+			).values_list('mandate_id').annotate(amount=self.Sum('amount')))
+		return amounts
+
+	def update_mandate_status(self, mandate_id, old_status, status):
+		## update() skips auto_now fields
+		return bool(self.Mandate.objects.filter(id=mandate_id, status=old_status).update(
+			status=status, updated=self.timezone.now()))
+
+	def mark_mandates_checked(self, mandate_ids, now):
+		mandate_ids = list(mandate_ids)
+		with self.db_transaction.atomic():
+			for start in range(0, len(mandate_ids), IN_CHUNK):
+				self.Mandate.objects.filter(id__in=mandate_ids[start:start + IN_CHUNK]).update(checked_at=self.aware(now))
+
+	def save_payment_link(self, user_id, transaction_id, link):
+		return self.PaymentLinkBSE.objects.create(user_id=user_id, transaction_id=transaction_id, link=link)
+
+	def save_payment_links(self, links):
+		self.PaymentLinkBSE.objects.bulk_create([
+			self.PaymentLinkBSE(user_id=user_id, transaction_id=transaction_id, link=link)
+			for user_id, transaction_id, link in links
+		])
+
+	def payment_link(self, user_id, transaction_id, since):
+		return self.PaymentLinkBSE.objects.filter(
+			user_id=user_id, transaction_id=transaction_id, created__gte=self.aware(since),
+		).order_by('-created').first()
+
+	def scheme_plans(self, fields, changed_since=None):
+		queryset = self.SchemePlan.objects.all()
+		if changed_since is not None:
+			queryset = queryset.filter(last_updated__gte=changed_since)
+		return queryset.values_list(*fields).iterator()
+
+	def holding_folios(self, user_ids, plan_ids):
+		return self.Holding.objects.filter(
+			user_id__in=user_ids, scheme_plan_id__in=plan_ids, folio_number__gt='',
+		).values_list('user_id', 'scheme_plan_id', 'folio_number', 'units')
+
+	def purchase_folios(self, user_ids, plan_ids):
+		return self.Transaction.objects.filter(
+			user_id__in=user_ids,
+			scheme_plan_id__in=plan_ids,
+			transaction_type='P',	## folio must have been allotted in a purchase transaction only
+			status='6',	## status is 'completed'
+			folio_number__gt='',	## folio is not blank
+		).values_list('user_id', 'scheme_plan_id', 'folio_number').distinct()
+
+	def atomic(self):
+		return self.db_transaction.atomic()
+
+	def holding_for_update(self, transaction):
+		holdings = self.Holding.objects.select_for_update().filter(
+			user_id=transaction.user_id, scheme_plan_id=transaction.scheme_plan_id)
+		if transaction.transaction_type == 'R' and not transaction.folio_number:
+			return holdings.order_by('-units', 'folio_number').first()
+		holding, created = holdings.get_or_create(folio_number=transaction.folio_number or '')
+		return holding
+
+	def save_holding(self, holding):
+		holding.save()
+
+	def leases(self):
+		return list(self.TrackerLease.objects.order_by('name'))
+
+	def claim_lease(self, name, owner, now, expires_at):
+		now = self.aware(now)
+		with self.db_transaction.atomic():
+			if self.TrackerLease.objects.filter(
+				self.Q(owner=owner) | self.Q(owner='') | self.Q(expires_at__isnull=True) | self.Q(expires_at__lt=now),
+				name=name,
+			).update(owner=owner, expires_at=self.aware(expires_at)):
+				return True
+			if self.TrackerLease.objects.filter(name=name).exists():
+				return False
+			self.TrackerLease.objects.create(name=name, owner=owner, expires_at=self.aware(expires_at))
+			return True
+
+	def release_lease(self, name, owner):
+		self.TrackerLease.objects.filter(name=name, owner=owner).update(owner='', expires_at=None)
+
+
+################ SQL
+
+def load_schema(path=None):
+	'''
+	Reads the schema file written by the export_repository_schema management command
+	'''
+	with open(path or settings.REPOSITORY_SCHEMA) as f:
+		return json.load(f)
+
+
+def export_schema():
+	'''
+	Returns tables of the models used by repositories and specs of order validators
+	Needs django; called by the export_repository_schema management command
+	'''
+	from models import funds, transactions, users
+	import validators
+	models = (
+		transactions.Transaction, transactions.TransactionBSE, transactions.TransactionXsipBSE,
+		transactions.TransResponseBSE, transactions.PaymentLinkBSE, transactions.Holding, transactions.TrackerLease,
+		users.Info, users.KycDetail, users.BankDetail, users.BranchRepo, users.Mandate,
+		funds.SchemePlan,
+	)
+	return {
+		'tables': dict((model.__name__, model._meta.db_table) for model in models),
+		'validators': validators.export_specs(),
+	}
+
+
+def db_value(value):
+	'''
+	Aware datetimes are stored in UTC without a timezone, as django does
+	'''
+	if isinstance(value, datetime.datetime) and value.tzinfo is not None:
+		return (value - value.utcoffset()).replace(tzinfo=None)
+	return value
+
+
+class SQLRepository(Repository):
+	'''
+	Backend on a DB-API connection (format paramstyle, eg. MySQLdb). Rows are returned as Records
+	connect is called once per thread to open its connection. Queries use %s placeholders
+	'''
+	PLACEHOLDER = '%s'
+	FOR_UPDATE = ' FOR UPDATE'
+	## modulo operator, escaped as the connection fills in parameters with the % operator
+	MODULO = '%%'
+
+	def __init__(self, connect, schema=None):
+		self.connect = connect
+		schema = schema if schema is not None else load_schema()
+		self.tables = dict(schema['tables'])
+		self.tables.update(settings.REPOSITORY_TABLES)
+		self.specs = schema['validators']
+		self.validators = {}
+		self.columns_of = {}
+		self.local = threading.local()
+
+	################ connection
+
+	def connection(self):
+		connection = getattr(self.local, 'connection', None)
+		if connection is None:
+			connection = self.local.connection = self.connect()
+		return connection
+
+	def cursor(self, sql, params=()):
+		cursor = self.connection().cursor()
+		cursor.execute(sql.replace('%s', self.PLACEHOLDER), [db_value(p) for p in params])
+		return cursor
+
+	def begin(self):
+		## DB-API starts a transaction implicitly
+		pass
+
+	def commit(self):
+		self.connection().commit()
+
+	def rollback(self):
+		self.connection().rollback()
+
+	@contextlib.contextmanager
+	def atomic(self):
+		depth = getattr(self.local, 'depth', 0)
+		if not depth:
+			self.begin()
+		self.local.depth = depth + 1
+		try:
+			yield
+		except Exception:
+			self.local.depth = depth
+			if not depth:
+				self.rollback()
+			raise
+		self.local.depth = depth
+		if not depth:
+			self.commit()
+
+	def end_read(self):
+		'''
+		Ends the transaction a read outside atomic() opened so that a long running worker doesn't read
+		from an old snapshot
+		'''
+		if not getattr(self.local, 'depth', 0):
+			self.commit()
+
+	################ queries
+
+	def table(self, model):
+		return self.tables[model]
+
+	def columns(self, model):
+		columns = self.columns_of.get(model)
+		if columns is None:
+			cursor = self.cursor('SELECT * FROM %s WHERE 1 = 0' % self.table(model))
+			columns = self.columns_of[model] = [d[0] for d in cursor.description]
+		return columns
+
+	def convert(self, model, names, row):
+		return row
+
+	def query(self, sql, params=()):
+		cursor = self.cursor(sql, params)
+		rows = cursor.fetchall()
+		self.end_read()
+		return rows
+
+	def select(self, model, where='1 = 1', params=(), order_by=None, for_update=False):
+		sql = 'SELECT * FROM %s WHERE %s' % (self.table(model), where)
+		if order_by:
+			sql += ' ORDER BY ' + order_by
+		if for_update:
+			sql += self.FOR_UPDATE
+		cursor = self.cursor(sql, params)
+		names = [d[0] for d in cursor.description]
+		rows = cursor.fetchall()
+		if not for_update:
+			self.end_read()
+		return [Record(**dict(zip(names, self.convert(model, names, row)))) for row in rows]
+
+	def select_one(self, model, where, params=(), for_update=False):
+		rows = self.select(model, where, params, for_update=for_update)
+		if not rows:
+			raise DoesNotExist('%s matching query does not exist.' % model)
+		if len(rows) > 1:
+			raise InternalError(
+				676, "get() returned more than one %s" % model
+			)
+		return rows[0]
+
+	def stamp(self, model, values, created):
+		now = datetime.datetime.utcnow()
+		columns = self.columns(model)
+		if created and 'created' in columns and values.get('created') is None:
+			values['created'] = now
+		if 'updated' in columns:
+			values['updated'] = now
+		return values
+
+	def record_values(self, model, record):
+		columns = self.columns(model)
+		return dict((k, v) for k, v in vars(record).items() if k in columns)
+
+	def insert_many(self, model, rows):
+		'''
+		Inserts dicts of column values, all with the same columns. Returns id of the last row
+		'''
+		if not rows:
+			return None
+		names = sorted(rows[0])
+		sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+			self.table(model), ', '.join(names), ', '.join(['%s'] * len(names)))
+		with self.atomic():
+			if len(rows) == 1:
+				## lastrowid is only set by execute()
+				return self.cursor(sql, [rows[0][name] for name in names]).lastrowid
+			cursor = self.connection().cursor()
+			cursor.executemany(sql.replace('%s', self.PLACEHOLDER),
+				[[db_value(row[name]) for name in names] for row in rows])
+			return cursor.lastrowid
+
+	def insert(self, model, values):
+		values = self.stamp(model, values, True)
+		last_id = self.insert_many(model, [values])
+		if values.get('id') is None:
+			values['id'] = last_id
+		return Record(**values)
+
+	def update(self, model, record, pk='id'):
+		values = self.stamp(model, self.record_values(model, record), False)
+		names = sorted(name for name in values if name != pk)
+		with self.atomic():
+			self.cursor('UPDATE %s SET %s WHERE %s = %%s' % (
+				self.table(model), ', '.join('%s = %%s' % name for name in names), pk),
+				[values[name] for name in names] + [values[pk]])
+		for name in names:
+			setattr(record, name, values[name])
+
+	def in_list(self, values):
+		return '(%s)' % ', '.join(['%s'] * len(values))
+
+	def in_shards(self, shards):
+		'''
+		Condition on transactions of users in shards, true of all if shards is None
+		'''
+		if shards is None:
+			return '1 = 1'
+		if not shards:
+			return '1 = 0'
+		return '(user_id %s %d) IN (%s)' % (
+			self.MODULO, settings.TRACKER_SHARDS, ', '.join(str(int(shard)) for shard in shards))
+
+	################ transactions
+
+	def transaction(self, transaction_id, for_update=False):
+		return self.select_one('Transaction', 'id = %s', [transaction_id], for_update=for_update)
+
+	def save_transaction(self, transaction):
+		self.update('Transaction', transaction)
+
+	def transactions_to_track(self, shards=None):
+		return self.select('Transaction',
+			"(status IN ('2', '4', '5') OR (status = '6' AND order_type = '2')) AND " + self.in_shards(shards),
+			order_by='created')
+
+	def sips_to_track(self, shards=None):
+		return self.select('Transaction', "order_type = '2' AND status IN ('2', '4', '5', '6') AND " + self.in_shards(shards))
+
+	def sip_amount_on_mandate(self, user_id, mandate_id):
+		rows = self.query(
+			"SELECT SUM(amount) FROM %s WHERE user_id = %%s AND order_type = '2' AND status IN ('2', '5', '6') "
+			"AND mandate_id = %%s" % self.table('Transaction'), [user_id, mandate_id])
+		return rows[0][0] or 0
+
+	def payments_due(self, now, limit=None, shards=None):
+		return self.select('Transaction',
+			"order_type = '1' AND status IN ('2', '4') AND (next_check_at IS NULL OR next_check_at <= %s) AND " +
+			self.in_shards(shards), [now], order_by='next_check_at, id' + (' LIMIT %d' % limit if limit else ''))
+
+	def schedule_checks(self, next_check_at_by_id):
+		if not next_check_at_by_id:
+			return
+		sql = 'UPDATE %s SET next_check_at = %s WHERE id = %s' % (
+			self.table('Transaction'), self.PLACEHOLDER, self.PLACEHOLDER)
+		with self.atomic():
+			self.connection().cursor().executemany(sql,
+				[[db_value(next_check_at), transaction_id] for transaction_id, next_check_at in next_check_at_by_id.items()])
+
+	################ order records
+
+	def validator(self, name):
+		validator = self.validators.get(name)
+		if validator is None:
+			import validators
+			validator = self.validators[name] = validators.OrderValidator.from_spec(self.specs[name])
+		return validator
+
+	def order_counters(self, order_type, client_codes, today_str):
+		model = {'1': 'TransactionBSE', '2': 'TransactionXsipBSE'}[order_type]
+		client_codes = sorted(set(str(cc) for cc in client_codes))
+		return [tuple(row) for row in self.query(
+			'SELECT client_code, trans_no FROM %s WHERE client_code IN %s AND trans_no LIKE %%s' % (
+				self.table(model), self.in_list(client_codes)),
+			client_codes + ['%' + today_str + '%'])]
+
+	def insert_order(self, order):
+		self.insert_orders([order])
+
+	def insert_orders(self, orders):
+		with self.atomic():
+			for model in set(order._model for order in orders):
+				self.insert_many(model, [
+					self.stamp(model, self.record_values(model, order), True)
+					for order in orders if order._model == model
+				])
+
+	################ responses
+
+	def save_response(self, **fields):
+		return self.insert('TransResponseBSE', fields)
+
+	def order_id(self, trans_no):
+		return self.select_one('TransResponseBSE', 'trans_no = %s', [trans_no]).order_id
+
+	def order_ids(self, trans_nos):
+		trans_nos = list(trans_nos)
+		order_ids = {}
+		for start in range(0, len(trans_nos), IN_CHUNK):
+			chunk = trans_nos[start:start + IN_CHUNK]
+			order_ids.update(self.query('SELECT trans_no, order_id FROM %s WHERE trans_no IN %s' % (
+				self.table('TransResponseBSE'), self.in_list(chunk)), chunk))
+		return order_ids
+
+	def placed_orders(self, transaction_ids):
+		transaction_ids = list(transaction_ids)
+		placed = {}
+		for start in range(0, len(transaction_ids), IN_CHUNK):
+			chunk = transaction_ids[start:start + IN_CHUNK]
+			for transaction_id, order_id in self.query(
+				"SELECT o.internal_transaction_id, r.order_id FROM %s o JOIN %s r ON r.trans_no = o.trans_no "
+				"WHERE r.success_flag = '0' AND o.internal_transaction_id IN %s "
+				"ORDER BY o.created, LENGTH(o.trans_no), o.trans_no" % (
+				self.table('TransactionBSE'), self.table('TransResponseBSE'), self.in_list(chunk)), chunk):
+				placed.setdefault(transaction_id, []).append(order_id)
+		return placed
+
+	################ users
+
+	def user(self, user_id):
+		return self.select_one('Info', 'id = %s', [user_id])
+
+	def kyc(self, user_id):
+		return self.select_one('KycDetail', 'user_id = %s', [user_id])
+
+	def bank(self, user_id):
+		bank = self.select_one('BankDetail', 'user_id = %s', [user_id])
+		bank.ifsc_code = self.select_one('BranchRepo', 'id = %s', [bank.branch_id]).ifsc_code
+		return bank
+
+	################ mandates
+
+	def mandates(self, user_id, statuses):
+		statuses = [str(s) for s in statuses]
+		return self.select('Mandate', 'user_id = %%s AND status IN %s' % self.in_list(statuses), [user_id] + statuses)
+
+	def create_mandate(self, mandate_id, user_id, bank_id, amount, status):
+		return self.insert('Mandate', {
+			'id': mandate_id, 'user_id': user_id, 'bank_id': bank_id, 'amount': amount, 'status': status,
+		})
+
+	def mandates_to_track(self, statuses, checked_before=None, shards=None):
+		statuses = [str(s) for s in statuses]
+		where = 'status IN %s AND %s' % (self.in_list(statuses), self.in_shards(shards))
+		params = list(statuses)
+		if checked_before is not None:
+			where += ' AND (checked_at IS NULL OR checked_at <= %s)'
+			params.append(checked_before)
+		return self.select('Mandate', where, params, order_by='created')
+
+	def sip_amounts_on_mandates(self, mandate_ids):
+		mandate_ids = [str(mandate_id) for mandate_id in mandate_ids]
+		amounts = {}
+		for start in range(0, len(mandate_ids), IN_CHUNK):
+			chunk = mandate_ids[start:start + IN_CHUNK]
+			amounts.update(self.query(
+				"SELECT mandate_id, SUM(amount) FROM %s WHERE order_type = '2' AND status IN ('2', '5', '6') "
+				"AND mandate_id IN %s GROUP BY mandate_id" % (self.table('Transaction'), self.in_list(chunk)), chunk))
+		return amounts
+
+	def update_mandate_status(self, mandate_id, old_status, status):
+		values = self.stamp('Mandate', {'status': status}, False)
+		names = sorted(values)
+		with self.atomic():
+			cursor = self.cursor('UPDATE %s SET %s WHERE id = %%s AND status = %%s' % (
+				self.table('Mandate'), ', '.join('%s = %%s' % name for name in names)),
+				[values[name] for name in names] + [mandate_id, old_status])
+			return bool(cursor.rowcount)
+
+	def mark_mandates_checked(self, mandate_ids, now):
+		mandate_ids = list(mandate_ids)
+		with self.atomic():
+			for start in range(0, len(mandate_ids), IN_CHUNK):
+				chunk = mandate_ids[start:start + IN_CHUNK]
+				self.cursor('UPDATE %s SET checked_at = %%s WHERE id IN %s' % (
+					self.table('Mandate'), self.in_list(chunk)), [now] + chunk)
+
+	################ payment links
+
+	def save_payment_link(self, user_id, transaction_id, link):
+		return self.insert('PaymentLinkBSE', {'user_id': user_id, 'transaction_id': transaction_id, 'link': link})
+
+	def save_payment_links(self, links):
+		self.insert_many('PaymentLinkBSE', [
+			self.stamp('PaymentLinkBSE', {'user_id': user_id, 'transaction_id': transaction_id, 'link': link}, True)
+			for user_id, transaction_id, link in links
+		])
+
+	def payment_link(self, user_id, transaction_id, since):
+		links = self.select('PaymentLinkBSE', 'user_id = %s AND transaction_id = %s AND created >= %s',
+			[user_id, transaction_id, since], order_by='created DESC LIMIT 1')
+		return links[0] if links else None
+
+	################ scheme plans and holdings
+
+	def scheme_plans(self, fields, changed_since=None):
+		sql = 'SELECT %s FROM %s' % (', '.join(fields), self.table('SchemePlan'))
+		params = []
+		if changed_since is not None:
+			sql += ' WHERE last_updated >= %s'
+			params.append(changed_since)
+		fields = list(fields)
+		return [self.convert('SchemePlan', fields, row) for row in self.query(sql, params)]
+
+	def holding_folios(self, user_ids, plan_ids):
+		user_ids, plan_ids = list(user_ids), list(plan_ids)
+		return self.query(
+			"SELECT user_id, scheme_plan_id, folio_number, units FROM %s WHERE user_id IN %s "
+			"AND scheme_plan_id IN %s AND folio_number > ''" % (
+				self.table('Holding'), self.in_list(user_ids), self.in_list(plan_ids)),
+			user_ids + plan_ids)
+
+	def purchase_folios(self, user_ids, plan_ids):
+		user_ids, plan_ids = list(user_ids), list(plan_ids)
+		return self.query(
+			"SELECT DISTINCT user_id, scheme_plan_id, folio_number FROM %s WHERE user_id IN %s "
+			"AND scheme_plan_id IN %s AND transaction_type = 'P' AND status = '6' AND folio_number > ''" % (
+				self.table('Transaction'), self.in_list(user_ids), self.in_list(plan_ids)),
+			user_ids + plan_ids)
+
+	def holding_for_update(self, transaction):
+		where = 'user_id = %s AND scheme_plan_id = %s'
+		params = [transaction.user_id, transaction.scheme_plan_id]
+		if transaction.transaction_type == 'R' and not transaction.folio_number:
+			holdings = self.select('Holding', where, params, order_by='units DESC, folio_number', for_update=True)
+			return holdings[0] if holdings else None
+		folio_number = transaction.folio_number or ''
+		holdings = self.select('Holding', where + ' AND folio_number = %s', params + [folio_number], for_update=True)
+		if holdings:
+			return holdings[0]
+		return self.insert('Holding', {
+			'user_id': transaction.user_id, 'scheme_plan_id': transaction.scheme_plan_id,
+			'folio_number': folio_number, 'units': 0.0, 'invested': 0.0, 'missing_navs': 0,
+			'num_transactions': 0, 'last_transaction_id': None,
+		})
+
+	def save_holding(self, holding):
+		self.update('Holding', holding)
+
+	################ tracker leases
+
+	def leases(self):
+		return self.select('TrackerLease', order_by='name')
+
+	def claim_lease(self, name, owner, now, expires_at):
+		with self.atomic():
+			cursor = self.cursor(
+				"UPDATE %s SET owner = %%s, expires_at = %%s WHERE name = %%s "
+				"AND (owner = %%s OR owner = '' OR expires_at IS NULL OR expires_at < %%s)" % self.table('TrackerLease'),
+				[owner, expires_at, name, owner, now])
+			if cursor.rowcount:
+				return True
+			if self.select('TrackerLease', 'name = %s', [name]):
+				return False
+			self.insert('TrackerLease', {'name': name, 'owner': owner, 'expires_at': expires_at})
+			return True
+
+	def release_lease(self, name, owner):
+		with self.atomic():
+			self.cursor("UPDATE %s SET owner = '', expires_at = NULL WHERE name = %%s AND owner = %%s" % (
+				self.table('TrackerLease')), [name, owner])
+
+
+def parse_datetime(value):
+	if not isinstance(value, string_types):
+		return value
+	value = value.replace('T', ' ')[:26]
+	return datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S.%f' if '.' in value else '%Y-%m-%d %H:%M:%S')
+
+
+def parse_date(value):
+	if not isinstance(value, string_types):
+		return value
+	return datetime.datetime.strptime(value[:10], '%Y-%m-%d').date()
+
+
+def parse_bool(value):
+	return value if value is None else bool(value)
+
+
+class SQLiteRepository(SQLRepository):
+	'''
+	Backend on an sqlite database file, eg. the one django's sqlite3 backend created
+	sqlite has no date or boolean types so columns declared so by django are parsed when read
+	Transactions take the write lock up front (BEGIN IMMEDIATE) as sqlite has no SELECT ... FOR UPDATE
+	'''
+	PLACEHOLDER = '?'
+	FOR_UPDATE = ''
+	MODULO = '%'
+	PARSERS = {'date': parse_date, 'datetime': parse_datetime, 'bool': parse_bool}
+
+	def __init__(self, path, schema=None):
+		import sqlite3
+		## autocommit mode; transactions are begun and committed explicitly by atomic()
+		SQLRepository.__init__(self, lambda: sqlite3.connect(path, isolation_level=None), schema)
+		self.parsers_of = {}
+
+	def begin(self):
+		self.cursor('BEGIN IMMEDIATE')
+
+	def commit(self):
+		self.cursor('COMMIT')
+
+	def rollback(self):
+		self.cursor('ROLLBACK')
+
+	def end_read(self):
+		pass
+
+	def convert(self, model, names, row):
+		parsers = self.parsers_of.get(model)
+		if parsers is None:
+			parsers = self.parsers_of[model] = dict(
+				(name, self.PARSERS[decltype.lower()])
+				for cid, name, decltype, notnull, default, pk in self.query('PRAGMA table_info(%s)' % self.table(model))
+				if decltype.lower() in self.PARSERS
+			)
+		return [parsers[name](value) if name in parsers else value for name, value in zip(names, row)]
+
+
+################ PROCESS LEVEL REPOSITORY
+
+_repository = {'current': None}
+_lock = threading.Lock()
+
+
+def create(backend=None):
+	'''
+	Creates the repository of backend- 'django', 'sqlite' (settings.REPOSITORY_DB) or 'sql'
+	(connection opened with settings.REPOSITORY_SQL_MODULE.connect(**settings.REPOSITORY_SQL_CONNECT))
+	'''
+	backend = backend or settings.REPOSITORY_BACKEND
+	if backend == 'django':
+		return DjangoRepository()
+	elif backend == 'sqlite':
+		return SQLiteRepository(settings.REPOSITORY_DB)
+	elif backend == 'sql':
+		module = importlib.import_module(settings.REPOSITORY_SQL_MODULE)
+		return SQLRepository(lambda: module.connect(**settings.REPOSITORY_SQL_CONNECT))
+	raise InternalError(
+		677, "Unknown repository backend %s" % backend
+	)
+
+
+def get():
+	'''
+	Returns the process level repository, created on first use from settings.REPOSITORY_BACKEND
+	'''
+	if _repository['current'] is None:
+		with _lock:
+			if _repository['current'] is None:
+				_repository['current'] = create()
+	return _repository['current']
+
+
+def use(repository):
+	'''
+	Sets the process level repository, eg. in a worker that opens its own
+	'''
+	_repository['current'] = repository
+	return repository
@@ -0,0 +1,206 @@
+'''
+Author: utkarshohm
+Description: Resilience of calls to BSEStar- its SOAP endpoints (see api.soap_call) and page loads of its
+	web portal (see web.load_page). Calls to each endpoint go through one Endpoint, which
+	- keeps outcomes and latency of its recent calls; timers and counters are exported by metrics.py
+	- opens a circuit breaker when too many recent calls failed, failing calls at once for a cooldown
+		instead of waiting on a service that is down, and then lets one trial call through
+	- limits calls in flight AIMD style- the limit grows by one for every limit successful calls and is
+		cut on a transient failure or a slow call- so that parallel workers settle near the highest
+		concurrency BSE tolerates. Workers can size their pools with Endpoint.limit
+	- retries transient failures (connection errors, timeouts, server errors) with jittered exponential
+		backoff. Calls that change something on BSE (orders, mandates...) are only retried when the
+		request can't have reached BSE
+	Only transient failures count as failures of an endpoint; BSE rejecting a request means it is up
+'''
+
+import collections
+import errno
+import logging
+import random
+import socket
+import threading
+import time
+
+import settings
+import errors
+import metrics
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+log = logging.getLogger('bse.resilience')
+
+## exception classes (by name, so that selenium and requests aren't imported) of transient failures
+## a BadStatusLine from the browser means it stopped responding, which retrying a page load doesn't help
+TRANSIENT_ERRORS = ('TimeoutException', 'ErrorInResponseException')
+## and of failures before a request was sent
+UNSENT_ERRORS = ('ConnectTimeout',)
+
+
+def is_transient(exc):
+	'''
+	Whether exc is a failure of the network or of the service rather than a rejection of the request
+	'''
+	if isinstance(exc, errors.BSEError):
+		return exc.retryable
+	if isinstance(exc, EnvironmentError):
+		## socket errors, and requests' connection errors and timeouts
+		return True
+	name = type(exc).__name__
+	if name == 'TransportError':
+		## zeep's error for a http status other than 200- 5xx are failures of the service
+		return (getattr(exc, 'status_code', None) or 500) >= 500
+	return name in TRANSIENT_ERRORS
+
+
+def is_unsent(exc):
+	'''
+	Whether exc was raised before the request reached the service
+	'''
+	if isinstance(exc, socket.error) and getattr(exc, 'errno', None) == errno.ECONNREFUSED:
+		return True
+	return type(exc).__name__ in UNSENT_ERRORS
+
+
+def backoff(attempt):
+	'''
+	Seconds to wait before retry number attempt- full jitter up to an exponentially growing bound
+	'''
+	return random.uniform(0, min(settings.RESILIENCE_MAX_BACKOFF, settings.RESILIENCE_BACKOFF * 2 ** (attempt - 1)))
+
+
+class Endpoint(object):
+	'''
+	Circuit breaker, concurrency limit and retries of calls to one endpoint
+	'''
+
+	def __init__(self, name):
+		self.name = name
+		self.cond = threading.Condition()
+		self.outcomes = collections.deque(maxlen=settings.RESILIENCE_WINDOW)
+		self.state = CLOSED
+		self.opened_at = None
+		self.probing = False
+		self.limit = float(settings.RESILIENCE_CONCURRENCY)
+		self.in_flight = 0
+		## moving average of latency in seconds
+		self.latency = None
+
+	def call(self, func, idempotent=True):
+		'''
+		Returns func(), retrying transient failures. Raises at once if the circuit is open
+		'''
+		attempt = 0
+		while True:
+			self.acquire()
+			started = time.time()
+			try:
+				result = func()
+			except Exception as e:
+				self.release(started, e)
+				if attempt >= settings.RESILIENCE_RETRIES or \
+					not (is_transient(e) if idempotent else is_unsent(e)):
+					raise
+				attempt += 1
+				metrics.incr('retries', endpoint=self.name, code=metrics.error_code(e))
+				time.sleep(backoff(attempt))
+				continue
+			self.release(started)
+			return result
+
+	def acquire(self):
+		with self.cond:
+			self.admit()
+			while self.in_flight >= int(self.limit):
+				self.cond.wait(1.0)
+			self.in_flight += 1
+
+	def admit(self):
+		if self.state == OPEN:
+			if time.time() - self.opened_at < settings.RESILIENCE_COOLDOWN:
+				metrics.incr('circuit_rejections', endpoint=self.name)
+				raise errors.CircuitOpenError(
+					678, "Circuit breaker of %s is open after repeated failures" % self.name
+				)
+			self.state = HALF_OPEN
+		if self.state == HALF_OPEN:
+			## one trial call at a time
+			if self.probing:
+				metrics.incr('circuit_rejections', endpoint=self.name)
+				raise errors.CircuitOpenError(
+					678, "Circuit breaker of %s is open after repeated failures" % self.name
+				)
+			self.probing = True
+
+	def release(self, started, exc=None):
+		elapsed = time.time() - started
+		failed = exc is not None and is_transient(exc)
+		with self.cond:
+			self.in_flight -= 1
+			self.latency = elapsed if self.latency is None else 0.8 * self.latency + 0.2 * elapsed
+			self.outcomes.append(failed)
+			if self.state == HALF_OPEN:
+				self.probing = False
+				if failed:
+					self.open()
+				else:
+					self.state = CLOSED
+					self.outcomes.clear()
+			elif failed and self.state == CLOSED and self.failure_rate() >= settings.RESILIENCE_FAILURE_RATE \
+				and len(self.outcomes) >= settings.RESILIENCE_MIN_CALLS:
+				self.open()
+
+			## additive increase, multiplicative decrease
+			if failed or elapsed > settings.RESILIENCE_SLOW_CALL:
+				self.limit = max(settings.RESILIENCE_MIN_CONCURRENCY, self.limit * settings.RESILIENCE_DECREASE)
+			else:
+				self.limit = min(settings.RESILIENCE_MAX_CONCURRENCY, self.limit + 1.0 / self.limit)
+			self.cond.notify_all()
+
+	def open(self):
+		self.state = OPEN
+		self.opened_at = time.time()
+		metrics.incr('circuit_opened', endpoint=self.name)
+		log.warning('Circuit breaker of %s opened, failure rate %.2f', self.name, self.failure_rate())
+
+	def failure_rate(self):
+		return float(sum(self.outcomes)) / len(self.outcomes) if self.outcomes else 0.0
+
+	def stats(self):
+		with self.cond:
+			return {
+				'state': self.state,
+				'failure_rate': self.failure_rate(),
+				'latency': self.latency,
+				'limit': int(self.limit),
+				'in_flight': self.in_flight,
+			}
+
+
+################ PROCESS LEVEL ENDPOINTS
+
+_endpoints = {}
+_lock = threading.Lock()
+
+
+def endpoint(name):
+	'''
+	The Endpoint of name, created on first use
+	'''
+	ep = _endpoints.get(name)
+	if ep is None:
+		with _lock:
+			ep = _endpoints.get(name)
+			if ep is None:
+				ep = _endpoints[name] = Endpoint(name)
+	return ep
+
+
+def stats():
+	'''
+	Stats of all endpoints by name
+	'''
+	return dict((name, ep.stats()) for name, ep in list(_endpoints.items()))
@@ -0,0 +1,354 @@
+'''
+Author: utkarshohm
+Description: Returns engine that sets return_till_date and return_date of all completed transactions
+	in bulk. Navs of all held scheme plans are loaded once from the columnar time series store, every
+	lumpsum order and every SIP instalment (from sip_dates) becomes one cash flow, and units, value and
+	returns of all transactions are computed in a few vectorized numpy passes. SIP returns are XIRR
+	from the batched solver in xirr.py. Results are written back with batched UPDATE queries
+'''
+
+import datetime
+
+import numpy as np
+from django.db.models import Case, When, Value, FloatField
+
+from models.transactions import Transaction
+import metrics
+import timeseries
+import xirr
+
+
+## transaction statuses whose investment is still held- completed and SIP concluded
+HELD_STATUS = ('6', '8')
+## returns of investments held for less than this many days are absolute, else annualised
+ANNUALISE_AFTER_DAYS = 365
+## rows per UPDATE query when writing back
+UPDATE_BATCH = 500
+## rows fetched per round trip when reading transactions
+READ_CHUNK = 10000
+
+
+class NavPanel(object):
+	'''
+	Navs of many scheme plans concatenated into one sorted array keyed by (plan position, day)
+	so that navs of any number of (scheme plan, date) pairs are found with a single binary search
+	Nav series are keyed by SchemePlan id in the store
+	'''
+
+	def __init__(self, scheme_ids, store=None):
+		store = store or timeseries.fund_store()
+		self.scheme_ids = np.array(sorted(set(int(i) for i in scheme_ids)), dtype=np.int64)
+		keys = []
+		values = []
+		self.latest_day = np.full(len(self.scheme_ids), -1, dtype=np.int64)
+		self.latest_nav = np.full(len(self.scheme_ids), np.nan)
+		for pos, scheme_id in enumerate(self.scheme_ids):
+			series = store.get(int(scheme_id))
+			if not len(series):
+				continue
+			keys.append((pos << 32) + series.dates.astype(np.int64))
+			values.append(series.values)
+			self.latest_day[pos] = series.dates[-1]
+			self.latest_nav[pos] = series.values[-1]
+		self.keys = np.concatenate(keys) if keys else np.empty(0, dtype=np.int64)
+		self.values = np.concatenate(values) if values else np.empty(0)
+
+	def positions(self, scheme_ids):
+		'''
+		Returns position of each scheme id in the panel, -1 for schemes not in the panel
+		'''
+		scheme_ids = np.asarray(scheme_ids, dtype=np.int64)
+		if not len(self.scheme_ids):
+			return np.full(len(scheme_ids), -1, dtype=np.int64)
+		pos = np.searchsorted(self.scheme_ids, scheme_ids)
+		pos = np.minimum(pos, len(self.scheme_ids) - 1)
+		return np.where(self.scheme_ids[pos] == scheme_ids, pos, -1)
+
+	def as_of(self, positions, days):
+		'''
+		Returns nav of each (position, day) on that day or the last nav before it
+		NaN where the scheme has no nav on or before that day
+		'''
+		positions = np.asarray(positions, dtype=np.int64)
+		days = np.asarray(days, dtype=np.int64)
+		out = np.full(len(days), np.nan)
+		if not len(self.keys):
+			return out
+		idx = np.searchsorted(self.keys, (positions << 32) + days, side='right') - 1
+		ok = (positions >= 0) & (idx >= 0)
+		ok[ok] = (self.keys[idx[ok]] >> 32) == positions[ok]
+		out[ok] = self.values[idx[ok]]
+		return out
+
+
+class CashFlows(object):
+	'''
+	Purchase cash flows of many transactions as flat arrays, one element per lumpsum order
+	or SIP instalment. owner is the index of the transaction a flow belongs to
+	transaction_ids, scheme_ids and user_ids are aligned with transactions
+	'''
+
+	def __init__(self, transaction_ids, scheme_ids, user_ids, owner, days, amounts):
+		self.transaction_ids = transaction_ids
+		self.scheme_ids = scheme_ids
+		self.user_ids = user_ids
+		self.owner = owner
+		self.days = days
+		self.amounts = amounts
+
+
+class Returns(object):
+	'''
+	Returns of many transactions as arrays aligned with transaction_ids
+	absolute, annualised and xirr are in % and NaN where navs were not available
+	'''
+
+	def __init__(self, transaction_ids, invested, value, absolute, annualised, holding_days, as_of_days, num_flows, xirr=None):
+		self.transaction_ids = transaction_ids
+		self.invested = invested
+		self.value = value
+		self.absolute = absolute
+		self.annualised = annualised
+		self.holding_days = holding_days
+		self.as_of_days = as_of_days
+		self.num_flows = num_flows
+		self.xirr = xirr
+
+	def reported(self):
+		'''
+		Return shown to users- absolute below ANNUALISE_AFTER_DAYS of (amount weighted) holding,
+		annualised after; XIRR for SIPs (more than one instalment) when it is available
+		'''
+		reported = np.where(self.holding_days < ANNUALISE_AFTER_DAYS, self.absolute, self.annualised)
+		if self.xirr is not None:
+			use_xirr = (self.num_flows > 1) & (self.holding_days >= ANNUALISE_AFTER_DAYS) & ~np.isnan(self.xirr)
+			reported = np.where(use_xirr, self.xirr, reported)
+		return reported
+
+
+################ LOADING
+
+def parse_sip_dates(sip_dates):
+	'''
+	Parses comma separated DDMMYY dates of many SIP transactions in one pass
+	Returns (owner, days) where owner is the index in sip_dates the date came from
+	'''
+	counts = []
+	tokens = []
+	for dates in sip_dates:
+		parts = [d for d in dates.split(',') if d] if dates else []
+		counts.append(len(parts))
+		tokens.extend(parts)
+	owner = np.repeat(np.arange(len(sip_dates), dtype=np.int64), counts)
+	if not tokens:
+		return owner, np.empty(0, dtype=np.int64)
+	digits = np.array(tokens, dtype='S6').view(np.uint8).reshape(-1, 6).astype(np.int64) - ord('0')
+	day = digits[:, 0] * 10 + digits[:, 1]
+	month = digits[:, 2] * 10 + digits[:, 3]
+	year = 2000 + digits[:, 4] * 10 + digits[:, 5]
+	months = (np.array(year - 1970, dtype='timedelta64[Y]').astype('timedelta64[M]') +
+		np.array(month - 1, dtype='timedelta64[M]'))
+	first_of_month = (np.datetime64('1970-01', 'M') + months).astype('datetime64[D]')
+	days = (first_of_month + np.array(day - 1, dtype='timedelta64[D]')).astype(np.int64)
+	return owner, days
+
+
+def read_in_chunks(queryset, fields, chunk=READ_CHUNK):
+	'''
+	Yields values_list tuples of fields (the first of which is id) of rows of queryset, reading chunk rows
+	per query in order of id. MySQLdb fetches the whole result of a query, even through iterator(), so this
+	keeps memory bounded however many transactions there are
+	'''
+	queryset = queryset.order_by('id')
+	last_id = None
+	while True:
+		page = queryset if last_id is None else queryset.filter(id__gt=last_id)
+		rows = list(page.values_list(*fields)[:chunk])
+		for row in rows:
+			yield row
+		if len(rows) < chunk:
+			return
+		last_id = rows[-1][0]
+
+
+def load_cash_flows(queryset=None):
+	'''
+	Reads purchase transactions that are still held and turns them into cash flows
+	Lumpsum orders are one flow on datetime_at_mf, SIP orders one flow per instalment done
+	'''
+	if queryset is None:
+		queryset = Transaction.objects.filter(
+			status__in=HELD_STATUS,
+			transaction_type__in=('P', 'A'),
+		)
+	rows = read_in_chunks(queryset, (
+		'id', 'scheme_plan_id', 'user_id', 'order_type', 'amount', 'datetime_at_mf', 'sip_dates', 'sip_num_inst_done',
+	))
+
+	ids = []
+	schemes = []
+	users = []
+	amounts = []
+	lumpsum_owner = []
+	lumpsum_days = []
+	sip_owner = []
+	sip_dates = []
+	for tr_id, scheme_id, user_id, order_type, amount, datetime_at_mf, dates, num_inst_done in rows:
+		if amount is None:
+			continue
+		if order_type == '2':
+			## only instalments that have been processed
+			dates = ','.join([d for d in (dates or '').split(',') if d][:num_inst_done or 0])
+			if not dates:
+				continue
+			sip_owner.append(len(ids))
+			sip_dates.append(dates)
+		else:
+			if datetime_at_mf is None:
+				continue
+			lumpsum_owner.append(len(ids))
+			lumpsum_days.append(timeseries.to_days(datetime_at_mf))
+		ids.append(tr_id)
+		schemes.append(scheme_id)
+		users.append(user_id)
+		amounts.append(amount)
+
+	ids = np.array(ids, dtype=np.int64)
+	schemes = np.array(schemes, dtype=np.int64)
+	users = np.array(users, dtype=np.int64)
+	amounts = np.array(amounts, dtype=np.float64)
+
+	sip_idx, sip_days = parse_sip_dates(sip_dates)
+	sip_owner = np.array(sip_owner, dtype=np.int64)[sip_idx] if len(sip_idx) else np.empty(0, dtype=np.int64)
+	owner = np.concatenate([np.array(lumpsum_owner, dtype=np.int64), sip_owner])
+	days = np.concatenate([np.array(lumpsum_days, dtype=np.int64), sip_days])
+	return CashFlows(ids, schemes, users, owner, days, amounts[owner] if len(owner) else np.empty(0))
+
+
+################ COMPUTATION
+
+def compute_returns(flows, panel, as_of=None, with_xirr=True):
+	'''
+	Computes returns of every transaction in flows using navs in panel
+	Each flow buys amount / nav units on its day; holdings are valued at the latest nav of the
+	scheme (or nav as of as_of date). Annualised return uses the amount weighted holding period
+	and XIRR treats every instalment as a separate cash flow
+	'''
+	n = len(flows.transaction_ids)
+	positions = panel.positions(flows.scheme_ids)
+	if as_of is None:
+		value_days = panel.latest_day[np.maximum(positions, 0)]
+		value_days = np.where(positions >= 0, value_days, -1)
+		value_nav = np.where(positions >= 0, panel.latest_nav[np.maximum(positions, 0)], np.nan)
+	else:
+		value_days = np.full(n, timeseries.to_days(as_of), dtype=np.int64)
+		value_nav = panel.as_of(positions, value_days)
+
+	flow_pos = positions[flows.owner]
+	buy_nav = panel.as_of(flow_pos, flows.days)
+	units = flows.amounts / buy_nav
+	## a flow without nav makes its whole transaction's return unknown
+	missing = np.bincount(flows.owner, weights=np.isnan(units), minlength=n) > 0
+	units = np.where(np.isnan(units), 0.0, units)
+
+	invested = np.bincount(flows.owner, weights=flows.amounts, minlength=n)
+	total_units = np.bincount(flows.owner, weights=units, minlength=n)
+	held_days = (value_days[flows.owner] - flows.days).astype(np.float64)
+	weighted_days = np.bincount(flows.owner, weights=flows.amounts * held_days, minlength=n)
+
+	with np.errstate(divide='ignore', invalid='ignore'):
+		value = total_units * value_nav
+		growth = value / invested
+		holding_days = weighted_days / invested
+		absolute = (growth - 1.0) * 100.0
+		years = np.maximum(holding_days, 1.0) / 365.0
+		annualised = (np.power(growth, 1.0 / years) - 1.0) * 100.0
+
+	bad = missing | (invested <= 0) | np.isnan(value_nav)
+	absolute[bad] = np.nan
+	annualised[bad] = np.nan
+	value[bad] = np.nan
+	num_flows = np.bincount(flows.owner, minlength=n)
+
+	rates = None
+	if with_xirr:
+		owner, days, amounts = terminal_flows(flows, value, value_days)
+		rates = xirr.xirr_batch(owner, days, amounts, n) * 100.0
+		rates[bad] = np.nan
+	return Returns(flows.transaction_ids, invested, value, absolute, annualised, holding_days, value_days, num_flows, rates)
+
+
+def terminal_flows(flows, value, value_days, group=None):
+	'''
+	Returns (owner, days, amounts) of xirr cash flows- every purchase as an outflow and the
+	current value of every transaction as an inflow on its valuation day
+	group maps each transaction to a portfolio (eg. its user); by default each transaction is its own
+	'''
+	held = ~np.isnan(value)
+	if group is None:
+		group = np.arange(len(value))
+	owner = np.concatenate([group[flows.owner], group[held]])
+	days = np.concatenate([flows.days, value_days[held]])
+	amounts = np.concatenate([-flows.amounts, value[held]])
+	return owner, days, amounts
+
+
+def user_xirr(flows, result):
+	'''
+	XIRR (in %) of the whole portfolio of every user, from all instalments of all their held
+	transactions and current value of those. Returns (user_ids, rates)
+	Transactions whose value is unknown are left out along with their flows
+	'''
+	known = ~np.isnan(result.value)
+	user_ids, group = np.unique(flows.user_ids, return_inverse=True)
+	keep = known[flows.owner]
+	kept = CashFlows(flows.transaction_ids, flows.scheme_ids, flows.user_ids, flows.owner[keep], flows.days[keep], flows.amounts[keep])
+	owner, days, amounts = terminal_flows(kept, result.value, result.as_of_days, group)
+	return user_ids, xirr.xirr_batch(owner, days, amounts, len(user_ids)) * 100.0
+
+
+################ WRITING BACK
+
+def save_returns(transaction_ids, values, return_days, batch=UPDATE_BATCH):
+	'''
+	Writes return_till_date and return_date of many transactions with one UPDATE per batch
+	NaN values are skipped. Returns number of transactions updated
+	'''
+	ok = ~np.isnan(values)
+	transaction_ids = transaction_ids[ok]
+	values = np.round(values[ok], 4)
+	return_days = return_days[ok]
+	updated = 0
+	## one query per batch per return date; usually all holdings share the latest nav date
+	for day in np.unique(return_days):
+		same_day = return_days == day
+		ids = transaction_ids[same_day]
+		vals = values[same_day]
+		return_date = timeseries.from_days(day)
+		for start in range(0, len(ids), batch):
+			chunk_ids = [int(i) for i in ids[start:start + batch]]
+			chunk_vals = [float(v) for v in vals[start:start + batch]]
+			updated += Transaction.objects.filter(id__in=chunk_ids).update(
+				return_till_date=Case(
+					*[When(id=i, then=Value(v)) for i, v in zip(chunk_ids, chunk_vals)],
+					output_field=FloatField()
+				),
+				return_date=return_date,
+			)
+	return updated
+
+
+def update_transaction_returns(queryset=None, store=None, as_of=None):
+	'''
+	Sets return_till_date (in %) and return_date of all held purchase transactions
+	Called daily after navs are loaded
+	'''
+	with metrics.timer('returns', stage='load_transactions'):
+		flows = load_cash_flows(queryset)
+	with metrics.timer('returns', stage='load_navs'):
+		panel = NavPanel(np.unique(flows.scheme_ids), store)
+	with metrics.timer('returns', stage='compute'):
+		result = compute_returns(flows, panel, as_of)
+	with metrics.timer('returns', stage='save'):
+		updated = save_returns(result.transaction_ids, result.reported(), result.as_of_days)
+	return updated
@@ -0,0 +1,375 @@
+'''
+Author: utkarshohm
+Description: Monthly pipeline that fills risk and return statistics of all scheme plans- rows of
+	SchemePlanHistory and avg/min/max_return of SchemePlan and BenchmarkIndex. Month end navs of all
+	plans are read from the columnar time series store into one (plan x month) matrix and each plan's
+	benchmark is the FundBenchmarkIndex weighted mix of index series. Rolling window statistics of all
+	plans and months are then computed together from cumulative sums, so the cost does not depend on
+	window length. Snapshot rows are written with bulk_create. An incremental run reads only the month ends
+	that windows of new months span. django and the models are imported on first use (see lazy.py)
+'''
+
+import datetime
+import warnings
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+from errors import InternalError
+import lazy
+import metrics
+import settings
+import timeseries
+
+Case = lazy.attribute('django.db.models', 'Case')
+When = lazy.attribute('django.db.models', 'When')
+Value = lazy.attribute('django.db.models', 'Value')
+FloatField = lazy.attribute('django.db.models', 'FloatField')
+Max = lazy.attribute('django.db.models', 'Max')
+SchemePlan = lazy.attribute('models.funds', 'SchemePlan')
+SchemePlanHistory = lazy.attribute('models.funds', 'SchemePlanHistory')
+FundBenchmarkIndex = lazy.attribute('models.funds', 'FundBenchmarkIndex')
+BenchmarkIndex = lazy.attribute('models.funds', 'BenchmarkIndex')
+NavPanel = lazy.attribute('returns', 'NavPanel')
+
+
+## windows (in years) that statistics can be computed over
+WINDOWS = (1, 3, 5)
+## avg/min/max return are of rolling returns of this many months within the window
+RETURN_MONTHS = 12
+## a month end nav older than this many days (scheme stopped publishing navs) is not used
+STALE_NAV_DAYS = 7
+## rows per INSERT/UPDATE query
+WRITE_BATCH = 500
+## plans per chunk when computing rolling min/max, bounds memory to chunk x months x window floats
+ROW_CHUNK = 500
+
+
+################ MONTHLY MATRICES
+
+def month_ends(first_day, last_day):
+	'''
+	Returns days (since epoch) of ends of all complete months between first_day and last_day
+	'''
+	first = np.array(first_day, dtype='datetime64[D]').astype('datetime64[M]')
+	last = np.array(last_day, dtype='datetime64[D]').astype('datetime64[M]')
+	months = np.arange(first, last + 1)
+	ends = ((months + 1).astype('datetime64[D]') - 1).astype(np.int64)
+	return ends[ends <= last_day]
+
+
+def month_start(day):
+	'''
+	Returns first date of the month of day (since epoch)
+	'''
+	d = timeseries.from_days(day)
+	return datetime.date(d.year, d.month, 1)
+
+
+def monthly_values(panel, ids, ends):
+	'''
+	Returns (len(ids) x len(ends)) matrix of value of every series on every month end
+	NaN before a series starts and after it goes stale
+	'''
+	positions = panel.positions(ids)
+	n, t = len(positions), len(ends)
+	pos = np.repeat(positions, t)
+	days = np.tile(ends, n)
+	values = panel.as_of(pos, days).reshape(n, t)
+	latest = np.where(positions >= 0, panel.latest_day[np.maximum(positions, 0)], -1)
+	values[ends[None, :] > latest[:, None] + STALE_NAV_DAYS] = np.nan
+	return values
+
+
+def period_returns(values, months=1):
+	'''
+	Returns matrix of returns (as fractions) over the last `months` months at every month end
+	First `months` columns are NaN
+	'''
+	out = np.full(values.shape, np.nan)
+	with np.errstate(divide='ignore', invalid='ignore'):
+		out[:, months:] = values[:, months:] / values[:, :-months] - 1.0
+	return out
+
+
+def benchmark_returns(weights, index_returns):
+	'''
+	Monthly returns of weighted benchmarks- weights is (plans x indices), index_returns (indices x months)
+	Weights of indices without a return in a month are spread over the remaining ones
+	'''
+	available = ~np.isnan(index_returns)
+	total = np.dot(weights, available)
+	with np.errstate(divide='ignore', invalid='ignore'):
+		bench = np.dot(weights, np.where(available, index_returns, 0.0)) / total
+	bench[total == 0] = np.nan
+	return bench
+
+
+def window_start(column, years):
+	'''
+	Returns first month end column that statistics of the window of `years` years ending at column read-
+	monthly returns of the window need the nav a month before it, and rolling RETURN_MONTHS returns
+	within it (for avg/min/max return) navs that many months before
+	'''
+	return max(0, column - 12 * years - RETURN_MONTHS + 1)
+
+
+################ ROLLING WINDOWS
+
+def rolling_sum(x, k):
+	'''
+	Sum of every k consecutive columns of x ending at each column, NaN where fewer than k columns precede
+	NaNs count as 0, so pair with rolling_sum of the validity mask
+	'''
+	c = np.zeros((x.shape[0], x.shape[1] + 1))
+	np.cumsum(np.where(np.isnan(x), 0.0, x), axis=1, out=c[:, 1:])
+	out = np.full(x.shape, np.nan)
+	if k <= x.shape[1]:
+		out[:, k - 1:] = c[:, k:] - c[:, :-k]
+	return out
+
+
+def rolling_reduce(x, k, func):
+	'''
+	Applies a nan-aware reduction (np.nanmin, np.nanmax, np.nanmean) over every k consecutive columns
+	ending at each column, on strided views in chunks of rows
+	'''
+	out = np.full(x.shape, np.nan)
+	n, t = x.shape
+	if k > t:
+		return out
+	for start in range(0, n, ROW_CHUNK):
+		block = np.ascontiguousarray(x[start:start + ROW_CHUNK])
+		rows = block.shape[0]
+		windows = as_strided(
+			block, shape=(rows, t - k + 1, k),
+			strides=(block.strides[0], block.strides[1], block.strides[1]),
+		)
+		## nan-reductions of all-NaN windows warn; those windows are NaN as intended
+		with warnings.catch_warnings():
+			warnings.simplefilter('ignore', RuntimeWarning)
+			out[start:start + rows, k - 1:] = func(windows, axis=2)
+	return out
+
+
+class RiskStats(object):
+	'''
+	Statistics of many plans at every month end as (plans x months) matrices
+	Risk measures are in decimal and annualised, returns in %- as stored in SchemePlanHistory
+	'''
+	FIELDS = ('avg_return', 'min_return', 'max_return', 'std_dev', 'sortino_ratio', 'alpha', 'beta', 'sharpe_ratio')
+
+	def __init__(self, **stats):
+		for field in self.FIELDS:
+			setattr(self, field, stats[field])
+
+
+def compute_risk(navs, bench, years, risk_free_rate=None):
+	'''
+	Computes rolling statistics over windows of `years` years ending at every month end
+	navs is (plans x months) month end navs and bench (plans x months) monthly benchmark returns
+	Risk measures need a full window of monthly returns; alpha and beta also a full window of
+	benchmark returns. avg/min/max return are of rolling RETURN_MONTHS returns within the window
+	'''
+	if years not in WINDOWS:
+		raise InternalError(
+			670, "Risk window of %s years not supported" % years
+		)
+	if risk_free_rate is None:
+		risk_free_rate = settings.RISK_FREE_RATE
+	k = 12 * years
+	rf = (1.0 + risk_free_rate) ** (1.0 / 12) - 1.0
+
+	r = period_returns(navs)
+	valid = (~np.isnan(r)).astype(np.float64)
+	full = rolling_sum(valid, k) == k
+	paired = ~np.isnan(r) & ~np.isnan(bench)
+	r_p = np.where(paired, r, np.nan)
+	b_p = np.where(paired, bench, np.nan)
+	full_bench = full & (rolling_sum(paired.astype(np.float64), k) == k)
+
+	with np.errstate(divide='ignore', invalid='ignore'):
+		mean = rolling_sum(r, k) / k
+		var = (rolling_sum(r * r, k) - k * mean * mean) / (k - 1)
+		std_dev = np.sqrt(np.maximum(var, 0.0) * 12)
+		excess = (mean - rf) * 12
+		sharpe = excess / std_dev
+		downside = np.minimum(r - rf, 0.0)
+		downside_dev = np.sqrt(rolling_sum(downside * downside, k) / k * 12)
+		sortino = excess / downside_dev
+
+		mean_r = rolling_sum(r_p, k) / k
+		mean_b = rolling_sum(b_p, k) / k
+		cov = (rolling_sum(r_p * b_p, k) - k * mean_r * mean_b) / (k - 1)
+		var_b = (rolling_sum(b_p * b_p, k) - k * mean_b * mean_b) / (k - 1)
+		beta = cov / var_b
+		alpha = ((mean_r - rf) - beta * (mean_b - rf)) * 12
+
+	rolling = period_returns(navs, RETURN_MONTHS) * 100.0
+	stats = {
+		'std_dev': std_dev,
+		'sharpe_ratio': sharpe,
+		'sortino_ratio': sortino,
+		'alpha': alpha,
+		'beta': beta,
+		'avg_return': rolling_reduce(rolling, k, np.nanmean),
+		'min_return': rolling_reduce(rolling, k, np.nanmin),
+		'max_return': rolling_reduce(rolling, k, np.nanmax),
+	}
+	for field, values in stats.items():
+		values[~(full_bench if field in ('alpha', 'beta') else full)] = np.nan
+		values[~np.isfinite(values)] = np.nan
+	return RiskStats(**stats)
+
+
+################ LOADING
+
+def load_benchmark_weights(plan_ids, index_ids):
+	'''
+	Returns (plans x indices) matrix of FundBenchmarkIndex percentages of the fund scheme of every plan
+	'''
+	plan_pos = dict((int(p), i) for i, p in enumerate(plan_ids))
+	index_pos = dict((int(p), i) for i, p in enumerate(index_ids))
+	plans_of_fund = {}
+	for plan_id, fund_id in SchemePlan.objects.filter(id__in=[int(p) for p in plan_ids]).values_list('id', 'fund_scheme_id'):
+		plans_of_fund.setdefault(fund_id, []).append(plan_pos[plan_id])
+
+	weights = np.zeros((len(plan_ids), len(index_ids)))
+	rows = FundBenchmarkIndex.objects.filter(
+		fund_scheme_id__in=[f for f in plans_of_fund if f is not None],
+		benchmark_index_id__isnull=False,
+	).values_list('fund_scheme_id', 'benchmark_index_id', 'percentage')
+	for fund_id, index_id, percentage in rows:
+		if index_id in index_pos:
+			for pos in plans_of_fund[fund_id]:
+				weights[pos, index_pos[index_id]] = percentage
+	return weights
+
+
+def latest_snapshot_date():
+	return SchemePlanHistory.objects.aggregate(latest=Max('starting_date'))['latest']
+
+
+################ WRITING
+
+def bulk_update(model, ids, field_values, batch=WRITE_BATCH):
+	'''
+	Sets float fields of many rows with one UPDATE per batch; field_values maps field to array aligned with ids
+	NaN is written as NULL
+	'''
+	updated = 0
+	ids = [int(i) for i in ids]
+	for start in range(0, len(ids), batch):
+		chunk = ids[start:start + batch]
+		changes = {}
+		for field, values in field_values.items():
+			chunk_values = values[start:start + batch]
+			changes[field] = Case(
+				*[When(id=i, then=Value(None if np.isnan(v) else float(v))) for i, v in zip(chunk, chunk_values)],
+				output_field=FloatField()
+			)
+		updated += model.objects.filter(id__in=chunk).update(**changes)
+	return updated
+
+
+def snapshot_rows(plan_ids, ends, stats, columns, details=None):
+	'''
+	Builds SchemePlanHistory rows for given month columns of stats
+	details maps plan id to current ratings/aum/expense ratio, copied only into snapshots of the latest month
+	'''
+	rows = []
+	last = len(ends) - 1
+	for col in columns:
+		starting_date = month_start(ends[col])
+		values = dict((field, getattr(stats, field)[:, col]) for field in RiskStats.FIELDS)
+		has_stats = ~np.isnan(values['std_dev'])
+		for pos in np.nonzero(has_stats)[0]:
+			row = dict((field, None if np.isnan(values[field][pos]) else round(float(values[field][pos]), 6))
+				for field in RiskStats.FIELDS)
+			if details is not None and col == last:
+				row.update(details.get(int(plan_ids[pos]), {}))
+			rows.append(SchemePlanHistory(starting_date=starting_date, scheme_id=int(plan_ids[pos]), **row))
+	return rows
+
+
+def plan_details(plan_ids):
+	'''
+	Current values of fields of SchemePlanHistory that are copied from SchemePlan rather than computed
+	'''
+	details = {}
+	rows = SchemePlan.objects.filter(id__in=[int(p) for p in plan_ids]).values_list(
+		'id', 'rating_crisil', 'rating_vro', 'rating_ms', 'expense_ratio', 'fund_scheme__aum',
+	)
+	for plan_id, rating_crisil, rating_vro, rating_ms, expense_ratio, aum in rows:
+		details[plan_id] = {
+			'rating_crisil': rating_crisil,
+			'rating_vro': rating_vro,
+			'rating_ms': rating_ms,
+			'expense_ratio': expense_ratio,
+			'aum': aum,
+		}
+	return details
+
+
+################ PIPELINE
+
+def update_risk_snapshots(incremental=True, years=None, store=None, index_store=None, plan_ids=None):
+	'''
+	Writes SchemePlanHistory snapshots for month ends not yet snapshotted (only months after the
+	latest snapshot if incremental, else every month missing a row) and sets avg/min/max_return of
+	SchemePlan and BenchmarkIndex from the latest month. Run after the month's navs are loaded
+	Returns number of snapshot rows created
+	'''
+	if years is None:
+		years = settings.RISK_WINDOW_YEARS
+	store = store or timeseries.fund_store()
+	index_store = index_store or timeseries.index_store()
+
+	with metrics.timer('risk', stage='load_navs'):
+		if plan_ids is None:
+			plan_ids = SchemePlan.objects.values_list('id', flat=True)
+		panel = NavPanel(plan_ids, store)
+		plan_ids = panel.scheme_ids
+		has_navs = panel.latest_day >= 0
+		if not has_navs.any():
+			return 0
+		first_day = int(min(store.get(int(p)).dates[0] for p in plan_ids[has_navs]))
+		ends = month_ends(first_day, int(panel.latest_day.max()))
+		if not len(ends):
+			return 0
+		if incremental:
+			latest = latest_snapshot_date()
+			columns = [c for c in range(len(ends)) if latest is None or month_start(ends[c]) > latest]
+			## only windows ending at new months, and at the last one for avg/min/max_return of plans, are
+			## computed- so only the month ends they span are read
+			start = window_start(columns[0] if columns else len(ends) - 1, years)
+			ends = ends[start:]
+			columns = [c - start for c in columns]
+		navs = monthly_values(panel, plan_ids, ends)
+
+	with metrics.timer('risk', stage='load_benchmarks'):
+		index_panel = NavPanel(BenchmarkIndex.objects.values_list('id', flat=True), index_store)
+		index_ids = index_panel.scheme_ids
+		index_values = monthly_values(index_panel, index_ids, ends)
+		weights = load_benchmark_weights(plan_ids, index_ids)
+		bench = benchmark_returns(weights, period_returns(index_values))
+
+	with metrics.timer('risk', stage='compute'):
+		stats = compute_risk(navs, bench, years)
+		## benchmark's own rolling returns, for BenchmarkIndex
+		index_stats = compute_risk(index_values, period_returns(index_values), years)
+
+	with metrics.timer('risk', stage='save'):
+		if incremental:
+			existing = set()
+		else:
+			columns = range(len(ends))
+			existing = set(SchemePlanHistory.objects.values_list('scheme_id', 'starting_date'))
+		rows = snapshot_rows(plan_ids, ends, stats, columns, plan_details(plan_ids))
+		rows = [row for row in rows if (row.scheme_id, row.starting_date) not in existing]
+		SchemePlanHistory.objects.bulk_create(rows, batch_size=WRITE_BATCH)
+
+		fields = ('avg_return', 'min_return', 'max_return')
+		bulk_update(SchemePlan, plan_ids, dict((f, getattr(stats, f)[:, -1]) for f in fields))
+		bulk_update(BenchmarkIndex, index_ids, dict((f, getattr(index_stats, f)[:, -1]) for f in fields))
+	return len(rows)
@@ -0,0 +1,81 @@
+'''
+Author: utkarshohm
+Description: When status of a pending transaction is checked next, from its state and age. next_check_at of
+	transactions is set from this after each check (see tracking.py), so that the tracker daemon and
+	update_transaction_status only check transactions that are due, not every pending one every run
+	- awaiting payment ('2', '4'): soon after the order and then less and less often, each check a fraction
+		of its age later (exponential backoff). It fails due to no payment after settings.SCHEDULE_PAYMENT_EXPIRY
+	- paid and sent to RTA ('5'): at the allotment crawl on each market date allotment is expected on,
+		then with exponential backoff as for payments
+	- SIP instalments are checked on their instalment dates (see tracking.orders_to_check), not scheduled here
+	All datetimes are naive UTC, as next_check_at is stored
+'''
+
+import datetime
+
+import settings
+import market
+
+
+PAYMENT_PENDING = ('2', '4')
+RTA_PENDING = '5'
+
+
+def created(tr):
+	return tr.created.replace(tzinfo=None)
+
+
+def backoff(age, max_interval):
+	'''
+	Time to the next check of a transaction of age (timedelta)- settings.SCHEDULE_BACKOFF of its age,
+	at least settings.SCHEDULE_MIN_INTERVAL and at most max_interval seconds
+	'''
+	seconds = min(max(age.total_seconds() * settings.SCHEDULE_BACKOFF, settings.SCHEDULE_MIN_INTERVAL), max_interval)
+	return datetime.timedelta(seconds=seconds)
+
+
+def payment_expired(tr, now):
+	'''
+	Whether transaction tr has waited for payment longer than settings.SCHEDULE_PAYMENT_EXPIRY at now
+	'''
+	return tr.status in PAYMENT_PENDING and \
+		(now - created(tr)).total_seconds() > settings.SCHEDULE_PAYMENT_EXPIRY
+
+
+def allotment_checks(order_d):
+	'''
+	Datetimes of the allotment crawls on the settings.SCHEDULE_ALLOTMENT_DAYS market dates from order date order_d
+	'''
+	allotment_time = datetime.datetime.strptime(settings.SCHEDULE_ALLOTMENT_TIME, '%H:%M').time()
+	checks = []
+	d = order_d
+	while d is not None and len(checks) < settings.SCHEDULE_ALLOTMENT_DAYS:
+		checks.append(datetime.datetime.combine(d, allotment_time) - market.IST_OFFSET)
+		d = market.next_market_date(d + datetime.timedelta(days=1))
+	return checks
+
+
+def next_check_at(tr, now):
+	'''
+	When status of transaction tr is checked next, after a check at now
+	None for transactions that aren't scheduled- SIPs and those in a final state
+	'''
+	if tr.order_type != '1':
+		return None
+	age = now - created(tr)
+	if tr.status in PAYMENT_PENDING:
+		return now + backoff(age, settings.SCHEDULE_PAYMENT_MAX_INTERVAL)
+	elif tr.status == RTA_PENDING:
+		order_d = market.calculate_order_date(created(tr) + market.IST_OFFSET)
+		for check_at in (allotment_checks(order_d) if order_d else []):
+			if check_at > now:
+				return check_at
+		return now + backoff(age, settings.SCHEDULE_ALLOTMENT_MAX_INTERVAL)
+	return None
+
+
+def is_due(tr, now):
+	'''
+	Whether status of transaction tr is due a check at now
+	'''
+	return tr.next_check_at is None or tr.next_check_at.replace(tzinfo=None) <= now
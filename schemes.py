@@ -0,0 +1,186 @@
+'''
+Author: utkarshohm
+Description: Process level cache of the scheme plan master. Keeps one compact record per SchemePlan
+	with the codes used to talk to BSE, RTAs and AMFI and the attributes that decide whether an order
+	is allowed, indexed by id, bse_code, isin, rta_code and amc_code. Loaded with one query and then
+	refreshed incrementally from last_updated, so order preparation doesn't lazy-load a SchemePlan
+	per order. Load it before forking worker processes (see preload) and workers share the same
+	pages read-only, or with settings.SNAPSHOT_FILE set, workers that are not forked read plans from the
+	snapshot their parent published (see snapshot.py)
+'''
+
+import re
+import threading
+import time
+
+from errors import InternalError
+import repository
+import settings
+import snapshot
+
+
+## fields of SchemePlan copied into records
+FIELDS = (
+	'id', 'name', 'bse_code', 'isin', 'rta_code', 'amc_code',
+	'if_open', 'if_sip', 'min_inv', 'min_addl_inv', 'min_sip_inv', 'min_sip_inst', 'sip_start_dates',
+	'last_updated',
+)
+
+DAY_REGEX = re.compile(r'\d+')
+
+
+class SchemeRecord(object):
+	'''
+	Read-only copy of the fields of a SchemePlan needed to place and check orders
+	sip_start_days is sip_start_dates parsed into a frozenset of days of month
+	'''
+	__slots__ = (
+		'id', 'name', 'bse_code', 'isin', 'rta_code', 'amc_code',
+		'if_open', 'if_sip', 'min_inv', 'min_addl_inv', 'min_sip_inv', 'min_sip_inst', 'sip_start_days',
+		'last_updated',
+	)
+
+	def __init__(self, id, name, bse_code, isin, rta_code, amc_code, if_open, if_sip,
+		min_inv, min_addl_inv, min_sip_inv, min_sip_inst, sip_start_dates, last_updated):
+		self.id = id
+		self.name = name
+		self.bse_code = bse_code
+		self.isin = isin
+		self.rta_code = rta_code
+		self.amc_code = amc_code
+		## if_open is a NullBooleanField; unknown is treated as open like the model's default
+		self.if_open = if_open is not False
+		self.if_sip = bool(if_sip)
+		self.min_inv = min_inv
+		self.min_addl_inv = min_addl_inv
+		self.min_sip_inv = min_sip_inv
+		self.min_sip_inst = min_sip_inst
+		self.sip_start_days = frozenset(int(d) for d in DAY_REGEX.findall(sip_start_dates or ''))
+		self.last_updated = last_updated
+
+	def __repr__(self):
+		return '<SchemeRecord %s %s>' % (self.id, self.bse_code)
+
+
+class SchemeCache(object):
+	'''
+	Records of all scheme plans and indices on their codes
+	refresh() reads only plans changed since the last refresh. Plans are never deleted
+	(SchemePlan is protected by foreign keys), so removals are not tracked
+	'''
+	INDEXED = ('bse_code', 'isin', 'rta_code', 'amc_code')
+
+	def __init__(self, max_age=None):
+		self.max_age = settings.SCHEME_CACHE_MAX_AGE if max_age is None else max_age
+		self.by_id = {}
+		self.indices = dict((field, {}) for field in self.INDEXED)
+		self.last_updated = None
+		self.refreshed_at = None
+		self.lock = threading.Lock()
+
+	def __len__(self):
+		return len(self.by_id)
+
+	def refresh(self, force=False):
+		'''
+		Loads plans changed since the last refresh if the cache is older than max_age (or if forced)
+		Returns number of records loaded
+		'''
+		if not force and self.refreshed_at is not None and time.time() - self.refreshed_at < self.max_age:
+			return 0
+		with self.lock:
+			started = time.time()
+			## >= so that plans saved in the same instant as the last refresh are not missed
+			rows = repository.get().scheme_plans(FIELDS, changed_since=self.last_updated)
+			count = 0
+			for row in rows:
+				self.add(SchemeRecord(*row))
+				count += 1
+			self.refreshed_at = started
+			return count
+
+	def add(self, record):
+		old = self.by_id.get(record.id)
+		if old is not None:
+			for field in self.INDEXED:
+				index = self.indices[field]
+				key = getattr(old, field)
+				if key and index.get(key) is old:
+					del index[key]
+		self.by_id[record.id] = record
+		for field in self.INDEXED:
+			key = getattr(record, field)
+			if key:
+				self.indices[field][key] = record
+		if self.last_updated is None or (record.last_updated and record.last_updated > self.last_updated):
+			self.last_updated = record.last_updated
+
+	def lookup(self, field, key):
+		'''
+		Returns record of the plan whose field is key, None if there is none
+		A miss forces a refresh in case the plan was added after the last one
+		'''
+		self.refresh()
+		index = self.by_id if field == 'id' else self.indices[field]
+		record = index.get(key)
+		if record is None:
+			self.refresh(force=True)
+			record = index.get(key)
+		return record
+
+	def get(self, plan_id):
+		return self.lookup('id', plan_id)
+
+	def by_bse_code(self, bse_code):
+		return self.lookup('bse_code', bse_code)
+
+	def by_isin(self, isin):
+		return self.lookup('isin', isin)
+
+	def by_rta_code(self, rta_code):
+		return self.lookup('rta_code', rta_code)
+
+	def by_amc_code(self, amc_code):
+		return self.lookup('amc_code', amc_code)
+
+	def records(self):
+		self.refresh()
+		return list(self.by_id.values())
+
+
+## one cache per process
+CACHE = SchemeCache()
+
+
+def cache():
+	'''
+	Returns the process level cache, refreshed if it is older than settings.SCHEME_CACHE_MAX_AGE
+	With settings.SNAPSHOT_FILE set, the plans of the published snapshot if there is one
+	'''
+	if settings.SNAPSHOT_FILE:
+		mapped = snapshot.current()
+		if mapped is not None:
+			return mapped.schemes
+	CACHE.refresh()
+	return CACHE
+
+
+def preload():
+	'''
+	Loads the cache fully. Call in the parent before forking workers so that they share its memory
+	instead of each loading it; workers then only refresh plans changed since
+	'''
+	CACHE.refresh(force=True)
+	return CACHE
+
+
+def bse_code(plan_id):
+	'''
+	Returns bse_code of a scheme plan without querying it
+	'''
+	record = cache().get(plan_id)
+	if record is None:
+		raise InternalError(
+			671, "Scheme plan %s not found" % plan_id
+		)
+	return record.bse_code
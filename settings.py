@@ -57,3 +57,198 @@ METHOD_UPLOAD_URL = [
     'http://bsestarmfdemo.bseindia.com/2016/01/IMFUploadService/',
     'http://www.bsestarmf.in/2016/01/IStarMFWebService/'
 ]
+
+
+'''
+Audit log of SOAP requests sent to BSEStar and responses received
+Regulations require to archive these for 5 years, so segments are never deleted by the library
+'''
+# directory where compressed JSONL segments are written
+AUDIT_LOG_DIR = 'logs/soap_audit'
+# a new segment is started once this many (uncompressed) bytes are written to the current one
+AUDIT_SEGMENT_MAX_BYTES = 64 * 1024 * 1024
+# records waiting to be written; if writer falls this far behind, the calling thread waits for room
+AUDIT_QUEUE_SIZE = 10000
+# seconds to wait for room in a full queue before the calling thread writes the record itself
+AUDIT_QUEUE_TIMEOUT = 0.1
+# set to True to also print zeep's raw http traffic to console when debugging
+SOAP_DEBUG = False
+
+
+'''
+Latency and outcome metrics of api and web functions
+'''
+# cheap enough to leave on in production
+METRICS_ENABLED = True
+# prefix of all exported metric names
+METRICS_PREFIX = 'bse'
+# statsd daemon to send metrics to at end of every run; None to disable
+METRICS_STATSD_HOST = None
+METRICS_STATSD_PORT = 8125
+# file for prometheus node_exporter's textfile collector, written at end of every run; None to disable
+METRICS_PROMETHEUS_FILE = None
+# print a per-run summary at end of every management command
+METRICS_SUMMARY = False
+
+
+'''
+Profiling of management command runs. Can also be turned on per run with --profile
+'''
+PROFILE_COMMANDS = False
+# a report (txt, json and cProfile .prof files) is written here for every profiled run
+PROFILE_DIR = 'logs/profile'
+
+
+'''
+Columnar store of daily nav and index time series (see timeseries.py)
+'''
+TIMESERIES_DIR = 'data/timeseries'
+
+
+'''
+Monthly risk and return snapshots of scheme plans (see risk.py)
+'''
+# annual risk free rate used for sharpe, sortino and alpha
+RISK_FREE_RATE = 0.06
+# years of monthly returns that risk measures in SchemePlanHistory are computed over- 1, 3 or 5
+RISK_WINDOW_YEARS = 3
+
+
+'''
+Process level cache of scheme plans (see schemes.py)
+'''
+# seconds after which the cache reads plans changed since its last refresh
+SCHEME_CACHE_MAX_AGE = 300
+
+
+'''
+Data access of api.py and web.py (see repository.py)
+'''
+# 'django' to use the django ORM; 'sqlite' or 'sql' to run without django on a plain DB-API connection
+REPOSITORY_BACKEND = 'django'
+# tables and order validation rules exported from the django models for the sqlite and sql backends
+# by the export_repository_schema management command
+REPOSITORY_SCHEMA = 'data/repository_schema.json'
+# database file of the sqlite backend
+REPOSITORY_DB = 'db.sqlite3'
+# DB-API module and keyword arguments of its connect() for the sql backend
+REPOSITORY_SQL_MODULE = 'MySQLdb'
+REPOSITORY_SQL_CONNECT = {}
+# table names to use instead of the exported ones, by model name
+REPOSITORY_TABLES = {}
+
+
+'''
+Calendar of days BSE is open for mutual fund transactions (see market.py)
+'''
+MARKET_DATES_FILE = 'requirements/market_dates.csv'
+
+
+'''
+Daemon that keeps transaction status up to date in place of cron runs of update_transaction_status (see tracker.py)
+'''
+# times (IST, HH:MM) on market days at which order status is crawled from the web portal
+TRACKER_CRAWL_TIMES = ('10:05', '15:05', '18:05')
+# seconds between polls for transactions whose payment status is due a check
+TRACKER_TICK = 30
+# most payment statuses checked per poll
+TRACKER_PAYMENT_BATCH = 100
+# seconds between exports of metrics; the registry is reset after each export like at the end of a cron run
+TRACKER_METRICS_INTERVAL = 60
+# seconds idle after which the crawler logs into the web portal again
+TRACKER_SESSION_MAX_IDLE = 900
+# seconds after which the crawler's browser is restarted
+TRACKER_DRIVER_MAX_AGE = 86400
+# number of shards transactions are split into by user id between tracker daemons sharing the database
+# (see leases.py); the same on all of them. 1 for one daemon tracking all transactions, without leases
+TRACKER_SHARDS = 1
+# seconds a daemon holds its shards without renewing them- longer than a step between renewals takes (a crawl
+# renews them every third of this), and than clocks of machines running daemons differ
+TRACKER_LEASE_TTL = 600
+
+
+'''
+When status of pending transactions is checked (see schedule.py)
+'''
+# status is checked again after this fraction of the transaction's age, at least this many seconds later
+# eg. a transaction created 10 minutes ago is checked again in 2.5 minutes, one created 2 hours ago in 30 minutes
+SCHEDULE_BACKOFF = 0.25
+SCHEDULE_MIN_INTERVAL = 60
+# and at most this many seconds later- for transactions awaiting payment and for those awaiting allotment
+SCHEDULE_PAYMENT_MAX_INTERVAL = 3600
+SCHEDULE_ALLOTMENT_MAX_INTERVAL = 86400
+# seconds after which a transaction still awaiting payment has failed due to no payment
+SCHEDULE_PAYMENT_EXPIRY = 3 * 86400
+# time (IST, HH:MM) of the crawl by which allotments of the day are shown, and number of market dates
+# from the order date on which allotment is expected
+SCHEDULE_ALLOTMENT_TIME = '18:05'
+SCHEDULE_ALLOTMENT_DAYS = 2
+
+
+'''
+Circuit breakers, concurrency limits and retries of calls to BSEStar (see resilience.py)
+'''
+# a circuit opens when this share of an endpoint's last RESILIENCE_WINDOW calls failed, and at least
+# RESILIENCE_MIN_CALLS were made
+RESILIENCE_WINDOW = 20
+RESILIENCE_MIN_CALLS = 5
+RESILIENCE_FAILURE_RATE = 0.5
+# seconds an open circuit fails calls for before letting a trial call through
+RESILIENCE_COOLDOWN = 30
+# calls in flight per endpoint- at start, least and most
+RESILIENCE_CONCURRENCY = 4
+RESILIENCE_MIN_CONCURRENCY = 1
+RESILIENCE_MAX_CONCURRENCY = 16
+# the limit is multiplied by this on a failure or a call slower than RESILIENCE_SLOW_CALL seconds
+RESILIENCE_DECREASE = 0.5
+RESILIENCE_SLOW_CALL = 10.0
+# retries of a transient failure, and seconds of backoff before the first retry (doubled for each next) and at most
+RESILIENCE_RETRIES = 3
+RESILIENCE_BACKOFF = 0.5
+RESILIENCE_MAX_BACKOFF = 10.0
+
+
+'''
+Crawling of BSEStar's web portal (see web.py)
+'''
+# retries of a login or a crawl whose pages didn't render in time, and restarts of a browser that stopped responding
+CRAWLER_RETRIES = 3
+
+
+'''
+Snapshot of the market calendar and scheme plans shared by worker processes (see snapshot.py)
+'''
+# file the parent process publishes the snapshot to and workers map; None for every process to load its own
+SNAPSHOT_FILE = None
+# seconds after which a worker checks whether a newer snapshot was published
+SNAPSHOT_CHECK_INTERVAL = 60
+
+
+'''
+Reconciliation of transactions with order status and allotment files of BSE and RTAs (see reconcile.py)
+'''
+# names (any case) of the columns used, as the header line of a file may give them
+RECONCILE_COLUMNS = {
+	'order_id': ('Order No', 'Order Number', 'Order Id', 'ORDER_NO', 'ORDERNO'),
+	'status': ('Order Status', 'Status', 'ORDER_STATUS'),
+	'folio': ('Folio No', 'Folio Number', 'Folio', 'FOLIO_NO', 'FOLIONO'),
+	'date': ('Order Date', 'Date', 'ORDER_DATE', 'Allotment Date', 'ALLOTMENT_DATE'),
+}
+# formats of dates in files; a time after the date is ignored
+RECONCILE_DATE_FORMATS = ('%d/%m/%Y', '%d-%b-%Y', '%d-%m-%Y', '%Y-%m-%d', '%d%m%Y')
+# matched rows saved together
+RECONCILE_BATCH = 1000
+
+
+'''
+Payment links of transactions, reused while they are valid (see payment_links.py)
+'''
+# seconds after BSEStar made a transaction's payment link that it is reused; less than BSEStar keeps a link valid
+PAYMENT_LINK_TTL = 600
+
+
+'''
+Status of mandates after registration (see mandates.py)
+'''
+# seconds after a mandate's status was read from the web portal's mandate report before it is read again
+MANDATE_CHECK_INTERVAL = 4 * 3600
@@ -0,0 +1,333 @@
+'''
+Author: utkarshohm
+Description: Snapshot of the market calendar and the scheme plan master in one read-only file, for pools of
+	worker processes. A parent process publishes it (publish(), or the export_snapshot management command)
+	and workers map it into memory- the OS keeps one copy of its pages for all of them, and dates and plans
+	are read in place by binary search, so workers neither load the calendar and plans nor keep copies
+	market.dates() and schemes.cache() read from it when settings.SNAPSHOT_FILE is set
+	The file carries version stamps of its sources. publish() rewrites it, atomically by a rename, only
+	when the calendar file or the plans changed, and workers attach to the new file once they see it
+	Layout- magic, offset and length of a json header (stamps and offsets of sections), sections, the header
+	- dates: sorted date ordinals, int32
+	- records: offset and length (uint32) of each plan's fields as json, followed by the json
+	- id: sorted (id int64, record number uint32); bse_code, isin, rta_code, amc_code: (offset and length
+		of key, record number) sorted by key, followed by the keys
+'''
+
+import datetime
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+
+import settings
+from errors import InternalError
+
+
+MAGIC = b'MFSNAP01'
+PREFIX = struct.Struct('<8sQI')
+## sections start after the prefix, 8 byte aligned
+START = PREFIX.size + (-PREFIX.size % 8)
+DATE = struct.Struct('<i')
+SLICE = struct.Struct('<II')
+ID_ENTRY = struct.Struct('<qI')
+KEY_ENTRY = struct.Struct('<III')
+
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+def to_bytes(value):
+	return value if isinstance(value, bytes) else value.encode('utf-8')
+
+
+################ READING
+
+class MappedDates(object):
+	'''
+	Sorted sequence of dates read from the snapshot on access; bisect works on it as on a list
+	'''
+
+	def __init__(self, mm, offset, count):
+		self.mm = mm
+		self.offset = offset
+		self.count = count
+
+	def __len__(self):
+		return self.count
+
+	def __getitem__(self, i):
+		if i < 0:
+			i += self.count
+		if not 0 <= i < self.count:
+			raise IndexError('date index out of range')
+		return datetime.date.fromordinal(DATE.unpack_from(self.mm, self.offset + DATE.size * i)[0])
+
+
+class MappedSchemes(object):
+	'''
+	Scheme plans of the snapshot, with the lookups of schemes.SchemeCache
+	Records are decoded on lookup. Plans added after the snapshot was published are looked up in the
+	process level cache, ie. the database
+	'''
+	INDEXED = ('bse_code', 'isin', 'rta_code', 'amc_code')
+
+	def __init__(self, mm, sections):
+		self.mm = mm
+		self.sections = sections
+		self.count = sections['records'][1]
+
+	def __len__(self):
+		return self.count
+
+	def refresh(self, force=False):
+		return 0
+
+	def record(self, n):
+		import schemes
+		offset, length = SLICE.unpack_from(self.mm, self.sections['records'][0] + SLICE.size * n)
+		values = json.loads(self.mm[offset:offset + length].decode('utf-8'))
+		if values[-1] is not None:
+			values[-1] = datetime.datetime.strptime(values[-1], DATETIME_FORMAT)
+		return schemes.SchemeRecord(*values)
+
+	def find(self, field, key):
+		'''
+		Number of the record whose field is key, None if there is none
+		'''
+		offset, count = self.sections[field]
+		lo, hi = 0, count
+		if field == 'id':
+			key = int(key)
+			while lo < hi:
+				mid = (lo + hi) // 2
+				entry_key, n = ID_ENTRY.unpack_from(self.mm, offset + ID_ENTRY.size * mid)
+				if entry_key < key:
+					lo = mid + 1
+				elif entry_key > key:
+					hi = mid
+				else:
+					return n
+			return None
+		key = to_bytes(key)
+		while lo < hi:
+			mid = (lo + hi) // 2
+			key_offset, key_length, n = KEY_ENTRY.unpack_from(self.mm, offset + KEY_ENTRY.size * mid)
+			entry_key = self.mm[key_offset:key_offset + key_length]
+			if entry_key < key:
+				lo = mid + 1
+			elif entry_key > key:
+				hi = mid
+			else:
+				return n
+		return None
+
+	def lookup(self, field, key):
+		if not key:
+			return None
+		n = self.find(field, key)
+		if n is None:
+			import schemes
+			return schemes.CACHE.lookup(field, key)
+		return self.record(n)
+
+	def get(self, plan_id):
+		return self.lookup('id', plan_id)
+
+	def by_bse_code(self, bse_code):
+		return self.lookup('bse_code', bse_code)
+
+	def by_isin(self, isin):
+		return self.lookup('isin', isin)
+
+	def by_rta_code(self, rta_code):
+		return self.lookup('rta_code', rta_code)
+
+	def by_amc_code(self, amc_code):
+		return self.lookup('amc_code', amc_code)
+
+	def records(self):
+		return [self.record(n) for n in range(self.count)]
+
+
+class Snapshot(object):
+	'''
+	A snapshot file mapped read-only
+	'''
+
+	def __init__(self, path):
+		with open(path, 'rb') as f:
+			self.stat = file_id(os.fstat(f.fileno()))
+			self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		if self.mm[:len(MAGIC)] != MAGIC:
+			raise InternalError(
+				682, "%s is not a snapshot file" % path
+			)
+		self.header = read_header(self.mm)
+		self.version = self.header['version']
+		sections = self.header['sections']
+		self.dates = MappedDates(self.mm, *sections['dates'])
+		self.schemes = MappedSchemes(self.mm, sections)
+
+
+def read_header(buf):
+	magic, offset, length = PREFIX.unpack_from(buf, 0)
+	return json.loads(buf[offset:offset + length].decode('utf-8'))
+
+
+def file_id(st):
+	return (st.st_ino, st.st_size, st.st_mtime)
+
+
+_current = {'snapshot': None, 'checked_at': None}
+_lock = threading.Lock()
+
+
+def current(force=False):
+	'''
+	The snapshot at settings.SNAPSHOT_FILE, None if there is none. Checks for a newly published one at most
+	every settings.SNAPSHOT_CHECK_INTERVAL seconds (or if forced)
+	'''
+	now = time.time()
+	checked_at = _current['checked_at']
+	if not force and checked_at is not None and now - checked_at < settings.SNAPSHOT_CHECK_INTERVAL:
+		return _current['snapshot']
+	with _lock:
+		snapshot = _current['snapshot']
+		try:
+			stat = file_id(os.stat(settings.SNAPSHOT_FILE))
+		except OSError:
+			stat = None
+		if stat is None:
+			snapshot = None
+		elif snapshot is None or snapshot.stat != stat:
+			## the old mapping is unmapped once no record being read refers to it
+			snapshot = Snapshot(settings.SNAPSHOT_FILE)
+		_current['snapshot'] = snapshot
+		_current['checked_at'] = now
+	return snapshot
+
+
+################ PUBLISHING
+
+def market_stamp(path=None):
+	with open(path or settings.MARKET_DATES_FILE, 'rb') as f:
+		return hashlib.sha1(f.read()).hexdigest()
+
+
+def schemes_stamp(repo=None):
+	'''
+	Number of plans and when the last of them changed- a plan added or changed changes it
+	'''
+	import repository
+	rows = (repo or repository.get()).scheme_plans(('id', 'last_updated'))
+	last_updated = max([encode_datetime(r[1]) for r in rows if r[1] is not None] or [None])
+	return [len(rows), last_updated]
+
+
+def encode_datetime(value):
+	if value is None:
+		return None
+	import repository
+	return repository.db_value(value).strftime(DATETIME_FORMAT)
+
+
+def published_header(path):
+	'''
+	Header of the snapshot at path, None if there is none
+	'''
+	try:
+		with open(path, 'rb') as f:
+			prefix = f.read(PREFIX.size)
+			if len(prefix) < PREFIX.size or prefix[:len(MAGIC)] != MAGIC:
+				return None
+			magic, offset, length = PREFIX.unpack(prefix)
+			f.seek(offset)
+			return json.loads(f.read(length).decode('utf-8'))
+	except (IOError, OSError):
+		return None
+
+
+def build(dates, rows):
+	'''
+	Returns sections of a snapshot of market dates and scheme plan rows (in the order of schemes.FIELDS)
+	as (list of byte strings, dict of section name to [offset, count])
+	'''
+	import schemes
+	chunks = []
+	sections = {}
+	size = [START]
+
+	def add(name, data, count):
+		sections[name] = [size[0], count]
+		chunks.append(data)
+		size[0] += len(data)
+		## keep sections 8 byte aligned
+		padding = -size[0] % 8
+		chunks.append(b'\0' * padding)
+		size[0] += padding
+
+	add('dates', b''.join(DATE.pack(d.toordinal()) for d in dates), len(dates))
+
+	blobs = []
+	for row in rows:
+		values = list(row)
+		values[-1] = encode_datetime(values[-1])
+		blobs.append(json.dumps(values, default=str).encode('utf-8'))
+	table_size = SLICE.size * len(blobs)
+	table = []
+	offset = size[0] + table_size
+	for blob in blobs:
+		table.append(SLICE.pack(offset, len(blob)))
+		offset += len(blob)
+	add('records', b''.join(table) + b''.join(blobs), len(blobs))
+
+	ids = dict((row[0], n) for n, row in enumerate(rows))
+	add('id', b''.join(ID_ENTRY.pack(k, ids[k]) for k in sorted(ids)), len(ids))
+
+	for field in MappedSchemes.INDEXED:
+		position = schemes.FIELDS.index(field)
+		## a later plan with the same code wins, as in schemes.SchemeCache
+		keys = dict((to_bytes(row[position]), n) for n, row in enumerate(rows) if row[position])
+		entries = []
+		offset = size[0] + KEY_ENTRY.size * len(keys)
+		for k in sorted(keys):
+			entries.append(KEY_ENTRY.pack(offset, len(k), keys[k]))
+			offset += len(k)
+		add(field, b''.join(entries) + b''.join(sorted(keys)), len(keys))
+	return chunks, sections
+
+
+def publish(path=None, force=False, repo=None):
+	'''
+	Writes a snapshot of the market calendar and scheme plans to path (settings.SNAPSHOT_FILE) unless
+	the one there is of the same calendar and plans. Returns its version
+	'''
+	import market
+	import repository
+	import schemes
+	path = path or settings.SNAPSHOT_FILE
+	repo = repo or repository.get()
+	stamps = {'market': market_stamp(), 'schemes': schemes_stamp(repo)}
+	header = published_header(path)
+	if not force and header is not None and header['stamps'] == stamps:
+		return header['version']
+
+	chunks, sections = build(market.load_dates(), repo.scheme_plans(schemes.FIELDS))
+	version = hashlib.sha1(json.dumps(stamps, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+	data = json.dumps({'version': version, 'stamps': stamps, 'sections': sections}, sort_keys=True).encode('utf-8')
+	body = b''.join(chunks)
+
+	## written to a temporary file and renamed so that workers never map a partly written file
+	tmp_path = '%s.%d.tmp' % (path, os.getpid())
+	with open(tmp_path, 'wb') as f:
+		f.write(PREFIX.pack(MAGIC, START + len(body), len(data)))
+		f.write(b'\0' * (START - PREFIX.size))
+		f.write(body)
+		f.write(data)
+		f.flush()
+		os.fsync(f.fileno())
+	os.rename(tmp_path, path)
+	return version
@@ -0,0 +1,87 @@
+'''
+Author: utkarshohm
+Description: Import time benchmark of the modules workers and cron jobs start from. Each module is imported
+	in a fresh interpreter a few times and the fastest import is compared with its budget; heavy
+	dependencies that got imported along are reported too, as they must only load on first use
+	Run it after changing imports- exits with 1 on a regression:
+		python startup.py
+	web.py is python 2 only, run with python 2 to include it
+'''
+
+import json
+import os
+import subprocess
+import sys
+
+
+## dependencies that only the functions needing them may import
+HEAVY = ('selenium', 'pyvirtualdisplay', 'zeep', 'lxml', 'django', 'numpy', 'scipy', 'pytz', 'dateutil')
+
+## module: seconds its import may take
+BUDGETS = {
+	'api': 0.15,
+	'web': 0.15,
+	'tracking': 0.1,
+	'market': 0.05,
+	'repository': 0.05,
+}
+
+CODE = '''
+import json, sys, time
+started = time.time()
+import %(module)s
+elapsed = time.time() - started
+heavy = [name for name in %(heavy)r if name in sys.modules]
+sys.stdout.write(json.dumps({'seconds': elapsed, 'heavy': heavy}))
+'''
+
+
+def measure(module, repeat=5, python=None):
+	'''
+	Returns {'seconds': fastest import of module, 'heavy': heavy dependencies it imported}
+	'''
+	root = os.path.dirname(os.path.abspath(__file__))
+	best = None
+	for i in range(repeat):
+		with open(os.devnull, 'w') as devnull:
+			output = subprocess.check_output(
+				[python or sys.executable, '-c', CODE % {'module': module, 'heavy': HEAVY}], cwd=root, stderr=devnull)
+		result = json.loads(output.decode('utf-8'))
+		if best is None or result['seconds'] < best['seconds']:
+			best = result
+	return best
+
+
+def benchmark(budgets=None, repeat=5, python=None):
+	'''
+	Measures modules of budgets (BUDGETS by default). Returns (results, list of regressions)
+	Modules that can't be imported by this python (web.py on python 3) are skipped
+	'''
+	budgets = budgets or BUDGETS
+	results = {}
+	regressions = []
+	for module in sorted(budgets):
+		try:
+			result = measure(module, repeat, python)
+		except subprocess.CalledProcessError:
+			results[module] = None
+			continue
+		results[module] = result
+		if result['seconds'] > budgets[module]:
+			regressions.append('%s imports in %.3fs, budget is %.3fs' % (module, result['seconds'], budgets[module]))
+		if result['heavy']:
+			regressions.append('%s imports %s' % (module, ', '.join(result['heavy'])))
+	return results, regressions
+
+
+if __name__ == '__main__':
+	results, regressions = benchmark()
+	for module in sorted(results):
+		result = results[module]
+		if result is None:
+			print('%-12s skipped, cannot be imported by this python' % module)
+		else:
+			print('%-12s %.3fs  %s' % (module, result['seconds'], ', '.join(result['heavy']) or '-'))
+	for regression in regressions:
+		print('REGRESSION: %s' % regression)
+	sys.exit(1 if regressions else 0)
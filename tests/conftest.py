@@ -0,0 +1,116 @@
+'''
+Author: utkarshohm
+Description: Fixtures of the tests. Modules are imported as top level modules, as api.py and web.py import
+	them, and tables are in an sqlite database read through repository.SQLiteRepository, so the tests run
+	without django, a browser or BSEStar
+	Run them from the root of the repository with
+		python -m pytest tests
+'''
+
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import settings
+settings.MARKET_DATES_FILE = os.path.join(ROOT, 'requirements', 'market_dates.csv')
+
+import repository
+
+
+## tables of the models the tests use, as django's sqlite3 backend creates them
+TABLES = {
+	'Transaction': '''CREATE TABLE t_transaction (
+		id integer PRIMARY KEY AUTOINCREMENT, user_id integer, scheme_plan_id integer,
+		transaction_type varchar(1), order_type varchar(1), status varchar(1), status_comment varchar(1000),
+		amount real, all_redeem bool, sip_num_inst integer, sip_start_date date, sip_num_inst_done integer,
+		sip_dates varchar(255), sip_order_ids varchar(255), mandate_id varchar(10), datetime_at_mf datetime,
+		created datetime, bse_trans_no varchar(20), folio_number varchar(25), next_check_at datetime
+	)''',
+	'TransactionBSE': '''CREATE TABLE t_transactionbse (
+		trans_no varchar(19) PRIMARY KEY, trans_code varchar(3), client_code varchar(20), scheme_cd varchar(20), buy_sell varchar(1), order_val real, all_redeem varchar(1), folio_no varchar(20),
+		internal_transaction_id integer, created datetime
+	)''',
+	'TransResponseBSE': '''CREATE TABLE t_transresponsebse (
+		id integer PRIMARY KEY AUTOINCREMENT, trans_code varchar(3), trans_no varchar(19), order_id varchar(10),
+		user_id varchar(10), member_id varchar(20), client_code varchar(20), bse_remarks varchar(1000),
+		success_flag varchar(1), order_type varchar(1), created datetime
+	)''',
+	'Holding': '''CREATE TABLE t_holding (
+		id integer PRIMARY KEY AUTOINCREMENT, user_id integer, scheme_plan_id integer, folio_number varchar(25),
+		units real, invested real, missing_navs integer, num_transactions integer, last_transaction_id integer,
+		updated datetime
+	)''',
+	'PaymentLinkBSE': '''CREATE TABLE t_paymentlinkbse (
+		id integer PRIMARY KEY AUTOINCREMENT, user_id integer, transaction_id integer, link varchar(1000),
+		created datetime
+	)''',
+	'SchemePlan': '''CREATE TABLE t_schemeplan (
+		id integer PRIMARY KEY AUTOINCREMENT, name varchar(100), bse_code varchar(15), isin varchar(15),
+		rta_code varchar(10), amc_code varchar(10), if_open bool, if_sip bool, min_inv real, min_addl_inv real,
+		min_sip_inv real, min_sip_inst integer, sip_start_dates varchar(255), last_updated datetime
+	)''',
+	'Mandate': '''CREATE TABLE t_mandate (
+		id varchar(10) PRIMARY KEY, user_id integer, bank_id integer, status varchar(2), amount real,
+		updated datetime, created datetime, checked_at datetime
+	)''',
+	'TrackerLease': '''CREATE TABLE t_trackerlease (
+		id integer PRIMARY KEY AUTOINCREMENT, name varchar(50) UNIQUE, owner varchar(100), expires_at datetime
+	)''',
+}
+
+
+def create_tables(path):
+	import sqlite3
+	connection = sqlite3.connect(path)
+	for sql in TABLES.values():
+		connection.execute(sql)
+	connection.commit()
+	connection.close()
+
+
+def sqlite_repository(path):
+	schema = {
+		'tables': dict((model, sql.split()[2]) for model, sql in TABLES.items()),
+		'validators': {},
+	}
+	return repository.SQLiteRepository(path, schema)
+
+
+@pytest.fixture
+def db_path(tmpdir):
+	path = str(tmpdir.join('db.sqlite3'))
+	create_tables(path)
+	return path
+
+
+@pytest.fixture
+def repo(db_path):
+	'''
+	An SQLiteRepository on empty tables, also returned by repository.get() during the test
+	'''
+	repo = sqlite_repository(db_path)
+	previous = repository._repository['current']
+	repository._repository['current'] = repo
+	yield repo
+	repository._repository['current'] = previous
+
+
+class Navs(object):
+	'''
+	Nav of every scheme plan on every date, in place of the time series store
+	'''
+
+	def __init__(self, nav=10.0):
+		self.nav = nav
+
+	def on(self, scheme_plan_id, d):
+		return self.nav if d is not None else None
+
+
+@pytest.fixture
+def navs():
+	return Navs()
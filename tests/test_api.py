@@ -0,0 +1,151 @@
+import datetime
+import socket
+
+import pytest
+
+import api
+from errors import CircuitOpenError, RejectionError, TransportError, ValidationError
+import repository
+import resilience
+
+
+class Eligibility(object):
+	IneligibleOrderError = Exception
+
+	def ensure_eligible(self, transactions):
+		pass
+
+	def split(self, transactions):
+		return list(transactions), []
+
+
+class Posted(list):
+	'''
+	(trans_no, status of its transaction when it was posted) of every order posted; orders whose trans_no
+	is in failures raise the error given there
+	'''
+
+	def __init__(self):
+		super(Posted, self).__init__()
+		self.failures = {}
+
+
+@pytest.fixture
+def posted(repo, monkeypatch):
+	posted = Posted()
+
+	def soap_post_order(client, bse_order):
+		posted.append((bse_order.trans_no, repo.transaction(bse_order.transaction_id).status))
+		error = posted.failures.get(bse_order.trans_no)
+		if error is not None:
+			raise error
+		return 'O' + bse_order.trans_no
+
+	monkeypatch.setattr(api, 'eligibility', Eligibility())
+	monkeypatch.setattr(api, 'init_soap_client', lambda wsdl: None)
+	monkeypatch.setattr(api, 'set_soap_logging', lambda: None)
+	monkeypatch.setattr(api, 'soap_get_password_order', lambda client: {})
+	monkeypatch.setattr(api, 'soap_post_order', soap_post_order)
+	return posted
+
+
+def add_transaction(repo, transaction_type='R'):
+	return repo.insert('Transaction', {
+		'user_id': 1, 'scheme_plan_id': 7, 'transaction_type': transaction_type, 'order_type': '1', 'status': '0',
+		'status_comment': '', 'amount': 12000.0, 'all_redeem': False, 'sip_num_inst_done': 0, 'sip_dates': '',
+		'sip_order_ids': '', 'created': datetime.datetime(2017, 5, 2, 4, 0), 'bse_trans_no': '',
+	})
+
+
+def orders(monkeypatch, legs):
+	'''
+	Makes prepare_orders give the orders of legs, dict of transaction id to number of its orders
+	'''
+	def prepare_orders_by_transaction(transactions, pass_dict, check=True):
+		return [
+			(tr, repository.Record(trans_no='T%d%d' % (tr.id, i), folio_no='F%d' % i, transaction_id=tr.id))
+			for tr in transactions for i in range(legs[tr.id])
+		]
+
+	monkeypatch.setattr(api, 'prepare_orders_by_transaction', prepare_orders_by_transaction)
+	monkeypatch.setattr(api, 'prepare_orders', lambda transactions, pass_dict, check=True: [
+		bse_order for tr, bse_order in prepare_orders_by_transaction(transactions, pass_dict, check)])
+
+
+def test_orders_of_a_redemption_are_posted_after_it_is_saved(repo, posted, monkeypatch):
+	tr = add_transaction(repo)
+	orders(monkeypatch, {tr.id: 3})
+
+	assert api.create_transaction_bse(tr) == 'OT%d0' % tr.id
+
+	assert posted == [('T%d0' % tr.id, '0'), ('T%d1' % tr.id, '2'), ('T%d2' % tr.id, '2')]
+	tr = repo.transaction(tr.id)
+	assert (tr.status, tr.bse_trans_no) == ('2', 'T%d0' % tr.id)
+
+
+def test_failed_later_order_is_noted_and_raised(repo, posted, monkeypatch):
+	tr = add_transaction(repo)
+	orders(monkeypatch, {tr.id: 3})
+	posted.failures['T%d1' % tr.id] = RejectionError(641, 'folio is locked')
+
+	with pytest.raises(RejectionError):
+		api.create_transaction_bse(tr)
+
+	## the third order is not posted, and the transaction stays placed
+	assert len(posted) == 2
+	tr = repo.transaction(tr.id)
+	assert tr.status == '2'
+	assert tr.status_comment == 'Order T%d1 of folio F1 not placed: folio is locked' % tr.id
+
+
+def test_batch_errors_affect_their_transaction_only(repo, posted, monkeypatch):
+	placed, rejected, unsent, partly = [add_transaction(repo) for i in range(4)]
+	orders(monkeypatch, {placed.id: 2, rejected.id: 1, unsent.id: 1, partly.id: 2})
+	posted.failures['T%d0' % rejected.id] = RejectionError(641, 'rejected')
+	posted.failures['T%d0' % unsent.id] = CircuitOpenError(678, 'circuit open')
+	posted.failures['T%d1' % partly.id] = TransportError(679, 'connection reset')
+
+	order_ids = api.create_transactions_bse([placed, rejected, unsent, partly])
+
+	assert order_ids == {placed.id: 'OT%d0' % placed.id, partly.id: 'OT%d0' % partly.id}
+	assert len(posted) == 6
+	statuses = dict((tr.id, repo.transaction(tr.id).status) for tr in (placed, rejected, unsent, partly))
+	assert statuses == {placed.id: '2', rejected.id: '1', unsent.id: '0', partly.id: '2'}
+	assert repo.transaction(rejected.id).status_comment == 'rejected'
+	assert repo.transaction(unsent.id).status_comment == 'Order T%d0 not placed: circuit open' % unsent.id
+	assert repo.transaction(partly.id).status_comment.startswith('Order T%d1 of folio F1 not placed' % partly.id)
+
+
+def test_trans_no_taken_meanwhile_is_a_validation_error(repo):
+	tr = add_transaction(repo, transaction_type='P')
+	order = lambda trans_no: repository.Record(
+		_model='TransactionBSE', trans_code='NEW', trans_no=trans_no, internal_transaction_id=tr.id)
+	api.insert_orders(repo, [order('T1')])
+
+	with pytest.raises(ValidationError) as raised:
+		api.insert_orders(repo, [order('T2'), order('T1')])
+	assert raised.value.code == 648
+	## none of the batch is saved
+	assert [row[0] for row in repo.query('SELECT trans_no FROM t_transactionbse', [])] == ['T1']
+
+
+@pytest.mark.parametrize('flag, calls', [('11', 4), ('03', 1)])
+def test_only_mfapi_reads_are_retried(monkeypatch, flag, calls):
+	class Service(object):
+		calls = 0
+
+		def MFAPI(self, *args, **kwargs):
+			Service.calls += 1
+			raise socket.error('connection reset')
+
+	class Client(object):
+		service = Service()
+
+	monkeypatch.setattr(api, 'soap_set_wsa_headers', lambda method_url, svc_url: None)
+	monkeypatch.setattr(api.audit, 'log_soap', lambda *args: None)
+	monkeypatch.setattr(resilience.time, 'sleep', lambda seconds: None)
+	monkeypatch.setattr(api.settings, 'RESILIENCE_RETRIES', 3)
+
+	with pytest.raises(Exception):
+		api.soap_call(Client(), 'MFAPI', 'method', 'svc-mfapi-' + flag, flag, 'params')
+	assert Service.calls == calls
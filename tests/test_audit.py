@@ -0,0 +1,55 @@
+import gzip
+import json
+import logging
+import os
+
+try:
+	import queue
+except ImportError:
+	import Queue as queue
+
+import audit
+
+
+def audit_record(operation):
+	record = logging.LogRecord('bse.audit', logging.INFO, __file__, 0, operation, None, None)
+	record.audit = (1491192000.0, operation, 'method', 'svc', (), {'Password': 'secret'}, '100|ok', None, 0.01)
+	return record
+
+
+def lines(log_dir):
+	found = []
+	for name in sorted(os.listdir(log_dir)):
+		with gzip.open(os.path.join(log_dir, name), 'rb') as f:
+			found.extend(json.loads(line.decode('utf-8')) for line in f)
+	return found
+
+
+def test_full_queue_spills_records_instead_of_dropping_them(tmpdir):
+	records = queue.Queue(maxsize=1)
+	writer = audit.AuditWriter(records, str(tmpdir.join('audit')), 1024 * 1024)
+	handler = audit.QueueHandler(records, writer.write, timeout=0.01)
+
+	for operation in ('orderEntryParam', 'getPassword', 'MFAPI'):
+		handler.emit(audit_record(operation))
+	writer.close_segment()
+
+	## writer is not running, so the first record waits in the queue and the rest are written synchronously
+	assert records.get_nowait()[1] == 'orderEntryParam'
+	assert handler.spilled == 2
+	written = lines(str(tmpdir.join('audit')))
+	assert [r['operation'] for r in written] == ['getPassword', 'MFAPI']
+	assert written[0]['request']['kwargs'] == {'Password': audit.REDACTED}
+
+
+def test_shutdown_removes_the_handler_and_configure_starts_afresh(tmpdir, monkeypatch):
+	monkeypatch.setattr(audit.settings, 'AUDIT_LOG_DIR', str(tmpdir.join('audit')))
+	logger = logging.getLogger(audit.LOGGER_NAME)
+	for run in range(2):
+		audit.log_soap('getPassword', 'method', 'svc', (), {}, '100|ok', None, 0.01)
+		assert logger.handlers == [audit._handler]
+		audit.shutdown()
+		assert logger.handlers == []
+		assert (audit._handler, audit._writer) == (None, None)
+
+	assert [r['operation'] for r in lines(str(tmpdir.join('audit')))] == ['getPassword', 'getPassword']
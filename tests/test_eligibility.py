@@ -0,0 +1,78 @@
+import collections
+import datetime
+
+import pytest
+
+import eligibility
+import schemes
+
+
+Transaction = collections.namedtuple('Transaction', (
+	'id', 'scheme_plan_id', 'transaction_type', 'order_type', 'amount', 'sip_num_inst', 'sip_start_date',
+))
+
+
+def plan(id, if_open=True, if_sip=True, sip_start_dates='1,10,20'):
+	return schemes.SchemeRecord(id, 'Plan %d' % id, 'B%d' % id, 'INF%d' % id, '', '', if_open, if_sip,
+		5000.0, 1000.0, 500.0, 6, sip_start_dates, None)
+
+
+## scheme cache of plans 1 (sip on 1, 10, 20), 2 (closed), 3 (no sip) and 4 (sip on any day)
+CACHE = dict((r.id, r) for r in (plan(1), plan(2, if_open=False), plan(3, if_sip=False), plan(4, sip_start_dates='')))
+
+
+def lumpsum(id, plan_id, amount, transaction_type='P'):
+	return Transaction(id, plan_id, transaction_type, '1', amount, None, None)
+
+
+def sip(id, plan_id, amount=1000.0, inst=12, day=10):
+	return Transaction(id, plan_id, 'P', '2', amount, inst, datetime.date(2017, 5, day))
+
+
+def codes(transactions):
+	return [(r.transaction_id, r.code) for r in eligibility.check(transactions, CACHE)]
+
+
+def test_eligible_transactions_pass():
+	assert codes([lumpsum(1, 1, 5000.0), lumpsum(2, 1, 1000.0, 'A'), sip(3, 1), sip(4, 4, day=13)]) == []
+
+
+@pytest.mark.parametrize('transaction, code', [
+	(lumpsum(1, 9, 5000.0), eligibility.UNKNOWN_SCHEME),
+	(lumpsum(1, 2, 5000.0), eligibility.CLOSED_SCHEME),
+	(sip(1, 3), eligibility.SIP_NOT_ALLOWED),
+	(lumpsum(1, 1, 4999.0), eligibility.BELOW_MIN_INV),
+	(lumpsum(1, 1, 999.0, 'A'), eligibility.BELOW_MIN_ADDL_INV),
+	(sip(1, 1, amount=499.0), eligibility.BELOW_MIN_SIP_INV),
+	(sip(1, 1, inst=5), eligibility.BELOW_MIN_SIP_INST),
+	(sip(1, 1, day=13), eligibility.SIP_START_DAY),
+])
+def test_each_rule_rejects(transaction, code):
+	assert codes([transaction]) == [(1, code)]
+
+
+def test_rejections_are_in_order_of_transactions_with_all_reasons():
+	rejections = eligibility.check([
+		sip(1, 1), sip(2, 1, amount=100.0, inst=2), lumpsum(3, 9, 1.0), lumpsum(4, 1, 5000.0),
+	], CACHE)
+
+	assert [(r.index, r.code) for r in rejections] == [
+		(1, eligibility.BELOW_MIN_SIP_INV), (1, eligibility.BELOW_MIN_SIP_INST), (2, eligibility.UNKNOWN_SCHEME),
+	]
+	assert rejections[0].message == 'SIP instalment 100.0 is below minimum of 500.0'
+
+
+def test_redemptions_are_not_checked():
+	assert codes([Transaction(1, 9, 'R', '1', 1.0, None, None)]) == []
+
+
+def test_split_and_ensure_eligible():
+	transactions = [lumpsum(1, 1, 5000.0), lumpsum(2, 2, 5000.0)]
+	eligible, rejections = eligibility.split(transactions, CACHE)
+	assert eligible == transactions[:1]
+	assert [r.transaction_id for r in rejections] == [2]
+
+	with pytest.raises(eligibility.IneligibleOrderError) as e:
+		eligibility.ensure_eligible(transactions, CACHE)
+	assert e.value.code == 672
+	assert e.value.rejections[0].code == eligibility.CLOSED_SCHEME
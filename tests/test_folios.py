@@ -0,0 +1,84 @@
+import collections
+import datetime
+
+import pytest
+
+from errors import InternalError
+from folios import Folio, FolioResolver
+
+
+Transaction = collections.namedtuple('Transaction', (
+	'user_id', 'scheme_plan_id', 'transaction_type', 'amount', 'all_redeem',
+))
+
+
+def redemption(amount, all_redeem=False):
+	return Transaction(1, 7, 'R', amount, all_redeem)
+
+
+def resolver(*values):
+	folios = [Folio('F%d' % i, None if v is None else v / 10.0, v) for i, v in enumerate(values)]
+	folios.sort(key=Folio.sort_key)
+	return FolioResolver({(1, 7): folios})
+
+
+def legs(resolver, transaction):
+	return [(l.folio_number, l.amount, l.all_redeem) for l in resolver.redemption_legs(transaction)]
+
+
+def test_redemption_within_largest_folio_is_one_leg():
+	assert legs(resolver(3000.0, 8000.0), redemption(5000.0)) == [('F1', 5000.0, False)]
+
+
+def test_redemption_larger_than_a_folio_empties_folios_largest_first():
+	assert legs(resolver(3000.0, 8000.0, 2000.0), redemption(12000.0)) == [
+		('F1', None, True), ('F0', None, True), ('F2', 1000.0, False),
+	]
+
+
+def test_redemption_of_exactly_the_holdings_redeems_all_folios():
+	assert legs(resolver(3000.0, 8000.0), redemption(11000.0)) == [('F1', None, True), ('F0', None, True)]
+
+
+def test_all_redeem_redeems_every_folio():
+	assert legs(resolver(3000.0, 8000.0), redemption(None, all_redeem=True)) == [
+		('F1', None, True), ('F0', None, True),
+	]
+
+
+def test_unknown_balances_take_the_amount_from_the_first_folio():
+	assert legs(resolver(None, 8000.0), redemption(12000.0)) == [('F1', 12000.0, False)]
+
+
+def test_redemption_more_than_holdings_fails():
+	with pytest.raises(InternalError) as e:
+		resolver(3000.0, 8000.0).redemption_legs(redemption(12000.0))
+	assert e.value.code == 673
+
+
+def test_no_folio_fails():
+	with pytest.raises(InternalError) as e:
+		FolioResolver({}).redemption_legs(redemption(100.0))
+	assert e.value.code == 632
+
+
+class Series(object):
+	def __init__(self, values):
+		self.values = values
+
+	def __len__(self):
+		return len(self.values)
+
+
+def test_preload_values_ledger_folios_at_latest_nav(repo):
+	now = datetime.datetime(2017, 5, 4)
+	for folio_number, units in (('F1', 100.0), ('F2', 300.0), ('F3', 0.0)):
+		repo.insert('Holding', {'user_id': 1, 'scheme_plan_id': 7, 'folio_number': folio_number, 'units': units,
+			'invested': 0.0, 'missing_navs': 0, 'num_transactions': 1, 'last_transaction_id': 1, 'updated': now})
+	store = {7: Series([9.0, 10.0])}
+
+	folios = FolioResolver.preload([redemption(3500.0), Transaction(2, 7, 'P', 100.0, False)], store=store)
+
+	## folios without units are left out, and the fresh purchase needs none
+	assert list(folios.folios) == [(1, 7)]
+	assert legs(folios, redemption(3500.0)) == [('F2', None, True), ('F1', 500.0, False)]
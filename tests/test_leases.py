@@ -0,0 +1,83 @@
+import datetime
+
+import leases
+
+from conftest import sqlite_repository
+
+
+NOW = datetime.datetime(2017, 5, 4, 10, 0)
+TTL = 600
+
+
+def daemon(db_path, owner):
+	## each daemon with its own connection, as on another machine
+	return leases.ShardLeases(sqlite_repository(db_path), owner=owner, shards=8, ttl=TTL)
+
+
+def later(seconds):
+	return NOW + datetime.timedelta(seconds=seconds)
+
+
+def test_shards_spread_over_daemons_as_they_join(db_path):
+	a, b, c = [daemon(db_path, owner) for owner in ('a', 'b', 'c')]
+
+	assert a.renew(NOW) == list(range(8))
+	## b joins; a frees shards above its fair share, which b claims once it renews again
+	b.renew(later(1))
+	a.renew(later(2))
+	assert a.held == [0, 1, 2, 3]
+	assert len(b.renew(later(3))) == 4
+	c.renew(later(4))
+	a.renew(later(5))
+	b.renew(later(6))
+	c.renew(later(7))
+
+	held = a.held + b.held + c.held
+	assert sorted(held) == list(range(8))
+	assert max(len(a.held), len(b.held), len(c.held)) == 3
+
+
+def test_shards_of_a_dead_daemon_are_taken_over_once_expired(db_path):
+	a, b = daemon(db_path, 'a'), daemon(db_path, 'b')
+	a.renew(NOW)
+	b.renew(later(1))
+	a.renew(later(2))
+	b.renew(later(3))
+
+	## a stops renewing; its shards are not free before they expire
+	assert len(b.renew(later(TTL))) == 4
+	assert b.renew(later(TTL + 10)) == list(range(8))
+
+
+def test_extend_keeps_shards_through_a_long_step(db_path):
+	a, b = daemon(db_path, 'a'), daemon(db_path, 'b')
+	a.renew(NOW)
+
+	## a is crawling past the ttl, extending its leases every third of it
+	for seconds in (200, 400, 600, 800):
+		assert a.extend(later(seconds)) == list(range(8))
+	b.renew(later(900))
+	assert b.held == []
+	## a's fair share drops to half at its next renew, and b picks up the rest
+	a.renew(later(950))
+	assert len(b.renew(later(960))) == 4
+
+
+def test_extend_drops_shards_taken_over(db_path):
+	a, b = daemon(db_path, 'a'), daemon(db_path, 'b')
+	a.renew(NOW)
+	b.renew(later(TTL + 1))
+
+	assert a.extend(later(TTL + 2)) == []
+
+
+def test_heartbeat_extends_leases_while_it_runs(db_path):
+	a = daemon(db_path, 'a')
+	a.renew(NOW)
+	extended = []
+	a.extend = lambda: extended.append(1)
+
+	with leases.Heartbeat(a, interval=0.01) as heartbeat:
+		while not extended:
+			heartbeat.stopped.wait(0.01)
+	assert not heartbeat.is_alive()
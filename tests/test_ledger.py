@@ -0,0 +1,119 @@
+import datetime
+
+import pytest
+
+import ledger
+
+from conftest import Navs
+
+
+TRADED = datetime.datetime(2017, 4, 3, 15, 0)
+
+
+def row(id, transaction_type='P', order_type='1', status='6', amount=1000.0, all_redeem=False, sip_dates='',
+	sip_num_inst_done=0, folio_number='F1', user_id=1, scheme_plan_id=7):
+	return ledger.Row(id, user_id, scheme_plan_id, transaction_type, order_type, status, amount, all_redeem,
+		sip_dates, sip_num_inst_done, TRADED, folio_number)
+
+
+def flows(tr, old_status, old_inst_done=0):
+	return [(sign, amount, d.strftime('%d%m%y') if d else None)
+		for sign, amount, d in ledger.purchase_flows(tr, old_status, old_inst_done)]
+
+
+def test_lumpsum_flows_in_when_completed_and_out_when_reversed():
+	assert flows(row(1, status='6'), '5') == [(1, 1000.0, '030417')]
+	assert flows(row(1, status='7'), '6') == [(-1, 1000.0, '030417')]
+	assert flows(row(1, status='5'), '2') == []
+	assert flows(row(1, status='6', amount=None), '5') == []
+
+
+def test_sip_flows_are_the_instalments_added():
+	sip = row(1, order_type='2', amount=500.0, sip_dates='030417,030517,030617', sip_num_inst_done=3)
+
+	## first completion brings in every instalment done, later ones only the new instalments
+	assert flows(sip, '2', 0) == [(1, 500.0, '030417'), (1, 500.0, '030517'), (1, 500.0, '030617')]
+	assert flows(sip, '6', 2) == [(1, 500.0, '030617')]
+	sip.status = '7'
+	assert flows(sip, '6', 3) == [(-1, 500.0, '030417'), (-1, 500.0, '030517'), (-1, 500.0, '030617')]
+
+
+def test_replay_builds_positions_per_folio():
+	positions = ledger.replay([
+		row(1, amount=1000.0),
+		row(2, transaction_type='A', amount=2000.0),
+		row(3, order_type='2', amount=500.0, sip_dates='030417,030517', sip_num_inst_done=2, folio_number='F2'),
+		row(4, status='5', amount=9000.0),
+		row(5, amount=700.0, user_id=2),
+	], Navs())
+
+	assert sorted(positions) == [(1, 7, 'F1'), (1, 7, 'F2'), (2, 7, 'F1')]
+	f1 = positions[(1, 7, 'F1')]
+	assert (f1.units, f1.invested, f1.num_transactions, f1.last_transaction_id) == (300.0, 3000.0, 2, 2)
+	assert positions[(1, 7, 'F2')].units == pytest.approx(100.0)
+
+
+def test_replay_of_redemptions():
+	positions = ledger.replay([
+		row(1, amount=1000.0, folio_number='F1'),
+		row(2, amount=3000.0, folio_number='F2'),
+		## without a folio a redemption is taken from the largest one
+		row(3, transaction_type='R', amount=1500.0, folio_number=''),
+		row(4, transaction_type='R', all_redeem=True, amount=None, folio_number='F1'),
+	], Navs())
+
+	f1, f2 = positions[(1, 7, 'F1')], positions[(1, 7, 'F2')]
+	assert (f1.units, f1.invested) == (0.0, 0.0)
+	assert f2.units == pytest.approx(150.0)
+	assert f2.invested == pytest.approx(1500.0)
+
+
+def test_missing_navs_are_counted():
+	class NoNavs(object):
+		def on(self, scheme_plan_id, d):
+			return None
+
+	position = ledger.replay([row(1)], NoNavs())[(1, 7, 'F1')]
+	assert (position.units, position.invested, position.missing_navs) == (0.0, 1000.0, 1)
+
+
+def test_record_matches_replay(repo):
+	tr = repo.insert('Transaction', {
+		'user_id': 1, 'scheme_plan_id': 7, 'transaction_type': 'P', 'order_type': '1', 'status': '6',
+		'status_comment': '', 'amount': 1000.0, 'all_redeem': False, 'sip_num_inst_done': 0, 'sip_dates': '',
+		'sip_order_ids': '', 'datetime_at_mf': TRADED, 'created': TRADED, 'bse_trans_no': '', 'folio_number': 'F1',
+	})
+
+	with repo.atomic():
+		assert ledger.record(tr, '5', 0, Navs(), repo) is not None
+	## a status already recorded changes nothing
+	assert ledger.record(tr, '6', 0, Navs(), repo) is None
+
+	position = ledger.replay([row(tr.id)], Navs())[(1, 7, 'F1')]
+	holding = repo.holding_for_update(tr)
+	assert (holding.units, holding.invested, holding.num_transactions) == (
+		position.units, position.invested, position.num_transactions)
+
+
+def test_reversed_redemption_is_put_back_by_record_and_replay(repo):
+	fields = {
+		'user_id': 1, 'scheme_plan_id': 7, 'order_type': '1', 'status': '6', 'status_comment': '',
+		'all_redeem': False, 'sip_num_inst_done': 0, 'sip_dates': '', 'sip_order_ids': '', 'datetime_at_mf': TRADED,
+		'created': TRADED, 'bse_trans_no': '', 'folio_number': 'F1',
+	}
+	purchase = repo.insert('Transaction', dict(fields, transaction_type='P', amount=1000.0))
+	redemption = repo.insert('Transaction', dict(fields, transaction_type='R', amount=400.0))
+	with repo.atomic():
+		ledger.record(purchase, '5', 0, Navs(), repo)
+		ledger.record(redemption, '5', 0, Navs(), repo)
+		assert repo.holding_for_update(purchase).units == pytest.approx(60.0)
+		redemption.status = '7'
+		repo.save_transaction(redemption)
+		assert ledger.record(redemption, '6', 0, Navs(), repo) is not None
+
+	position = ledger.replay([row(purchase.id), row(redemption.id, transaction_type='R', status='7', amount=400.0)],
+		Navs())[(1, 7, 'F1')]
+	holding = repo.holding_for_update(purchase)
+	assert (holding.units, holding.invested) == pytest.approx((position.units, position.invested))
+	assert (position.units, position.invested) == pytest.approx((100.0, 1000.0))
+	assert holding.num_transactions == position.num_transactions == 3
@@ -0,0 +1,78 @@
+import datetime
+
+import pytest
+
+import mandates
+
+
+NOW = datetime.datetime(2017, 5, 4, 12, 0)
+
+
+def add_mandate(repo, mandate_id, status, amount=None, created=None, checked_at=None):
+	repo.insert('Mandate', {
+		'id': mandate_id, 'user_id': 9, 'bank_id': 1, 'status': status, 'amount': amount,
+		'created': created or datetime.datetime(2017, 4, 1), 'checked_at': checked_at,
+	})
+
+
+def add_sip(repo, mandate_id, amount, status='6'):
+	repo.insert('Transaction', {
+		'user_id': 9, 'scheme_plan_id': 7, 'transaction_type': 'P', 'order_type': '2', 'status': status,
+		'amount': amount, 'mandate_id': mandate_id, 'created': datetime.datetime(2017, 4, 3),
+	})
+
+
+def statuses(repo):
+	return dict((m.id, m.status) for m in repo.select('Mandate', '1 = 1', []))
+
+
+def test_mandate_status_code():
+	assert mandates.mandate_status_code(' approved ') == '5'
+	assert mandates.mandate_status_code('SENT TO BANK') == '4'
+	assert mandates.mandate_status_code('NO SUCH STATUS') is None
+
+
+def test_mandates_to_check_skips_recently_checked(repo, monkeypatch):
+	monkeypatch.setattr(mandates.settings, 'MANDATE_CHECK_INTERVAL', 3600)
+	add_mandate(repo, 'M1', '2')
+	add_mandate(repo, 'M2', '4', checked_at=NOW - datetime.timedelta(minutes=10))
+	add_mandate(repo, 'M3', '3', checked_at=NOW - datetime.timedelta(hours=2))
+	add_mandate(repo, 'M4', '5')
+
+	assert [m.id for m in mandates.mandates_to_check(NOW, repo)] == ['M1', 'M3']
+
+
+def test_save_mandate_statuses(repo):
+	for mandate_id, status in [('M1', '2'), ('M2', '3'), ('M3', '4'), ('M4', '4'), ('M5', '4')]:
+		add_mandate(repo, mandate_id, status)
+	mandate_list = mandates.mandates_to_check(NOW, repo)
+	## another check accepted M4 after it was read
+	repo.update_mandate_status('M4', '4', '5')
+
+	changed = mandates.save_mandate_statuses(mandate_list, {
+		'M1': 'SCAN IMAGE UPLOADED', 'M2': 'SCAN IMAGE UPLOADED', 'M3': 'REJECTED', 'M4': 'REJECTED',
+		'M5': 'SOMETHING NEW',
+	}, repo, now=NOW)
+
+	assert changed == 2
+	assert statuses(repo) == {'M1': '3', 'M2': '3', 'M3': '6', 'M4': '5', 'M5': '4'}
+	## all of them were checked, even those not changed or not in the report
+	assert mandates.mandates_to_check(NOW + datetime.timedelta(seconds=1), repo) == []
+
+
+def test_mark_exhausted(repo):
+	add_mandate(repo, 'M1', '5', amount=1000.0)
+	add_mandate(repo, 'M2', '5', amount=1000.0)
+	add_mandate(repo, 'M3', '7', amount=1000.0)
+	add_mandate(repo, 'M4', '5')
+	add_sip(repo, 'M1', 600.0)
+	add_sip(repo, 'M1', 400.0, status='2')
+	add_sip(repo, 'M2', 600.0)
+	## SIPs that ended don't use the mandate
+	add_sip(repo, 'M2', 600.0, status='7')
+	add_sip(repo, 'M3', 600.0, status='1')
+	add_sip(repo, 'M4', 100000.0)
+
+	assert mandates.mark_exhausted(repo) == 2
+	assert statuses(repo) == {'M1': '7', 'M2': '5', 'M3': '5', 'M4': '5'}
+	assert mandates.mark_exhausted(repo) == 0
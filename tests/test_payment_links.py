@@ -0,0 +1,100 @@
+import datetime
+import threading
+
+import pytest
+
+import api
+from errors import RejectionError
+import payment_links
+
+
+@pytest.fixture
+def made(monkeypatch):
+	'''
+	(client code, transaction id) of every link BSEStar is asked to make
+	'''
+	made = []
+
+	def soap_create_payment(client, client_code, transaction_id, pass_dict):
+		made.append((client_code, transaction_id))
+		return 'https://bsestar/pay/%s/%s' % (client_code, transaction_id)
+
+	monkeypatch.setattr(api, 'soap_create_payment', soap_create_payment)
+	monkeypatch.setattr(payment_links.PaymentLinks, 'login', lambda self: (None, {}))
+	return made
+
+
+def test_links_are_kept_per_transaction(repo, made):
+	links = payment_links.PaymentLinks(ttl=600, repo=repo)
+
+	first = links.get(9, 1)
+	assert links.get('9', 1) == first
+	## a later transaction of the client gets a link returning to its own payment page
+	assert links.get(9, 2) == 'https://bsestar/pay/9/2'
+	assert made == [('9', 1), ('9', 2)]
+
+	## another process finds the links saved
+	assert payment_links.PaymentLinks(ttl=600, repo=repo).get(9, 2) == 'https://bsestar/pay/9/2'
+	assert len(made) == 2
+
+
+def test_prepare_makes_a_link_per_transaction(repo, made):
+	links = payment_links.PaymentLinks(ttl=600, repo=repo)
+	links.get(9, 1)
+
+	prepared = links.prepare([(9, 1), (9, 2), (9, 2), (8, 3)])
+
+	assert prepared == {
+		1: 'https://bsestar/pay/9/1', 2: 'https://bsestar/pay/9/2', 3: 'https://bsestar/pay/8/3',
+	}
+	assert made == [('9', 1), ('9', 2), ('8', 3)]
+	assert repo.payment_link(8, 3, datetime.datetime.utcnow() - datetime.timedelta(minutes=1)).link == 'https://bsestar/pay/8/3'
+
+
+
+def test_requests_for_a_link_being_made_wait_for_it(repo, monkeypatch):
+	started = threading.Event()
+	release = threading.Event()
+	made = []
+
+	def soap_create_payment(client, client_code, transaction_id, pass_dict):
+		made.append((client_code, transaction_id))
+		started.set()
+		release.wait(5)
+		return 'https://bsestar/pay/%s/%s' % (client_code, transaction_id)
+
+	monkeypatch.setattr(api, 'soap_create_payment', soap_create_payment)
+	monkeypatch.setattr(payment_links.PaymentLinks, 'login', lambda self: (None, {}))
+	links = payment_links.PaymentLinks(ttl=600, repo=repo)
+	results = []
+	first = threading.Thread(target=lambda: results.append(links.get(9, 1)))
+	first.start()
+	assert started.wait(5)
+
+	kind, call = links.claim(('9', 1), datetime.datetime.utcnow())
+	assert kind == 'wait'
+	waiter = threading.Thread(target=lambda: results.append(links.get(9, 1)))
+	waiter.start()
+	release.set()
+	first.join(5)
+	waiter.join(5)
+
+	assert call.result() == 'https://bsestar/pay/9/1'
+	assert results == ['https://bsestar/pay/9/1'] * 2
+	assert made == [('9', 1)]
+
+
+def test_waiting_requests_get_the_error_of_the_call(repo):
+	links = payment_links.PaymentLinks(ttl=600, repo=repo)
+	now = datetime.datetime.utcnow()
+	kind, call = links.claim(('9', 1), now)
+	assert kind == 'make'
+	assert links.claim(('9', 1), now) == ('wait', call)
+
+	error = RejectionError(0, 'no orders awaiting payment')
+	links.finish(('9', 1), call, error=error)
+
+	with pytest.raises(RejectionError):
+		call.result()
+	## the next request makes the link again
+	assert links.claim(('9', 1), now)[0] == 'make'
@@ -0,0 +1,211 @@
+import datetime
+
+import pytest
+
+import ledger
+import reconcile
+import tracking
+
+from conftest import Navs
+
+
+NOW = datetime.datetime(2017, 5, 4, 12, 0)
+CREATED = datetime.datetime(2017, 4, 3, 4, 0)
+
+STATUS_FILE = (
+	'Order Date,Order No,Scheme Name,Folio No,Order Status\n'
+	'03/05/2017,202,"Fund, Growth",F9,ALLOTMENT DONE\n'
+	'02/05/2017,101,X,,SENT TO RTA FOR VALIDATION\n'
+	'02/05/2017,999,X,,ALLOTMENT DONE\n'
+	'02/05/2017,102,X,,WEIRD\n'
+)
+ALLOTMENT_FILE = (
+	'ORDER_NO|FOLIO_NO|ALLOTMENT_DATE\n'
+	'202|F9|03/05/2017 18:00\n'
+)
+
+
+@pytest.fixture(autouse=True)
+def fixed_navs(monkeypatch):
+	monkeypatch.setattr(ledger, 'Navs', Navs)
+
+
+def add_transaction(repo, **fields):
+	values = {
+		'user_id': 1, 'scheme_plan_id': 7, 'transaction_type': 'P', 'order_type': '1', 'status': '2',
+		'status_comment': '', 'amount': 1000.0, 'all_redeem': False, 'sip_num_inst': None,
+		'sip_start_date': None, 'sip_num_inst_done': 0, 'sip_dates': '', 'sip_order_ids': '',
+		'datetime_at_mf': None, 'created': CREATED, 'bse_trans_no': '', 'folio_number': '',
+	}
+	values.update(fields)
+	return repo.insert('Transaction', values)
+
+
+def sip(repo, status='6', inst_done=1):
+	return add_transaction(repo, user_id=9, order_type='2', status=status, amount=500.0, sip_num_inst=6,
+		sip_start_date=datetime.date(2017, 4, 3), sip_num_inst_done=inst_done, sip_dates='030417,030517',
+		sip_order_ids='201,202', folio_number='F9')
+
+
+def index_of(repo, transactions):
+	'''
+	OrderIndex of transactions as orders_to_check() finds them, order id of each given
+	'''
+	date_dict_list = []
+	for tr, order_id, order_d in transactions:
+		tr = repo.transaction(tr.id)
+		date_dict_list.append({
+			'date': order_d, 'ids': [tr.id], 'state': [tracking.state(tr)], 'order_ids': [order_id],
+			'next_check_at': [None], 'folio_number': [tr.folio_number],
+			'date_at_mf': [tr.datetime_at_mf.date() if tr.order_type == '1' and tr.datetime_at_mf else None],
+			'status': ['0'], 'folio': [''],
+		})
+	return reconcile.OrderIndex(date_dict_list)
+
+
+def test_parse_report_file_finds_columns_by_name():
+	rows = list(reconcile.parse_report_file(STATUS_FILE.splitlines(True)))
+	assert [(r.order_id, r.status, r.folio) for r in rows] == [
+		('202', '6', 'F9'), ('101', '5', ''), ('999', '6', ''), ('102', 'WEIRD', ''),
+	]
+	assert rows[0].date == datetime.date(2017, 5, 3)
+
+	allotted = list(reconcile.parse_report_file(ALLOTMENT_FILE.splitlines(True)))
+	assert [(r.order_id, r.status, r.folio, r.date) for r in allotted] == [
+		('202', reconcile.ALLOTTED, 'F9', datetime.date(2017, 5, 3)),
+	]
+
+
+def test_reconcile_applies_rows_and_counts_the_rest(repo):
+	lumpsum = add_transaction(repo, status='2')
+	index = index_of(repo, [(lumpsum, '101', datetime.date(2017, 5, 2))])
+
+	counts = reconcile.reconcile([STATUS_FILE.splitlines(True)], repo, index=index, now=NOW)
+
+	assert counts['applied'] == 1
+	assert counts['unmatched'] == 3
+	assert repo.transaction(lumpsum.id).status == '5'
+
+
+def test_reconcile_dry_run_saves_nothing(repo):
+	lumpsum = add_transaction(repo, status='2')
+	index = index_of(repo, [(lumpsum, '101', datetime.date(2017, 5, 2))])
+
+	counts = reconcile.reconcile([STATUS_FILE.splitlines(True)], repo, index=index, now=NOW, dry_run=True)
+
+	assert counts['dry_run'] == 1 and counts['applied'] == 0
+	assert repo.transaction(lumpsum.id).status == '2'
+
+
+@pytest.mark.parametrize('batch', [1, 1000])
+def test_sip_instalment_in_two_files_is_applied_once(repo, batch):
+	tr = sip(repo)
+	index = index_of(repo, [(tr, '202', datetime.date(2017, 5, 3))])
+
+	counts = reconcile.reconcile(
+		[STATUS_FILE.splitlines(True), ALLOTMENT_FILE.splitlines(True)], repo, index=index, now=NOW, batch=batch)
+
+	tr = repo.transaction(tr.id)
+	assert tr.sip_num_inst_done == 2
+	assert tr.status == '6'
+	assert counts['applied'] == 1
+	## one instalment of 500 at a nav of 10
+	holding = repo.holding_for_update(tr)
+	assert holding.units == pytest.approx(50.0)
+	assert holding.invested == pytest.approx(500.0)
+
+
+def test_failed_sip_instalment_is_dropped_once(repo):
+	tr = sip(repo)
+	index = index_of(repo, [(tr, '202', datetime.date(2017, 5, 3))])
+	cancelled = 'Order No,Order Status\n202,ORDER CANCELLED BY USER\n'
+
+	counts = reconcile.reconcile([cancelled.splitlines(True), cancelled.splitlines(True)], repo, index=index,
+		now=NOW, batch=1)
+
+	tr = repo.transaction(tr.id)
+	assert tr.sip_dates == '030417'
+	assert tr.sip_order_ids == '201'
+	assert tr.sip_num_inst_done == 1
+	assert counts['applied'] == 1 and counts['unchanged'] == 1
+
+
+def test_first_sip_instalment_moves_through_statuses(repo):
+	tr = sip(repo, status='2', inst_done=0)
+	index = index_of(repo, [(tr, '201', datetime.date(2017, 4, 3))])
+	sent = 'Order No,Order Status\n201,SENT TO RTA FOR VALIDATION\n'
+	cancelled = 'Order No,Order Status\n201,ORDER CANCELLED BY USER\n'
+
+	counts = reconcile.reconcile([sent.splitlines(True), cancelled.splitlines(True)], repo, index=index,
+		now=NOW, batch=1)
+
+	## the order stays the current instalment after it was sent to the RTA, so the later row applies too
+	assert counts['applied'] == 2
+	assert repo.transaction(tr.id).status == '1'
+
+
+class Report(list):
+	def writerow(self, row):
+		self.append(row)
+
+
+def test_diff_report_lists_rows_that_differ(repo):
+	lumpsum = add_transaction(repo, status='2')
+	invalid = add_transaction(repo, status='2')
+	index = index_of(repo, [
+		(lumpsum, '101', datetime.date(2017, 5, 2)), (invalid, '102', datetime.date(2017, 5, 2)),
+	])
+	report = Report()
+
+	reconcile.reconcile([STATUS_FILE.splitlines(True)], repo, report=report, index=index, now=NOW)
+
+	assert sorted(report) == sorted([
+		['101', lumpsum.id, '2', 'SENT TO RTA FOR VALIDATION', '', '2017-05-02', '', 'applied'],
+		['102', invalid.id, '2', 'WEIRD', '', '2017-05-02', '', 'invalid'],
+	])
+
+
+def test_diff_report_lists_rows_whose_folio_or_date_differ(repo):
+	## an instalment in progress of a SIP in folio F9, and a lumpsum order of folio F1 already allotted on
+	## 2017-05-01 whose row the RTA hasn't updated
+	instalment = sip(repo)
+	lumpsum = add_transaction(repo, status='5', folio_number='F1', datetime_at_mf=datetime.datetime(2017, 5, 1, 12, 0))
+	index = index_of(repo, [
+		(instalment, '202', datetime.date(2017, 5, 3)), (lumpsum, '101', datetime.date(2017, 5, 2)),
+	])
+	report = Report()
+	status_file = (
+		'Order Date,Order No,Folio No,Order Status\n'
+		'03/05/2017,202,F8,ALLOTMENT DONE\n'
+		'02/05/2017,101,F1,SENT TO RTA FOR VALIDATION\n'
+	)
+
+	counts = reconcile.reconcile([status_file.splitlines(True)], repo, report=report, index=index, now=NOW)
+
+	assert (counts['applied'], counts['mismatch'], counts['unchanged']) == (1, 1, 0)
+	assert sorted(report) == sorted([
+		['202', instalment.id, '6', 'ALLOTMENT DONE', 'F8', '2017-05-03', 'folio_number', 'applied'],
+		['101', lumpsum.id, '5', 'SENT TO RTA FOR VALIDATION', 'F1', '2017-05-02', 'datetime_at_mf', 'mismatch'],
+	])
+	assert repo.transaction(lumpsum.id).status == '5'
+
+
+def test_redemption_across_folios_is_applied_once_all_its_orders_are_read(repo):
+	tr = add_transaction(repo, transaction_type='R', status='2')
+	state = tracking.state(tr)
+	index = reconcile.OrderIndex([{
+		'date': datetime.date(2017, 5, 2), 'ids': [tr.id, tr.id], 'state': [state, state],
+		'order_ids': ['301', '302'], 'next_check_at': [None, None], 'folio_number': ['', ''],
+		'date_at_mf': [None, None], 'status': ['0', '0'], 'folio': ['', ''],
+	}])
+	first = 'Order No,Order Status\n301,SENT TO RTA FOR VALIDATION\n'
+	second = 'Order No,Order Status\n302,SENT TO RTA FOR VALIDATION\n'
+
+	counts = reconcile.reconcile([first.splitlines(True)], repo, index=index, now=NOW)
+	assert counts['partial'] == 1
+	assert repo.transaction(tr.id).status == '2'
+
+	counts = reconcile.reconcile([second.splitlines(True)], repo, index=index, now=NOW)
+	assert counts['applied'] == 1
+	assert repo.transaction(tr.id).status == '5'
+	assert index.lookup('301')[1] == index.lookup('302')[1] == ('5', 0)
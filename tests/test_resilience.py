@@ -0,0 +1,126 @@
+import socket
+
+import pytest
+
+from errors import CircuitOpenError, RejectionError
+import resilience
+import settings
+
+
+@pytest.fixture
+def clock(monkeypatch):
+	'''
+	Time seen by resilience.py, moved by hand; retries don't sleep
+	'''
+	clock = [1000.0]
+	monkeypatch.setattr(resilience.time, 'time', lambda: clock[0])
+	monkeypatch.setattr(resilience.time, 'sleep', lambda seconds: None)
+	monkeypatch.setattr(settings, 'RESILIENCE_WINDOW', 10)
+	monkeypatch.setattr(settings, 'RESILIENCE_MIN_CALLS', 4)
+	monkeypatch.setattr(settings, 'RESILIENCE_FAILURE_RATE', 0.5)
+	monkeypatch.setattr(settings, 'RESILIENCE_COOLDOWN', 30)
+	monkeypatch.setattr(settings, 'RESILIENCE_RETRIES', 3)
+	return clock
+
+
+def fail():
+	raise socket.error('connection reset')
+
+
+def test_transient_failures_are_retried(clock):
+	endpoint = resilience.Endpoint('orders')
+	calls = []
+
+	def flaky():
+		calls.append(1)
+		if len(calls) < 3:
+			fail()
+		return 'ok'
+
+	assert endpoint.call(flaky) == 'ok'
+	assert len(calls) == 3
+
+
+def test_changes_are_retried_only_if_unsent(clock):
+	endpoint = resilience.Endpoint('orders')
+	calls = []
+
+	def reset():
+		calls.append(1)
+		fail()
+
+	with pytest.raises(socket.error):
+		endpoint.call(reset, idempotent=False)
+	assert len(calls) == 1
+
+
+def test_rejections_are_not_retried_and_do_not_count_as_failures(clock):
+	endpoint = resilience.Endpoint('orders')
+	calls = []
+
+	def reject():
+		calls.append(1)
+		raise RejectionError(641, 'rejected')
+
+	for i in range(5):
+		with pytest.raises(RejectionError):
+			endpoint.call(reject)
+	assert len(calls) == 5
+	assert endpoint.state == resilience.CLOSED
+
+
+def test_circuit_opens_after_failures_and_closes_after_a_trial_call(clock):
+	endpoint = resilience.Endpoint('orders')
+	## one call and its 3 retries fail
+	with pytest.raises(socket.error):
+		endpoint.call(fail)
+	assert endpoint.state == resilience.OPEN
+
+	with pytest.raises(CircuitOpenError):
+		endpoint.call(lambda: 'ok')
+
+	## after the cooldown a trial call goes through; its success closes the circuit
+	clock[0] += 31
+	assert endpoint.call(lambda: 'ok') == 'ok'
+	assert endpoint.state == resilience.CLOSED
+
+
+def test_failed_trial_call_opens_the_circuit_again(clock):
+	endpoint = resilience.Endpoint('orders')
+	with pytest.raises(socket.error):
+		endpoint.call(fail)
+	clock[0] += 31
+	## the retry of the failed trial call finds the circuit open again
+	with pytest.raises(CircuitOpenError):
+		endpoint.call(fail)
+	assert endpoint.state == resilience.OPEN
+
+
+def test_limit_grows_additively_and_is_cut_multiplicatively(clock, monkeypatch):
+	monkeypatch.setattr(settings, 'RESILIENCE_RETRIES', 0)
+	endpoint = resilience.Endpoint('orders')
+	assert endpoint.limit == settings.RESILIENCE_CONCURRENCY == 4
+
+	## a limit's worth of successful calls raises it by one
+	for i in range(4):
+		endpoint.call(lambda: 'ok')
+	limit = endpoint.limit
+	assert 4.9 < limit <= 5.0
+
+	with pytest.raises(socket.error):
+		endpoint.call(fail)
+	assert endpoint.limit == pytest.approx(limit * settings.RESILIENCE_DECREASE)
+	assert endpoint.stats()['limit'] == 2
+
+
+def test_slow_calls_cut_the_limit_but_not_below_the_least(clock):
+	endpoint = resilience.Endpoint('orders')
+
+	def slow():
+		clock[0] += settings.RESILIENCE_SLOW_CALL + 1
+		return 'ok'
+
+	for i in range(5):
+		endpoint.call(slow)
+	assert endpoint.limit == settings.RESILIENCE_MIN_CONCURRENCY
+	assert endpoint.state == resilience.CLOSED
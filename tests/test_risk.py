@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+import risk
+
+
+def toy_panel(plans=4, months=60, seed=3):
+	'''
+	Month end navs of plans starting in different months, and monthly benchmark returns
+	'''
+	rng = np.random.RandomState(seed)
+	navs = 10.0 * np.cumprod(1.0 + rng.normal(0.01, 0.04, (plans, months)), axis=1)
+	for plan in range(plans):
+		navs[plan, :plan * 5] = np.nan
+	bench = rng.normal(0.008, 0.03, (plans, months))
+	bench[:, 0] = np.nan
+	return navs, bench
+
+
+def test_rolling_windows_match_a_loop():
+	navs, bench = toy_panel()
+	r = risk.period_returns(navs)
+	k = 12
+	sums = risk.rolling_sum(r, k)
+	mins = risk.rolling_reduce(r, k, np.nanmin)
+	for plan in range(navs.shape[0]):
+		for col in range(navs.shape[1]):
+			if col < k - 1:
+				assert np.isnan(sums[plan, col]) and np.isnan(mins[plan, col])
+				continue
+			window = r[plan, col - k + 1:col + 1]
+			assert sums[plan, col] == pytest.approx(np.nansum(window))
+			if np.isnan(window).all():
+				assert np.isnan(mins[plan, col])
+			else:
+				assert mins[plan, col] == pytest.approx(np.nanmin(window))
+
+
+def test_std_dev_needs_a_full_window():
+	navs, bench = toy_panel()
+	stats = risk.compute_risk(navs, bench, 1, risk_free_rate=0.06)
+	## plan 2 starts in month 10, so its first full year of returns ends in month 22
+	assert np.isnan(stats.std_dev[2, :22]).all()
+	r = navs[2, 11:23] / navs[2, 10:22] - 1.0
+	assert stats.std_dev[2, 22] == pytest.approx(np.std(r, ddof=1) * np.sqrt(12))
+
+
+@pytest.mark.parametrize('years', [1, 3])
+def test_windows_of_the_months_read_incrementally_are_unchanged(years):
+	navs, bench = toy_panel()
+	full = risk.compute_risk(navs, bench, years)
+	for column in (40, 59):
+		start = risk.window_start(column, years)
+		part = risk.compute_risk(navs[:, start:], bench[:, start:], years)
+		for field in risk.RiskStats.FIELDS:
+			np.testing.assert_allclose(
+				getattr(part, field)[:, column - start:], getattr(full, field)[:, column:], err_msg=field)
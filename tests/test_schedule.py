@@ -0,0 +1,47 @@
+import collections
+import datetime
+
+import schedule
+
+
+Transaction = collections.namedtuple('Transaction', ('order_type', 'status', 'created', 'next_check_at'))
+
+## a friday morning in IST, before the cut off, so 5 May is its order date
+CREATED = datetime.datetime(2017, 5, 5, 4, 0)
+
+
+def at(days=0, hours=0, minutes=0):
+	return CREATED + datetime.timedelta(days=days, hours=hours, minutes=minutes)
+
+
+def test_payments_are_checked_less_often_as_they_age():
+	tr = Transaction('1', '2', CREATED, None)
+	## at least a minute apart, a quarter of the age, at most an hour apart
+	assert schedule.next_check_at(tr, at()) == at(minutes=1)
+	assert schedule.next_check_at(tr, at(minutes=40)) == at(minutes=50)
+	assert schedule.next_check_at(tr, at(days=1)) == at(days=1, hours=1)
+
+
+def test_orders_sent_to_rta_are_checked_at_allotment_crawls_then_with_backoff():
+	tr = Transaction('1', '5', CREATED, None)
+	## 18:05 IST on the order date and on the next market date, a monday
+	assert schedule.next_check_at(tr, at(hours=6)) == datetime.datetime(2017, 5, 5, 12, 35)
+	assert schedule.next_check_at(tr, at(hours=9)) == datetime.datetime(2017, 5, 8, 12, 35)
+	assert schedule.next_check_at(tr, at(days=3, hours=9)) == at(days=3, hours=9) + \
+		datetime.timedelta(seconds=(3 * 86400 + 9 * 3600) * 0.25)
+
+
+def test_sips_and_final_states_are_not_scheduled():
+	assert schedule.next_check_at(Transaction('2', '2', CREATED, None), at(hours=1)) is None
+	assert schedule.next_check_at(Transaction('1', '6', CREATED, None), at(hours=1)) is None
+
+
+def test_payment_expiry_and_due():
+	tr = Transaction('1', '2', CREATED, at(hours=1))
+	assert not schedule.payment_expired(tr, at(days=3))
+	assert schedule.payment_expired(tr, at(days=3, minutes=1))
+	assert not schedule.payment_expired(tr._replace(status='5'), at(days=4))
+
+	assert not schedule.is_due(tr, at(minutes=59))
+	assert schedule.is_due(tr, at(hours=1))
+	assert schedule.is_due(tr._replace(next_check_at=None), at())
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+import bisect
+import datetime
+
+import pytest
+
+from errors import InternalError
+import market
+import schemes
+import snapshot
+
+
+UPDATED = datetime.datetime(2017, 5, 4, 10, 30, 0, 250000)
+
+
+def add_plan(repo, id, bse_code, **fields):
+	values = {
+		'id': id, 'name': 'Plan %d' % id, 'bse_code': bse_code, 'isin': 'INF%03d' % id, 'rta_code': 'R%d' % id,
+		'amc_code': '', 'if_open': True, 'if_sip': True, 'min_inv': 5000.0, 'min_addl_inv': 1000.0,
+		'min_sip_inv': 500.0, 'min_sip_inst': 6, 'sip_start_dates': '1,10', 'last_updated': UPDATED,
+	}
+	values.update(fields)
+	return repo.insert('SchemePlan', values)
+
+
+@pytest.fixture
+def plans(repo):
+	add_plan(repo, 12, 'B12', if_sip=False, sip_start_dates='', min_sip_inst=None)
+	add_plan(repo, 3, 'B3', amc_code='A3', name=u'Fund ₹ Growth')
+	return repo
+
+
+def test_published_snapshot_reads_back_dates_and_plans(plans, tmpdir):
+	path = str(tmpdir.join('snapshot.bin'))
+	snapshot.publish(path, repo=plans)
+	mapped = snapshot.Snapshot(path)
+
+	dates = market.load_dates()
+	assert len(mapped.dates) == len(dates)
+	assert (mapped.dates[0], mapped.dates[-1]) == (dates[0], dates[-1])
+	d = datetime.date(2017, 5, 6)
+	assert bisect.bisect_left(mapped.dates, d) == bisect.bisect_left(dates, d)
+
+	found = mapped.schemes
+	assert len(found) == 2
+	for plan in plans.scheme_plans(schemes.FIELDS):
+		record, expected = found.get(plan[0]), schemes.SchemeRecord(*plan)
+		for field in schemes.SchemeRecord.__slots__:
+			assert getattr(record, field) == getattr(expected, field)
+	assert found.by_bse_code('B3').name == u'Fund ₹ Growth'
+	assert found.by_isin('INF012').id == 12
+	assert found.by_rta_code('R12').id == 12
+	assert found.by_amc_code('A3').id == 3
+	assert found.get(3).sip_start_days == frozenset([1, 10])
+
+
+def test_publish_rewrites_only_when_plans_change(plans, tmpdir):
+	path = str(tmpdir.join('snapshot.bin'))
+	version = snapshot.publish(path, repo=plans)
+	assert snapshot.publish(path, repo=plans) == version
+
+	add_plan(plans, 20, 'B20', last_updated=UPDATED + datetime.timedelta(minutes=1))
+	assert snapshot.publish(path, repo=plans) != version
+	assert snapshot.Snapshot(path).schemes.by_bse_code('B20').id == 20
+
+
+def test_later_plan_with_same_code_wins():
+	row = dict(zip(schemes.FIELDS, (1, 'Old', 'B1', 'INF1', '', '', True, True, 1.0, 1.0, 1.0, 1, '', None)))
+	rows = [tuple(row[f] for f in schemes.FIELDS)]
+	row.update(id=2, name='New')
+	rows.append(tuple(row[f] for f in schemes.FIELDS))
+
+	chunks, sections = snapshot.build([], rows)
+	buf = bytearray(snapshot.START) + b''.join(chunks)
+	found = snapshot.MappedSchemes(bytes(buf), sections)
+	assert found.by_bse_code('B1').name == 'New'
+	assert found.get(1).name == 'Old'
+
+
+def test_other_files_are_not_mapped(tmpdir):
+	path = tmpdir.join('other.bin')
+	path.write_binary(b'not a snapshot file')
+	with pytest.raises(InternalError) as e:
+		snapshot.Snapshot(str(path))
+	assert e.value.code == 682
@@ -0,0 +1,95 @@
+import datetime
+import os
+
+import numpy as np
+import pytest
+
+import timeseries
+
+
+D = datetime.date
+
+
+@pytest.fixture
+def store(tmpdir):
+	return timeseries.fund_store(str(tmpdir))
+
+
+def test_write_sorts_and_keeps_last_point_of_a_date(store):
+	assert store.write(7, [D(2017, 5, 3), D(2017, 5, 1), '2017-05-03'], [12.0, 10.0, 13.0]) == 2
+
+	series = store.get(7)
+	assert (series.start_date, series.end_date) == (D(2017, 5, 1), D(2017, 5, 3))
+	assert list(series.values) == [10.0, 13.0]
+
+
+def test_slice_and_lookups(store):
+	store.write(7, [D(2017, 5, d) for d in (1, 2, 3, 5, 8)], [10.0, 11.0, 12.0, 13.0, 14.0])
+	series = store.get(7)
+
+	part = series.slice(D(2017, 5, 2), D(2017, 5, 5))
+	assert [timeseries.from_days(d) for d in part.dates] == [D(2017, 5, 2), D(2017, 5, 3), D(2017, 5, 5)]
+	assert list(part.values) == [11.0, 12.0, 13.0]
+	assert len(series.slice(D(2017, 5, 6), D(2017, 5, 7))) == 0
+	assert len(series.slice(end=D(2017, 5, 3))) == 3
+
+	## last value on or before a date
+	assert series.value_on(D(2017, 5, 7)) == 13.0
+	assert series.value_on(D(2017, 4, 30)) is None
+	as_of = series.as_of([D(2017, 4, 30), D(2017, 5, 4), D(2017, 6, 1)])
+	assert np.isnan(as_of[0]) and list(as_of[1:]) == [12.0, 14.0]
+
+
+def test_append_adds_only_later_points(store):
+	assert store.append(7, [D(2017, 5, 1), D(2017, 5, 2)], [10.0, 11.0]) == 2
+	store.get(7)
+	## rerun of a daily load with one new point, out of order
+	assert store.append(7, [D(2017, 5, 4), D(2017, 5, 2), D(2017, 5, 3)], [13.0, 99.0, 12.0]) == 2
+	assert store.append(7, [D(2017, 5, 4)], [99.0]) == 0
+
+	series = store.get(7)
+	assert [timeseries.from_days(d).day for d in series.dates] == [1, 2, 3, 4]
+	assert list(series.values) == [10.0, 11.0, 12.0, 13.0]
+	assert store.last_day(7) == timeseries.to_days(D(2017, 5, 4))
+
+
+def test_append_after_a_crashed_append_keeps_points_aligned(store):
+	store.append(7, [D(2017, 5, 1), D(2017, 5, 2)], [10.0, 11.0])
+	## an append that crashed after writing its values and half a date
+	series_dir = store.series_dir(7)
+	with open(os.path.join(series_dir, timeseries.VALUES_FILE), 'ab') as f:
+		f.write(np.array([12.0], dtype=timeseries.VALUE_DTYPE).tobytes())
+	with open(os.path.join(series_dir, timeseries.DATES_FILE), 'ab') as f:
+		f.write(b'\x01\x02')
+
+	assert len(store.get(7)) == 2
+	assert store.append(7, [D(2017, 5, 3), D(2017, 5, 4)], [13.0, 14.0]) == 2
+
+	series = store.get(7)
+	assert [timeseries.from_days(d).day for d in series.dates] == [1, 2, 3, 4]
+	assert list(series.values) == [10.0, 11.0, 13.0, 14.0]
+	assert os.path.getsize(os.path.join(series_dir, timeseries.VALUES_FILE)) == 4 * timeseries.VALUE_DTYPE.itemsize
+
+
+def test_missing_series_is_empty(store):
+	assert len(store.get(404)) == 0
+	assert store.last_day(404) is None
+	assert store.ids() == []
+
+
+def test_blob_round_trip(store):
+	store.write('NIFTY', [D(2017, 5, 1), D(2017, 5, 2)], [9300.5, 9313.8])
+	series = timeseries.Series.from_blob('NIFTY', store.get('NIFTY').to_blob())
+	assert list(series.dates) == list(store.get('NIFTY').dates)
+	assert list(series.values) == [9300.5, 9313.8]
+
+
+def test_points_from_list_decodes_every_layout():
+	dates, values = timeseries.points_from_list([
+		['2017-05-01', '10.5'], {'date': '02/05/2017', 'nav': 11}, {'d': '03-May-2017', 'v': ''},
+	])
+	assert list(dates) == [timeseries.to_days(D(2017, 5, 1)), timeseries.to_days(D(2017, 5, 2))]
+	assert list(values) == [10.5, 11.0]
+
+	dates, values = timeseries.points_from_list([1.0, 2.0], start_date=D(2017, 5, 1))
+	assert list(dates) == [timeseries.to_days(D(2017, 5, 1)) + i for i in range(2)]
@@ -0,0 +1,80 @@
+import datetime
+
+import pytest
+
+import ledger
+import tracking
+
+from conftest import Navs
+
+
+NOW = datetime.datetime(2017, 5, 4, 12, 0)
+
+
+@pytest.fixture(autouse=True)
+def fixed_navs(monkeypatch):
+	monkeypatch.setattr(ledger, 'Navs', Navs)
+
+
+def redemption(repo, status='2'):
+	return repo.insert('Transaction', {
+		'user_id': 1, 'scheme_plan_id': 7, 'transaction_type': 'R', 'order_type': '1', 'status': status,
+		'status_comment': '', 'amount': 12000.0, 'all_redeem': False, 'sip_num_inst_done': 0, 'sip_dates': '',
+		'sip_order_ids': '', 'created': datetime.datetime(2017, 5, 2, 4, 0), 'bse_trans_no': 'T1',
+	})
+
+
+def add_order(repo, tr, trans_no, order_id, success_flag='0'):
+	repo.insert('TransactionBSE', {'trans_code': 'NEW', 'trans_no': trans_no, 'internal_transaction_id': tr.id,
+		'created': datetime.datetime(2017, 5, 2, 4, 0)})
+	if order_id is not None:
+		repo.save_response(trans_code='NEW', trans_no=trans_no, order_id=order_id, success_flag=success_flag,
+			order_type='1')
+
+
+def test_placed_orders_are_the_accepted_orders_of_each_transaction(repo):
+	first, second = redemption(repo), redemption(repo)
+	## orders of a batch, made at the same time, are in order of the counter ending their trans_no
+	add_order(repo, first, 'T10', '102')
+	add_order(repo, second, 'T3', '301')
+	add_order(repo, first, 'T9', '101')
+	## rejected, and not posted
+	add_order(repo, first, 'T11', '0', success_flag='1')
+	add_order(repo, first, 'T12', None)
+
+	assert repo.placed_orders([first.id, second.id, 999]) == {first.id: ['101', '102'], second.id: ['301']}
+
+
+@pytest.mark.parametrize('statuses, status', [
+	(['5'], '5'),
+	(['5', '0'], '0'),
+	(['5', '5'], '5'),
+	(['6', '5'], '5'),
+	(['5', '1'], '5'),
+	(['1', '-1'], '1'),
+	(['WEIRD', '5'], 'WEIRD'),
+])
+def test_combined_status(statuses, status):
+	assert tracking.combined_status(statuses) == status
+
+
+def test_transaction_of_several_orders_is_updated_from_all_of_them(repo):
+	tr = redemption(repo)
+
+	def date_dict(*statuses):
+		return {
+			'date': datetime.date(2017, 5, 2), 'ids': [tr.id] * len(statuses),
+			'state': [tracking.state(repo.transaction(tr.id))] * len(statuses),
+			'order_ids': ['10%d' % i for i in range(len(statuses))], 'next_check_at': [None] * len(statuses),
+			'status': list(statuses), 'folio': ['F%d' % i for i in range(len(statuses))],
+		}
+
+	## one of them not found in the report
+	assert tracking.save_order_statuses([date_dict('5', '0')], repo, now=NOW) == []
+	assert repo.transaction(tr.id).status == '2'
+
+	saved = tracking.save_order_statuses([date_dict('5', '5')], repo, now=NOW)
+	assert [t.id for t in saved] == [tr.id]
+	tr = repo.transaction(tr.id)
+	assert tr.status == '5'
+	assert tr.folio_number in ('', None)
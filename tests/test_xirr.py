@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+import xirr
+
+
+def test_batch_matches_scalar_solver():
+	owner, days, amounts = xirr.random_sip_portfolios(300, max_inst=36, seed=1)
+	rates = xirr.xirr_batch(owner, days, amounts, 300, chunk=64)
+
+	for i in range(300):
+		mine = owner == i
+		expected = xirr.xirr_scalar(list(days[mine]), list(amounts[mine]))
+		assert rates[i] == pytest.approx(expected, abs=1e-6)
+
+
+def test_known_rates():
+	## 1000 invested, 1100 a year later
+	assert xirr.xirr_scalar([0, 365], [-1000.0, 1100.0]) == pytest.approx(0.1)
+	rates = xirr.xirr_batch([0, 0, 1, 1, 1], [0, 365, 0, 365, 730], [-1000.0, 1100.0, -1000.0, -1000.0, 2152.5], 2)
+	assert rates == pytest.approx([0.1, 0.05], abs=1e-7)
+
+
+def test_portfolios_without_a_sign_change_have_no_rate():
+	rates = xirr.xirr_batch([0, 0, 2, 2], [0, 30, 0, 365], [-1000.0, -1000.0, -1000.0, 900.0], 3)
+	assert np.isnan(rates[0]) and np.isnan(rates[1])
+	assert rates[2] == pytest.approx(-0.1)
+	assert np.isnan(xirr.xirr_scalar([0, 30], [1000.0, 1000.0]))
+
+
+def test_bisection_agrees_with_newton():
+	owner, days, amounts = xirr.random_sip_portfolios(50, max_inst=24, seed=2)
+	years, flows, mask = xirr.pad(owner, days, amounts, 50)
+	assert xirr.bisect(years, flows) == pytest.approx(xirr.solve(years, flows), abs=1e-6)
@@ -0,0 +1,383 @@
+'''
+Author: utkarshohm
+Description: Columnar store for daily time series of fund navs and index values. Replaces reading
+	the whole FundTimeSeries.nav_data / IndexTimeSeries.data list of a mongo document element by element.
+	Every series is a pair of contiguous arrays- dates as int32 days since 1970-01-01 (sorted) and values
+	as float64- kept in two flat files that are memory-mapped on read. So a range of dates is found by
+	binary search and returned as zero-copy numpy views, and a daily update only appends a few bytes
+'''
+
+import datetime
+import numbers
+import os
+
+import numpy as np
+
+import settings
+from errors import InternalError
+
+
+DATE_DTYPE = np.dtype('<i4')
+VALUE_DTYPE = np.dtype('<f8')
+DATES_FILE = 'dates.i4'
+VALUES_FILE = 'values.f8'
+
+## kinds of series kept in the store, one directory each
+FUND = 'fund'
+INDEX = 'index'
+
+EPOCH = datetime.date(1970, 1, 1)
+
+
+################ DATE HELPERS
+
+def to_days(d):
+	'''
+	Converts a date, datetime or string (YYYY-MM-DD, DD/MM/YYYY, DD-MM-YYYY, DD-Mon-YYYY) to days since epoch
+	'''
+	if isinstance(d, datetime.datetime):
+		d = d.date()
+	elif not isinstance(d, datetime.date):
+		d = parse_date(str(d).strip())
+	return (d - EPOCH).days
+
+
+def from_days(days):
+	return EPOCH + datetime.timedelta(days=int(days))
+
+
+def parse_date(s):
+	for fmt in ('%Y-%m-%d', '%d/%m/%Y', '%d-%m-%Y', '%d-%b-%Y', '%d/%m/%y', '%Y-%m-%d %H:%M:%S'):
+		try:
+			return datetime.datetime.strptime(s, fmt).date()
+		except ValueError:
+			pass
+	raise ValueError("Time series: unknown date format %r" % s)
+
+
+def days_array(dates):
+	'''
+	Converts a sequence of dates (or an array of days) to an int32 array of days since epoch
+	'''
+	if isinstance(dates, np.ndarray) and dates.dtype.kind in 'iu':
+		return dates.astype(DATE_DTYPE, copy=False)
+	if isinstance(dates, np.ndarray) and dates.dtype.kind == 'M':
+		return dates.astype('datetime64[D]').astype(np.int64).astype(DATE_DTYPE)
+	return np.array([to_days(d) for d in dates], dtype=DATE_DTYPE)
+
+
+################ SERIES
+
+class Series(object):
+	'''
+	A time series as two aligned arrays. Arrays are read-only views (of a memory map when loaded
+	from the store) so slicing never copies data
+	'''
+	__slots__ = ('series_id', 'dates', 'values')
+
+	def __init__(self, series_id, dates, values):
+		self.series_id = series_id
+		self.dates = dates
+		self.values = values
+
+	def __len__(self):
+		return len(self.dates)
+
+	@property
+	def start_date(self):
+		return from_days(self.dates[0]) if len(self.dates) else None
+
+	@property
+	def end_date(self):
+		return from_days(self.dates[-1]) if len(self.dates) else None
+
+	def slice(self, start=None, end=None):
+		'''
+		Returns the series between start and end dates (both inclusive) in O(log n)
+		'''
+		lo = 0 if start is None else np.searchsorted(self.dates, to_days(start), side='left')
+		hi = len(self.dates) if end is None else np.searchsorted(self.dates, to_days(end), side='right')
+		return Series(self.series_id, self.dates[lo:hi], self.values[lo:hi])
+
+	def as_of(self, dates):
+		'''
+		Returns values on (or last available before) each of dates, vectorized
+		NaN where dates are before the start of the series
+		'''
+		days = days_array(dates)
+		idx = np.searchsorted(self.dates, days, side='right') - 1
+		out = np.full(len(days), np.nan)
+		ok = idx >= 0
+		out[ok] = self.values[idx[ok]]
+		return out
+
+	def value_on(self, d):
+		'''
+		Value on (or last available before) date d, None if series starts after d
+		'''
+		idx = np.searchsorted(self.dates, to_days(d), side='right') - 1
+		if idx < 0:
+			return None
+		return float(self.values[idx])
+
+	def to_blob(self):
+		'''
+		Returns the series as a binary blob (eg. for storing in a mongo BinData field)
+		Layout: uint32 length, dates as int32, values as float64, all little endian
+		'''
+		n = len(self.dates)
+		return (
+			np.array([n], dtype='<u4').tobytes() +
+			np.ascontiguousarray(self.dates, dtype=DATE_DTYPE).tobytes() +
+			np.ascontiguousarray(self.values, dtype=VALUE_DTYPE).tobytes()
+		)
+
+	@classmethod
+	def from_blob(cls, series_id, blob):
+		'''
+		Inverse of to_blob(); arrays are views on blob, not copies
+		'''
+		n = int(np.frombuffer(blob, dtype='<u4', count=1)[0])
+		dates = np.frombuffer(blob, dtype=DATE_DTYPE, count=n, offset=4)
+		values = np.frombuffer(blob, dtype=VALUE_DTYPE, count=n, offset=4 + 4 * n)
+		return cls(series_id, dates, values)
+
+
+################ STORE
+
+class TimeSeriesStore(object):
+	'''
+	Keeps each series of a kind in <root>/<kind>/<series_id>/{dates.i4,values.f8}
+	Values file is always written before dates file so a reader never sees a date without its value, and
+	an append first drops values (or parts of a point) left without a date by one that crashed
+	'''
+
+	def __init__(self, root=None, kind=FUND):
+		self.root = root or settings.TIMESERIES_DIR
+		self.kind = kind
+		self.path = os.path.join(self.root, kind)
+		self._cache = {}
+
+	def series_dir(self, series_id):
+		return os.path.join(self.path, str(series_id))
+
+	def ids(self):
+		'''
+		Returns ids of all series in the store
+		'''
+		if not os.path.isdir(self.path):
+			return []
+		ids = []
+		for name in os.listdir(self.path):
+			ids.append(int(name) if name.isdigit() else name)
+		return sorted(ids)
+
+	def exists(self, series_id):
+		return os.path.exists(os.path.join(self.series_dir(series_id), DATES_FILE))
+
+	def get(self, series_id):
+		'''
+		Returns the series memory-mapped read-only; an empty series if it doesn't exist
+		Maps are cached and remapped only if the files have grown since
+		'''
+		dates_path = os.path.join(self.series_dir(series_id), DATES_FILE)
+		values_path = os.path.join(self.series_dir(series_id), VALUES_FILE)
+		try:
+			n = os.path.getsize(dates_path) // DATE_DTYPE.itemsize
+		except OSError:
+			return Series(series_id, np.empty(0, DATE_DTYPE), np.empty(0, VALUE_DTYPE))
+
+		cached = self._cache.get(series_id)
+		if cached is not None and len(cached) == n:
+			return cached
+		if n == 0:
+			series = Series(series_id, np.empty(0, DATE_DTYPE), np.empty(0, VALUE_DTYPE))
+		else:
+			## guard against a half written append- values are written first
+			n = min(n, os.path.getsize(values_path) // VALUE_DTYPE.itemsize)
+			series = Series(
+				series_id,
+				np.memmap(dates_path, dtype=DATE_DTYPE, mode='r', shape=(n,)),
+				np.memmap(values_path, dtype=VALUE_DTYPE, mode='r', shape=(n,)),
+			)
+		self._cache[series_id] = series
+		return series
+
+	def last_day(self, series_id):
+		'''
+		Returns the last date (days since epoch) of a series, None if it is empty or doesn't exist
+		Reads only the last few bytes, so appends to thousands of series don't map them all
+		'''
+		try:
+			with open(os.path.join(self.series_dir(series_id), DATES_FILE), 'rb') as f:
+				f.seek(0, os.SEEK_END)
+				size = f.tell()
+				if size < DATE_DTYPE.itemsize:
+					return None
+				f.seek(size - size % DATE_DTYPE.itemsize - DATE_DTYPE.itemsize)
+				return int(np.frombuffer(f.read(DATE_DTYPE.itemsize), dtype=DATE_DTYPE)[0])
+		except (IOError, OSError):
+			return None
+
+	def write(self, series_id, dates, values):
+		'''
+		Replaces a series with given points, sorted by date with duplicate dates dropped (last one kept)
+		Files are written to temporary names and renamed so readers never see a partial series
+		'''
+		days = days_array(dates)
+		values = np.asarray(values, dtype=VALUE_DTYPE)
+		if len(days) != len(values):
+			raise InternalError(
+				660, "Time series %s has %d dates but %d values" % (series_id, len(days), len(values))
+			)
+		## stable sort, then keep last point of each date
+		order = np.argsort(days, kind='mergesort')
+		days = days[order]
+		values = values[order]
+		if len(days):
+			keep = np.append(days[1:] != days[:-1], True)
+			days = days[keep]
+			values = values[keep]
+
+		series_dir = self.series_dir(series_id)
+		if not os.path.isdir(series_dir):
+			os.makedirs(series_dir)
+		for name, arr in ((VALUES_FILE, values), (DATES_FILE, days)):
+			path = os.path.join(series_dir, name)
+			with open(path + '.tmp', 'wb') as f:
+				f.write(np.ascontiguousarray(arr).tobytes())
+			os.rename(path + '.tmp', path)
+		self._cache.pop(series_id, None)
+		return len(days)
+
+	def append(self, series_id, dates, values):
+		'''
+		Appends points dated after the last point of the series and ignores the rest, so
+		re-running a daily load is harmless. Returns number of points appended
+		'''
+		days = days_array(dates)
+		values = np.asarray(values, dtype=VALUE_DTYPE)
+		if len(days) != len(values):
+			raise InternalError(
+				660, "Time series %s has %d dates but %d values" % (series_id, len(days), len(values))
+			)
+		if not self.exists(series_id):
+			return self.write(series_id, days, values)
+		## drop what a crashed append left behind, else the values appended below would not line up with
+		## their dates
+		self.truncate(series_id)
+		last = self.last_day(series_id)
+		if last is None:
+			return self.write(series_id, days, values)
+		new = days > last
+		if not new.any():
+			return 0
+		days = days[new]
+		values = values[new]
+		if len(days) > 1 and (np.diff(days) <= 0).any():
+			order = np.argsort(days, kind='mergesort')
+			days = days[order]
+			values = values[order]
+			keep = np.append(days[1:] != days[:-1], True)
+			days = days[keep]
+			values = values[keep]
+
+		series_dir = self.series_dir(series_id)
+		with open(os.path.join(series_dir, VALUES_FILE), 'ab') as f:
+			f.write(values.tobytes())
+		with open(os.path.join(series_dir, DATES_FILE), 'ab') as f:
+			f.write(days.astype(DATE_DTYPE).tobytes())
+		self._cache.pop(series_id, None)
+		return len(days)
+
+	def truncate(self, series_id):
+		'''
+		Cuts both files of a series to the points they both have whole- an append that crashed may have
+		left values without dates, or part of a value or date. Returns number of points kept
+		'''
+		series_dir = self.series_dir(series_id)
+		paths = ((os.path.join(series_dir, DATES_FILE), DATE_DTYPE), (os.path.join(series_dir, VALUES_FILE), VALUE_DTYPE))
+		n = min(os.path.getsize(path) // dtype.itemsize for path, dtype in paths)
+		for path, dtype in paths:
+			if os.path.getsize(path) != n * dtype.itemsize:
+				with open(path, 'r+b') as f:
+					f.truncate(n * dtype.itemsize)
+		self._cache.pop(series_id, None)
+		return n
+
+	def load_many(self, series_ids):
+		'''
+		Returns dict of series_id to series for all given ids
+		'''
+		return dict((series_id, self.get(series_id)) for series_id in set(series_ids))
+
+
+def fund_store(root=None):
+	return TimeSeriesStore(root, FUND)
+
+
+def index_store(root=None):
+	return TimeSeriesStore(root, INDEX)
+
+
+################ IMPORTERS from mongo documents in models.graphs
+
+def points_from_list(data, start_date=None):
+	'''
+	Decodes the untyped ListField of a time series document into (dates, values)
+	Elements can be [date, value] pairs, {'date': .., 'nav'/'value': ..} dicts, or plain values
+	at daily frequency starting from start_date
+	'''
+	dates = []
+	values = []
+	for i, point in enumerate(data):
+		if isinstance(point, dict):
+			d = point.get('date', point.get('d'))
+			v = point.get('nav', point.get('value', point.get('v')))
+		elif isinstance(point, (list, tuple)):
+			d, v = point[0], point[1]
+		else:
+			if start_date is None:
+				raise InternalError(
+					661, "Time series has plain values but no start_date"
+				)
+			d, v = to_days(start_date) + i, point
+		if v is None or v == '':
+			continue
+		dates.append(int(d) if isinstance(d, numbers.Integral) else to_days(d))
+		values.append(float(v))
+	return np.array(dates, dtype=DATE_DTYPE), np.array(values, dtype=VALUE_DTYPE)
+
+
+def import_fund_time_series(store=None, documents=None):
+	'''
+	Copies nav_data of FundTimeSeries documents (all by default) into the store keyed by scheme_id
+	Returns number of series imported
+	'''
+	from models.graphs import FundTimeSeries
+	store = store or fund_store()
+	if documents is None:
+		documents = FundTimeSeries.objects.all()
+	count = 0
+	for doc in documents:
+		dates, values = points_from_list(doc.nav_data, doc.start_date)
+		store.write(doc.scheme_id, dates, values)
+		count += 1
+	return count
+
+
+def import_index_time_series(store=None, documents=None):
+	'''
+	Copies data of IndexTimeSeries documents (all by default) into the store keyed by index_id
+	Returns number of series imported
+	'''
+	from models.graphs import IndexTimeSeries
+	store = store or index_store()
+	if documents is None:
+		documents = IndexTimeSeries.objects.all()
+	count = 0
+	for doc in documents:
+		dates, values = points_from_list(doc.data, doc.start_date)
+		store.write(doc.index_id, dates, values)
+		count += 1
+	return count
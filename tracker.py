@@ -0,0 +1,185 @@
+'''
+Author: utkarshohm
+Description: Long running daemon that keeps transaction status up to date, in place of cron runs of the
+	update_transaction_status management command at 10:05, 15:05 and 18:05. Every run of that command
+	starts python, django, a browser and a virtual display and logs in, and status is hours stale between runs
+	The daemon keeps SOAP clients (see api.init_soap_client) and a logged in browser (web.CrawlerSession) and
+	- polls payment status of transactions awaiting payment, each when its next_check_at is due, checking
+		young transactions often and old ones rarely (see schedule.py and tracking.check_payments)
+	- crawls order status of transactions due a check from the web portal at settings.TRACKER_CRAWL_TIMES
+		on market dates, and then status of mandates awaiting acceptance in the same browser (see mandates.py)
+	With settings.TRACKER_SHARDS above 1 several daemons, on one machine or many, can run against one
+	database; each renews its leases every tick, and from a heartbeat thread during a crawl, and tracks only
+	transactions of the shards it holds (see leases.py)
+	SIGTERM or SIGINT stop it after the step under way. Run it with
+		python manage.py run_tracker
+	or, with the sqlite or sql repository backend, without django
+		python tracker.py
+'''
+
+import datetime
+import signal
+import time
+
+import settings
+import audit
+import lazy
+import leases
+import market
+import metrics
+import repository
+import tracking
+
+web = lazy.module('web')
+
+
+def next_crawl(after):
+	'''
+	First crawl time (naive IST) on a market date later than naive IST datetime after
+	None if the market calendar ends before
+	'''
+	times = sorted(datetime.datetime.strptime(t, '%H:%M').time() for t in settings.TRACKER_CRAWL_TIMES)
+	d = market.next_market_date(after.date())
+	while d is not None:
+		for t in times:
+			crawl_at = datetime.datetime.combine(d, t)
+			if crawl_at > after:
+				return crawl_at
+		d = market.next_market_date(d + datetime.timedelta(days=1))
+	return None
+
+
+class Tracker(object):
+	'''
+	The daemon. run() loops until stopped, calling tick() every settings.TRACKER_TICK seconds
+	'''
+
+	def __init__(self, repo=None, crawl=True, crawl_now=False):
+		self.repo = repo or repository.get()
+		self.crawl = crawl
+		self.session = None
+		self.leases = leases.ShardLeases(self.repo) if settings.TRACKER_SHARDS > 1 else None
+		self.stopping = False
+		self.next_crawl = market.now_ist() if crawl_now else next_crawl(market.now_ist())
+		self.next_flush = time.time() + settings.TRACKER_METRICS_INTERVAL
+
+	def stop(self, signum=None, frame=None):
+		self.stopping = True
+
+	def run(self):
+		signal.signal(signal.SIGTERM, self.stop)
+		signal.signal(signal.SIGINT, self.stop)
+		print('Tracker started, next crawl at %s IST' % self.next_crawl)
+		try:
+			while not self.stopping:
+				self.tick()
+				self.sleep(settings.TRACKER_TICK)
+		finally:
+			self.close_session()
+			self.leave()
+			metrics.flush()
+			audit.shutdown()
+		print('Tracker stopped')
+
+	def sleep(self, seconds):
+		## in short slices so that a signal stops the daemon promptly (python 3 resumes an interrupted sleep)
+		until = time.time() + seconds
+		while not self.stopping and time.time() < until:
+			time.sleep(min(1.0, until - time.time()))
+
+	def tick(self):
+		if self.leases is not None:
+			self.step('leases', self.leases.renew)
+		self.step('payments', self.poll_payments)
+		if self.crawl and self.next_crawl is not None and market.now_ist() >= self.next_crawl:
+			self.step('crawl', self.crawl_status)
+			self.next_crawl = next_crawl(market.now_ist())
+			print('Next crawl at %s IST' % self.next_crawl)
+		self.release()
+		if time.time() >= self.next_flush:
+			metrics.flush()
+			metrics.REGISTRY.reset()
+			self.next_flush = time.time() + settings.TRACKER_METRICS_INTERVAL
+
+	def step(self, name, func):
+		'''
+		Calls func; an error is counted and printed and the daemon goes on
+		'''
+		try:
+			with metrics.timer('tracker', step=name):
+				func()
+		except Exception as e:
+			print('Error in %s: %r' % (name, e))
+
+	################ steps
+
+	def shards(self):
+		'''
+		Shards held, None if not sharded
+		'''
+		return None if self.leases is None else self.leases.held
+
+	def poll_payments(self):
+		return tracking.check_payments(limit=settings.TRACKER_PAYMENT_BATCH, repo=self.repo, shards=self.shards())
+
+	def crawl_status(self):
+		'''
+		Crawls order status (and order ids of SIP instalments placed today) and mandate status in the browser
+		kept open
+		'''
+		shards = self.shards()
+		if shards is None:
+			return self.crawl_shards(shards)
+		if not shards:
+			return
+		## a crawl can take longer than the leases last
+		with leases.Heartbeat(self.leases):
+			return self.crawl_shards(shards)
+
+	def crawl_shards(self, shards):
+		if self.session is None:
+			self.session = web.CrawlerSession()
+		try:
+			self.session.update_transaction_status(shards)
+			self.session.update_mandate_status(shards)
+		except Exception:
+			## the browser may be left in any state, the next crawl starts a new one
+			self.close_session()
+			raise
+
+	def close_session(self):
+		if self.session is None:
+			return
+		session, self.session = self.session, None
+		try:
+			session.close()
+		except Exception as e:
+			print('Error in closing crawler session: %r' % e)
+
+	def leave(self):
+		'''
+		Frees leases of shards so that other daemons take them over at once
+		'''
+		if self.leases is None:
+			return
+		try:
+			self.leases.release()
+		except Exception as e:
+			print('Error in releasing leases: %r' % e)
+
+	def release(self):
+		'''
+		Drops what a long running django process holds on to- stale DB connections and, with DEBUG on, its log of queries
+		'''
+		if lazy.loaded('django.db'):
+			from django.db import close_old_connections, reset_queries
+			reset_queries()
+			close_old_connections()
+
+
+def main():
+	Tracker().run()
+
+
+if __name__ == '__main__':
+	main()
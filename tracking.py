@@ -0,0 +1,368 @@
+'''
+Author: utkarshohm
+Description: Light part of status tracking- which orders need checking on which market day, what the
+	statuses shown by BSEStar's order reports mean and how they update transactions. The heavy part,
+	reading those reports from the web portal with selenium, is in web.py, so this can be imported and
+	used without a browser. Payment status, which BSEStar's api does tell, is checked here too
+	Only transactions due a check by their next_check_at are checked (see schedule.py), and with several
+	tracker daemons, only those of the shards a daemon holds (see leases.py). Updates of a transaction are
+	made only if its status is still the one read, so a check made twice updates it once
+'''
+
+import collections
+import datetime
+import time
+
+import settings
+from errors import InternalError
+import ledger
+import lazy
+import market
+import metrics
+import repository
+import schedule
+
+api = lazy.module('api')
+
+
+timezone = lazy.attribute('pytz', 'timezone')
+relativedelta = lazy.attribute('dateutil.relativedelta', 'relativedelta')
+
+## status column of BSEStar's order status report to Transaction status; '-1' is payment not received
+STATUS_BY_TEXT = {
+	'ALLOTMENT DONE': '6',
+	'SENT TO RTA FOR VALIDATION': '5',
+	'ORDER CANCELLED BY USER': '1',
+	'PAYMENT NOT RECEIVED TILL DATE': '-1',
+}
+
+
+## order of statuses of an order as it moves on
+PROGRESS = {'2': 0, '4': 1, '5': 2, '6': 3}
+
+
+def order_status_code(text):
+	return STATUS_BY_TEXT.get(text, text)
+
+
+def local_created(tr):
+	'''
+	Datetime a transaction was created at, in IST
+	'''
+	return tr.created.replace(tzinfo=timezone('UTC')).astimezone(timezone('Asia/Calcutta'))
+
+
+def state(tr):
+	'''
+	What an update of status of transaction tr depends on- its status and SIP instalments done
+	'''
+	return (tr.status, tr.sip_num_inst_done)
+
+
+def locked_if_unchanged(repo, transaction_id, expected):
+	'''
+	Reads a transaction again and locks it, in repo.atomic(), if its state() is still expected
+	None if it changed since, eg. by a tracker that held its shard before
+	'''
+	tr = repo.transaction(transaction_id, for_update=True)
+	if state(tr) != tuple(expected):
+		metrics.incr('stale_updates')
+		return None
+	return tr
+
+
+################ PAYMENT STATUS
+
+def check_payments(now=None, limit=None, repo=None, shards=None):
+	'''
+	Checks payment status of lumpsum transactions due a check (at most limit of them, of users in shards
+	if given) using BSEStar's api with one password for all, fails those that have waited too long for
+	payment and schedules the next check of the rest. now is naive UTC. Returns number of transactions checked
+	'''
+	now = now or datetime.datetime.utcnow()
+	repo = repo or repository.get()
+	tr_list = repo.payments_due(now, limit, shards)
+	if not tr_list:
+		return 0
+	client = api.init_soap_client(api.WSDL_UPLOAD_URL[settings.LIVE])
+	api.set_soap_logging()
+	pass_dict = api.soap_get_password_upload(client)
+	next_check_at_by_id = {}
+	for tr in tr_list:
+		try:
+			status = api.soap_get_payment_status(client, tr.user_id, tr.id, pass_dict)
+		except Exception as e:
+			print('Error in payment status of transaction %d: %r' % (tr.id, e))
+			status = 'error'
+		if status in ('2', '5'):
+			tr.status = status
+		elif status == '0' and schedule.payment_expired(tr, now):
+			with repo.atomic():
+				locked = locked_if_unchanged(repo, tr.id, state(tr))
+				if locked is not None:
+					locked.status = '1'
+					locked.status_comment = 'Failed due to no payment'
+					repo.save_transaction(locked)
+			if locked is None:
+				## updated meanwhile by another check, which scheduled the next one
+				metrics.incr('payment_checks', status='stale')
+				continue
+			tr = locked
+			status = 'expired'
+		metrics.incr('payment_checks', status=status)
+		next_check_at_by_id[tr.id] = schedule.next_check_at(tr, now)
+	repo.schedule_checks(next_check_at_by_id)
+	return len(tr_list)
+
+
+################ ORDER STATUS
+
+def orders_to_check(today=None, repo=None, now=None, shards=None, due_only=True):
+	'''
+	Groups transactions that need a status update by the market date their order (or SIP instalment)
+	was placed on. Returns list of dicts, one per date, in order of creation of transactions, with
+	aligned lists of transaction ids, their state(), order ids and their next check if status doesn't
+	change, folio and allotment date (of a lumpsum order) they have, and placeholders for status and folio
+	Lumpsum transactions not due a check at now (naive UTC) are left out unless due_only is False, and if
+	shards are given, transactions of users in other shards
+	'''
+	today = today or datetime.date.today()
+	repo = repo or repository.get()
+	now = now or datetime.datetime.utcnow()
+	tr_list = []
+	for tr in repo.transactions_to_track(shards):
+		## remove sip transactions whose instalment is not under process
+		if tr.order_type == '2' and tr.sip_num_inst_done == len(tr.sip_dates.split(',')):
+			pass
+		## remove transactions that were checked recently enough
+		elif due_only and not schedule.is_due(tr, now):
+			metrics.incr('order_checks', status='not_due')
+		else:
+			tr_list.append(tr)
+
+	## order ids of lumpsum transactions in a few queries rather than one per transaction; a redemption
+	## across folios has one per folio
+	placed = repo.placed_orders([tr.id for tr in tr_list if tr.order_type == '1'])
+
+	## process transaction time to find order date
+	date_dict_list = []
+	date_dict = None
+	prev_order_d = datetime.date(2016, 1, 1)
+	for tr in tr_list:
+		## get date of order
+		order_dt = local_created(tr)
+		if tr.order_type == '1':
+			## get order ids of the transaction
+			order_ids = placed.get(tr.id)
+			if not order_ids:
+				raise repository.DoesNotExist(
+					"Update order status: order id not found for transaction %d" % tr.id
+				)
+		else:
+			order_ids = tr.sip_order_ids.split(',')
+			if len(order_ids) > tr.sip_num_inst_done:
+				order_ids = [order_ids[tr.sip_num_inst_done]]
+				if len(order_ids) > 1:
+					## update order_dt because its a sip instalment
+					order_dt = datetime.datetime(*(time.strptime(tr.sip_dates.split(',')[tr.sip_num_inst_done], '%d%m%y')[0:3]))
+			else:
+				## problem in sip_order_ids field
+				raise InternalError(
+					685, "Update order status: order id not found in Transaction table for transaction %d" % tr.id
+				)
+
+		## dont check for orders/instalments which will be placed in future
+		if order_dt.date() > today:
+			continue
+		order_d = market.calculate_order_date(order_dt)
+
+		## raise exception as no order date found
+		if not order_d:
+			raise InternalError(
+				686, "Update order status: order date of transaction %d could not be found" % tr.id
+			)
+
+		## dont check for orders/instalments which are offline currently
+		elif order_d > today:
+			continue
+
+		## save order ids and date
+		if prev_order_d != order_d:
+			date_dict = {
+				'date': order_d,
+				'ids': [],
+				'state': [],
+				'order_ids': [],
+				'next_check_at': [],
+				'folio_number': [],
+				'date_at_mf': [],
+				'status': [],
+				'folio': [],
+			}
+			date_dict_list.append(date_dict)
+			prev_order_d = order_d
+		next_check_at = schedule.next_check_at(tr, now)
+		## datetime_at_mf of a SIP is of its first instalment, not of the one being checked
+		date_at_mf = tr.datetime_at_mf.date() if tr.order_type == '1' and tr.datetime_at_mf else None
+		for order_id in order_ids:
+			date_dict['ids'].append(tr.id)
+			date_dict['state'].append(state(tr))
+			date_dict['order_ids'].append(order_id)
+			date_dict['next_check_at'].append(next_check_at)
+			date_dict['folio_number'].append(tr.folio_number or '')
+			date_dict['date_at_mf'].append(date_at_mf)
+			date_dict['status'].append('0')
+			date_dict['folio'].append('')
+	return date_dict_list
+
+
+def combined_status(statuses):
+	'''
+	Status of a transaction placed as several orders (a redemption across folios) from statuses found for
+	them- '0' until all of them are found, then the least advanced of those that didn't fail, or the
+	first failure if all of them failed
+	'''
+	if '0' in statuses:
+		return '0'
+	live = [status for status in statuses if status not in ('1', '-1')]
+	if not live:
+		return statuses[0]
+	## statuses not understood come first, as they would for a single order
+	return min(live, key=lambda status: PROGRESS.get(status, -1))
+
+
+def apply_order_status(tr, status, folio, order_d):
+	'''
+	Updates transaction tr with status of its order (or current SIP instalment) found on market date order_d
+	'''
+	## one-time or 1st isnt of sip transaction
+	if tr.status in ['2','4','5']:
+		## update status and status_comment
+		if status == '-1':
+			if tr.status == '2':
+				tr.status_comment = 'Failed due to no payment'
+			else:
+				tr.status_comment = 'Failed due to error in payment'
+			tr.status = '1'
+		## update status, folio, datetime
+		elif status == '6':
+			tr.status = status
+			if folio != '':
+				tr.folio_number = folio
+			if tr.order_type == '2':
+				tr.sip_num_inst_done = 1
+			tr.datetime_at_mf = datetime.datetime(order_d.year, order_d.month, order_d.day, 12, 0, 0, tzinfo=timezone('UTC'))
+		else:
+			tr.status = status
+
+	## 2nd or later inst of sip transaction
+	elif tr.status == '6' and tr.order_type == '2':
+		if status == '6':
+			## update sip_num_inst_done as instalment successful
+			tr.sip_num_inst_done += 1
+			if tr.sip_num_inst_done == tr.sip_num_inst:
+				## update to sip concluded
+				tr.status = '8'
+		elif status in ['-1', '1']:
+			## update sip_dates and sip_order_ids as instalment was unsuccessful
+			last_pos = tr.sip_dates.rfind(',')
+			tr.sip_dates = tr.sip_dates[:last_pos]
+			last_pos = tr.sip_order_ids.rfind(',')
+			tr.sip_order_ids = tr.sip_order_ids[:last_pos]
+
+
+def save_order_statuses(date_dict_list, repo=None, navs=None, now=None):
+	'''
+	Saves statuses found for the orders of orders_to_check() and keeps holdings in step
+	Schedules the next check of all of them, from their new status if it changed
+	A transaction updated since orders_to_check() read it is left as is
+	Returns transactions whose status was saved
+	'''
+	repo = repo or repository.get()
+	navs = navs or ledger.Navs()
+	now = now or datetime.datetime.utcnow()
+	next_check_at_by_id = {}
+	saved = []
+	for date_dict in date_dict_list:
+		## a transaction placed as several orders has an entry for each and is updated once, from all of them
+		entries = collections.OrderedDict()
+		for i in range(0, len(date_dict['ids'])):
+			entries.setdefault(date_dict['ids'][i], []).append(i)
+		for legs in entries.values():
+			i = legs[0]
+			status = combined_status([date_dict['status'][j] for j in legs])
+			## folios of orders of a redemption across folios are known already
+			folio = date_dict['folio'][i] if len(legs) == 1 else ''
+			if status != '0':
+				with repo.atomic():
+					tr = locked_if_unchanged(repo, date_dict['ids'][i], date_dict['state'][i])
+					if tr is not None:
+						old_status, old_inst_done = tr.status, tr.sip_num_inst_done
+						apply_order_status(tr, status, folio, date_dict['date'])
+						repo.save_transaction(tr)
+						## keep holdings in step with completed orders and sip instalments, in the same transaction
+						ledger.record(tr, old_status, old_inst_done, navs, repo)
+				if tr is None:
+					continue
+				next_check_at_by_id[tr.id] = schedule.next_check_at(tr, now)
+				saved.append(tr)
+			else:
+				next_check_at_by_id[date_dict['ids'][i]] = date_dict['next_check_at'][i]
+	repo.schedule_checks(next_check_at_by_id)
+	return saved
+
+
+################ SIP INSTALMENTS
+
+def sips_due(today, repo=None, shards=None):
+	'''
+	SIP transactions whose first or next instalment order is placed on market date today, of users in
+	shards if given
+	'''
+	repo = repo or repository.get()
+	tr_list = []
+	for sip in repo.sips_to_track(shards):
+		## first instalment
+		if sip.status != '6':
+			order_dt = local_created(sip)
+			## use below line if sip order was placed with first order not today
+			# order_dt = datetime.datetime.strptime(str(sip.sip_start_date), "%Y-%m-%d").replace(tzinfo=timezone('UTC')).astimezone(timezone('Asia/Calcutta'))
+		## second or later instalment
+		## filtering for those that are not already populated
+		elif len(sip.sip_dates.split(',')) == sip.sip_num_inst_done:
+			order_dt = datetime.datetime.strptime(str(sip.sip_start_date), "%Y-%m-%d") + relativedelta(months=sip.sip_num_inst_done - 1)
+			## dont check for orders/instalments which will be placed in future
+			if order_dt.date() > today:
+				continue
+		## order id and date already populated
+		else:
+			continue
+		## find exact order date
+		order_d = market.calculate_order_date(order_dt)
+		if not order_d:
+			# raise exception as no order date found
+			raise InternalError(
+				686, "Find sip order id: order date not found for transaction %d" % sip.id
+			)
+		if order_d == today:
+			tr_list.append(sip)
+	return tr_list
+
+
+def add_sip_order(tr, today, order_id, repo=None):
+	'''
+	Saves order id of the instalment of SIP transaction tr placed today
+	Does nothing if it is saved already, eg. by another tracker, or tr changed since it was read
+	'''
+	repo = repo or repository.get()
+	with repo.atomic():
+		tr = locked_if_unchanged(repo, tr.id, state(tr))
+		if tr is None or order_id in tr.sip_order_ids.split(','):
+			return
+		if tr.status != '6':
+			tr.sip_dates = today.strftime("%d%m%y")
+			tr.sip_order_ids = order_id
+		else:
+			tr.sip_dates += "," + today.strftime("%d%m%y")
+			tr.sip_order_ids += "," + order_id
+		repo.save_transaction(tr)
@@ -0,0 +1,349 @@
+'''
+Author: utkarshohm
+Description: Lightweight validators for BSEStar order entry records. They are compiled once
+	from the field definitions of TransactionBSE and TransactionXsipBSE (max lengths, regex
+	validators, choices) and validate plain dicts without touching the database, so that
+	preparing an order does not pay for the full django ModelForm machinery.
+	Compiled rules can be exported as a spec (see as_spec) so that processes without django
+	validate orders the same way (see repository.py)
+'''
+
+import re
+
+from errors import InternalError
+
+
+EMPTY_VALUES = (None, '', [], (), {})
+
+MSG_REQUIRED = 'This field is required.'
+MSG_MAX_LENGTH = 'Ensure this value has at most %d characters (it has %d).'
+MSG_CHOICE = 'Select a valid choice. %s is not one of the available choices.'
+MSG_FK_CHOICE = 'Select a valid choice. That choice is not one of the available choices.'
+## message of django's RegexValidator
+MSG_INVALID = 'Enter a valid value.'
+NUMERIC_REGEX = re.compile(r'^[0-9]*$')
+
+try:
+	text_type = unicode
+except NameError:
+	text_type = str
+
+
+def text(value):
+	'''
+	Same as django's force_text for the values orders are made of
+	'''
+	if isinstance(value, bytes) and not isinstance(value, text_type):
+		return value.decode('utf-8')
+	return text_type(value)
+
+
+class FieldRule(object):
+	'''
+	Validation rules of one model field, extracted once from its definition
+	relation is True for foreign keys; related_model is their model when compiled from django
+	'''
+	__slots__ = ('name', 'attname', 'required', 'max_length', 'choices', 'regexes', 'validators', 'strip',
+		'relation', 'related_model')
+
+	def __init__(self, name, attname, required, max_length=None, choices=None, regexes=(), validators=(), strip=True,
+		relation=False, related_model=None):
+		self.name = name
+		self.attname = attname
+		self.required = required
+		self.max_length = max_length
+		self.choices = choices
+		self.regexes = tuple(regexes)
+		self.validators = tuple(validators)
+		self.strip = strip
+		self.relation = relation or related_model is not None
+		self.related_model = related_model
+
+	@classmethod
+	def from_field(cls, field):
+		'''
+		Compiles the rule from a django model field
+		'''
+		from django.core.validators import MaxLengthValidator, RegexValidator
+		from django.db import models
+
+		regexes = []
+		others = []
+		for validator in field.validators:
+			if isinstance(validator, MaxLengthValidator):
+				## max_length is checked directly
+				continue
+			elif isinstance(validator, RegexValidator):
+				regexes.append((validator.regex, validator.inverse_match, validator.message))
+			else:
+				others.append(validator)
+		choices = None
+		if field.choices:
+			choices = frozenset(text(k) for k, v in field.flatchoices)
+		related_model = None
+		if isinstance(field, models.ForeignKey):
+			related_model = field.remote_field.model if hasattr(field, 'remote_field') else field.rel.to
+		return cls(
+			name=field.name,
+			attname=field.attname,
+			required=not field.blank,
+			max_length=field.max_length,
+			choices=choices,
+			regexes=regexes,
+			validators=others,
+			## choice fields are not stripped by django forms
+			strip=not field.choices,
+			related_model=related_model,
+		)
+
+	def as_spec(self):
+		'''
+		Returns the rule as a json serializable dict
+		Only rules made of max length, choices and regexes can be exported
+		'''
+		if self.validators:
+			raise InternalError(
+				675, "Validators of field %s can't be exported" % self.name
+			)
+		return {
+			'name': self.name,
+			'attname': self.attname,
+			'required': self.required,
+			'max_length': self.max_length,
+			'choices': sorted(self.choices) if self.choices is not None else None,
+			'regexes': [(regex.pattern, regex.flags, inverse_match, text(message))
+				for regex, inverse_match, message in self.regexes],
+			'strip': self.strip,
+			'relation': self.relation,
+		}
+
+	@classmethod
+	def from_spec(cls, spec):
+		return cls(
+			name=spec['name'],
+			attname=spec['attname'],
+			required=spec['required'],
+			max_length=spec['max_length'],
+			choices=frozenset(spec['choices']) if spec['choices'] is not None else None,
+			regexes=[(re.compile(pattern, flags), inverse_match, message)
+				for pattern, flags, inverse_match, message in spec['regexes']],
+			strip=spec['strip'],
+			relation=spec['relation'],
+		)
+
+	def clean(self, value):
+		'''
+		Returns (cleaned value, list of error messages)
+		'''
+		if self.relation:
+			return self.clean_fk(value)
+
+		if value in EMPTY_VALUES:
+			value = ''
+		else:
+			value = text(value)
+			if self.strip:
+				value = value.strip()
+
+		if value == '':
+			if self.required:
+				return value, [MSG_REQUIRED]
+			return value, []
+
+		errors = []
+		if self.choices is not None and value not in self.choices:
+			errors.append(MSG_CHOICE % value)
+		if self.max_length is not None and len(value) > self.max_length:
+			errors.append(MSG_MAX_LENGTH % (self.max_length, len(value)))
+		for regex, inverse_match, message in self.regexes:
+			if (not regex.search(value)) != inverse_match:
+				errors.append(text(message))
+		if self.validators:
+			from django.core.exceptions import ValidationError
+			for validator in self.validators:
+				try:
+					validator(value)
+				except ValidationError as e:
+					errors.extend(e.messages)
+		return value, errors
+
+	def clean_fk(self, value):
+		'''
+		Accepts a model instance, a record with an id (see repository.Record) or a primary key.
+		Existence of the row is not checked here (that needs a query) and is left to the database constraint
+		'''
+		if value in EMPTY_VALUES:
+			if self.required:
+				return None, [MSG_REQUIRED]
+			return None, []
+		if self.related_model is not None and isinstance(value, self.related_model):
+			return value, []
+		## all related models of orders have integer primary keys
+		value = getattr(value, 'id', value)
+		try:
+			return int(value), []
+		except (TypeError, ValueError):
+			return None, [MSG_FK_CHOICE]
+
+
+class OrderValidator(object):
+	'''
+	Validates plain dicts against the rules of a model, accepting and rejecting the same inputs
+	as a ModelForm of that model with the same fields/exclude, overrides mirror fields declared
+	on the form itself. Database level checks (uniqueness of trans_no, existence of the internal
+	transaction) are left to the database instead of being queried for every order
+	Built from a django model (from_model) or from an exported spec (from_spec); the latter builds
+	repository.Record objects instead of model instances
+	'''
+
+	def __init__(self, model_name, rules, pk_name, verbose_name, defaults=None, model=None):
+		self.model_name = model_name
+		self.rules = rules
+		self.pk_name = pk_name
+		self.verbose_name = verbose_name
+		self.defaults = defaults or {}
+		self.model = model
+
+	@classmethod
+	def from_model(cls, model, fields=None, exclude=(), overrides=None):
+		from django.db import models
+
+		overrides = overrides or {}
+		rules = []
+		defaults = {}
+		for field in model._meta.fields:
+			if field.has_default() and not callable(field.default):
+				defaults[field.attname] = field.default
+			if not field.editable or isinstance(field, models.AutoField):
+				continue
+			if fields is not None and field.name not in fields:
+				continue
+			if field.name in exclude:
+				continue
+			if field.name in overrides:
+				rules.append(overrides[field.name])
+			else:
+				rules.append(FieldRule.from_field(field))
+		return cls(model.__name__, rules, model._meta.pk.name, text(model._meta.verbose_name), defaults, model)
+
+	def as_spec(self):
+		return {
+			'model_name': self.model_name,
+			'rules': [rule.as_spec() for rule in self.rules],
+			'pk_name': self.pk_name,
+			'verbose_name': self.verbose_name,
+			'defaults': self.defaults,
+		}
+
+	@classmethod
+	def from_spec(cls, spec):
+		return cls(
+			spec['model_name'],
+			[FieldRule.from_spec(rule) for rule in spec['rules']],
+			spec['pk_name'],
+			spec['verbose_name'],
+			spec['defaults'],
+		)
+
+	def clean(self, data):
+		'''
+		Returns (cleaned_data, errors) where errors is a dict of field name to list of messages
+		'''
+		cleaned = {}
+		errors = {}
+		for rule in self.rules:
+			value, field_errors = rule.clean(data.get(rule.name))
+			if field_errors:
+				errors[rule.name] = field_errors
+			elif rule.relation and (rule.related_model is None or not isinstance(value, rule.related_model)):
+				cleaned[rule.attname] = value
+			else:
+				cleaned[rule.name] = value
+		return cleaned, errors
+
+	def build(self, cleaned):
+		'''
+		Returns an unsaved model instance (or record) from cleaned data
+		'''
+		if self.model is not None:
+			return self.model(**cleaned)
+		from repository import Record
+		values = dict(self.defaults)
+		values.update(cleaned)
+		record = Record(**values)
+		record._model = self.model_name
+		return record
+
+	def build_many(self, data_list):
+		'''
+		Validates a batch of dicts and returns unsaved instances ready for bulk_create
+		Also rejects a batch that repeats a primary key, which the database would reject anyway
+		'''
+		instances = []
+		errors = {}
+		seen = set()
+		for i, data in enumerate(data_list):
+			cleaned, row_errors = self.clean(data)
+			pk = cleaned.get(self.pk_name)
+			if pk in seen:
+				row_errors.setdefault(self.pk_name, []).append(
+					'%s with this %s already exists.' % (self.verbose_name.capitalize(), self.pk_name)
+				)
+			seen.add(pk)
+			if row_errors:
+				errors[i] = row_errors
+			else:
+				instances.append(self.build(cleaned))
+		return instances, errors
+
+
+################ VALIDATORS - same fields as the forms they replace
+
+## name: (model, keyword arguments of OrderValidator.from_model)
+VALIDATORS = {
+	# Used in validating fields when preparing new order entry
+	'new_order': ('TransactionBSE', {
+		'exclude': ('dp_txn', 'kyc_status', 'euin', 'euin_val', 'dpc'),
+	}),
+	# Used in validating fields when preparing cancellation order entry
+	'cxl_order': ('TransactionBSE', {
+		'fields': ('trans_code', 'trans_no', 'order_id', 'user_id', 'password', 'pass_key', 'internal_transaction', 'client_code', 'member_id'),
+		'overrides': {
+			'order_id': FieldRule('order_id', 'order_id', required=True, max_length=8,
+				regexes=[(NUMERIC_REGEX, False, MSG_INVALID)]),
+		},
+	}),
+	# Used in validating fields when preparing new XSIP order entry
+	'new_xsip_order': ('TransactionXsipBSE', {
+		'exclude': ('trans_mode', 'dp_txn', 'freq_type', 'freq_allowed', 'euin', 'euin_val', 'dpc'),
+	}),
+	# Used in validating fields when preparing cancellation XSIP order entry
+	'cxl_xsip_order': ('TransactionXsipBSE', {
+		'fields': ('trans_code', 'trans_no', 'xsip_reg_id', 'user_id', 'password', 'pass_key', 'internal_transaction', 'client_code', 'member_id'),
+		'overrides': {
+			'xsip_reg_id': FieldRule('xsip_reg_id', 'xsip_reg_id', required=True, max_length=10,
+				regexes=[(NUMERIC_REGEX, False, MSG_INVALID)]),
+		},
+	}),
+}
+
+_compiled = {}
+
+
+def from_models(name):
+	'''
+	Returns validator of VALIDATORS compiled from its django model, compiled once per process
+	'''
+	validator = _compiled.get(name)
+	if validator is None:
+		from models import transactions
+		model_name, kwargs = VALIDATORS[name]
+		validator = _compiled[name] = OrderValidator.from_model(getattr(transactions, model_name), **kwargs)
+	return validator
+
+
+def export_specs():
+	'''
+	Returns specs of all VALIDATORS keyed by name
+	'''
+	return dict((name, from_models(name).as_spec()) for name in VALIDATORS)
@@ -1,31 +1,50 @@
 ''' 
 Author: utkarshohm
-Description: crawl BSEStar web portal (bsestrmf.in) to update transaction status
+Description: crawl BSEStar web portal (bsestrmf.in) to update transaction and mandate status
     because API endpoints are not provided for this. These crawling functions are resilient to handle
     common crawling exceptions because crawling often encounters errors in html rendering or data loading
+    Transactions are read and saved through repository.get(), so the crawler runs with or without django
+    This is the heavy part of status tracking: selenium is imported on first use of the browser, and which
+    orders to check and how statuses update transactions are in tracking.py, which doesn't need a browser,
+    and likewise for mandates in mandates.py
 '''
 
-from django.db.models import Q
-
-# for crawling
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait, Select
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.common.exceptions import TimeoutException, NoSuchElementException, StaleElementReferenceException, 
-    ErrorInResponseException, ElementNotVisibleException, UnexpectedAlertPresentException, NoAlertPresentException
+# for crawling- imported on first use
+import lazy
+webdriver = lazy.module('selenium.webdriver')
+By = lazy.attribute('selenium.webdriver.common.by', 'By')
+WebDriverWait = lazy.attribute('selenium.webdriver.support.ui', 'WebDriverWait')
+EC = lazy.module('selenium.webdriver.support.expected_conditions')
 from httplib import BadStatusLine
 
 # for datetime processing
-from pytz import timezone
-from datetime import datetime, timedelta, date
-from time import strptime, sleep
-from dateutil.relativedelta import relativedelta
-
-from models.users import Info
-from models.funds import FundScheme
-from models.transactions import Transaction, TransResponseBSE
+from datetime import date, timedelta
+from time import sleep
+import time
+
 import settings
+import errors
+import mandates
+import market
+import metrics
+import repository
+import resilience
+import tracking
+
+## name of the web portal's endpoint in resilience.py
+PORTAL = 'bsestarmf.in'
+
+## headers of the mandate id and status columns of the mandate report, in order of preference
+MANDATE_ID_HEADERS = ('MANDATE CODE', 'MANDATE ID', 'MANDATE NO')
+MANDATE_STATUS_HEADERS = ('STATUS', 'MANDATE STATUS')
+
+
+def crawl_errors(*names):
+    '''
+    Selenium exception classes of names, for except clauses. Imported only once an exception is raised
+    '''
+    exceptions = lazy.module('selenium.common.exceptions')
+    return tuple(getattr(exceptions, name) for name in names)
 
 
 ################### MAIN FUNCTIONS - called by management commands transact_using_api and track_status_using_api_and_web
@@ -34,12 +53,96 @@ def crawl_to_update_transaction_status():
     '''
     Sets up webdriver and selenium for crawling to update_transaction_status()
     '''
-    driver = init_driver()     
+    session = CrawlerSession()
+    try:
+        session.update_transaction_status()
+    finally:
+        session.close()
+
+
+def crawl_to_update_mandate_status():
+    '''
+    Sets up webdriver and selenium for crawling to update_mandate_status()
+    '''
+    session = CrawlerSession()
     try:
-        driver = login(driver)
-        driver = update_transaction_status(driver)
+        session.update_mandate_status()
     finally:
-        quit_driver(driver)
+        session.close()
+
+
+class CrawlerSession(object):
+    '''
+    Browser logged into the BSEStar web portal that is kept open between crawls by the tracker daemon
+    (tracker.py), instead of starting a browser and logging in for every crawl
+    Logs in again when it has been idle longer than the portal keeps a session and restarts the
+    browser once it is max_age seconds old, so that its memory doesn't grow over weeks
+    A browser that stops responding is started again, settings.CRAWLER_RETRIES times per crawl
+    '''
+
+    def __init__(self, max_idle=None, max_age=None):
+        self.max_idle = max_idle or settings.TRACKER_SESSION_MAX_IDLE
+        self.max_age = max_age or settings.TRACKER_DRIVER_MAX_AGE
+        self.driver = None
+        self.started = None
+        self.last_used = None
+
+    def ready(self):
+        '''
+        Returns the driver, logged in
+        '''
+        now = time.time()
+        if self.driver is not None and now - self.started > self.max_age:
+            metrics.incr('crawler_session', event='recycle')
+            self.close()
+        if self.driver is None:
+            self.driver = init_driver()
+            self.started = time.time()
+            self.driver = login(self.driver)
+        elif now - self.last_used > self.max_idle:
+            metrics.incr('crawler_session', event='relogin')
+            self.driver = login(self.driver)
+        self.last_used = time.time()
+        return self.driver
+
+    def update_transaction_status(self, shards=None):
+        self.crawl(update_transaction_status, shards)
+
+    def update_mandate_status(self, shards=None):
+        self.crawl(update_mandate_status, shards)
+
+    def crawl(self, func, *args):
+        '''
+        Calls func(driver, *args), which returns the driver, in the browser kept open
+        '''
+        for attempt in range(settings.CRAWLER_RETRIES + 1):
+            try:
+                self.driver = func(self.ready(), *args)
+                self.last_used = time.time()
+                return
+            except errors.BrowserError as e:
+                error = e
+                print("Restarting browser: %s" % e)
+                metrics.incr('crawler_session', event='restart')
+                self.discard()
+        raise error
+
+    def close(self):
+        if self.driver is None:
+            return
+        try:
+            quit_driver(self.driver)
+        finally:
+            self.driver = None
+
+    def discard(self):
+        '''
+        Closes a browser that stopped responding. Quitting it may fail too but it must not be left running
+        '''
+        try:
+            self.close()
+        except Exception as e:
+            print("Error in quitting driver: %s" % e)
 
 
 ################### Crawling setup functions
@@ -49,7 +152,8 @@ def init_driver():
     Initialize driver based on headless or chrome browser
     For automated crawling on a linux server, prefer headless
     '''
-    return init_driver_headless()
+    with metrics.timer('crawler', stage='init_driver'):
+        return init_driver_headless()
     # return init_driver_chrome()
 
 
@@ -58,7 +162,7 @@ def init_driver_headless():
     Initialize headless browser. it needs a virtual display
     '''
     from pyvirtualdisplay import Display
-    global Display  # global variable because its needed in quit_driver()
+    global display  # global variable because its needed in quit_driver()
     display = Display(visible = 0, size = (1024, 768))
     display.start()
     print "display initialized for headless browser"
@@ -87,33 +191,41 @@ def init_driver_chrome():
 def login(driver):
     '''
     Logs into the BSEStar web portal using login credentials defined in settings
+    Retries settings.CRAWLER_RETRIES times if the page doesn't render in time
+    Raises errors.BrowserError if the browser stopped responding; CrawlerSession starts a new one then
     '''
-    try:
-        line = "https://www.bsestarmf.in/Index.aspx"
-        driver.get(line)
-        print("Opened login page")
-        
-        # enter credentials
-        userid = WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.ID, "txtUserId")))
-        memberid = WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.ID, "txtMemberId")))
-        password = WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.ID, "txtPassword")))
-        userid.send_keys(settings.USERID[settings.LIVE])
-        memberid.send_keys(settings.MEMBERID[settings.LIVE])
-        password.send_keys(settings.PASSWORD[settings.LIVE])
-        submit = driver.find_element_by_id("btnLogin")
-        submit.click()
-        print("Logged in")
-        return driver
-
-    except (TimeoutException, NoSuchElementException, StaleElementReferenceException, 
-        ErrorInResponseException, ElementNotVisibleException):
-        print("Retrying in login")
-        return login(driver)
+    for attempt in range(settings.CRAWLER_RETRIES + 1):
+        try:
+            with metrics.timer('crawler', stage='login'):
+                line = "https://www.bsestarmf.in/Index.aspx"
+                load_page(driver, line)
+                print("Opened login page")
+                
+                # enter credentials
+                userid = WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.ID, "txtUserId")))
+                memberid = WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.ID, "txtMemberId")))
+                password = WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.ID, "txtPassword")))
+                userid.send_keys(settings.USERID[settings.LIVE])
+                memberid.send_keys(settings.MEMBERID[settings.LIVE])
+                password.send_keys(settings.PASSWORD[settings.LIVE])
+                submit = driver.find_element_by_id("btnLogin")
+                submit.click()
+            print("Logged in")
+            return driver
+
+        except crawl_errors('TimeoutException', 'NoSuchElementException', 'StaleElementReferenceException',
+            'ErrorInResponseException', 'ElementNotVisibleException') as e:
+            error = e
+            print("Retrying in login")
+
+        except (BadStatusLine) as e:
+            raise errors.BrowserError(
+                681, "Browser stopped responding in login: %r" % e
+            )
 
-    except (BadStatusLine):
-        print("Retrying for BadStatusLine in login")
-        driver = init_driver()
-        return login(driver)
+    raise errors.TransportError(
+        680, "Login failed after %d attempts: %r" % (settings.CRAWLER_RETRIES + 1, error)
+    )
 
 
 def quit_driver(driver):
@@ -124,7 +236,15 @@ def quit_driver(driver):
         
     # when using chrome browser
     # service.stop()
-    
+
+
+
+def load_page(driver, url):
+    '''
+    Opens url in the browser through the web portal's circuit breaker, retrying timeouts (see resilience.py)
+    '''
+    resilience.endpoint(PORTAL).call(lambda: driver.get(url))
+
 
 def make_ready(driver):
     '''
@@ -137,218 +257,105 @@ def make_ready(driver):
 
 ###################### helper functions for crawling bsestar   
 
-def update_transaction_status(self, driver):
+def update_transaction_status(driver, shards=None):
     '''
     Updates status of all transactions that need a status update (i.e. not completed or failed)
     incl SIP transactions which have instalment order due today
+    Only of users in shards if given (see leases.py)
+    Retries settings.CRAWLER_RETRIES times if a page doesn't render in time
+    Raises errors.BrowserError if the browser stopped responding; CrawlerSession starts a new one then
     '''
-    try:
-        # order_id (identifier of each transaction on BSEStar) is necessary to check status on web portal
-        # its returned by create_transaction_bse() api call but
-        # SIP investments constitute of several instalments each of which has an order_id
-        # so, save order_id of all sip instalment orders that are due today
-        dt = date.today()
-        find_sip_order_id(driver, dt)
-        
-        # update status of all orders incl sip instalment orders
-        update_order_status(driver)
-        return driver
-
-    except (TimeoutException, StaleElementReferenceException, ErrorInResponseException, ElementNotVisibleException):
-        print("Retrying")
-        return update_transaction_status(driver)
+    for attempt in range(settings.CRAWLER_RETRIES + 1):
+        try:
+            # order_id (identifier of each transaction on BSEStar) is necessary to check status on web portal
+            # its returned by create_transaction_bse() api call but
+            # SIP investments constitute of several instalments each of which has an order_id
+            # so, save order_id of all sip instalment orders that are due today
+            dt = date.today()
+            find_sip_order_id(driver, dt, shards)
+            
+            # update status of all orders incl sip instalment orders
+            update_order_status(driver, shards)
+            return driver
+
+        except crawl_errors('TimeoutException', 'StaleElementReferenceException', 'ErrorInResponseException',
+            'ElementNotVisibleException') as e:
+            error = e
+            print("Retrying")
+
+        except (BadStatusLine) as e:
+            raise errors.BrowserError(
+                681, "Browser stopped responding in updating transaction status: %r" % e
+            )
 
-    except (BadStatusLine):
-        print("Retrying for BadStatusLine in login")
-        driver = init_driver()     
-        driver = login(driver)
-        return update_transaction_status(driver)
+    raise errors.TransportError(
+        680, "Updating transaction status failed after %d attempts: %r" % (settings.CRAWLER_RETRIES + 1, error)
+    )
 
 
-def calculate_order_date(self, order_dt):
+def calculate_order_date(order_dt):
     '''
-    Checks if BSE was open for MF transactions at the datetime when order was placed (order_dt)
-    If it was not, then which is the next date when market was open and order would get placed
-    Uses market_dates.csv which has list of all dates when BSE was open for MF transactions
-    Uses 1500 hours as cut off time when BSE closes for MF transactions
+    Next date when market was open and an order placed at order_dt would get placed
+    Kept for callers of web.py; see market.calculate_order_date()
     '''
-    if order_dt.hour >= 15:
-        order_dt += timedelta(days=1)
-    order_d = order_dt.date()
-    lines = open('requirements/market_dates.csv', 'r').read().splitlines()
-    for line in lines:
-        market_date = date(*(strptime(line.strip(), '%d/%m/%y')[0:3]))
-        if market_date >= order_d:
-            return market_date
-    # error 
-    return False
+    return market.calculate_order_date(order_dt)
 
 
-def update_order_status(self, driver):
+def update_order_status(driver, shards=None):
     '''
     Updates status (see field status in Transaction model in transactions) of transactions
     BSEStar hasn't implemented this as an API endpoint so it needs crawling of bsestarmf.in
     '''
 
-    ## fetch the transactions that need to be updated
-    tr_queryset = Transaction.objects.filter(
-            Q(status__in=('2','4','5')) |
-            Q(status='6', order_type='2')
-        ).order_by(
-            'created'
-        )
-    tr_list = []
-    for tr in tr_queryset:
-        ## remove sip transactions whose instalment is not under process
-        if tr.order_type == '2' and tr.sip_num_inst_done == len(tr.sip_dates.split(',')):
-            pass
-        else:
-            tr_list.append(tr) 
-
-    ## process transaction time to find order date
-    date_dict_list = []
-    date_dict = None
-    prev_order_d = date(2016, 1, 1)
-    for tr in tr_list:
-        ## get date of order
-        order_dt = tr.created.replace(tzinfo=timezone('UTC')).astimezone(timezone('Asia/Calcutta'))
-        if tr.order_type == '1':
-            ## get order_id of the transaction  
-            order_id = TransResponseBSE.objects.get(trans_no=tr.bse_trans_no).order_id
-        else:
-            order_ids = tr.sip_order_ids.split(',')
-            if len(order_ids) > tr.sip_num_inst_done: 
-                order_id = order_ids[tr.sip_num_inst_done]
-                if len(order_ids) > 1:
-                    ## update order_dt because its a sip instalment
-                    order_dt = datetime(*(strptime(tr.sip_dates.split(',')[tr.sip_num_inst_done], "%d%m%y")[0:3]))
-                    print order_dt
-            else:
-                ## problem in sip_order_ids field
-                raise Exception(
-                    "Update order status: order id not found in Transaction table"
-                )
-        
-        ## dont check for orders/instalments which will be placed in future
-        if order_dt.date() > date.today():
-            continue
-        order_d = self.calculate_order_date(order_dt)
-        
-        ## raise exception as no order date found
-        if not order_d:
-            raise Exception(
-                "Update order status: order date could not be found"
-            )
-        
-        ## dont check for orders/instalments which are offline currently
-        elif order_d > date.today():
-            continue
-        
-        ## save order id and date
-        if prev_order_d != order_d:
-            date_dict = {
-                'date': order_d,
-                'ids': [tr.id],
-                'order_ids': [order_id],
-                'status': ['0'],
-                'folio': [''],
-            }
-            date_dict_list.append(date_dict)
-            prev_order_d = order_d
-        else: 
-            date_dict['ids'].append(tr.id)
-            date_dict['order_ids'].append(order_id)
-            date_dict['status'].append('0')
-            date_dict['folio'].append('')
+    with metrics.timer('crawler', stage='db_read', page='order_status'):
+        ## fetch the transactions that need to be updated, grouped by date of order
+        date_dict_list = tracking.orders_to_check(shards=shards)
     
     ## crawl to get orders by date
     for date_dict in date_dict_list:
         ## navigate to page
-        line = "https://www.bsestarmf.in/RptOrderStatusReportNew.aspx"
-        driver.get(line)
-        print (driver.title)
-        date = WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.ID, 'txtToDate')))
-        date.clear()
-        date.send_keys(date_dict['date'].strftime("%d-%b-%Y"))
-        sleep(2)    # needed as page refreshes after setting date
-        # make_ready(driver)
-
-        submit = WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.ID, "btnSubmit")))
-        submit.click()
-        sleep(2)
-        # make_ready(driver)
+        with metrics.timer('crawler', stage='navigation', page='order_status'):
+            line = "https://www.bsestarmf.in/RptOrderStatusReportNew.aspx"
+            load_page(driver, line)
+            print (driver.title)
+            date = WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.ID, 'txtToDate')))
+            date.clear()
+            date.send_keys(date_dict['date'].strftime("%d-%b-%Y"))
+            sleep(2)    # needed as page refreshes after setting date
+            # make_ready(driver)
+
+            submit = WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.ID, "btnSubmit")))
+            submit.click()
+            sleep(2)
+            # make_ready(driver)
         
         ## parse the table- find orders for this date
-        table = WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.XPATH, "//table[@class='glbTableD']/tbody")))
-        print ('html loading done')
-        rows = table.find_elements(By.XPATH, "tr[@class='tblERow'] | tr[@class='tblORow']")
-
-        for row in rows:
-            fields = row.find_elements(By.XPATH, "td")
-            order_id = fields[3].text
-            status = fields[18].text
-            if status == "ALLOTMENT DONE":
-                status = '6'
-            elif status == "SENT TO RTA FOR VALIDATION":
-                status = '5'
-            elif status == "ORDER CANCELLED BY USER":
-                status = '1'
-            elif status == "PAYMENT NOT RECEIVED TILL DATE":
-                status = '-1'
-
-            # match with list of order ids
-            for i in range(0, len(date_dict['ids'])):
-                if order_id == date_dict['order_ids'][i]:
-                    date_dict['status'][i] = status
-                    date_dict['folio'][i] = fields[15].text
-                    print "found", order_id, status
-                    break
+        with metrics.timer('crawler', stage='table_parse', page='order_status'):
+            table = WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.XPATH, "//table[@class='glbTableD']/tbody")))
+            print ('html loading done')
+            rows = table.find_elements(By.XPATH, "tr[@class='tblERow'] | tr[@class='tblORow']")
+
+            for row in rows:
+                fields = row.find_elements(By.XPATH, "td")
+                order_id = fields[3].text
+                status = tracking.order_status_code(fields[18].text)
+
+                # match with list of order ids
+                for i in range(0, len(date_dict['ids'])):
+                    if order_id == date_dict['order_ids'][i]:
+                        date_dict['status'][i] = status
+                        date_dict['folio'][i] = fields[15].text
+                        print "found", order_id, status
+                        break
             
     ## save status in db
-    for date_dict in date_dict_list:
-        for i in range(0, len(date_dict['ids'])):
-            if date_dict['status'][i] != '0':
-                tr = Transaction.objects.get(id=date_dict['ids'][i])
-                ## one-time or 1st isnt of sip transaction 
-                if tr.status in ['2','4','5']:
-                    ## update status and status_comment
-                    if date_dict['status'][i] == '-1':
-                        if tr.status == '2':
-                            tr.status_comment = 'Failed due to no payment'
-                        else:
-                            tr.status_comment = 'Failed due to error in payment'
-                        tr.status = '1'
-                    ## update status, folio, datetime
-                    elif date_dict['status'][i] == '6':
-                        tr.status = date_dict['status'][i]
-                        if date_dict['folio'][i] != '':
-                            tr.folio_number = date_dict['folio'][i]
-                        if tr.order_type == '2':
-                            tr.sip_num_inst_done = 1
-                        tr.datetime_at_mf = datetime(date_dict['date'].year, date_dict['date'].month, date_dict['date'].day, 12, 0, 0, tzinfo=timezone('UTC'))
-                    else:
-                        tr.status = date_dict['status'][i]
-                
-                ## 2nd or later inst of sip transaction 
-                elif tr.status == '6' and tr.order_type == '2':
-                    if date_dict['status'][i] == '6':
-                        ## update sip_num_inst_done as instalment successful
-                        tr.sip_num_inst_done += 1
-                        if tr.sip_num_inst_done == tr.sip_num_inst:
-                            ## update to sip concluded 
-                            tr.status = '8'
-                    elif date_dict['status'][i] in ['-1', '1']:
-                        ## update sip_dates and sip_order_ids as instalment was unsuccessful
-                        last_pos = tr.sip_dates.rfind(',')
-                        tr.sip_dates = tr.sip_dates[:last_pos]
-                        last_pos = tr.sip_order_ids.rfind(',')
-                        tr.sip_order_ids = tr.sip_order_ids[:last_pos]     
-                tr.save()
+    with metrics.timer('crawler', stage='db_writeback', page='order_status'):
+        tracking.save_order_statuses(date_dict_list)
 
     ## this is a good place to put in a slack alert
     
     
-def find_sip_order_id(self, driver, today):
+def find_sip_order_id(driver, today, shards=None):
     '''
     Finds order ID (identifier of each transaction on BSEStar) for all sip instalments due today
     Order ID is necessary to check status on web portal
@@ -356,88 +363,148 @@ def find_sip_order_id(self, driver, today):
     BSEStar hasn't implemented this as an API endpoint so it needs crawling of bsestarmf.in
     '''
 
-    ## fetch sip transactions due today
-    sip_list = Transaction.objects.filter(
-            order_type='2',
-            status__in=('2','4','5','6'),
-        )
-
-    tr_list = []
-    for sip in sip_list:
-        ## first instalment
-        if sip.status != '6':
-            order_dt = sip.created.replace(tzinfo=timezone('UTC')).astimezone(timezone('Asia/Calcutta'))
-            ## use below line if sip order was placed with first order not today
-            # order_dt = datetime.strptime(str(sip.sip_start_date), "%Y-%m-%d").replace(tzinfo=timezone('UTC')).astimezone(timezone('Asia/Calcutta'))
-        ## second or later instalment
-        ## filtering for those that are not already populated
-        elif len(sip.sip_dates.split(',')) == sip.sip_num_inst_done:
-            order_dt = datetime.strptime(str(sip.sip_start_date), "%Y-%m-%d") + relativedelta(months=sip.sip_num_inst_done - 1)
-            ## dont check for orders/instalments which will be placed in future
-            if order_dt.date() > today:
-                continue
-        ## order id and date already populated
-        else:
-            continue
-        ## find exact order date 
-        order_d = self.calculate_order_date(order_dt)
-        if not order_d:
-            # raise exception as no order date found
-            raise Exception(
-                "Find sip order id: order date not found for transaction %d" % sip.id
-            )
-        if order_d == today:
-            tr_list.append(sip)
+    repo = repository.get()
+    with metrics.timer('crawler', stage='db_read', page='provisional_order'):
+        ## fetch sip transactions due today
+        tr_list = tracking.sips_due(today, repo, shards)
     print "%d sip orders to be placed today" % len(tr_list)
 
     if len(tr_list) > 0:
         ## navigate to page
-        # line = "https://www.bsestarmf.in/ViewOrder.aspx"
-        line = "https://www.bsestarmf.in/RptProvisionalOrderReportNew.aspx"
-        driver.get(line)
+        with metrics.timer('crawler', stage='navigation', page='provisional_order'):
+            # line = "https://www.bsestarmf.in/ViewOrder.aspx"
+            line = "https://www.bsestarmf.in/RptProvisionalOrderReportNew.aspx"
+            load_page(driver, line)
+            print (driver.title)
+            dt = WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.ID, 'txtToDate')))
+            dt.clear()
+            dt.send_keys(today.strftime("%d-%b-%Y"))
+            sleep(2)    # needed as page refreshes after setting date
+            # make_ready(driver)
+        
+            submit = WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.ID, "btnSubmit")))
+            submit.click()
+            sleep(2)
+            # make_ready(driver)
+        
+        ## parse table of orders to get order id
+        with metrics.timer('crawler', stage='table_parse', page='provisional_order'):
+            table = WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.XPATH, "//table[@class='glbTableD']/tbody")))
+            print ('html loading done')
+            rows = table.find_elements(By.XPATH, "tr[@class='tblERow'] | tr[@class='tblORow']")
+            print len(rows)
+            for row in rows:
+                fields = row.find_elements(By.XPATH, "td")
+                order_id = fields[5].text
+                if order_id == '':
+                    continue
+                # isin = fields[6].text
+                # user_id = fields[8].text
+                # amount = fields[12].text
+                sip_reg_no = fields[24].text
+
+                # match orders with list of sip transactions
+                for tr in tr_list:
+                    try:
+                        # if isin == tr.scheme_plan.isin and user_id== tr.user_id and amount == tr.amount and len(tr.sip_dates) == tr.sip_num_inst_done:
+                        if sip_reg_no == repo.order_id(tr.bse_trans_no):
+                            ## save order id and date in table
+                            tracking.add_sip_order(tr, today, order_id, repo)
+                            print "found and saved", tr.id, sip_reg_no, order_id
+                            break
+                    except Exception as e:
+                        print e, tr.id, today, len(tr.sip_order_ids)
+
+    ## this is a good place to put in a slack alert
+
+
+def update_mandate_status(driver, shards=None):
+    '''
+    Updates status (see field status in Mandate model in users) of mandates awaiting acceptance, all from
+    one query of the mandate report, and marks accepted mandates used up by SIPs exhausted (see mandates.py)
+    Only of users in shards if given (see leases.py)
+    Retries settings.CRAWLER_RETRIES times if the page doesn't render in time
+    Raises errors.BrowserError if the browser stopped responding; CrawlerSession starts a new one then
+    '''
+    repo = repository.get()
+    with metrics.timer('crawler', stage='db_read', page='mandate_status'):
+        mandate_list = mandates.mandates_to_check(repo=repo, shards=shards)
+    print "%d mandates to be checked" % len(mandate_list)
+
+    if len(mandate_list) > 0:
+        ## the report lists mandates registered in a date range- one covering all of them
+        ## a day earlier as created is in UTC and the report's dates in IST
+        from_date = min(mandate.created for mandate in mandate_list).date() - timedelta(days=1)
+        for attempt in range(settings.CRAWLER_RETRIES + 1):
+            try:
+                statuses = read_mandate_report(driver, from_date, date.today())
+                break
+
+            except crawl_errors('TimeoutException', 'StaleElementReferenceException', 'ErrorInResponseException',
+                'ElementNotVisibleException') as e:
+                error = e
+                print("Retrying")
+
+            except (BadStatusLine) as e:
+                raise errors.BrowserError(
+                    681, "Browser stopped responding in updating mandate status: %r" % e
+                )
+        else:
+            raise errors.TransportError(
+                680, "Updating mandate status failed after %d attempts: %r" % (settings.CRAWLER_RETRIES + 1, error)
+            )
+
+        ## save status in db
+        with metrics.timer('crawler', stage='db_writeback', page='mandate_status'):
+            mandates.save_mandate_statuses(mandate_list, statuses, repo)
+
+    ## sip transactions change how much of a mandate is used, whether or not any was checked
+    with metrics.timer('crawler', stage='db_writeback', page='mandate_usage'):
+        mandates.mark_exhausted(repo, shards)
+    return driver
+
+
+def read_mandate_report(driver, from_date, to_date):
+    '''
+    Returns dict of mandate id to status text of mandates in the mandate report of from_date to to_date
+    Columns are found by their headers (see MANDATE_ID_HEADERS and MANDATE_STATUS_HEADERS)
+    '''
+    ## navigate to page
+    with metrics.timer('crawler', stage='navigation', page='mandate_status'):
+        line = "https://www.bsestarmf.in/RptMandateStatusReport.aspx"
+        load_page(driver, line)
         print (driver.title)
-        dt = WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.ID, 'txtToDate')))
+        dt = WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.ID, 'txtFromDate')))
         dt.clear()
-        dt.send_keys(today.strftime("%d-%b-%Y"))
+        dt.send_keys(from_date.strftime("%d-%b-%Y"))
         sleep(2)    # needed as page refreshes after setting date
-        # make_ready(driver)
-        
+        dt = WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.ID, 'txtToDate')))
+        dt.clear()
+        dt.send_keys(to_date.strftime("%d-%b-%Y"))
+        sleep(2)
+
         submit = WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.ID, "btnSubmit")))
         submit.click()
         sleep(2)
-        # make_ready(driver)
-        
-        ## parse table of orders to get order id
-        table = WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.XPATH, "//table[@class='glbTableD']/tbody")))
+
+    ## parse the table- status of every mandate in it
+    with metrics.timer('crawler', stage='table_parse', page='mandate_status'):
+        table = WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.XPATH, "//table[@class='glbTableD']")))
         print ('html loading done')
-        rows = table.find_elements(By.XPATH, "tr[@class='tblERow'] | tr[@class='tblORow']")
-        print len(rows)
+        headers = [cell.text.strip().upper() for cell in table.find_elements(By.XPATH, ".//tr[th][1]/th")]
+        id_columns = [headers.index(h) for h in MANDATE_ID_HEADERS if h in headers]
+        status_columns = [headers.index(h) for h in MANDATE_STATUS_HEADERS if h in headers]
+        if not id_columns or not status_columns:
+            raise errors.InternalError(
+                684, "No mandate id or status column in mandate report with headers %r" % headers
+            )
+
+        statuses = {}
+        rows = table.find_elements(By.XPATH, ".//tr[@class='tblERow'] | .//tr[@class='tblORow']")
         for row in rows:
             fields = row.find_elements(By.XPATH, "td")
-            order_id = fields[5].text
-            if order_id == '':
+            if len(fields) <= max(id_columns[0], status_columns[0]):
                 continue
-            # isin = fields[6].text
-            # user_id = fields[8].text
-            # amount = fields[12].text
-            sip_reg_no = fields[24].text
-
-            # match orders with list of sip transactions
-            for tr in tr_list:
-                try:
-                    # if isin == tr.scheme_plan.isin and user_id== tr.user_id and amount == tr.amount and len(tr.sip_dates) == tr.sip_num_inst_done:
-                    if sip_reg_no == TransResponseBSE.objects.get(trans_no=tr.bse_trans_no).order_id:
-                        ## save order id and date in table
-                        if tr.status != '6':
-                            tr.sip_dates = today.strftime("%d%m%y")
-                            tr.sip_order_ids = order_id
-                        else:
-                            tr.sip_dates += "," + today.strftime("%d%m%y")
-                            tr.sip_order_ids += "," + order_id
-                        tr.save()
-                        print "found and saved", tr.id, sip_reg_no, order_id
-                        break
-                except Exception as e:
-                    print e, tr.id, today, len(tr.sip_order_ids)
-
-    ## this is a good place to put in a slack alert
+            statuses[fields[id_columns[0]].text.strip()] = fields[status_columns[0]].text
+    print "%d mandates in report" % len(statuses)
+    return statuses
@@ -0,0 +1,259 @@
+'''
+Author: utkarshohm
+Description: XIRR of many portfolios solved at once. Cash flows of all portfolios are padded into
+	(portfolio x flow) matrices and Newton-Raphson iterations run on all rows together; rows where
+	Newton does not converge fall back to (equally vectorized) bisection. Used by returns.py for
+	SIP transactions and per-user returns. Run this file to benchmark it against a scalar solver
+'''
+
+import time
+
+import numpy as np
+
+
+## default tolerance on the rate (0.00001% a year)
+TOLERANCE = 1e-7
+MAX_NEWTON_ITER = 50
+MAX_BISECT_ITER = 200
+## bracket of rates searched by bisection, -99.99% to 100000% a year
+BRACKET = (-0.9999, 1000.0)
+## rows solved together; bounds memory to CHUNK x (longest portfolio) floats
+CHUNK = 20000
+
+
+################ PADDING
+
+def pad(owner, days, amounts, n):
+	'''
+	Packs flows of n portfolios (owner is portfolio index of each flow) into padded matrices
+	Returns (years, amounts, mask) of shape (n, longest portfolio) where years are counted from
+	the first flow of each portfolio
+	'''
+	owner = np.asarray(owner, dtype=np.int64)
+	days = np.asarray(days, dtype=np.float64)
+	amounts = np.asarray(amounts, dtype=np.float64)
+	order = np.lexsort((days, owner))
+	owner = owner[order]
+	days = days[order]
+	amounts = amounts[order]
+
+	counts = np.bincount(owner, minlength=n)
+	width = int(counts.max()) if len(counts) else 0
+	starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+	col = np.arange(len(owner)) - starts[owner]
+
+	first_day = np.zeros(n)
+	has_flows = counts > 0
+	first_day[has_flows] = days[starts[has_flows]]
+
+	years = np.zeros((n, width))
+	flows = np.zeros((n, width))
+	mask = np.zeros((n, width), dtype=bool)
+	years[owner, col] = (days - first_day[owner]) / 365.0
+	flows[owner, col] = amounts
+	mask[owner, col] = True
+	return years, flows, mask
+
+
+################ SOLVER
+
+def npv(rates, years, flows):
+	'''
+	Net present value of each row at its rate; padded entries have zero flows
+	'''
+	discount = np.exp(-years * np.log1p(rates)[:, None])
+	return (flows * discount).sum(axis=1)
+
+
+def npv_and_derivative(rates, years, flows):
+	log_base = np.log1p(rates)[:, None]
+	discount = np.exp(-years * log_base)
+	value = (flows * discount).sum(axis=1)
+	derivative = (-years * flows * discount).sum(axis=1) / (1.0 + rates)
+	return value, derivative
+
+
+def solve(years, flows, tol=TOLERANCE, guess=0.1, max_newton_iter=MAX_NEWTON_ITER, max_bisect_iter=MAX_BISECT_ITER):
+	'''
+	Returns XIRR (as a fraction a year) of every row of padded matrices
+	NaN for rows without a root, ie. where flows don't change sign
+	'''
+	n = len(flows)
+	rates = np.full(n, guess)
+	done = np.zeros(n, dtype=bool)
+	## a root needs both an outflow and an inflow
+	solvable = (flows > 0).any(axis=1) & (flows < 0).any(axis=1)
+	active = solvable.copy()
+
+	with np.errstate(over='ignore', invalid='ignore', divide='ignore'):
+		for i in range(max_newton_iter):
+			if not active.any():
+				break
+			idx = np.nonzero(active)[0]
+			value, derivative = npv_and_derivative(rates[idx], years[idx], flows[idx])
+			step = value / derivative
+			new_rates = rates[idx] - step
+			bad = ~np.isfinite(new_rates) | (new_rates <= BRACKET[0]) | (new_rates > BRACKET[1])
+			converged = ~bad & (np.abs(step) < tol)
+			rates[idx[~bad]] = new_rates[~bad]
+			done[idx[converged]] = True
+			## rows that left the bracket go to bisection
+			active[idx[bad | converged]] = False
+
+		fallback = solvable & ~done
+		if fallback.any():
+			idx = np.nonzero(fallback)[0]
+			rates[idx] = bisect(years[idx], flows[idx], tol, max_bisect_iter)
+
+	rates[~solvable] = np.nan
+	return rates
+
+
+def bisect(years, flows, tol=TOLERANCE, max_iter=MAX_BISECT_ITER):
+	'''
+	Bisection on all rows together within BRACKET; NaN for rows without a sign change in it
+	'''
+	n = len(flows)
+	lo = np.full(n, BRACKET[0])
+	hi = np.full(n, BRACKET[1])
+	f_lo = npv(lo, years, flows)
+	f_hi = npv(hi, years, flows)
+	ok = np.sign(f_lo) != np.sign(f_hi)
+	for i in range(max_iter):
+		mid = (lo + hi) / 2.0
+		f_mid = npv(mid, years, flows)
+		left = np.sign(f_mid) == np.sign(f_lo)
+		lo = np.where(left, mid, lo)
+		f_lo = np.where(left, f_mid, f_lo)
+		hi = np.where(left, hi, mid)
+		if (hi - lo).max() < tol:
+			break
+	rates = (lo + hi) / 2.0
+	rates[~ok] = np.nan
+	return rates
+
+
+def xirr_batch(owner, days, amounts, n, tol=TOLERANCE, chunk=CHUNK):
+	'''
+	XIRR of n portfolios from flat arrays of flows- owner (portfolio index), days and amounts
+	Investments are negative amounts and redemptions/current value positive
+	Solved in chunks of portfolios to bound memory of padded matrices
+	'''
+	owner = np.asarray(owner, dtype=np.int64)
+	days = np.asarray(days)
+	amounts = np.asarray(amounts, dtype=np.float64)
+	rates = np.full(n, np.nan)
+	order = np.argsort(owner, kind='mergesort')
+	owner = owner[order]
+	days = days[order]
+	amounts = amounts[order]
+	bounds = np.searchsorted(owner, np.arange(0, n + chunk, chunk))
+	for c in range(0, n, chunk):
+		lo, hi = bounds[c // chunk], bounds[c // chunk + 1]
+		size = min(chunk, n - c)
+		years, flows, mask = pad(owner[lo:hi] - c, days[lo:hi], amounts[lo:hi], size)
+		rates[c:c + size] = solve(years, flows, tol)
+	return rates
+
+
+################ SCALAR REFERENCE
+
+def xirr_scalar(days, amounts, tol=TOLERANCE, guess=0.1):
+	'''
+	XIRR of a single portfolio with plain python Newton-Raphson and bisection fallback
+	Reference for the batched solver; also fine for one-off use
+	'''
+	first = min(days)
+	years = [(d - first) / 365.0 for d in days]
+	if not (any(a > 0 for a in amounts) and any(a < 0 for a in amounts)):
+		return float('nan')
+
+	def f(rate):
+		return sum(a * (1.0 + rate) ** -t for a, t in zip(amounts, years))
+
+	rate = guess
+	for i in range(MAX_NEWTON_ITER):
+		try:
+			value = f(rate)
+			derivative = sum(-t * a * (1.0 + rate) ** (-t - 1) for a, t in zip(amounts, years))
+			step = value / derivative
+		except (OverflowError, ZeroDivisionError):
+			break
+		new_rate = rate - step
+		if new_rate <= BRACKET[0] or new_rate > BRACKET[1]:
+			break
+		rate = new_rate
+		if abs(step) < tol:
+			return rate
+
+	lo, hi = BRACKET
+	f_lo = f(lo)
+	if (f_lo > 0) == (f(hi) > 0):
+		return float('nan')
+	for i in range(MAX_BISECT_ITER):
+		mid = (lo + hi) / 2.0
+		f_mid = f(mid)
+		if (f_mid > 0) == (f_lo > 0):
+			lo, f_lo = mid, f_mid
+		else:
+			hi = mid
+		if hi - lo < tol:
+			break
+	return (lo + hi) / 2.0
+
+
+################ BENCHMARK
+
+def random_sip_portfolios(n, max_inst=60, seed=0):
+	'''
+	Generates n SIP portfolios- monthly instalments and a current value that grew at a random rate
+	'''
+	rng = np.random.RandomState(seed)
+	inst = rng.randint(1, max_inst + 1, n)
+	rate = rng.uniform(-0.3, 0.5, n)
+	owner = np.repeat(np.arange(n), inst)
+	month = np.arange(len(owner)) - np.repeat(np.cumsum(inst) - inst, inst)
+	days = month * 30
+	amounts = -np.full(len(owner), 1000.0)
+	end = inst * 30 + 15
+	value = np.bincount(owner, weights=1000.0 * (1 + rate[owner]) ** ((end[owner] - days) / 365.0))
+	return (
+		np.concatenate([owner, np.arange(n)]),
+		np.concatenate([days, end]),
+		np.concatenate([amounts, value]),
+	)
+
+
+def benchmark(n=20000, max_inst=60, scalar_sample=2000, seed=0):
+	'''
+	Times the batched solver on n portfolios against the scalar solver on a sample of them
+	Returns dict of timings and the largest difference between the two
+	'''
+	owner, days, amounts = random_sip_portfolios(n, max_inst, seed)
+
+	started = time.time()
+	rates = xirr_batch(owner, days, amounts, n)
+	batch_time = time.time() - started
+
+	sample = min(scalar_sample, n)
+	order = np.argsort(owner, kind='mergesort')
+	splits = np.cumsum(np.bincount(owner, minlength=n))[:-1]
+	groups = list(zip(np.split(days[order].tolist(), splits), np.split(amounts[order].tolist(), splits)))[:sample]
+	started = time.time()
+	scalar = [xirr_scalar(list(d), list(a)) for d, a in groups]
+	scalar_time = (time.time() - started) * n / float(sample)
+
+	diff = np.nanmax(np.abs(rates[:sample] - np.array(scalar)))
+	return {
+		'portfolios': n,
+		'batch_seconds': batch_time,
+		'scalar_seconds_estimated': scalar_time,
+		'speedup': scalar_time / batch_time if batch_time else float('inf'),
+		'max_abs_diff': float(diff),
+	}
+
+
+if __name__ == '__main__':
+	result = benchmark()
+	for key in sorted(result):
+		print('%s: %s' % (key, result[key]))